@@ -5,8 +5,6 @@ __author__ = 'nrsantos'
 import random
 import string
 
-from sqlalchemy import distinct
-
 import arcpy
 
 from . import api_components
@@ -15,6 +13,7 @@ from .api_components import listing  # make it available as api.listing for now
 from .api_components import counts
 from .api_components import support
 from .api_components import presence
+from .api_components import presence_index
 
 from . import local_vars
 from . import funcs
@@ -81,12 +80,10 @@ def get_common_names_in_hucs(huc_list):
 	session = api_components.support.connect_orm()
 
 	try:
-		distinct_list = session.query(distinct(orm.Observation.species_id)).filter(orm.Observation.zone_id.in_(huc_list)).all()
-		species = []
-		for record in distinct_list:
-			species.append(str(session.query(orm.Species.common_name).filter(orm.Species.fid == record[0]).one()[0]))
-
-		species.sort()
+		records = session.query(orm.Species.fid, orm.Species.common_name).distinct()\
+					.join(orm.Observation, orm.Observation.species_id == orm.Species.fid)\
+					.filter(orm.Observation.zone_id.in_(huc_list)).all()
+		species = sorted(str(record.common_name) for record in records)
 	finally:
 		session.close()
 
@@ -1,3 +1,3 @@
 from __future__ import absolute_import, division, print_function
 
-__all__ = ["counts", "listing", "presence", "support"]
\ No newline at end of file
+__all__ = ["counts", "listing", "presence", "presence_index", "support"]
\ No newline at end of file
@@ -3,12 +3,13 @@ from __future__ import absolute_import, division, print_function
 from sqlalchemy import distinct
 
 from . import support
+from . import presence_index
 
 from .. import local_vars
 from .. import orm_models as orm
 
 
-def get_hucs_for_species_as_list(species_code, presence_types, collections=local_vars.hq_collections):
+def get_hucs_for_species_as_list(species_code, presence_types, collections=local_vars.hq_collections, use_index=None):
 	"""
 		Given a species code and a presence type, returns a list of huc12 IDs.
 
@@ -17,12 +18,16 @@ def get_hucs_for_species_as_list(species_code, presence_types, collections=local
 	:param species_code: a PISCES species code (eg: SOM09)
 	:param presence_type: list of presence type codes, or the string definitions from local_vars (separated by commas)
 	:param collections: list of collection ids, or the string degintions from local_vars (separated by commas)
+	:param use_index: When True, answers from the in-memory presence index instead of querying. Defaults to local_vars.use_presence_index
 	:return: list of HUC 12 ids for that species, presence type, and collection.
 	"""
 
 	presence = support._parse_presence_types_and_collections_to_list(presence_types)
 	collections = support._parse_presence_types_and_collections_to_list(collections)
 
+	if presence_index.enabled(use_index):
+		return presence_index.get_index().hucs_for_species(species_code, presence, collections)
+
 	session = support.connect_orm()
 
 	try:
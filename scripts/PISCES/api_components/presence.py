@@ -10,6 +10,9 @@ from .. import orm_models as orm
 from .. import log
 
 from . import support
+from . import presence_index
+
+zone_taxon = collections_package.namedtuple('zone_taxon', ["zone_id", "taxon"])
 
 aggregation_level_lookup = {
 # used so that we can use hybrid columns to get actual full taxonomic distinct name since species names may not be distinct across genera, and genera may not be distinct across families
@@ -26,7 +29,8 @@ def get_presence_by_huc_set(species_or_group,
 							zone_list,
 						 taxonomic_aggregation_level="fid",
 						 presence_types=local_vars.current_obs_types,
-						 collections=local_vars.hq_collections):
+						 collections=local_vars.hq_collections,
+						 use_index=None):
 	"""
 		Given a species list or species group, returns presence/absence information,
 		optionally aggregated up the taxonomic tree. This function does *not* return
@@ -34,15 +38,25 @@ def get_presence_by_huc_set(species_or_group,
 		present in the zone IDs provided in zone_list. For HUC_12 presence for a single species, use
 		listing.get_hucs_for_species_as_list.
 
-		The current orm method used here can be pretty slow, so caution against heavy use of this function.
+		The current orm method used here can be pretty slow, so caution against heavy use of this function. For
+		heavy use, enable the in-memory presence index (see use_index).
 	:param species_or_group: a list of species codes or groups
 	:param huc12_list: A list of Zone IDs to use to look up presence
 	:param taxonomic_aggregation_level: default fid: Possible values: None, fid, common_name, scientific_name, species, genus, or family - None will give results by individual taxa, using common name as output. species groups subspecies to species, genus groups subspecies up to genus level, and family groups subspecies up to family level
 	:param presence_types:
 	:param collections:
+	:param use_index: When True, answers from the in-memory presence index instead of querying. Defaults to local_vars.use_presence_index
 	:return: list of namedtuples (zone_id, taxon) with presence specified
 	"""
 
+	if presence_index.enabled(use_index):
+		index = presence_index.get_index()
+		return index.presence_in_zones(taxa=funcs.text_to_species_list(species_or_group),
+									   attribute=_get_aggregation_attribute(taxonomic_aggregation_level),
+									   zone_list=zone_list,
+									   presence_types=support._parse_presence_types_and_collections_to_list(presence_types),
+									   collections=_parse_collections_for_index(collections))
+
 	session = support.connect_orm(hotload=True)
 
 	try:
@@ -67,7 +81,8 @@ def get_presence_by_huc_set(species_or_group,
 def get_presence_by_taxa(species_or_group,
 						 taxonomic_aggregation_level="fid",
 						 presence_types=local_vars.current_obs_types,
-						 collections=local_vars.hq_collections):
+						 collections=local_vars.hq_collections,
+						 use_index=None):
 	"""
 		Given a species list or species group, returns presence/absence information,
 		optionally aggregated up the taxonomic tree. For HUC_12 presence for a single species, use
@@ -75,22 +90,30 @@ def get_presence_by_taxa(species_or_group,
 
 		Returns a list of namedtuples with records for each zone and taxon - zones and taxons will each have multiple values.
 
-		The current orm method used here can be pretty slow, so caution against heavy use of this function.
+		The current orm method used here can be pretty slow, so caution against heavy use of this function. For
+		heavy use, enable the in-memory presence index (see use_index).
 	:param species_or_group: a list of species codes or groups
 	:param taxonomic_aggregation_level: default fid: Possible values: None, fid, common_name, scientific_name, species, genus, or family - None will give results by individual taxa, using common name as output. species groups subspecies to species, genus groups subspecies up to genus level, and family groups subspecies up to family level
 	:param presence_types:
 	:param collections:
+	:param use_index: When True, answers from the in-memory presence index instead of querying. Defaults to local_vars.use_presence_index
 	:return: list of namedtuples (zone_id, taxon) with presence specified
 	"""
 
+	if presence_index.enabled(use_index):
+		index = presence_index.get_index()
+		records = index.presence_by_taxa(taxa=funcs.text_to_species_list(species_or_group),
+										 attribute=_get_aggregation_attribute(taxonomic_aggregation_level),
+										 presence_types=support._parse_presence_types_and_collections_to_list(presence_types),
+										 collections=_parse_collections_for_index(collections))
+		return [zone_taxon(zone_id, taxon) for zone_id, taxon in records]
+
 	session = support.connect_orm(hotload=True)
 
 	try:
 		species_level, pisces_collections, presence, taxa = validate_parameters(session, collections, presence_types,
 																	species_or_group, taxonomic_aggregation_level)
 
-		zone_taxon = collections_package.namedtuple('zone_taxon', ["zone_id", "taxon"])
-
 		objects = session.query(orm.Observation.zone_id, species_level)\
 					.join(orm.observation_collections)\
 					.join(orm.Collection)\
@@ -126,6 +149,17 @@ def validate_parameters(session, collections, presence_types, species_or_group,
 
 	taxa = funcs.text_to_species_list(species_or_group)
 
+	species_level = getattr(orm.Species, _get_aggregation_attribute(taxonomic_aggregation_level))
+
+	return species_level, pisces_collections, presence, taxa
+
+
+def _get_aggregation_attribute(taxonomic_aggregation_level):
+	"""
+		Validates a taxonomic aggregation level and returns the name of the orm.Species attribute it corresponds to
+	:param taxonomic_aggregation_level:
+	:return:
+	"""
 	if taxonomic_aggregation_level is None:
 		taxonomic_aggregation_level = "common_name"  # use it as a default if it's set to None
 	level = taxonomic_aggregation_level.lower()
@@ -133,15 +167,23 @@ def validate_parameters(session, collections, presence_types, species_or_group,
 	if level not in ("fid", "common_name", "scientific_name", "species", "genus", "family"):
 		raise ValueError("Aggregation level can only be one of: family, genus, species for aggregation. common_name, scientific_name, and fid are allowed for subspecies clustering")
 
-	species_level = getattr(orm.Species, aggregation_level_lookup[level])
+	return aggregation_level_lookup[level]
 
-	return species_level, pisces_collections, presence, taxa
+
+def _parse_collections_for_index(collections):
+	"""
+		Same as the collections handling in validate_parameters, but the index takes None to mean all collections
+	"""
+	if collections:
+		return support._parse_presence_types_and_collections_to_list(collections)
+	return None
 
 
 def get_species_list_by_hucs(species_or_group,
 						 taxonomic_aggregation_level="fid",
 						 presence_types=local_vars.current_obs_types,
-						 collections=local_vars.hq_collections):
+						 collections=local_vars.hq_collections,
+						 use_index=None):
 	"""
 		Given a species list or species group, returns a dictionary with HUCs as keys and a species list as the value.
 		The values in the species list are controlled by the taxonomic aggregation level. Behind the scenes, calls
@@ -153,6 +195,7 @@ def get_species_list_by_hucs(species_or_group,
 	:param taxonomic_aggregation_level: default fid: Possible values: None, fid, common_name, scientific_name, species, genus, or family - None will give results by individual taxa, using common name as output. species groups subspecies to species, genus groups subspecies up to genus level, and family groups subspecies up to family level
 	:param presence_types:
 	:param collections:
+	:param use_index: passed through to get_presence_by_taxa
 	:return:
 	"""
 
@@ -161,7 +204,8 @@ def get_species_list_by_hucs(species_or_group,
 	presence_data = get_presence_by_taxa(species_or_group=species_or_group,
 										 taxonomic_aggregation_level=taxonomic_aggregation_level,
 										 presence_types=presence_types,
-										 collections=collections)
+										 collections=collections,
+										 use_index=use_index)
 
 	for row in presence_data:
 		if row.zone_id not in records:
@@ -0,0 +1,225 @@
+"""
+	An optional in-memory index of species presence used by the presence and listing API functions. The index is built
+	once per process from the observations table and keeps, for each combination of species FID, presence type, and
+	collection, a bitset (a plain Python integer) of the HUC_12s that combination is present in. Lookups then become a
+	handful of bitwise ORs and ANDs instead of a full SQLAlchemy query.
+
+	The index is rebuilt automatically when the row counts or maximum IDs of the observations or transactions tables
+	change, so it stays correct across imports and modifications. Enable it globally with
+	local_vars.use_presence_index = True, or per call with the use_index parameter on the supporting API functions.
+"""
+
+from __future__ import absolute_import, division, print_function
+
+import time
+
+from sqlalchemy import func
+
+from .. import local_vars
+from .. import orm_models as orm
+from .. import log
+
+from . import support
+
+signature_check_interval = 10  # seconds between checks of the database signature - set to 0 to check on every lookup
+
+_index = None
+_last_signature_check = 0
+
+
+def enabled(use_index=None):
+	"""
+		Resolves whether the index should be used for a call - an explicit use_index wins, otherwise the global
+		setting in local_vars.use_presence_index is used
+	:param use_index: None, True, or False
+	:return: boolean
+	"""
+	if use_index is None:
+		return bool(local_vars.use_presence_index)
+	return bool(use_index)
+
+
+def get_signature(session):
+	"""
+		Returns a tuple that changes whenever observations or transactions are added or removed. Used to decide
+		whether a built index is stale.
+	:param session: an open ORM session
+	:return: tuple of (observations count, observations max id, transactions count, transactions max id)
+	"""
+	observations = session.query(func.count(orm.Observation.pkey), func.max(orm.Observation.pkey)).one()
+	transactions = session.query(func.count(orm.Transaction.pkey), func.max(orm.Transaction.pkey)).one()
+	return tuple(observations) + tuple(transactions)
+
+
+def _int_list(items):
+	return tuple(sorted(set(int(item) for item in items)))
+
+
+class PresenceIndex(object):
+	"""
+		Bitset index of the observations table. Zones are assigned bit positions in sorted order, so decoding a
+		bitset returns HUC_12 IDs in the same order as the sorted query results would.
+	"""
+
+	def __init__(self, session):
+		self.signature = get_signature(session)
+
+		self.zones = []  # bit position -> HUC_12
+		self.zone_bits = {}  # HUC_12 -> bit position
+		self.collections = set()
+		self.species_attributes = {}  # fid -> dict of values for each taxonomic aggregation attribute
+
+		self._bits = {}  # (fid, presence_type, collection_id) -> bitset of zones
+		self._combined = {}  # memoized unions keyed by (fid, presence_types, collections)
+
+		self._load(session)
+
+	def _load(self, session):
+		log.write("Building in-memory presence index")
+
+		records = session.query(orm.Observation.species_id,
+								orm.Observation.zone_id,
+								orm.Observation.presence_type_id,
+								orm.observation_collections.c.collection_id)\
+					.join(orm.observation_collections, orm.Observation.pkey == orm.observation_collections.c.observation_id)\
+					.distinct().all()
+
+		self.zones = sorted(set(record[1] for record in records if record[1] is not None))
+		self.zone_bits = dict((zone, position) for position, zone in enumerate(self.zones))
+
+		for species_id, zone_id, presence_type, collection_id in records:
+			if zone_id is None or presence_type is None or collection_id is None:
+				continue
+			key = (species_id, int(presence_type), int(collection_id))
+			self._bits[key] = self._bits.get(key, 0) | (1 << self.zone_bits[zone_id])
+			self.collections.add(int(collection_id))
+
+		for species in session.query(orm.Species.fid, orm.Species.family, orm.Species.genus, orm.Species.species,
+									orm.Species.scientific_name, orm.Species.common_name):
+			fid, family, genus, species_name, scientific_name, common_name = species
+			self.species_attributes[fid] = {
+				"fid": fid,
+				"common_name": common_name,
+				"scientific_name": scientific_name,
+				"family": family,
+				# the hybrid properties on orm.Species concatenate in SQL, where a NULL part makes the whole value NULL
+				"full_taxonomic_name_species": None if None in (family, genus, species_name) else " ".join((family, genus, species_name)),
+				"full_taxonomic_name_genus": None if None in (family, genus) else " ".join((family, genus)),
+			}
+
+		log.write("Presence index built with {} zones and {} species/presence/collection sets".format(len(self.zones), len(self._bits)))
+
+	def zone_mask(self, zone_list):
+		"""
+			Converts a list of HUC_12 IDs into a bitset. Zones without any observations are ignored.
+		"""
+		mask = 0
+		for zone in zone_list:
+			if zone in self.zone_bits:
+				mask |= 1 << self.zone_bits[zone]
+		return mask
+
+	def zones_from_bits(self, bits):
+		"""
+			Converts a bitset back into a list of HUC_12 IDs, in sorted order
+		"""
+		zones = []
+		while bits:
+			lowest = bits & -bits
+			zones.append(self.zones[lowest.bit_length() - 1])
+			bits ^= lowest
+		return zones
+
+	def species_bits(self, fid, presence_types, collections=None):
+		"""
+			Returns the bitset of zones where a species has any of the presence types in any of the collections.
+		:param fid: PISCES species code
+		:param presence_types: iterable of presence type ids
+		:param collections: iterable of collection ids, or None for all collections
+		:return: bitset as an integer
+		"""
+		presence_types = _int_list(presence_types)
+		collections = _int_list(collections) if collections else tuple(sorted(self.collections))
+
+		key = (fid, presence_types, collections)
+		if key not in self._combined:
+			bits = 0
+			for presence_type in presence_types:
+				for collection in collections:
+					bits |= self._bits.get((fid, presence_type, collection), 0)
+			self._combined[key] = bits
+
+		return self._combined[key]
+
+	def hucs_for_species(self, fid, presence_types, collections=None):
+		return self.zones_from_bits(self.species_bits(fid, presence_types, collections))
+
+	def presence_by_taxa(self, taxa, attribute, presence_types, collections=None):
+		"""
+			Index version of presence.get_presence_by_taxa - returns distinct (zone_id, taxon) pairs
+		:param taxa: list of species codes
+		:param attribute: the orm.Species attribute name to report taxa as - see presence.aggregation_level_lookup
+		:return: list of (zone_id, taxon) tuples sorted by zone
+		"""
+		pairs = set()
+		for fid in set(taxa):
+			if fid not in self.species_attributes:
+				continue
+			taxon = self.species_attributes[fid][attribute]
+			for zone in self.zones_from_bits(self.species_bits(fid, presence_types, collections)):
+				pairs.add((zone, taxon))
+
+		return sorted(pairs, key=lambda pair: (pair[0], pair[1] is not None, pair[1]))
+
+	def presence_in_zones(self, taxa, attribute, zone_list, presence_types, collections=None):
+		"""
+			Index version of presence.get_presence_by_huc_set - returns the distinct taxa present in any of the zones
+		"""
+		mask = self.zone_mask(zone_list)
+		taxa_present = set()
+		for fid in set(taxa):
+			if fid not in self.species_attributes:
+				continue
+			if self.species_bits(fid, presence_types, collections) & mask:
+				taxa_present.add(self.species_attributes[fid][attribute])
+
+		return list(taxa_present)
+
+
+def get_index(session=None):
+	"""
+		Returns the process-wide presence index, building it on first use and rebuilding it if the database
+		signature has changed since it was built.
+	:param session: optional open ORM session. If not provided, one is opened and closed here
+	:return: PresenceIndex
+	"""
+	global _index, _last_signature_check
+
+	now = time.time()
+	if _index is not None and now - _last_signature_check < signature_check_interval:
+		return _index
+
+	session_opened = False
+	if not session:
+		session = support.connect_orm()
+		session_opened = True
+
+	try:
+		if _index is None or get_signature(session) != _index.signature:
+			_index = PresenceIndex(session)
+		_last_signature_check = now
+	finally:
+		if session_opened:
+			session.close()
+
+	return _index
+
+
+def invalidate():
+	"""
+		Discards the current index so that the next lookup rebuilds it. Useful after modifying data in the same process,
+		so that lookups don't have to wait for the next signature check.
+	"""
+	global _index, _last_signature_check
+	_index = None
+	_last_signature_check = 0
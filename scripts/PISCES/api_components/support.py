@@ -13,29 +13,35 @@ from ..funcs import isiterable
 
 def _parse_presence_types_and_collections_to_list(item):
 
+	# if string, split based on comma to return as list - checked first because strings are iterable on Python 3
+	if type(item) in (six.binary_type, six.text_type):
+		return [int(single_item) for single_item in item.split(",")]  # split based on comma and cast to int before putting in list
+
 	# if iterable, return the iterable
 	if isiterable(item):
 		return item
 
 	# if integer, return it as a list
 	if type(item) is int:
-		return [int]
+		return [item]
 
-	# if string, split based on comma to return as list
-	if type(item) in (six.binary_type, six.text_type):
-		return [int(single_item) for single_item in item.split(",")]  # split based on comma and cast to int before putting in list
-
-def connect_orm(hotload=False):
+def connect_orm(hotload=False, reset=False):
 	"""
-		A convenience function that connects to the database and creates a session.
+		A convenience function that connects to the database and creates a session. The engine behind the session is
+		created once per process and reused (see orm_models.get_engine_and_sessionmaker), so this is cheap to call.
 	:param hotload: A workaround for a bug (or a behavior I don't understand) where backreferences
 					can't be traversed unless some object comes through the pipe first. So, when
 					hotload is True, we load an object (doesn't matter what it is) so that future
 					queries that traverse relationships work. Modifying lazyloading behavior
 					or sqlalchemy versions didn't work.
+	:param reset: When True, disposes of the cached engine first so the session gets fresh connections - for tests,
+					or if the hotload workaround needs a clean start after the database file was replaced.
 	:return:
 	"""
 
+	if reset:
+		orm.reset(local_vars.ormdb)
+
 	orm.connect(local_vars.ormdb)
 	session = orm.Session()
 
@@ -6,10 +6,13 @@
 """
 from __future__ import absolute_import, division, print_function
 
+import collections
+
 import six
 
 import arcpy
 import sqlalchemy
+from sqlalchemy.orm import aliased
 
 from . import local_vars
 from .api import presence
@@ -18,25 +21,149 @@ from . import orm_models as orm
 
 aggregation_levels = ("family", "genus", "species")
 
-name_lookup_cache = {"Family": {}, "Genus": {}, "Species": {}}  # holds name lookups - each level there is for a separate lookup tree
+TaxonName = collections.namedtuple("TaxonName", ["common_name", "scientific_name"])
+
+name_lookup_cache = {"fid": {}, "Family": {}, "Genus": {}, "Species": {}}  # holds name lookups, loaded all at once by load_name_cache. fid is keyed by species code, Family by family name, Genus by (family, genus), and Species by (genus, species)
+name_lookup_cache_loaded = False
+
+
+def _split_species_string(scientific_name):
+	"""
+		Splits a Family genus species subspecies string into family, genus, and species - species includes anything
+		after the genus, since subspecies and hybrids have spaces in them
+	"""
+	name_parts = scientific_name.split(" ")
+	while len(name_parts) < 3:
+		name_parts.append("")
+	return name_parts[0], name_parts[1], " ".join(name_parts[2:])
+
+
+def load_name_cache(session=None):
+	"""
+		Loads the common and scientific names of every species code, and the common names of every family, genus, and
+		species in the taxonomy table, into name_lookup_cache - two queries, instead of one per name looked up.
+	:param session: an open ORM session to use. If not provided, one is opened and closed for this
+	"""
+	global name_lookup_cache_loaded
+
+	session_opened = False
+	if not session:
+		session = support.connect_orm(hotload=True)
+		session_opened = True
+
+	try:
+		cache = {"fid": {}, "Family": {}, "Genus": {}, "Species": {}}
+		for fid, common_name, scientific_name in session.query(orm.Species.fid, orm.Species.common_name, orm.Species.scientific_name):
+			cache["fid"][fid] = TaxonName(common_name, scientific_name)
+
+		parent = aliased(orm.TaxonomicLevel)
+		records = session.query(orm.TaxonomicLevel.level, orm.TaxonomicLevel.scientific_name, orm.TaxonomicLevel.common_name, parent.scientific_name)\
+						.outerjoin(parent, orm.TaxonomicLevel.parent_level_id == parent.pkey)\
+						.order_by(orm.TaxonomicLevel.pkey)
+		for level, scientific_name, common_name, parent_scientific_name in records:
+			level = level.capitalize()
+			if level == "Family":
+				key = scientific_name
+				full_name = scientific_name
+			elif level in ("Genus", "Species"):
+				key = (parent_scientific_name, scientific_name)
+				full_name = "{} {}".format(parent_scientific_name, scientific_name)
+			else:
+				continue
+			if key not in cache[level]:  # keep the first, as get_taxonomy does
+				cache[level][key] = TaxonName(common_name, full_name)
+
+		name_lookup_cache.clear()
+		name_lookup_cache.update(cache)
+		name_lookup_cache_loaded = True
+	finally:
+		if session_opened:
+			session.close()
 
 
-def get_common_name_from_species_string(scientific_name, level, speedup=True):
+def reset_name_cache():
+	"""
+		Clears name_lookup_cache so that the next lookup reloads it - for after species or taxonomy records change
+	"""
+	global name_lookup_cache_loaded
+	for level in name_lookup_cache:
+		name_lookup_cache[level] = {}
+	name_lookup_cache_loaded = False
+
+
+def _cached_name(name, level):
+	if level is None:
+		return name_lookup_cache["fid"].get(name)
+
+	family, genus, species = _split_species_string(name)
+	level = level.capitalize()
+	if level == "Family":
+		return name_lookup_cache["Family"].get(family)
+	elif level == "Genus":
+		return name_lookup_cache["Genus"].get((family, genus))
+	elif level == "Species":
+		return name_lookup_cache["Species"].get((genus, species))
+	else:
+		raise ValueError("level must be family, genus, species, or None (for species codes), not {}".format(level))
+
+
+def get_names(names, level=None, session=None):
+	"""
+		Looks up the common and scientific names for many species codes or species strings at once. Everything comes
+		from name_lookup_cache, which is loaded the first time it's needed and reloaded once if a name isn't in it,
+		in case it was added since.
+	:param names: iterable of species codes (when level is None) or Family genus species subspecies strings, such as
+		produced by species aggregation queries in the API
+	:param level: None for species codes, or family, genus, or species - the level to provide names at for species strings
+	:param session: an open ORM session to use if the cache needs loading. If not provided, one is opened and closed
+	:return: dict of each name -> TaxonName(common_name, scientific_name), or None for names that weren't found.
+		Scientific names for species strings are the family name, or the genus or species with its parent's name
+	"""
+	names = set(names)
+
+	reloaded = False
+	if not name_lookup_cache_loaded:
+		load_name_cache(session)
+		reloaded = True
+
+	results = dict((name, _cached_name(name, level)) for name in names)
+	if not reloaded and None in results.values():
+		load_name_cache(session)
+		results = dict((name, _cached_name(name, level)) for name in names)
+
+	return results
+
+
+def get_common_names(names, level=None, session=None):
+	"""
+		Like get_names, but returns only the common names
+	:return: dict of each name -> common name, or None for names that weren't found
+	"""
+	return dict((name, taxon_name.common_name if taxon_name else None) for name, taxon_name in get_names(names, level, session).items())
+
+
+def get_common_name_from_species_string(scientific_name, level, speedup=True, session=None):
 	"""
 		Given a Family_genus_species_subspecies string (such as produced by species aggregation queries in the API),
 		gets the common name associated with the specified taxonomic level. Not meant for looking up common names by
 		genus, species, and subspecies (use the Species model in the ORM directly for that). This function gives *aggregated*
-		common names at the species, genus, and family levels, where we have them
+		common names at the species, genus, and family levels, where we have them. To look up many names, use
+		get_common_names.
 
 	:param scientific_name: The name of the species, starting at family level down to the level specified in the paramer setting
 	:param level: family, genus, or species - what level to provide the common name at
-	:param speedup: Indicates that we should cache names - allows for testing of cache vs. noncache
+	:param speedup: Indicates that we should use the name cache (see get_names) - allows for testing of cache vs. noncache
+	:param session: an open ORM session to use. If not provided, one is opened and closed for this lookup
 
 	:return:
 	"""
-	global name_lookup_cache
+	if speedup:
+		return get_common_names([scientific_name], level=level, session=session)[scientific_name]
 
-	session = support.connect_orm(hotload=True)
+	session_opened = False
+	if not session:
+		session = support.connect_orm(hotload=True)
+		session_opened = True
 
 	try:
 		level_lookup = {
@@ -45,25 +172,7 @@ def get_common_name_from_species_string(scientific_name, level, speedup=True):
 			"species": 2,
 		}
 
-		name_parts = scientific_name.split(" ")  # split it by spaces
-		while len(name_parts) < 3:
-			name_parts.append("")  # we shouldn't use these empty ones, but it makes the expression below work in all cases, no matter how long of an initial string we got, so long as the string always starts with the family
-
-		#			family			genus	    species could have spaces in it - rejoin everything remaining with spaces
-		levels = [name_parts[0], name_parts[1], " ".join(name_parts[2:len(name_parts)])]
-
-		if speedup:  # we'll look through the cached dictionary to see if we already looked this species up. If so, return it
-			base_dict = name_lookup_cache[level.capitalize()]
-			for speed_level in levels:
-				if speed_level in base_dict:
-					if type(base_dict[speed_level]) is dict:  # then look up the next level
-						base_dict = base_dict[speed_level]
-					else:  # we're at the end, found our species already - if the key exists already, then we'll have populated it - could lead to a bug if this function crashes the first time after creating key but before populating it
-						return base_dict[speed_level]
-				else:
-					base_dict[speed_level] = {}
-					base_dict = base_dict[speed_level]
-
+		levels = _split_species_string(scientific_name)
 
 		species_scientific_name = levels[level_lookup[level.lower()]]  # there has to be a simpler way to get the scientific name for the
 																		# species level than I'm doing right now
@@ -72,18 +181,10 @@ def get_common_name_from_species_string(scientific_name, level, speedup=True):
 		else:
 			parent_sci_name = levels[level_lookup[level.lower()]-1]  # get the parent level scientific name
 
-		name = get_taxonomy(scientific_name=species_scientific_name, level=level, parent_scientific_name=parent_sci_name, session=session).common_name
-		if speedup:
-			base = name_lookup_cache[level.capitalize()]
-			for speed_level in levels:
-				if len(base[speed_level].keys()) == 0:  # if we hit a dict with no keys, then we're at the bottom of the tree
-					base[speed_level] = name  # replace it with the name instead
-				else:
-					base = base[speed_level]
-
-		return name
+		return get_taxonomy(scientific_name=species_scientific_name, level=level, parent_scientific_name=parent_sci_name, session=session).common_name
 	finally:
-		session.close()
+		if session_opened:
+			session.close()
 
 
 def get_taxonomy(scientific_name, level, session, parent_scientific_name=None,):
@@ -139,9 +240,12 @@ def join_assemblage_as_field(huc_dataset,
 										 collections=collections)
 
 	if taxonomic_aggregation_level.lower() in aggregation_levels:  # if we're aggregated, transform it back to a common name
-		for key in presence_data:  # this is SLOOOOOOW - adds a ton of time when it has to be run for assemblages on every species
-			presence_data[key] = [get_common_name_from_species_string(scientific_name=sci_name, level=taxonomic_aggregation_level)
-								  for sci_name in presence_data[key]]
+		all_names = set()
+		for key in presence_data:
+			all_names.update(presence_data[key])
+		common_names = get_common_names(all_names, level=taxonomic_aggregation_level)
+		for key in presence_data:
+			presence_data[key] = [common_names[sci_name] for sci_name in presence_data[key]]
 
 	if not field_name:
 		if type(presence_types) in (six.text_type, six.binary_type):  # if it's a string, it'll be comma separated - replace the commas with underscores
@@ -0,0 +1,3 @@
+"""
+	Synthetic data and benchmarks that run without arcpy. See runner for usage.
+"""
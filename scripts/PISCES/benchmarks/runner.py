@@ -0,0 +1,412 @@
+"""
+	Benchmarks for the parts of PISCES that don't need arcpy - presence lookups through the API, postprocess_zones
+	style per-zone queries, HUC network traversals, presence matrices for make_matrix, and observation inserts - run
+	against a synthetic database from benchmarks.synthetic.
+
+	Databases are opened with funcs.db_connect using the driver given to run - by default Python's sqlite3 module (see
+	local_vars.db_driver), so the benchmarks run without the SQLite ODBC driver, and every benchmark, including both
+	insert paths, is timed on the same driver.
+
+	Each run appends one JSON line to a results file with the timings, the dataset parameters, and the code version, and
+	compares the timings with the last run on the same dataset, so regressions show up as they're introduced.
+
+	python -m PISCES.benchmarks.runner [--hucs N] [--species N] [--observations N] [--seed N] [--repeat N]
+		[--only NAME] [--results PATH] [--threshold FRACTION] [--fail-on-regression] [--driver sqlite3|odbc]
+"""
+
+from __future__ import absolute_import, division, print_function
+
+import argparse
+import datetime
+import json
+import os
+import platform
+import shutil
+import sqlite3
+import subprocess
+import sys
+import tempfile
+import time
+
+from .. import __version__
+from .. import local_vars
+from .. import funcs
+from .. import log
+from .. import orm_models
+from .. import huc_network
+from ..api_components import presence
+from ..api_components import listing
+from ..api_components import presence_index
+from ..callbacks import batch
+from ..input_filters import common
+
+from . import synthetic
+
+default_repeat = 5
+default_threshold = 0.25  # a benchmark is flagged when its median is this fraction slower than in the previous run
+
+postprocess_queries = (  # the kind of per-zone queries map layers run through postprocess_zones
+	"select count(distinct species_id) as col_value from observations where zone_id = ? and presence_type in ({})".format(local_vars.current_obs_types),
+	"select count(*) as col_value from observations where zone_id = ?",
+	"select max(observation_date) as col_value from observations where zone_id = ? and presence_type in ({})".format(local_vars.historic_obs_types),
+)
+
+benchmarks = []  # (name, setup, function) - setup runs untimed before each repeat and returns the arguments for function
+
+
+def benchmark(name, setup=None):
+	"""
+		Registers a benchmark function
+	:param name: name the timings are recorded under
+	:param setup: function taking the benchmark context and returning a tuple of arguments for the benchmark. Runs
+		before each repeat and isn't timed
+	"""
+	def register(function):
+		benchmarks.append((name, setup, function))
+		return function
+	return register
+
+
+class Context(object):
+	"""
+		What the benchmarks share - the database, and the zones and species in it
+	"""
+
+	def __init__(self, db_path):
+		self.db_path = db_path
+
+		connection = sqlite3.connect(db_path)
+		try:
+			self.zone_pairs = connection.execute("select HUC_12, HU_12_DS from {}".format(local_vars.zones_table)).fetchall()
+			self.zones = [row[0] for row in self.zone_pairs]
+			self.species = [row[0] for row in connection.execute("select species_id from observations group by species_id order by count(*) desc").fetchall()]
+		finally:
+			connection.close()
+
+		self.network = huc_network.HUCNetwork(self.zone_pairs)
+		self.outlets = [zone for zone in self.network.zones if self.network.downstream(zone) is None]
+
+
+def use_database(db_path):
+	"""
+		Points PISCES at a database - the raw SQL connections, the ORM, and the cached indexes
+	"""
+	local_vars.maindb = db_path
+	local_vars.ormdb = db_path
+	local_vars.data_setup_run = False
+	funcs.close_pooled_connections()  # pooled connections could be to a previous database with the same path
+	orm_models.reset()
+	presence_index.invalidate()
+
+
+# API presence functions
+
+@benchmark("api.get_presence_by_taxa")
+def _presence_by_taxa(context):
+	presence.get_presence_by_taxa(context.species[:20], use_index=False)
+
+
+@benchmark("api.get_presence_by_taxa.index")
+def _presence_by_taxa_index(context):
+	presence.get_presence_by_taxa(context.species[:20], use_index=True)
+
+
+@benchmark("api.get_presence_by_huc_set")
+def _presence_by_huc_set(context):
+	presence.get_presence_by_huc_set(context.species[:20], context.zones[:500], use_index=False)
+
+
+@benchmark("api.get_hucs_for_species_as_list")
+def _hucs_for_species(context):
+	for fid in context.species[:20]:
+		listing.get_hucs_for_species_as_list(fid, local_vars.current_obs_types, use_index=False)
+
+
+@benchmark("api.get_hucs_for_species_as_list.index")
+def _hucs_for_species_index(context):
+	for fid in context.species[:20]:
+		listing.get_hucs_for_species_as_list(fid, local_vars.current_obs_types, use_index=True)
+
+
+def _invalidate_presence_index(context):
+	presence_index.invalidate()
+	return ()
+
+
+@benchmark("api.presence_index.build", setup=_invalidate_presence_index)
+def _build_presence_index(context):
+	presence_index.get_index()
+
+
+# postprocess_zones
+
+def _open_cursor(context):
+	return funcs.db_connect(context.db_path, "benchmark postprocess")
+
+
+@benchmark("postprocess_zones.per_zone", setup=_open_cursor)
+def _postprocess_per_zone(context, db_cursor, connection):
+	try:
+		for query in postprocess_queries:
+			for zone in context.zones:
+				db_cursor.execute(query, (zone,)).fetchone()
+	finally:
+		funcs.db_close(db_cursor, connection)
+
+
+@benchmark("postprocess_zones.batch", setup=_open_cursor)
+def _postprocess_batch(context, db_cursor, connection):
+	try:
+		batch.get_zone_values_for_queries(db_cursor, list(postprocess_queries), context.zones)
+	finally:
+		funcs.db_close(db_cursor, connection)
+
+
+# HUC network
+
+@benchmark("huc_network.build")
+def _build_network(context):
+	huc_network.HUCNetwork(context.zone_pairs)
+
+
+@benchmark("huc_network.upstream")
+def _upstream(context):
+	for zone in context.outlets:
+		context.network.upstream(zone, include_self=True)
+
+
+@benchmark("huc_network.distances_from", setup=lambda context: (huc_network.HUCNetwork(context.zone_pairs),))
+def _distances_from(context, network):
+	for zone in context.zones[::max(1, len(context.zones) // 25)]:
+		network.distances_from(zone)
+
+
+@benchmark("huc_network.accumulate_upstream")
+def _accumulate_upstream(context):
+	context.network.upstream_counts()
+
+
+# make_matrix
+
+def _matrix_records(context):
+	if not hasattr(context, "presence_records"):
+		context.presence_records = presence.get_presence_by_taxa(context.species, use_index=True)
+	return ()
+
+
+@benchmark("make_matrix.presence_frame", setup=_matrix_records)
+def _make_matrix(context):
+	from .. import tbx_make_matrix  # imports arcpy, which the package replaces with a mock when it isn't installed
+
+	matrix, fields = tbx_make_matrix.build_presence_matrix(context.presence_records, context.zones, lambda taxon: taxon)
+	tbx_make_matrix.presence_frame(matrix, context.zones, fields)
+
+
+# insert_data
+
+def _observation_set(context, count=5000):
+	if_method = common.EmptyRow()  # only method_id is used when inserting
+	if_method.method_id = 1
+
+	observations = []
+	for index in range(count):
+		obs = local_vars.observation()
+		obs.species_id = context.species[index % len(context.species)]
+		obs.zone_id = context.zones[index % len(context.zones)]
+		obs.presence_type = 1
+		obs.collections = [5]
+		observations.append(obs)
+
+	obs_set = common.observation_set(l_dataset_name="benchmark")
+	obs_set.set_id = 1
+	obs_set.results = [local_vars.result_set(observations, if_method)]
+	return obs_set
+
+
+@benchmark("insert_data.per_row", setup=lambda context: (_observation_set(context),))
+def _insert_per_row(context, obs_set):
+	db_cursor, db_conn = funcs.db_connect(context.db_path, "benchmark insert")
+	try:
+		obs_set.insert_data(db_cursor)
+		obs_set.insert_collections(db_cursor)
+	finally:
+		db_conn.rollback()  # so the inserts don't accumulate between repeats
+		funcs.db_close(db_cursor, db_conn)
+
+
+@benchmark("insert_data.batched", setup=lambda context: (_observation_set(context),))
+def _insert_batched(context, obs_set):
+	db_cursor, db_conn = funcs.db_connect(context.db_path, "benchmark insert")  # the same driver as per_row, so the timings compare
+	try:
+		obs_set.insert_batched(db_cursor, db_conn, batch_size=local_vars.import_batch_size or 5000, commit_interval=0)
+	finally:
+		db_conn.rollback()
+		funcs.db_close(db_cursor, db_conn)
+
+
+def run_benchmark(context, name, setup, function, repeat=default_repeat):
+	"""
+		Times a benchmark
+	:return: dict of min, median, and mean seconds, and the number of repeats
+	"""
+	timings = []
+	for iteration in range(repeat):
+		arguments = setup(context) if setup else ()
+		started = time.time()
+		function(context, *arguments)
+		timings.append(time.time() - started)
+
+	timings.sort()
+	middle = len(timings) // 2
+	median = timings[middle] if len(timings) % 2 else (timings[middle - 1] + timings[middle]) / 2
+	return {"min": timings[0], "median": median, "mean": sum(timings) / len(timings), "repeat": repeat}
+
+
+def get_commit():
+	"""
+		Returns the git commit of the code being benchmarked, or None if it can't be determined
+	"""
+	try:
+		output = subprocess.check_output(["git", "rev-parse", "HEAD"], cwd=os.path.dirname(os.path.abspath(__file__)), stderr=subprocess.STDOUT)
+		return output.decode("utf-8").strip()
+	except (OSError, subprocess.CalledProcessError):
+		return None
+
+
+def load_previous(results_path, dataset, driver="sqlite3"):
+	"""
+		Returns the most recent recorded run on the same dataset and driver, or None
+	"""
+	if not os.path.exists(results_path):
+		return None
+
+	previous = None
+	with open(results_path, 'r') as results_file:
+		for line in results_file:
+			line = line.strip()
+			if not line:
+				continue
+			try:
+				record = json.loads(line)
+			except ValueError:
+				continue
+			if record.get("dataset") == dataset and record.get("driver") == driver:
+				previous = record
+	return previous
+
+
+def find_regressions(results, previous, threshold=default_threshold):
+	"""
+		Compares median timings with a previous run
+	:param results: dict of benchmark name -> timing dict from run_benchmark
+	:param previous: record from load_previous, or None
+	:param threshold: fraction slower than the previous median that counts as a regression
+	:return: list of (name, previous median, current median) tuples
+	"""
+	if not previous:
+		return []
+
+	regressions = []
+	for name, timing in sorted(results.items()):
+		old = previous.get("results", {}).get(name)
+		if old and old.get("median") and timing["median"] > old["median"] * (1 + threshold):
+			regressions.append((name, old["median"], timing["median"]))
+	return regressions
+
+
+def get_database(dataset, db_path=None, regenerate=False):
+	"""
+		Returns the path to a synthetic database for the dataset parameters, generating it if it doesn't exist. Databases
+		are kept in the temp folder by parameters so repeated runs don't regenerate them.
+	"""
+	if db_path is None:
+		db_path = os.path.join(tempfile.gettempdir(), "pisces_benchmark_{n_hucs}_{n_species}_{n_observations}_{seed}.sqlite".format(**dataset))
+
+	if regenerate or not os.path.exists(db_path):
+		log.write("Generating synthetic database at {}".format(db_path), True)
+		partial_path = db_path + ".partial"
+		synthetic.generate(partial_path, overwrite=True, **dataset)
+		shutil.move(partial_path, db_path)
+
+	return db_path
+
+
+def run(dataset, db_path=None, repeat=default_repeat, only=None, results_path=None, threshold=default_threshold, regenerate=False, driver="sqlite3"):
+	"""
+		Runs the benchmarks and records the results
+	:param dataset: dict of synthetic.generate parameters (n_hucs, n_species, n_observations, seed)
+	:param db_path: where to keep the synthetic database. Defaults to a file named by the parameters in the temp folder
+	:param repeat: times to run each benchmark
+	:param only: list of name prefixes - only benchmarks whose names start with one of them run
+	:param results_path: JSON lines file to append results to. Defaults to benchmarks.jsonl in the PISCES log folder
+	:param threshold: fraction slower than the previous run that counts as a regression
+	:param regenerate: rebuild the synthetic database even if it already exists
+	:param driver: local_vars.db_driver to connect with for the run - "sqlite3" or "odbc"
+	:return: tuple of (record written to the results file, list of regressions from find_regressions)
+	"""
+	if results_path is None:
+		results_path = os.path.join(local_vars.internal_workspace, "log", "benchmarks.jsonl")
+
+	local_vars.db_driver = driver
+	use_database(get_database(dataset, db_path, regenerate))
+	context = Context(local_vars.maindb)
+
+	results = {}
+	for name, setup, function in benchmarks:
+		if only and not any(name.startswith(prefix) for prefix in only):
+			continue
+		results[name] = run_benchmark(context, name, setup, function, repeat)
+		log.write("{:<45} median {:>9.4f}s  min {:>9.4f}s".format(name, results[name]["median"], results[name]["min"]), True)
+
+	previous = load_previous(results_path, dataset, driver)
+	regressions = find_regressions(results, previous, threshold)
+	for name, old, new in regressions:
+		log.warning("{} regressed: median {:.4f}s, up from {:.4f}s in the previous run".format(name, new, old))
+
+	record = {
+		"timestamp": datetime.datetime.now().isoformat(),
+		"commit": get_commit(),
+		"version": __version__,
+		"python": platform.python_version(),
+		"platform": platform.platform(),
+		"driver": driver,
+		"dataset": dataset,
+		"results": results,
+	}
+
+	results_folder = os.path.dirname(results_path)
+	if results_folder and not os.path.exists(results_folder):
+		os.makedirs(results_folder)
+	with open(results_path, 'a') as results_file:
+		results_file.write(json.dumps(record, sort_keys=True) + "\n")
+
+	return record, regressions
+
+
+def main(argv=None):
+	parser = argparse.ArgumentParser(description="Runs PISCES benchmarks against a synthetic database")
+	parser.add_argument("--hucs", type=int, default=synthetic.default_parameters["n_hucs"])
+	parser.add_argument("--species", type=int, default=synthetic.default_parameters["n_species"])
+	parser.add_argument("--observations", type=int, default=synthetic.default_parameters["n_observations"])
+	parser.add_argument("--seed", type=int, default=synthetic.default_parameters["seed"])
+	parser.add_argument("--db", help="where to keep the synthetic database - defaults to a file named by the parameters in the temp folder")
+	parser.add_argument("--regenerate", action="store_true", help="rebuild the synthetic database")
+	parser.add_argument("--repeat", type=int, default=default_repeat)
+	parser.add_argument("--only", action="append", help="run benchmarks whose names start with this - can be repeated")
+	parser.add_argument("--results", help="JSON lines file to append results to")
+	parser.add_argument("--threshold", type=float, default=default_threshold, help="fraction slower than the last run that counts as a regression")
+	parser.add_argument("--driver", choices=("sqlite3", "odbc"), default="sqlite3", help="how to connect to the database - see local_vars.db_driver")
+	parser.add_argument("--fail-on-regression", action="store_true", help="exit with status 1 if anything regressed")
+	args = parser.parse_args(argv)
+
+	dataset = {"n_hucs": args.hucs, "n_species": args.species, "n_observations": args.observations, "seed": args.seed}
+	record, regressions = run(dataset, db_path=args.db, repeat=args.repeat, only=args.only, results_path=args.results,
+							  threshold=args.threshold, regenerate=args.regenerate, driver=args.driver)
+
+	if regressions and args.fail_on_regression:
+		return 1
+	return 0
+
+
+if __name__ == "__main__":
+	sys.exit(main())
@@ -0,0 +1,257 @@
+"""
+	Builds synthetic PISCES databases for benchmarks and tests. The schema comes from orm_models, so the tables and
+	columns match what the ORM and the raw SQL in the rest of the package expect, and the data is generated from a
+	seeded random number generator, so the same parameters always produce the same database.
+
+	Zones form a valid HU_12_DS tree - every zone drains to a zone created before it, or to a network end - and each
+	species has a contiguous range of zones along that network, so presence, network, and diversity queries see data
+	shaped like the real thing. Nothing here uses arcpy.
+"""
+
+from __future__ import absolute_import, division, print_function
+
+import bisect
+import collections
+import os
+import random
+import sqlite3
+import string
+
+import sqlalchemy
+
+from .. import local_vars
+from .. import orm_models
+from .. import db_management
+
+default_parameters = {
+	"n_hucs": 4000,
+	"n_species": 130,
+	"n_observations": 150000,
+	"seed": 1,
+}
+
+presence_types = (  # (type, description, default certainty, short description) - types 1 through 10, as in defs_observation_types
+	(1, "Observed", 1, "Observed"),
+	(2, "Historical", 2, "Historic"),
+	(3, "Extant", 1, "Extant"),
+	(4, "Extirpated", 1, "Extirpated"),
+	(5, "Historical, Expert", 2, "Historic (Expert)"),
+	(6, "Translocated", 1, "Translocated"),
+	(7, "Reintroduced", 1, "Reintroduced"),
+	(8, "Unknown", 3, "Unknown"),
+	(9, "Current, Expert", 2, "Current (Expert)"),
+	(10, "Historical, Translocated", 2, "Historic (Translocated)"),
+)
+presence_type_weights = (30, 15, 20, 2, 10, 6, 2, 1, 12, 2)
+
+collection_ids = tuple(range(1, 17))  # includes the high quality collections, 5, 15, and 16
+
+species_groups = (  # (id, name, short name)
+	(1, "Native_Fish", "native"),
+	(2, "Non_Native_Fish", "non_native"),
+	(3, "Flagship", "flagship"),
+	(4, "Anadromous", "anadromous"),
+	(5, "Narrow_20", "narrow"),
+)
+
+extra_tables = (  # tables that aren't in orm_models, with just the columns the code reads
+	"CREATE TABLE IF NOT EXISTS layer_cache (id INTEGER PRIMARY KEY, query_id INTEGER, bind_var TEXT, layer_file TEXT, last_updated TEXT)",
+	"CREATE TABLE IF NOT EXISTS newdata (id INTEGER PRIMARY KEY, imported INTEGER)",
+	"CREATE TABLE IF NOT EXISTS fieldmapping (id INTEGER PRIMARY KEY, newdata_id INTEGER, field_name TEXT, input_field TEXT, handler_function TEXT, required INTEGER)",
+)
+
+
+def _weighted_choice(generator, items, cumulative_weights):
+	position = generator.random() * cumulative_weights[-1]
+	return items[bisect.bisect_right(cumulative_weights, position)]
+
+
+def _cumulative(weights):
+	totals = []
+	for weight in weights:
+		totals.append(weight + (totals[-1] if totals else 0))
+	return totals
+
+
+def _species_code(number):
+	letters = string.ascii_uppercase
+	return "{}{}{}{:02d}".format(letters[(number // 676) % 26], letters[(number // 26) % 26], letters[number % 26], number // 17576 + 1)
+
+
+def make_zones(generator, n_hucs):
+	"""
+		Generates zones and the zone each one drains to. Every zone drains to an earlier zone in the same HUC_8, or to a
+		network end, so the network is a forest with no loops. Each outlet starts a new HUC_8.
+	:param generator: random.Random instance
+	:param n_hucs: number of zones
+	:return: list of (HUC_12, HUC_8, HU_12_DS) tuples
+	"""
+	zones = []
+	n_outlets = max(1, n_hucs // 200)
+	basin = 0
+	start = 0  # index of the first zone in the current HUC_8
+	for index in range(n_hucs):
+		if index < n_outlets or index - start >= 9999 or generator.random() < 0.002:
+			basin += 1
+			start = index
+			downstream = generator.choice(("OCEAN", "OCEAN", "OCEAN", "CLOSED BASIN"))
+		else:
+			# drain to a recent zone, which gives long main stems with branching tributaries
+			downstream = zones[generator.randint(max(start, index - 50), index - 1)][0]
+		huc_8 = "18{:06d}".format(basin)
+		zones.append(("{}{:04d}".format(huc_8, index - start), huc_8, downstream))
+	return zones
+
+
+def make_species(generator, n_species):
+	"""
+		Generates species in a small number of families and genera
+	:return: list of dicts of species attributes, with fids from AAA01 upward
+	"""
+	n_families = max(1, n_species // 15)
+	species = []
+	for number in range(n_species):
+		family = "Family{:02d}".format(generator.randrange(n_families))
+		genus = "Genus{:03d}".format(generator.randrange(max(1, n_species // 4)))
+		species.append({
+			"fid": _species_code(number),
+			"family": family,
+			"genus": genus,
+			"species": "species{:03d}".format(number),
+			"common_name": "Synthetic fish {}".format(number),
+			"native": generator.random() < 0.75,
+		})
+	return species
+
+
+def make_ranges(generator, zones, species):
+	"""
+		Gives each species a range - a random zone and the zones connected to it, upstream or downstream, out to a
+		random size
+	:return: dict of fid -> list of HUC_12 ids
+	"""
+	neighbors = {}
+	for huc_12, huc_8, downstream in zones:
+		neighbors.setdefault(huc_12, [])
+		if downstream in neighbors:
+			neighbors[downstream].append(huc_12)
+			neighbors[huc_12].append(downstream)
+
+	ranges = {}
+	for taxon in species:
+		size = max(1, int(generator.lognormvariate(3.5, 1.0)))
+		start = generator.choice(zones)[0]
+		zone_range = [start]
+		seen = set(zone_range)
+		queue = collections.deque(zone_range)
+		while queue and len(zone_range) < size:
+			for zone in neighbors[queue.popleft()]:
+				if zone not in seen and len(zone_range) < size:
+					seen.add(zone)
+					zone_range.append(zone)
+					queue.append(zone)
+		ranges[taxon["fid"]] = zone_range
+	return ranges
+
+
+def create_schema(db_path):
+	"""
+		Creates every table in orm_models, plus the tables outside the ORM that local_vars.data_setup and mapping read, in
+		a new database
+	:param db_path: path of the SQLite database. Must not exist
+	"""
+	engine = sqlalchemy.create_engine("sqlite:///{}".format(db_path))
+	try:
+		orm_models.Base.metadata.create_all(engine)
+	finally:
+		engine.dispose()
+
+	connection = sqlite3.connect(db_path)
+	try:
+		for statement in extra_tables:
+			connection.execute(statement)
+		connection.commit()
+	finally:
+		connection.close()
+
+
+def generate(db_path, n_hucs=default_parameters["n_hucs"], n_species=default_parameters["n_species"],
+			 n_observations=default_parameters["n_observations"], seed=default_parameters["seed"], indexes=True, overwrite=False):
+	"""
+		Generates a synthetic PISCES database
+	:param db_path: path of the SQLite database to create
+	:param n_hucs: number of zones in the HUC12 table
+	:param n_species: number of species
+	:param n_observations: number of observations. Each is in one or two collections
+	:param seed: random seed - the same parameters and seed always build the same database
+	:param indexes: create the managed index set from db_management after loading data
+	:param overwrite: replace db_path if it exists. Otherwise, an existing file raises ValueError
+	:return: dict of the parameters used
+	"""
+	if os.path.exists(db_path):
+		if not overwrite:
+			raise ValueError("{} already exists - pass overwrite=True to replace it".format(db_path))
+		os.remove(db_path)
+
+	generator = random.Random(seed)
+	create_schema(db_path)
+
+	zones = make_zones(generator, n_hucs)
+	species = make_species(generator, n_species)
+	ranges = make_ranges(generator, zones, species)
+
+	connection = sqlite3.connect(db_path)
+	try:
+		db_cursor = connection.cursor()
+		db_cursor.executemany("INSERT INTO {} (HUC_12, HUC_8, HU_12_DS, HU_12_NAME, STATES, Shape_Area) VALUES (?, ?, ?, ?, ?, ?)".format(local_vars.zones_table),
+							  [(huc_12, huc_8, downstream, "Zone {}".format(huc_12), "CA", generator.uniform(2e7, 2e8)) for huc_12, huc_8, downstream in zones])
+		db_cursor.executemany("INSERT INTO {} (zone, rim_dam, in_state) VALUES (?, ?, ?)".format(local_vars.zones_aux),
+							  [(huc_12, 0, 1) for huc_12, huc_8, downstream in zones])
+
+		db_cursor.executemany("INSERT INTO {} (fid, family, genus, species, scientific_name, taxonomic_unit, common_name, native, temporary) VALUES (?, ?, ?, ?, ?, 'Species', ?, ?, 0)".format(local_vars.species_table),
+							  [(taxon["fid"], taxon["family"], taxon["genus"], taxon["species"], "{} {}".format(taxon["genus"], taxon["species"]), taxon["common_name"], 1 if taxon["native"] else 0) for taxon in species])
+
+		db_cursor.executemany("INSERT INTO {} (id, group_name, short_name) VALUES (?, ?, ?)".format(local_vars.species_groups_table), species_groups)
+		members = []
+		for taxon in species:
+			members.append((taxon["fid"], 1 if taxon["native"] else 2))
+			if generator.random() < 0.1:
+				members.append((taxon["fid"], generator.choice((3, 4))))
+			if len(ranges[taxon["fid"]]) <= 20:
+				members.append((taxon["fid"], 5))
+		db_cursor.executemany("INSERT INTO {} (fid, group_id) VALUES (?, ?)".format(local_vars.species_group_members_table), members)
+
+		db_cursor.executemany("INSERT INTO {} (objectid, type, description, default_certainty, short_desc) VALUES (?, ?, ?, ?, ?)".format(local_vars.presence_types_table),
+							  [(presence_type[0],) + presence_type for presence_type in presence_types])
+		db_cursor.executemany("INSERT INTO {} (id, collection_name, short_name) VALUES (?, ?, ?)".format(local_vars.collections_table),
+							  [(collection_id, "Collection {}".format(collection_id), "c{}".format(collection_id)) for collection_id in collection_ids])
+
+		n_sets = max(1, n_observations // 2000)
+		db_cursor.executemany("INSERT INTO {} (set_id, name, source_data) VALUES (?, ?, ?)".format(local_vars.observation_sets_table),
+							  [(set_id, "synthetic_{}".format(set_id), "synthetic") for set_id in range(1, n_sets + 1)])
+
+		# widely distributed species get more observations, the way they do in the real data
+		fids = [taxon["fid"] for taxon in species]
+		species_weights = _cumulative([len(ranges[fid]) for fid in fids])
+		type_weights = _cumulative(presence_type_weights)
+		observations = []
+		observation_collections = []
+		for objectid in range(1, n_observations + 1):
+			fid = _weighted_choice(generator, fids, species_weights)
+			presence_type = _weighted_choice(generator, presence_types, type_weights)
+			observations.append((objectid, generator.randint(1, n_sets), fid, generator.choice(ranges[fid]), presence_type[0], 1, presence_type[2], 1,
+								 "{:04d}-01-01".format(generator.randint(1900, 2016)), "2016-01-01"))
+			observation_collections.append((objectid, generator.choice(collection_ids)))
+			if generator.random() < 0.3:
+				observation_collections.append((objectid, generator.choice(collection_ids)))
+
+		db_cursor.executemany("INSERT INTO {} (objectid, set_id, species_id, zone_id, presence_type, if_method, certainty, survey_method, observation_date, date_added) VALUES (?, ?, ?, ?, ?, ?, ?, ?, ?, ?)".format(local_vars.observations_table), observations)
+		db_cursor.executemany("INSERT INTO {} (observation_id, collection_id) VALUES (?, ?)".format(local_vars.observation_collections_table), sorted(set(observation_collections)))
+		connection.commit()
+	finally:
+		connection.close()
+
+	if indexes:
+		db_management.create_indexes(db_path)
+
+	return {"n_hucs": n_hucs, "n_species": n_species, "n_observations": n_observations, "seed": seed}
@@ -1,7 +1,6 @@
 from __future__ import absolute_import, division, print_function
 
 import os
-import sys
 import logging
 
 import arcpy
@@ -9,16 +8,19 @@ from .. import arcpy_metadata as md
 
 from .. import local_vars
 from .. import funcs
+from .. import huc_network
 
 from .richness_difference import richness_difference
+from . import diversity_engine
+from . import beta_diversity
 from .common import postprocess_zones, add_field, empty_object, function_arg, query, get_arg
 
-from ..code_library_data_files import generate_gdb_filename, fast_dissolve, make_temp
+from ..code_library_data_files import generate_gdb_filename, fast_dissolve, make_temp, write_columns_by_key
 
 log = logging.getLogger("PISCES.callbacks")
 
 connectivity_index = {}
-network_end_hucs = ["CLOSED BASIN", "Mexico", "OCEAN"]
+network_end_hucs = list(huc_network.network_end_hucs)
 diversity_network = None
 raster_working_gdb = None  # wll be set the first time it's used.
 
@@ -108,6 +110,9 @@ def mega_diversity_info(zones_layer, db_cursor, args, parent_layer):
 		-------- DOWNSTREAM INFO --------
 		downstream_assemblage: Assemblage of species in the HUC12 downstream
 
+		When local_vars.mega_diversity_single_pass is True, the presence data is loaded once and all of the columns are
+		computed in memory and written in a single cursor pass (see callbacks.diversity_engine).
+
 	@param zones_layer:
 	@param db_cursor:
 	@param args:
@@ -124,6 +129,69 @@ def mega_diversity_info(zones_layer, db_cursor, args, parent_layer):
 	historic_precence_types = get_arg(args, 3, local_vars.historic_obs_types)
 	run_non_qc = get_arg(args, 4, "0")
 
+	if local_vars.mega_diversity_single_pass:
+		t_layer = _mega_diversity_info_single_pass(zones_layer, run_non_qc == "1" or run_non_qc == 1)
+	else:
+		t_layer = _mega_diversity_info_by_metric(zones_layer, run_non_qc, parent_layer)
+
+	metadata = md.MetadataEditor(dataset=t_layer, temp_folder=local_vars.temp)
+	metadata.abstract.prepend(mega_diversity_info.__doc__)
+	metadata.title.set("All PISCES Richness Metrics")
+	metadata.save()
+
+	return t_layer
+
+
+def _mega_diversity_info_single_pass(zones_layer, run_non_qc):
+	"""
+		Computes every mega_diversity_info column from one load of the presence data, then adds the fields and writes
+		them all in one cursor pass. Beta diversity values are written to zones_aux in bulk.
+	"""
+
+	arcpy.env.overwriteOutput = True
+
+	l_name = arcpy.CreateUniqueName('mega_diversity_temp', local_vars.workspace)
+	l_temp_file = os.path.join(local_vars.workspace, l_name)
+	arcpy.CopyFeatures_management(zones_layer, l_temp_file)
+
+	downstream = {}
+	reader = arcpy.SearchCursor(l_temp_file)
+	for record in reader:
+		downstream[record.getValue(local_vars.huc_field)] = record.getValue("HU_12_DS")
+	del reader
+
+	db_connection, db_cursor = funcs.refresh_cursor(database=local_vars.maindb)
+	try:
+		log.info("Loading assemblages")
+		data = diversity_engine.AssemblageData(db_cursor, local_vars.hq_collections, db_true=local_vars.db_true, db_false=local_vars.db_false)
+
+		log.info("Computing diversity metrics")
+		fields, values, beta_diversity = diversity_engine.compute_mega_diversity(data, downstream,
+																				  diversity_engine.parse_types(local_vars.current_obs_types),
+																				  diversity_engine.parse_types(local_vars.historic_obs_types),
+																				  run_non_qc, network_end_hucs)
+
+		diversity_engine.write_beta_diversity(db_cursor, beta_diversity)
+	finally:
+		funcs.db_close(db_cursor, db_connection)
+
+	log.info("Writing diversity metrics")
+	for field_name, field_type, field_length in fields:
+		arcpy.AddField_management(l_temp_file, field_name, field_type, field_length=field_length)
+	write_columns_by_key(l_temp_file, local_vars.huc_field, values)
+
+	arcpy.env.overwriteOutput = False
+
+	arcpy.Delete_management(zones_layer)
+	arcpy.MakeFeatureLayer_management(l_temp_file, zones_layer)
+	return zones_layer
+
+
+def _mega_diversity_info_by_metric(zones_layer, run_non_qc, parent_layer):
+	"""
+		The original mega_diversity_info path - runs each metric as its own callback, each with a fresh cursor
+	"""
+
 	args_native = [
 		"""SELECT count(*) AS col_value
 			FROM
@@ -406,11 +474,7 @@ def mega_diversity_info(zones_layer, db_cursor, args, parent_layer):
 	db_connection, db_cursor = funcs.refresh_cursor(database=local_vars.maindb, connection=db_connection,
 													existing_cursor=db_cursor, close_connection=True)
 	t_layer = get_downstream_diversities(t_layer, db_cursor, None, parent_layer)
-
-	metadata = md.MetadataEditor(dataset=t_layer, temp_folder=local_vars.temp)
-	metadata.abstract.prepend(mega_diversity_info.__doc__)
-	metadata.title.set("All PISCES Richness Metrics")
-	metadata.save()
+	funcs.db_close(db_cursor, db_connection)
 
 	return t_layer
 
@@ -850,126 +914,66 @@ def connectivity(zones_layer, db_cursor, args, map_layer):
 
 	arcpy.AddField_management(zones_layer, "connectivity_upstream_count", "LONG")
 
-	select_vars = ""
 	for att in attributes:
-		# for every attribute, add a column to the layer and add it to the list of variables we want to collect info on in order to select appropriately
+		# for every attribute, add a column to the layer to hold the total for everything upstream
 		try:
 			arcpy.AddField_management(zones_layer, "connectivity_%s" % att, att_types)
 		except:
 			raise local_vars.MappingError(
 				"Couldn't add field in callback 'connectivity' - make sure you are specifying an appropriate data type for the column")
 
-		select_vars += "%s; " % att
+	log.info("Building HUC network for connectivity")
+	zone_rows = {}
+	reader = arcpy.SearchCursor(zones_layer)
+	for huc in reader:
+		zone_rows[huc.getValue("HUC_12")] = (huc.getValue("HU_12_DS"), [huc.getValue(att) for att in attributes])
+	del reader
 
-	huc_cursor = arcpy.UpdateCursor(zones_layer)
-	sys.setrecursionlimit(6000)  # set it to far higher than the number of HUCs - we shouldn't even get close to it...
+	network = huc_network.HUCNetwork((zone, zone_rows[zone][0]) for zone in zone_rows)
+	upstream_counts = network.upstream_counts()
+	upstream_totals = [network.accumulate_upstream([zone_rows[zone][1][att_index] for zone in network.zones]) for att_index in range(len(attributes))]
 
-	h_num = 0
+	global connectivity_index
+	connectivity_index = {}
+
+	huc_cursor = arcpy.UpdateCursor(zones_layer)
 	for huc in huc_cursor:
-		h_num += 1
-		print("%s - Next" % h_num)
-		connectivity_recurse(zones_layer, huc, select_vars, attributes, huc_cursor)
-		del huc
+		zone = huc.getValue("HUC_12")
+		if zone not in network:
+			continue
 
-	# this function short circuits if we've already evaluated a given huc, so the attributes and upstream of any given huc will only be run once for speed
+		index = network.zone_index[zone]
+		huc.setValue("connectivity_upstream_count", int(upstream_counts[index]))
+		for att_index, att in enumerate(attributes):
+			value = upstream_totals[att_index][index]
+			try:
+				huc.setValue("connectivity_%s" % att, int(value) if att_types.upper() in ("SHORT", "LONG") else float(value))
+			except:
+				log.error("Unable to set value of field connectivity_%s for huc %s" % (att, zone))
 
+		connectivity_index[zone] = network.upstream(zone)
+		huc_cursor.updateRow(huc)
 	del huc_cursor
 
 	log.info("Deleting EVERYTHING from table connectivity to insert new values!")
 	db_cursor.execute("delete * from Connectivity")
 
-	global connectivity_index
 	sql = "insert into connectivity (zoned,zoneu) values (?,?)"
-	for huc in connectivity_index.keys():
-		for up_huc in connectivity_index[huc]:
-			db_cursor.execute(sql, huc, up_huc)
+	db_cursor.executemany(sql, [(huc, up_huc) for huc in connectivity_index for up_huc in connectivity_index[huc]])
 
 	return zones_layer
 
 
-def connectivity_recurse(zones_layer, huc, select_vars, atts, huc_cursor):  # atts = attributes to look at
-
-	global connectivity_index
-
-	if huc.getValue(
-			"connectivity_upstream_count") is not None:  # if attributes are already set then we don't need to continue upstream of it - just use the current value
-		return_obj = empty_object()
-		return_obj.connectivity_upstream_count = huc.getValue("connectivity_upstream_count")
-		for item in atts:  # it's an object just for ease of access
-			return_obj.__dict__[item] = huc.getValue(item)  # add the value for the current huc
-			return_obj.__dict__["connectivity_%s" % item] = huc.getValue(
-				"connectivity_%s" % item)  # and the value for all upstream hucs
-			return_obj.hucs = connectivity_index[huc.HUC_12]  # set the list of upstream hucs
-		return return_obj
-
-	upstream_hucs = arcpy.UpdateCursor(zones_layer, "\"HU_12_DS\" = '%s'" % huc.getValue("HUC_12"), "", "",
-									   "")  # needs to be an update cursor because we need to use the cursor that a row came from to update
-	# select huc_12, attributes from local_vars.HUCS where HUC12FullState.HU_12_DS = huc_id
-
-	conn_count = 0  # the number of hucs upstream
-	return_obj = empty_object()
-	return_obj.hucs = []
-
-	for item in atts:
-		return_obj.__dict__[item] = huc.getValue(item)  # add the value for the current huc
-		return_obj.__dict__["connectivity_%s" % item] = None
-
-	hucs_upstream = False
-	# we have hucs upstream!
-	for up_huc in upstream_hucs:
-		hucs_upstream = True
-		conn_count += 1  # each huc here is an additional huc
-
-		# Recurse!
-		upstream_atts = connectivity_recurse(zones_layer, up_huc, select_vars, atts, upstream_hucs)
-
-		conn_count += upstream_atts.connectivity_upstream_count  # now also add the number of upstream hucs the upstream huc hadd
-		for item in atts:
-			if upstream_atts.__dict__["connectivity_%s" % item] is None:
-				upstream_atts.__dict__["connectivity_%s" % item] = 0
-			if upstream_atts.__dict__[item] is None:
-				upstream_atts.__dict__[item] = 0
-			if return_obj.__dict__["connectivity_%s" % item] is None:
-				return_obj.__dict__["connectivity_%s" % item] = 0
-
-			return_obj.__dict__["connectivity_%s" % item] += upstream_atts.__dict__["connectivity_%s" % item] + \
-															 upstream_atts.__dict__[
-																 item]  # add the value of the upstream huc to its upstream values and assign it to the spot on this huc
-			return_obj.hucs.append(up_huc.HUC_12)
-			return_obj.hucs.extend(upstream_atts.hucs)
-
-	if hucs_upstream is False:  # if nothing is upstream, then we didn't enter the loop!
-		for item in atts:
-			return_obj.__dict__[item] = huc.getValue(item)  # add the value for the current huc
-			return_obj.__dict__[
-				"connectivity_%s" % item] = 0  # WARNING - this doesn't scale to different data types...
-
-	return_obj.connectivity_upstream_count = conn_count
-	huc.setValue("connectivity_upstream_count", conn_count)
-	for field in atts:  #set the fields to the row
-		try:
-			huc.setValue("connectivity_%s" % field, return_obj.__dict__["connectivity_%s" % field])
-		except:
-			log.error("Unable to set value of field connectivity_%s for huc %s" % (field, huc.HUC_12))
-
-		try:
-			connectivity_index[huc.HUC_12] = return_obj.hucs
-		except:
-			log.error("Unable to save upstream hucs")
-
-	huc_cursor.updateRow(huc)
-	return return_obj
-
-
 def network_distance(zones_layer, db_cursor, args, map_layer):
 	log.info("Getting network distances")
 
 	# set up the lookup
-	zones_info = {}
+	zone_pairs = []
 	zones_cursor = arcpy.SearchCursor(zones_layer)
 	for zone in zones_cursor:
-		zones_info[zone.HUC_12] = zone.HU_12_DS
+		zone_pairs.append((zone.HUC_12, zone.HU_12_DS))
 	del zones_cursor
+	zones_info = huc_network.HUCNetwork(zone_pairs)
 
 	if args[0] is None:
 		return zones_layer
@@ -983,79 +987,79 @@ def network_distance(zones_layer, db_cursor, args, map_layer):
 									  zones_layer)  # copy it back - need to do this to not modify original hucs
 	arcpy.AddField_management(zones_layer, "network_distance", "INTEGER")
 
-	if not type(
-			args) == 'list':  # if we don't have a second huc, then just get the distance from every huc in the layer to this one
-		l_curs = arcpy.UpdateCursor(zones_layer)
-		ind = 0
-		for huc in l_curs:
-			ind += 1
-			print("%s..." % ind)  # print how many we've done!
-			if huc.HUC_12 == args:
-				huc.setValue("network_distance", 0)
-			else:
-				distance = network_get_distance(args, huc.HUC_12,
-												zones_info)  # we could save a TON of time on this by caching the path for args[0]
-				huc.setValue("network_distance", distance)
-			l_curs.updateRow(huc)
-	else:  # just do these two hucs, setting the attribute on the new huc
+	if len(args) > 1:  # just do these two hucs, setting the attribute on the second huc
 		distance = network_get_distance(args[0], args[1], zones_info)
 		l_curs = arcpy.UpdateCursor(zones_layer, "\"HUC_12\" = '%s'" % args[1])
 		for huc in l_curs:
 			huc.setValue("network_distance", distance)
 			l_curs.updateRow(huc)
+	else:  # if we don't have a second huc, then just get the distance from every huc in the layer to this one
+		# distances from args[0] are computed once for the whole network and cached, so each row is just a lookup
+		l_curs = arcpy.UpdateCursor(zones_layer)
+		for huc in l_curs:
+			if huc.HUC_12 == args[0]:
+				huc.setValue("network_distance", 0)
+			else:
+				huc.setValue("network_distance", network_get_distance(args[0], huc.HUC_12, zones_info))
+			l_curs.updateRow(huc)
 
 	return zones_layer
 
 
 def network_get_distance(zone1, zone2, zones_info):
-	huc1_path = []
-	huc2_path = []
-
-	network_get_path(zone=zone1, zones_downstream=zones_info, path_list=huc1_path)
-	network_get_path(zone=zone2, zones_downstream=zones_info, path_list=huc2_path)
-
-	distance = 0
-	for index in range(len(huc1_path)):
-		if huc1_path[index] in huc2_path:  # figure out where they meet first
-			distance = index
-			huc2_index = huc2_path.index(huc1_path[index])
-			if not huc2_index == -1:
-				return distance + huc2_index
-			else:
-				return 20000  # it's not actually there, which also shouldn't happen
+	"""
+		Returns the number of steps along the flow network between two zones
+	:param zone1:
+	:param zone2:
+	:param zones_info: a huc_network.HUCNetwork, or a dictionary of zone -> downstream zone
+	:return: the distance, or 20000 if the zones aren't connected
+	"""
+	if not isinstance(zones_info, huc_network.HUCNetwork):
+		zones_info = huc_network.HUCNetwork(zones_info.items())
 
-	# 20000 is a number large enough to not ever appear naturally - we can exclude it in symbology
-	return 20000  # if we get here, there was a problem, OR they aren't in the same basin (so, one is klamath and the other Sac, etc
+	distance = zones_info.distance(zone1, zone2)
+	if distance is None:
+		# 20000 is a number large enough to not ever appear naturally - we can exclude it in symbology
+		return 20000  # if we get here, there was a problem, OR they aren't in the same basin (so, one is klamath and the other Sac, etc
+	return distance
 
 
 def network_get_path(zone, zones_downstream, path_list):
-	global network_end_hucs
-
-	current_DS = zone
-	while (current_DS is not None):
+	"""
+		Adds the zone and every zone downstream of it to path_list, stopping at the end of the network
+	:param zone:
+	:param zones_downstream: a huc_network.HUCNetwork, or a dictionary of zone -> downstream zone
+	:param path_list: list to add the path to
+	"""
+	if not isinstance(zones_downstream, huc_network.HUCNetwork):
+		zones_downstream = huc_network.HUCNetwork(zones_downstream.items())
 
-		if current_DS in network_end_hucs:
-			break
-		path_list.append(current_DS)
-		try:
-			current_DS = zones_downstream[current_DS]
-		except KeyError:  # we have hucs that reference downstream hucs, but because we clip to CA, they are missing - we need to tolerate that
-			break
+	# we have hucs that reference downstream hucs, but because we clip to CA, they are missing - include_missing keeps
+	# them at the end of the path so that zones draining to the same missing huc still meet
+	path_list.extend(zones_downstream.path(zone, include_missing=True))
 
 
-def find_upstream(watershed, all_watersheds, dams_flag=False):
+def find_upstream(watershed, all_watersheds, dams_flag=False, network=None):
+	"""
+		Returns the list of every watershed upstream of watershed, and stores it on the watershed's upstream attribute
+	:param watershed: HUC_12 id
+	:param all_watersheds: dictionary of HUC_12 id -> watershed objects
+	:param dams_flag: when True, watersheds with dams are included, but nothing upstream of them is
+	:param network: a huc_network.HUCNetwork for all_watersheds. Pass one in when calling this repeatedly - otherwise
+		it's built on each call
+	:return: list of HUC_12 ids
+	"""
 	if len(all_watersheds[watershed].upstream) > 0:  # if we've already run for this watershed
 		return all_watersheds[watershed].upstream
 
 	if dams_flag and all_watersheds[watershed].has_dam:
 		return []  # if this is a dam and we're account for that, return nothing upstream - can't go further
 
-	all_us = []
-	for wat in all_watersheds:
-		if all_watersheds[wat].downstream == watershed:
-			us = find_upstream(wat, all_watersheds, dams_flag)
-			all_us.append(wat)
-			all_us += us
+	if network is None:
+		network = huc_network.HUCNetwork((wat, all_watersheds[wat].downstream) for wat in all_watersheds)
+
+	stop_at = [wat for wat in all_watersheds if all_watersheds[wat].has_dam] if dams_flag else None
+	all_us = network.upstream(watershed, stop_at=stop_at)
 
 	all_watersheds[watershed].upstream = all_us
 	return all_us
@@ -1077,6 +1081,9 @@ def get_diversity_into_network(dams_flag, db_cursor, native_flag, qc_flag, upstr
 
 	log.info("Getting upstream hucs - this may take some time")
 
+	if upstream_flag == "trace":
+		network = huc_network.HUCNetwork((l_wat, all_watersheds[l_wat].downstream) for l_wat in all_watersheds)
+
 	for l_wat in all_watersheds.keys():
 		if upstream_flag == "simple":
 			try:
@@ -1086,7 +1093,7 @@ def get_diversity_into_network(dams_flag, db_cursor, native_flag, qc_flag, upstr
 				pass  # it just doesn't exist
 		elif upstream_flag == "trace":
 			# the following function has a return value...untested code...
-			all_watersheds[all_watersheds[l_wat].downstream].upstream += find_upstream(l_wat, all_watersheds, dams_flag)
+			all_watersheds[all_watersheds[l_wat].downstream].upstream += find_upstream(l_wat, all_watersheds, dams_flag, network)
 
 	if dams_flag:
 		log.info("getting dam information")
@@ -1098,59 +1105,12 @@ def get_diversity_into_network(dams_flag, db_cursor, native_flag, qc_flag, upstr
 			all_watersheds[lz.Zone].has_dam = True
 		del results
 
-	non_native_query = """
-		SELECT DISTINCT species_id
-		FROM observations
-		WHERE presence_type IN (%s)
-		  AND zone_id = ?
-	 """ % (local_vars.current_obs_types)
-	native_query = """SELECT DISTINCT observations.species_id
-					FROM observations,
-						 species,
-						 species_groups
-					WHERE observations.zone_id = ?
-						AND species_groups.group_id = 1
-						AND species_groups.fid = species.fid
-					  AND observations.presence_type IN (%s)
-					  AND species.FID = Observations.Species_ID
-					  AND species.Native = %s""" % (local_vars.current_obs_types, local_vars.db_true)
-	qc_ext = "and observations.objectid = observation_collections.observation_id and observation_collections.collection_id in (%s)" % local_vars.hq_collections
-	non_native_qc_query = """SELECT DISTINCT species_id
-							FROM observations,
-								 observation_collections
-							WHERE presence_type IN (%s)
-							  AND zone_id = ? %s""" % (
-		local_vars.current_obs_types, qc_ext)
-	native_qc_query = """SELECT DISTINCT observations.species_id
-						FROM observations,
-							 species,
-							 observation_collections,
-							 species_groups
-						WHERE observations.zone_id = ?
-							AND species_groups.group_id = 1
-							AND species_groups.fid = species.fid
-							AND observations.presence_type IN (%s)
-							AND species.fid = observations.species_id
-							AND species.native = %s %s""" % (local_vars.current_obs_types, local_vars.db_true, qc_ext)
-
 	log.info("getting assemblage information")
-	# get the assemblage data
-	if native_flag:
-		if qc_flag:
-			query = native_qc_query
-		else:
-			query = native_query
-	else:
-		if qc_flag:
-			query = non_native_qc_query
-		else:
-			query = non_native_query
-
+	# get the assemblage data for every zone at once
+	assemblages = beta_diversity.load_assemblages(db_cursor, local_vars.current_obs_types, native_flag, qc_flag,
+												  local_vars.hq_collections, local_vars.db_true)
 	for l_wat in all_watersheds.keys():
-		results = db_cursor.execute(query, l_wat)
-
-		for species in results:  # add all the species to the assemblage
-			all_watersheds[l_wat].assemblage.append(species.species_id)
+		all_watersheds[l_wat].assemblage = assemblages.get(l_wat, [])
 
 	return all_watersheds
 
@@ -1203,27 +1163,30 @@ def diversity(zones_layer, db_cursor, args, map_layer):
 	log.info("calculating diversity")
 	# calculate the diversity
 
-	diversity_func = globals()[div_func]
+	if div_func in ("diversity_jaccard", "diversity_count"):
+		_diversity_by_matrix(all_watersheds, div_func)
+	else:
+		diversity_func = globals()[div_func]
 
-	for l_wat in all_watersheds.keys():
-		all_watersheds[l_wat].beta_div = diversity_func(all_watersheds[l_wat], all_watersheds)
+		for l_wat in all_watersheds.keys():
+			all_watersheds[l_wat].beta_div = diversity_func(all_watersheds[l_wat], all_watersheds)
 
 	log.info("updating data")
 
 	if dams_flag and native_flag:
-		sql = "UPDATE zones_aux SET beta_div_nat_cur = ? WHERE zone = ?"
+		aux_column = "beta_div_nat_cur"
 		layer_name = "div_native_dams"
 		assemblage_field_name = "assemblage_native_dams"
 	elif native_flag:
-		sql = "UPDATE zones_aux SET beta_div_nat_hist = ? WHERE zone = ?"
+		aux_column = "beta_div_nat_hist"
 		layer_name = "div_native"
 		assemblage_field_name = "assemblage_native"
 	elif dams_flag:
-		sql = "UPDATE zones_aux SET beta_div_nn_cur = ? WHERE zone = ?"
+		aux_column = "beta_div_nn_cur"
 		layer_name = "div_all_dams"
 		assemblage_field_name = "assemblage_all_dams"
 	else:
-		sql = "UPDATE zones_aux SET beta_div_nn_hist = ? WHERE zone = ?"
+		aux_column = "beta_div_nn_hist"
 		layer_name = "div_all"
 		assemblage_field_name = "assemblage_all"
 
@@ -1231,8 +1194,7 @@ def diversity(zones_layer, db_cursor, args, map_layer):
 		layer_name = "%s_qc" % layer_name
 		assemblage_field_name = "%s_qc" % assemblage_field_name
 
-	for l_wat in all_watersheds.keys():
-		db_cursor.execute(sql, all_watersheds[l_wat].beta_div, l_wat)
+	beta_diversity.write_zones_aux(db_cursor, aux_column, dict((l_wat, all_watersheds[l_wat].beta_div) for l_wat in all_watersheds))
 
 	new_layer = arcpy.CreateUniqueName(layer_name, local_vars.workspace)
 	layer_name = os.path.split(new_layer)[1]
@@ -1264,6 +1226,33 @@ def diversity(zones_layer, db_cursor, args, map_layer):
 	return zones_layer
 
 
+def _diversity_by_matrix(all_watersheds, div_func):
+	"""
+		Sets beta_div on every watershed using a zone x species matrix (see callbacks.beta_diversity). Gives the same
+		values as running diversity_jaccard or diversity_count on each watershed.
+	"""
+	zones = list(all_watersheds.keys())
+	presence = beta_diversity.PresenceMatrix(zones, dict((l_wat, all_watersheds[l_wat].assemblage) for l_wat in zones))
+
+	connected = {}
+	for l_wat in zones:
+		connected[l_wat] = list(all_watersheds[l_wat].upstream)
+		if all_watersheds[l_wat].downstream not in network_end_hucs and all_watersheds[l_wat].downstream in all_watersheds:
+			connected[l_wat].append(all_watersheds[l_wat].downstream)
+
+	if div_func == "diversity_jaccard":
+		values = presence.jaccard_dissimilarity(connected)
+	else:
+		values = presence.count_dissimilarity(connected)
+
+	for index, l_wat in enumerate(zones):
+		downstream = all_watersheds[l_wat].downstream
+		if div_func == "diversity_count" and (downstream in network_end_hucs or downstream not in all_watersheds):
+			all_watersheds[l_wat].beta_div = 0  # diversity_count only counts watersheds with a downstream watershed
+		else:
+			all_watersheds[l_wat].beta_div = values[index].item()
+
+
 def diversity_assemblage_to_cname(assemblage):
 	output_assemblage = []
 	for species in assemblage:
@@ -0,0 +1,96 @@
+"""
+	Set-based execution of the per-zone queries used by postprocess_zones. Instead of executing a query once per zone
+	from Python, the zone IDs are loaded into a temporary table and each query is run once as a correlated subquery
+	against it, so the database does the per-zone work in a single statement.
+
+	Nothing in here uses arcpy - the functions take any DB-API cursor (pyodbc in PISCES, or the sqlite3 module) and a
+	list of zone IDs, so the SQL side can be run and benchmarked on its own.
+"""
+
+from __future__ import absolute_import, division, print_function
+
+import logging
+
+log = logging.getLogger("PISCES.callbacks")
+
+zones_table = "pisces_batch_zones"
+
+
+def load_zones_table(db_cursor, zones):
+	"""
+		Creates (or recreates) the temporary table of zone IDs on the cursor's connection. Temporary tables are
+		private to the connection, so concurrent map builds don't see each other's zones.
+	:param db_cursor: DB-API cursor
+	:param zones: iterable of zone IDs. None values and duplicates are dropped
+	:return: list of the distinct zone IDs loaded
+	"""
+	distinct_zones = sorted(set(zone for zone in zones if zone is not None))
+
+	db_cursor.execute("DROP TABLE IF EXISTS temp.{}".format(zones_table))
+	db_cursor.execute("CREATE TEMP TABLE {} (zone_id TEXT PRIMARY KEY)".format(zones_table))
+	if distinct_zones:
+		db_cursor.executemany("INSERT INTO temp.{} (zone_id) VALUES (?)".format(zones_table), [(zone,) for zone in distinct_zones])
+
+	return distinct_zones
+
+
+def drop_zones_table(db_cursor):
+	db_cursor.execute("DROP TABLE IF EXISTS temp.{}".format(zones_table))
+
+
+def correlate_query(query):
+	"""
+		Turns a postprocess_zones query, which takes the zone as its only bind variable, into a single query that
+		returns (zone_id, col_value) for every zone in the temporary zones table.
+
+		The zone query becomes a scalar subquery, so like the fetchone() in the per-zone path, only the first row's
+		value is used, and zones with no result get NULL.
+	:param query: SQL with exactly one "?" where the zone ID goes
+	:return: SQL string
+	"""
+	query = str(query).strip().rstrip(";")
+	if query.count("?") != 1:
+		raise ValueError("Can only batch queries with exactly one bind variable for the zone - query has {}".format(query.count("?")))
+
+	correlated = query.replace("?", "{}.zone_id".format(zones_table))
+	return "SELECT {0}.zone_id AS zone_id, ({1}) AS col_value FROM temp.{0}".format(zones_table, correlated)
+
+
+def get_zone_values(db_cursor, query, zones=None):
+	"""
+		Runs a per-zone query for all zones at once.
+	:param db_cursor: DB-API cursor
+	:param query: SQL with exactly one "?" for the zone ID that selects a column named col_value
+	:param zones: zone IDs to run the query for. If None, uses the zones already loaded with load_zones_table
+	:return: dict of zone ID -> col_value
+	"""
+	if zones is not None:
+		load_zones_table(db_cursor, zones)
+
+	results = db_cursor.execute(correlate_query(query)).fetchall()
+	return dict((row[0], row[1]) for row in results)
+
+
+def get_zone_values_for_queries(db_cursor, queries, zones):
+	"""
+		Runs a set of per-zone queries for all zones, loading the zones table once. Any query that can't be batched
+		(wrong number of bind variables, or SQL the correlated form rejects) is left out of the results so that the
+		caller can fall back to running it per zone.
+	:param db_cursor: DB-API cursor
+	:param queries: list of SQL strings
+	:param zones: list of zone IDs
+	:return: dict keyed by query with values of dicts of zone ID -> col_value
+	"""
+	load_zones_table(db_cursor, zones)
+
+	results = {}
+	try:
+		for query in queries:
+			try:
+				results[query] = get_zone_values(db_cursor, query)
+			except Exception as e:
+				log.warning("Unable to run query as a batch - will run it per zone instead. Error was: {}".format(e))
+	finally:
+		drop_zones_table(db_cursor)
+
+	return results
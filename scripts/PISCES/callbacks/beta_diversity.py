@@ -0,0 +1,154 @@
+"""
+	Beta diversity with matrix operations. Assemblages for every zone are loaded with a single query into a zone x species
+	boolean matrix, and the dissimilarity between each zone and the zones connected to it (upstream, downstream, or
+	both) is computed for all zones at once instead of comparing sets watershed by watershed.
+
+	The connected zones for each zone are given as lists, which are flattened into the same compressed sparse row form
+	used by huc_network, so unions over connected zones are a single numpy reduceat. Nothing here uses arcpy.
+"""
+
+from __future__ import absolute_import, division, print_function
+
+import logging
+
+import numpy
+
+log = logging.getLogger("PISCES.callbacks")
+
+
+class PresenceMatrix(object):
+	"""
+		Zone x species presence. Rows are zones in the order given, columns are species in sorted order.
+	"""
+
+	def __init__(self, zones, assemblages):
+		"""
+		:param zones: list of zone ids - one row each
+		:param assemblages: dict of zone id -> iterable of species codes. Zones missing from it have no species
+		"""
+		self.zones = list(zones)
+		self.zone_index = dict((zone, index) for index, zone in enumerate(self.zones))
+
+		species = set()
+		for zone in self.zones:
+			species.update(assemblages.get(zone, ()))
+		self.species = sorted(species)
+		species_index = dict((fid, index) for index, fid in enumerate(self.species))
+
+		self.matrix = numpy.zeros((len(self.zones), len(self.species)), dtype=bool)
+		for row, zone in enumerate(self.zones):
+			columns = [species_index[fid] for fid in assemblages.get(zone, ())]
+			self.matrix[row, columns] = True
+
+	def assemblage(self, zone):
+		"""
+			Returns the list of species codes present in a zone
+		"""
+		return [self.species[column] for column in numpy.nonzero(self.matrix[self.zone_index[zone]])[0]]
+
+	def connected_indices(self, connected_zones):
+		"""
+			Flattens lists of connected zones into CSR arrays of row indices. Connected zones that aren't rows of the
+			matrix are dropped, the same way the set based functions skip zones they can't find.
+		:param connected_zones: dict of zone id -> list of connected zone ids
+		:return: tuple of (indptr, indices) numpy arrays
+		"""
+		indptr = numpy.zeros(len(self.zones) + 1, dtype=numpy.int64)
+		indices = []
+		for row, zone in enumerate(self.zones):
+			rows = [self.zone_index[other] for other in connected_zones.get(zone, ()) if other in self.zone_index]
+			indices.extend(rows)
+			indptr[row + 1] = indptr[row] + len(rows)
+		return indptr, numpy.array(indices, dtype=numpy.int64)
+
+	def connected_union(self, connected_zones):
+		"""
+			For each zone, the union of the assemblages of its connected zones
+		:param connected_zones: dict of zone id -> list of connected zone ids
+		:return: boolean matrix the same shape as self.matrix
+		"""
+		indptr, indices = self.connected_indices(connected_zones)
+		union = numpy.zeros(self.matrix.shape, dtype=bool)
+		if len(indices) == 0:
+			return union
+
+		has_connections = numpy.diff(indptr) > 0
+		reduced = numpy.logical_or.reduceat(self.matrix[indices], indptr[:-1][has_connections], axis=0)
+		union[has_connections] = reduced
+		return union
+
+	def jaccard_dissimilarity(self, connected_zones):
+		"""
+			1 - |intersection| / |union| of each zone's assemblage and the combined assemblage of its connected zones.
+			Zones where both are empty get 0.
+		:param connected_zones: dict of zone id -> list of connected zone ids
+		:return: numpy array of floats aligned with self.zones
+		"""
+		connected = self.connected_union(connected_zones)
+		intersection = numpy.logical_and(self.matrix, connected).sum(axis=1)
+		union = numpy.logical_or(self.matrix, connected).sum(axis=1)
+
+		dissimilarity = numpy.zeros(len(self.zones), dtype=numpy.float64)
+		nonzero = union > 0
+		dissimilarity[nonzero] = 1 - intersection[nonzero] / union[nonzero]
+		return dissimilarity
+
+	def count_dissimilarity(self, connected_zones):
+		"""
+			For each zone, the number of (species, connected zone) pairs where a species in the zone is missing from
+			the connected zone
+		:param connected_zones: dict of zone id -> list of connected zone ids
+		:return: numpy array of ints aligned with self.zones
+		"""
+		indptr, indices = self.connected_indices(connected_zones)
+		rows = numpy.repeat(numpy.arange(len(self.zones)), numpy.diff(indptr))
+		missing = numpy.logical_and(self.matrix[rows], numpy.logical_not(self.matrix[indices])).sum(axis=1)
+
+		counts = numpy.zeros(len(self.zones), dtype=numpy.int64)
+		numpy.add.at(counts, rows, missing)
+		return counts
+
+
+def load_assemblages(db_cursor, presence_types, native_flag=False, qc_flag=False, hq_collections=None, db_true=1):
+	"""
+		Loads the distinct species in every zone with one query. Equivalent to the per-watershed queries in
+		callbacks.get_diversity_into_network.
+	:param db_cursor: DB-API cursor
+	:param presence_types: comma separated string of presence types
+	:param native_flag: only native fish (species group 1)
+	:param qc_flag: only observations in hq_collections
+	:param hq_collections: comma separated string of collection ids - required when qc_flag is True
+	:param db_true: the database's value for True
+	:return: dict of zone id -> list of species codes
+	"""
+	tables = ["observations"]
+	conditions = ["observations.presence_type IN (%s)" % presence_types]
+	if native_flag:
+		tables += ["species", "species_groups"]
+		conditions += ["species_groups.group_id = 1",
+					   "species_groups.fid = species.fid",
+					   "species.fid = observations.species_id",
+					   "species.native = %s" % db_true]
+	if qc_flag:
+		tables.append("observation_collections")
+		conditions += ["observations.objectid = observation_collections.observation_id",
+					   "observation_collections.collection_id IN (%s)" % hq_collections]
+
+	query = "SELECT DISTINCT observations.zone_id, observations.species_id FROM {} WHERE {}".format(", ".join(tables), " AND ".join(conditions))
+
+	assemblages = {}
+	for row in db_cursor.execute(query).fetchall():
+		if row[0] not in assemblages:
+			assemblages[row[0]] = []
+		assemblages[row[0]].append(row[1])
+	return assemblages
+
+
+def write_zones_aux(db_cursor, column, values):
+	"""
+		Writes values to a zones_aux column with a single executemany
+	:param db_cursor: DB-API cursor
+	:param column: zones_aux column name
+	:param values: dict of zone id -> value
+	"""
+	db_cursor.executemany("UPDATE zones_aux SET {} = ? WHERE zone = ?".format(column), [(value, zone) for zone, value in values.items()])
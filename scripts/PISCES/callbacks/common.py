@@ -10,7 +10,8 @@ from .. import funcs
 from .. import local_vars
 
 from ..funcs import isiterable
-from ..code_library_data_files import write_column_by_key, generate_gdb_filename
+from ..code_library_data_files import write_column_by_key, write_columns_by_key, generate_gdb_filename
+from . import batch
 
 log = logging.getLogger("PISCES.callbacks")
 
@@ -113,6 +114,8 @@ def postprocess_zones(zones_layer, db_cursor, cb_args, parent_layer):
 		Flexible:{object path from parent layer being worked on} - example {custom_query.bind_var} would return parent_layer.custom_query.bind_var and dump it into the query at that location
 		Argument Format: query,column_name,column_data_type,query,column_name,column_data_type,query...etc
 		Notes: the value to be placed in the column for a given query should be selected "AS col_value" - that's what the following code will be looking to retrieve
+		When local_vars.postprocess_zones_batch is True, plain SQL queries are run once for all zones (see callbacks.batch)
+		and only function_args are run zone by zone.
 	'''
 
 	arcpy.env.overwriteOutput = True
@@ -126,6 +129,65 @@ def postprocess_zones(zones_layer, db_cursor, cb_args, parent_layer):
 
 	l_queries = split_postprocess_cbargs(cb_args, l_temp_file, parent_layer)
 
+	if local_vars.postprocess_zones_batch:
+		l_queries = _postprocess_zones_batch(l_temp_file, db_cursor, l_queries)  # returns the queries it couldn't run as a batch
+
+	if len(l_queries) > 0:
+		_postprocess_zones_by_row(l_temp_file, zones_layer, db_cursor, l_queries, cb_args, parent_layer)
+
+	arcpy.env.overwriteOutput = False
+
+	arcpy.Delete_management(zones_layer)  # kill the previous version
+	arcpy.MakeFeatureLayer_management(l_temp_file, zones_layer)  # and read in the new one
+
+	# return it
+	return zones_layer
+
+
+def _postprocess_zones_batch(l_temp_file, db_cursor, l_queries):
+	"""
+		Runs the plain SQL queries for postprocess_zones as one set-based query each (see callbacks.batch), then writes
+		all of their columns in a single cursor pass. Function arguments and any query that can't be batched are
+		returned so that they can be run row by row.
+	:param l_temp_file: the layer being postprocessed
+	:param db_cursor:
+	:param l_queries: query objects from split_postprocess_cbargs
+	:return: list of query objects that still need to be run for each row
+	"""
+
+	sql_queries = [str(l_query.query) for l_query in l_queries if not l_query.run_function]
+	if len(sql_queries) == 0:
+		return l_queries
+
+	zones = []
+	reader = arcpy.SearchCursor(l_temp_file)
+	for row in reader:
+		zones.append(row.getValue(local_vars.huc_field))
+	del reader
+
+	batch_results = batch.get_zone_values_for_queries(db_cursor, sql_queries, zones)
+
+	results_by_field = {}
+	remaining_queries = []
+	for l_query in l_queries:
+		if l_query.run_function or str(l_query.query) not in batch_results:
+			remaining_queries.append(l_query)
+			continue
+
+		zone_values = batch_results[str(l_query.query)]
+		results_by_field[l_query.column] = dict((zone, coerce_value_from_arc_type(zone_values[zone], l_query.col_type)) for zone in zone_values)
+
+	if results_by_field:
+		write_columns_by_key(l_temp_file, local_vars.huc_field, results_by_field)
+
+	return remaining_queries
+
+
+def _postprocess_zones_by_row(l_temp_file, zones_layer, db_cursor, l_queries, cb_args, parent_layer):
+	"""
+		The original postprocess_zones path - runs each query once per zone in the layer
+	"""
+
 	rows = arcpy.UpdateCursor(l_temp_file)
 
 	# for each row
@@ -157,15 +219,7 @@ def postprocess_zones(zones_layer, db_cursor, cb_args, parent_layer):
 
 		rows.updateRow(row)  # save it!
 
-	del row
 	del rows  # cleanup
-	arcpy.env.overwriteOutput = False
-
-	arcpy.Delete_management(zones_layer)  # kill the previous version
-	arcpy.MakeFeatureLayer_management(l_temp_file, zones_layer)  # and read in the new one
-
-	# return it
-	return zones_layer
 
 
 def stringify(in_list, delimiter=", "):
@@ -0,0 +1,280 @@
+"""
+	Single-pass computation of the metrics produced by mega_diversity_info. All presence information needed is loaded
+	with a few queries into an AssemblageData object, then every richness, sensitivity, loss/gain, beta diversity, and
+	downstream metric is computed in memory for all zones. The callback then writes every column in one cursor pass.
+
+	Definitions mirror the SQL used by the multi-pass version in callbacks.mega_diversity_info - see the docstring
+	there for what each field means. Nothing here uses arcpy, so the computation can be run against any DB-API cursor.
+"""
+
+from __future__ import absolute_import, division, print_function
+
+import logging
+
+from . import beta_diversity
+
+log = logging.getLogger("PISCES.callbacks")
+
+TEXT_LENGTH = 10000  # length postprocess_zones gives text fields
+LONG_TEXT_LENGTH = 65535  # length richness_difference gives text fields
+
+
+def parse_types(types_string):
+	"""
+		Turns a comma separated string of ids (like local_vars.current_obs_types) into a frozenset of ints
+	"""
+	if isinstance(types_string, (list, tuple, set, frozenset)):
+		return frozenset(int(item) for item in types_string)
+	return frozenset(int(item) for item in str(types_string).split(",") if item.strip() != "")
+
+
+class AssemblageData(object):
+	"""
+		Presence records for every zone, aggregated to (species, presence type) with the number of observation rows
+		and of high quality observation/collection rows behind each. The counts are kept because the sensitivity
+		averages in the SQL version are taken over joined rows, not over distinct species.
+	"""
+
+	def __init__(self, db_cursor, hq_collections, group_names=("Native_Fish", "Fish"), db_true=1, db_false=0):
+		self.records = {}  # zone_id -> list of (species_id, presence_type, observation_count, qc_count)
+
+		self.fish = set()  # members of species group 1 - what most of the queries treat as fish
+		self.native = set()  # species.native == db_true
+		self.nonnative = set()  # species.native == db_false
+		self.native_fish_view = set()  # members of the native_fish view
+		self.averages = {}  # fid -> species_aux.average, only for species with a species_aux record
+		self.common_names = {}
+		self.groups = {}  # group name -> set of fids
+
+		self._load(db_cursor, hq_collections, group_names, db_true, db_false)
+
+	def _load(self, db_cursor, hq_collections, group_names, db_true, db_false):
+		log.info("Loading assemblages for all zones")
+
+		results = db_cursor.execute("""SELECT observations.zone_id,
+											observations.species_id,
+											observations.presence_type,
+											count(*) AS observation_count,
+											sum(coalesce(qc.collection_count, 0)) AS qc_count
+										FROM observations
+										LEFT JOIN (SELECT observation_id, count(*) AS collection_count
+													FROM observation_collections
+													WHERE collection_id IN (%s)
+													GROUP BY observation_id) AS qc
+											ON observations.objectid = qc.observation_id
+										GROUP BY observations.zone_id, observations.species_id, observations.presence_type""" % hq_collections).fetchall()
+		for row in results:
+			if row[0] not in self.records:
+				self.records[row[0]] = []
+			self.records[row[0]].append((row[1], row[2], row[3], row[4]))
+
+		for row in db_cursor.execute("SELECT fid, native, common_name FROM species").fetchall():
+			if row[1] == db_true:
+				self.native.add(row[0])
+			elif row[1] == db_false:
+				self.nonnative.add(row[0])
+			self.common_names[row[0]] = row[2]
+
+		self.fish = set(row[0] for row in db_cursor.execute("SELECT fid FROM species_groups WHERE group_id = 1").fetchall())
+		self.native_fish_view = set(row[0] for row in db_cursor.execute("SELECT fid FROM native_fish").fetchall())
+
+		for row in db_cursor.execute("SELECT fid, average FROM species_aux").fetchall():
+			self.averages[row[0]] = row[1]
+
+		for group_name in group_names:
+			results = db_cursor.execute("""SELECT species_groups.fid
+											FROM species_groups, defs_species_groups
+											WHERE species_groups.group_id = defs_species_groups.id
+											AND defs_species_groups.group_name = ?""", (group_name,)).fetchall()
+			self.groups[group_name] = set(row[0] for row in results)
+
+	def species(self, zone, presence_types, qc=False, within=None):
+		"""
+			The distinct species in a zone with any of the presence types.
+		:param zone: zone id
+		:param presence_types: frozenset of presence type ids
+		:param qc: only count species with an observation in the high quality collections
+		:param within: optional set to intersect the result with
+		:return: set of species codes
+		"""
+		present = set()
+		for species_id, presence_type, observation_count, qc_count in self.records.get(zone, ()):
+			if presence_type in presence_types and (not qc or qc_count > 0):
+				present.add(species_id)
+
+		if within is not None:
+			present &= within
+		return present
+
+	def average_score(self, zone, presence_types, qc=False, low=None, high=None):
+		"""
+			Equivalent of the sensitivity_stats queries - the average species_aux.average over fish observation rows
+			in the zone (observation/collection rows when qc is True). Returns None when there's nothing to average.
+		"""
+		total = 0.0
+		weight = 0
+		for species_id, presence_type, observation_count, qc_count in self.records.get(zone, ()):
+			if presence_type not in presence_types or species_id not in self.fish or species_id not in self.averages:
+				continue
+
+			average = self.averages[species_id]
+			if average is None or (low is not None and average < low) or (high is not None and average > high):
+				continue
+
+			rows = qc_count if qc else observation_count
+			total += average * rows
+			weight += rows
+
+		if weight == 0:
+			return None
+		return total / weight
+
+	def common_name_list(self, species):
+		"""
+			Common names for a set of species, in species code order. Codes with no species record are logged and skipped
+			the same way diversity_assemblage_to_cname does.
+		"""
+		names = []
+		for fid in sorted(species):
+			if fid in self.common_names:
+				names.append(self.common_names[fid])
+			else:
+				log.error("Species in observations, but not recorded in species table - species code %s" % fid)
+		return names
+
+
+def _stringify(items, delimiter=", "):
+	# matches callbacks.common.stringify, which postprocess_zones uses for list values
+	return "".join("%s%s" % (item, delimiter) for item in items)
+
+
+def compute_mega_diversity(data, downstream, current_types, historic_types, run_non_qc=False,
+						   network_end_hucs=("CLOSED BASIN", "Mexico", "OCEAN")):
+	"""
+		Computes every mega_diversity_info column for every zone.
+	:param data: AssemblageData
+	:param downstream: dict of zone id -> downstream zone id for every zone in the layer
+	:param current_types: frozenset of current presence types
+	:param historic_types: frozenset of historic presence types
+	:param run_non_qc: also compute the columns that don't restrict to high quality collections
+	:param network_end_hucs: values of HU_12_DS that mark the end of the network
+	:return: tuple of (fields, values, beta_values). fields is an ordered list of (field name, field type, length),
+		values is a dict of field name -> dict of zone id -> value, and beta_values is a dict of zones_aux column
+		name -> dict of zone id -> value
+	"""
+
+	zones = sorted(zone for zone in downstream if zone is not None)
+	fields = []
+	values = {}
+
+	def add(field_name, field_type, zone_values, length=None):
+		fields.append((field_name, field_type, length))
+		values[field_name] = zone_values
+
+	fish_native = data.fish & data.native
+	fish_nonnative = data.fish & data.nonnative
+
+	# -------- BASIC RICHNESS --------
+	richness_definitions = [
+		("native_richness", data.native_fish_view, False, current_types, True),
+		("native_qc_richness", data.native_fish_view, True, current_types, False),
+		("native_qc_historic_richness", fish_native, True, historic_types, False),
+		("nonnative_richness", fish_nonnative, False, current_types, True),
+		("nonnative_qc_richness", fish_nonnative, True, current_types, False),
+		("all_richness", data.fish, False, current_types, True),
+		("all_qc_richness", data.fish, True, current_types, False),
+	]
+	for field_name, within, qc, presence_types, non_qc_only in richness_definitions:
+		if non_qc_only and not run_non_qc:
+			continue
+		add(field_name, "LONG", dict((zone, len(data.species(zone, presence_types, qc, within))) for zone in zones))
+
+	sensitive = set(fid for fid in fish_native if data.averages.get(fid) is not None and 0 < data.averages[fid] < 3.01)
+	if run_non_qc:
+		add("sens_nat_rich", "LONG", dict((zone, len(data.species(zone, current_types, False, sensitive))) for zone in zones))
+	add("sens_nat_qc_rich", "LONG", dict((zone, len(data.species(zone, current_types, True, sensitive))) for zone in zones))
+
+	add("sens_nat_assem", "TEXT", dict((zone, str(data.common_name_list(data.species(zone, current_types, False, sensitive)))) for zone in zones), TEXT_LENGTH)
+	add("sens_nat_qc_assem", "TEXT", dict((zone, str(data.common_name_list(data.species(zone, current_types, True, sensitive)))) for zone in zones), TEXT_LENGTH)
+
+	# -------- SENSITIVITY STATS --------
+	qc_options = [True, False] if run_non_qc else [True]
+	for qc in qc_options:
+		qc_insert = "qc_" if qc else ""
+		for suffix, high in (("score", None), ("under3", 3), ("under2", 2), ("under1", 1)):
+			low = None if high is None else 0
+			add("avg_%ssensitivity_%s" % (qc_insert, suffix), "DOUBLE",
+				dict((zone, data.average_score(zone, current_types, qc, low, high)) for zone in zones))
+
+	# -------- LOSSES AND EXTIRPATIONS --------
+	for group_name in ("Native_Fish", "Fish"):
+		group = data.groups.get(group_name, set())
+		current = dict((zone, data.species(zone, current_types, True, group)) for zone in zones)
+		historic = dict((zone, data.species(zone, historic_types, True, group)) for zone in zones)
+		has_data = [zone for zone in zones if current[zone] or historic[zone]]  # the SQL version only fills assemblages for zones with results
+
+		add("current_richness_{}".format(group_name), "LONG", dict((zone, len(current[zone])) for zone in zones))
+		add("historic_richness_{}".format(group_name), "LONG", dict((zone, len(historic[zone])) for zone in zones))
+		add("losses_{}".format(group_name), "LONG", dict((zone, len(historic[zone] - current[zone])) for zone in has_data))
+		add("gains_{}".format(group_name), "LONG", dict((zone, len(current[zone] - historic[zone])) for zone in has_data))
+		add("current_assemblage_{}".format(group_name), "TEXT", dict((zone, ", ".join(data.common_name_list(current[zone]))) for zone in has_data), LONG_TEXT_LENGTH)
+		add("historic_assemblage_{}".format(group_name), "TEXT", dict((zone, ", ".join(data.common_name_list(historic[zone]))) for zone in has_data), LONG_TEXT_LENGTH)
+		add("losses_list_{}".format(group_name), "TEXT", dict((zone, ", ".join(data.common_name_list(historic[zone] - current[zone]))) for zone in has_data), LONG_TEXT_LENGTH)
+		add("gains_list_{}".format(group_name), "TEXT", dict((zone, ", ".join(data.common_name_list(current[zone] - historic[zone]))) for zone in has_data), LONG_TEXT_LENGTH)
+		add("richness_difference_{}".format(group_name), "LONG", dict((zone, len(current[zone]) - len(historic[zone])) for zone in zones))
+
+	# -------- JACCARD DISTANCES --------
+	connected = dict((zone, []) for zone in zones)
+	for zone in zones:  # the "simple" upstream option - only directly upstream zones, plus the downstream zone
+		if downstream[zone] in connected and downstream[zone] not in network_end_hucs:
+			connected[downstream[zone]].append(zone)
+			connected[zone].append(downstream[zone])
+
+	beta_values = {}
+	assemblages = {}
+	diversity_definitions = [
+		("native", fish_native, True),
+		("native", fish_native, False),
+		("all", None, True),
+		("all", None, False),
+	]
+	for name, within, qc in diversity_definitions:
+		if not qc and not run_non_qc:
+			continue
+
+		assemblages = dict((zone, data.species(zone, current_types, qc, within)) for zone in zones)
+		beta = dict(zip(zones, beta_diversity.PresenceMatrix(zones, assemblages).jaccard_dissimilarity(connected).tolist()))
+
+		qc_suffix = "_qc" if qc else ""
+		add("div_{}{}".format(name, qc_suffix), "DOUBLE", beta)
+		add("assemblage_{}{}".format(name, qc_suffix), "TEXT", dict((zone, str(data.common_name_list(assemblages[zone]))) for zone in zones), TEXT_LENGTH)
+
+		# later runs overwrite earlier ones in zones_aux, same as calling diversity repeatedly
+		beta_values["beta_div_nat_hist" if name == "native" else "beta_div_nn_hist"] = beta
+
+	# -------- DOWNSTREAM INFO --------
+	native_qc_assemblages = dict((zone, data.species(zone, current_types, True, fish_native)) for zone in zones)
+	downstream_assemblage = {}
+	downstream_count = {}
+	for zone in zones:
+		if downstream[zone] in native_qc_assemblages:
+			downstream_species = native_qc_assemblages[downstream[zone]]
+			downstream_assemblage[zone] = _stringify(data.common_name_list(downstream_species))
+			downstream_count[zone] = float(len(downstream_species))
+		else:
+			downstream_assemblage[zone] = ""
+			downstream_count[zone] = 0.0
+	add("downstream_assemblage", "TEXT", downstream_assemblage, TEXT_LENGTH)
+	add("downstream_count", "DOUBLE", downstream_count)
+
+	return fields, values, beta_values
+
+
+def write_beta_diversity(db_cursor, beta_values):
+	"""
+		Writes beta diversity values to zones_aux with one executemany per column
+	:param db_cursor: DB-API cursor
+	:param beta_values: dict of zones_aux column -> dict of zone id -> value, as returned by compute_mega_diversity
+	"""
+	for column in beta_values:
+		beta_diversity.write_zones_aux(db_cursor, column, beta_values[column])
@@ -0,0 +1,460 @@
+"""
+	Clustering of zones by their species assemblages without arcpy, for tbx_make_clusters. Zones are clustered directly
+	from the presence matrix in memory - the matrix and the distances between zones are computed once per region and
+	reused for every number of groups, and the group sizes can run in parallel worker processes.
+
+	Without a spatial constraint, zones are clustered with k-medoids on the Jaccard distance between their assemblages.
+	With a contiguity constraint, zones are grouped like the SKATER method ArcGIS's Grouping Analysis uses - a minimum
+	spanning tree is built over adjacent zones, weighted by Jaccard distance, and the tree edge whose removal most
+	reduces the within-group sum of squared deviations (on standardized presence values) is cut until there are enough
+	groups. Zone adjacency is computed once from the zone polygons by build_zone_adjacency and stored in the
+	zone_adjacency table.
+
+	Each clustering is summarized with the same statistics Grouping Analysis reports - the Calinski-Harabasz pseudo
+	F-statistic, used to choose the number of groups, and the R-squared of each field.
+"""
+
+from __future__ import absolute_import, division, print_function
+
+import collections
+import heapq
+import multiprocessing
+
+import numpy
+
+from . import local_vars
+from . import log
+
+adjacency_table = "zone_adjacency"
+
+spatial_constraints = ("NO_SPATIAL_CONSTRAINT", "CONTIGUITY_EDGES_ONLY", "CONTIGUITY_EDGES_CORNERS")
+initialization_methods = ("FIND_SEED_LOCATIONS", "USE_RANDOM_SEEDS")
+
+_worker_clusterer = None  # Clusterer for pool worker processes, set by _initialize_worker
+
+
+def _shared_pairs(keys, zone_ids):
+	"""
+		Finds the pairs of zones that share a key (a rounded vertex or segment)
+	:param keys: integer array with a row for each key
+	:param zone_ids: the zone each key row belongs to
+	:return: integer array of (zone, zone) pairs, each pair once with the lower zone first
+	"""
+	rows = numpy.unique(numpy.column_stack([keys, zone_ids]), axis=0)  # sorted, so rows with the same key are consecutive
+	keys = rows[:, :-1]
+	zones = rows[:, -1]
+
+	pairs = [numpy.zeros((0, 2), dtype=rows.dtype)]
+	offset = 1
+	while offset < len(rows):
+		same = (keys[offset:] == keys[:-offset]).all(axis=1)
+		if not same.any():  # runs of the same key are consecutive, so no run is this long
+			break
+		pairs.append(numpy.column_stack([zones[:-offset][same], zones[offset:][same]]))
+		offset += 1
+
+	return numpy.unique(numpy.sort(numpy.vstack(pairs), axis=1), axis=0)
+
+
+def find_adjacency(zone_rings, precision=3):
+	"""
+		Finds which zones touch from their polygons. Zones that come from the same dataset share vertices along their
+		borders, so zones that share a vertex touch at least at a corner, and zones that share a segment share an edge.
+	:param zone_rings: list with the rings of each zone - as in spatial_join.ZoneIndex.rings
+	:param precision: decimal places vertices are rounded to before they're compared
+	:return: (corner pairs, edge pairs) - integer arrays of (zone, zone) positions in zone_rings. Edge pairs are also
+		corner pairs
+	"""
+	vertex_keys = []
+	vertex_zones = []
+	segment_keys = []
+	segment_zones = []
+	for zone, rings in enumerate(zone_rings):
+		for ring in rings:
+			vertices = numpy.round(numpy.asarray(ring, dtype=numpy.float64)[:, :2] * 10 ** precision).astype(numpy.int64)
+			if len(vertices) < 2:
+				continue
+			following = numpy.roll(vertices, -1, axis=0)
+			segments = numpy.hstack([vertices, following])
+			reversed_segments = numpy.hstack([following, vertices])
+			backwards = (segments[:, 0] > segments[:, 2]) | ((segments[:, 0] == segments[:, 2]) & (segments[:, 1] > segments[:, 3]))
+			segments[backwards] = reversed_segments[backwards]  # so neighbors, whose rings run the other way, get the same key
+			segments = segments[(segments[:, :2] != segments[:, 2:]).any(axis=1)]  # the closing vertex makes an empty segment
+
+			vertex_keys.append(vertices)
+			vertex_zones.append(numpy.full(len(vertices), zone, dtype=numpy.int64))
+			segment_keys.append(segments)
+			segment_zones.append(numpy.full(len(segments), zone, dtype=numpy.int64))
+
+	if not vertex_keys:
+		empty = numpy.zeros((0, 2), dtype=numpy.int64)
+		return empty, empty
+
+	corners = _shared_pairs(numpy.vstack(vertex_keys), numpy.concatenate(vertex_zones))
+	edges = _shared_pairs(numpy.vstack(segment_keys), numpy.concatenate(segment_zones))
+	return corners, edges
+
+
+def build_zone_adjacency(db_cursor, zone_index, id_field=local_vars.huc_field):
+	"""
+		Finds the zones that touch each other and stores them in the zone adjacency table, replacing what's there. Run
+		again whenever the zone polygons change. The caller commits.
+	:param db_cursor: DB-API cursor
+	:param zone_index: spatial_join.ZoneIndex of the zones - eg, from input_filters.common.load_zone_index
+	:param id_field: zone attribute with the HUC_12 ID
+	:return: number of pairs of zones that touch
+	"""
+	corners, edges = find_adjacency(zone_index.rings)
+	edge_pairs = set(map(tuple, edges.tolist()))
+	zone_ids = [attributes[id_field] for attributes in zone_index.attributes]
+
+	records = []
+	for zone, neighbor in corners.tolist():
+		shares_edge = int((zone, neighbor) in edge_pairs)
+		records.append((zone_ids[zone], zone_ids[neighbor], shares_edge))
+		records.append((zone_ids[neighbor], zone_ids[zone], shares_edge))
+
+	db_cursor.execute("DROP TABLE IF EXISTS {}".format(adjacency_table))
+	db_cursor.execute("CREATE TABLE {} (zone_id TEXT, neighbor_id TEXT, shares_edge INTEGER)".format(adjacency_table))
+	db_cursor.executemany("INSERT INTO {} (zone_id, neighbor_id, shares_edge) VALUES (?, ?, ?)".format(adjacency_table), records)
+	db_cursor.execute("CREATE INDEX {0}_zone ON {0} (zone_id)".format(adjacency_table))
+	log.write("Stored {} pairs of adjacent zones, {} sharing an edge".format(len(corners), len(edges)), True)
+	return len(corners)
+
+
+def load_zone_adjacency(db_cursor, zones, edges_only=False):
+	"""
+		Reads the neighbors of each zone from the zone adjacency table
+	:param db_cursor: DB-API cursor
+	:param zones: list of HUC_12 IDs
+	:param edges_only: only count zones that share an edge as neighbors, not zones that only touch at a corner
+	:return: list with the positions in zones of each zone's neighbors. Neighbors that aren't in zones are left out
+	"""
+	if db_cursor.execute("SELECT name FROM sqlite_master WHERE type = 'table' AND name = ?", (adjacency_table,)).fetchone() is None:
+		raise ValueError("Zone adjacency hasn't been computed - run tbx_make_clusters.build_zone_adjacency first")
+
+	positions = dict((zone, position) for position, zone in enumerate(zones))
+	neighbors = [[] for zone in zones]
+	query = "SELECT zone_id, neighbor_id FROM {}".format(adjacency_table)
+	if edges_only:
+		query += " WHERE shares_edge = 1"
+	for zone, neighbor in db_cursor.execute(query).fetchall():
+		if zone in positions and neighbor in positions:
+			neighbors[positions[zone]].append(positions[neighbor])
+	return neighbors
+
+
+def jaccard_distances(presence):
+	"""
+		Computes the Jaccard distance between the assemblages of every pair of zones - one minus the number of taxa
+		they share over the number in either. Zones without any taxa are a distance of 0 from each other.
+	:param presence: boolean array of zones x taxa
+	:return: float array of zones x zones
+	"""
+	presence = numpy.asarray(presence, dtype=numpy.float64)  # float so the product goes through BLAS
+	shared = presence.dot(presence.T)
+	counts = presence.sum(axis=1)
+	union = counts[:, None] + counts[None, :]
+	union -= shared
+
+	distances = numpy.ones_like(shared)
+	numpy.divide(shared, union, out=distances, where=union > 0)
+	numpy.subtract(1, distances, out=distances)
+	return distances
+
+
+def standardize(presence):
+	"""
+		Converts presence values to z-scores for each field, as Grouping Analysis does with its analysis fields
+	:param presence: boolean array of zones x fields
+	:return: (float array of zones x fields, boolean array of which fields vary). Fields that don't vary are left as 0
+	"""
+	values = numpy.asarray(presence, dtype=numpy.float64)
+	deviations = values - values.mean(axis=0)
+	spread = values.std(axis=0)
+	varies = spread > 0
+	deviations[:, varies] /= spread[varies]
+	deviations[:, ~varies] = 0
+	return deviations, varies
+
+
+def _seed_medoids(distances, num_groups, initialization_method, random_state):
+	"""
+		Chooses the starting medoids. FIND_SEED_LOCATIONS starts from the most central zone and adds the zone farthest
+		from the medoids chosen so far. USE_RANDOM_SEEDS picks zones at random, each weighted by its squared distance to
+		the closest medoid chosen so far (k-medoids++).
+	"""
+	if initialization_method == "FIND_SEED_LOCATIONS":
+		medoids = [int(distances.sum(axis=1).argmin())]
+	elif initialization_method == "USE_RANDOM_SEEDS":
+		random = numpy.random.RandomState(random_state)
+		medoids = [int(random.randint(len(distances)))]
+	else:
+		raise ValueError("Unknown initialization method {} - options are {}".format(initialization_method, ", ".join(initialization_methods)))
+
+	closest = distances[medoids[0]].copy()
+	while len(medoids) < num_groups:
+		if closest.max() == 0:
+			raise ValueError("Can't make {} groups - the zones only have {} distinct assemblages".format(num_groups, len(medoids)))
+		if initialization_method == "FIND_SEED_LOCATIONS":
+			medoid = int(closest.argmax())
+		else:
+			weights = closest ** 2
+			medoid = int(random.choice(len(distances), p=weights / weights.sum()))
+		medoids.append(medoid)
+		closest = numpy.minimum(closest, distances[medoid])
+
+	return numpy.array(medoids)
+
+
+def k_medoids(distances, num_groups, initialization_method="FIND_SEED_LOCATIONS", max_iterations=100, random_state=None):
+	"""
+		Clusters zones around medoids - the zone in each group with the smallest total distance to the others - by
+		alternately assigning zones to their closest medoid and moving each medoid to the center of its group
+	:param distances: float array of zones x zones
+	:param num_groups: number of groups to make
+	:param initialization_method: FIND_SEED_LOCATIONS or USE_RANDOM_SEEDS - see _seed_medoids
+	:param max_iterations: stop after this many rounds even if the medoids are still moving
+	:param random_state: seed for USE_RANDOM_SEEDS
+	:return: integer array with the group of each zone, numbered from 0
+	"""
+	if not 1 < num_groups <= len(distances):
+		raise ValueError("Can't split {} zones into {} groups".format(len(distances), num_groups))
+
+	medoids = _seed_medoids(distances, num_groups, initialization_method, random_state)
+	groups = numpy.arange(num_groups)
+	for iteration in range(max_iterations):
+		labels = distances[:, medoids].argmin(axis=1)
+		labels[medoids] = groups  # a zone identical to another medoid would otherwise leave its own group empty
+
+		new_medoids = medoids.copy()
+		for group in groups:
+			members = numpy.flatnonzero(labels == group)
+			new_medoids[group] = members[distances[numpy.ix_(members, members)].sum(axis=1).argmin()]
+		if (new_medoids == medoids).all():
+			break
+		medoids = new_medoids
+	else:
+		log.warning("k-medoids didn't converge on {} groups in {} iterations".format(num_groups, max_iterations))
+		labels = distances[:, medoids].argmin(axis=1)
+		labels[medoids] = groups
+
+	return labels
+
+
+def minimum_spanning_forest(distances, neighbors):
+	"""
+		Builds a minimum spanning tree over each set of connected zones with Prim's algorithm
+	:param distances: float array of zones x zones - the edge weights
+	:param neighbors: list of the neighbor positions of each zone
+	:return: list of (zone, zone) tree edges
+	"""
+	visited = numpy.zeros(len(distances), dtype=bool)
+	edges = []
+	for start in range(len(distances)):
+		if visited[start]:
+			continue
+		heap = [(0.0, start, -1)]
+		while heap:
+			weight, zone, from_zone = heapq.heappop(heap)
+			if visited[zone]:
+				continue
+			visited[zone] = True
+			if from_zone >= 0:
+				edges.append((from_zone, zone))
+			for neighbor in neighbors[zone]:
+				if not visited[neighbor]:
+					heapq.heappush(heap, (distances[zone, neighbor], neighbor, zone))
+	return edges
+
+
+def _walk_tree(root, tree):
+	"""
+		Lists the zones reachable from root in breadth first order, with the position in that list of each zone's parent
+	"""
+	order = [root]
+	parents = [-1]
+	seen = set(order)
+	position = 0
+	while position < len(order):
+		for neighbor in tree[order[position]]:
+			if neighbor not in seen:
+				seen.add(neighbor)
+				order.append(neighbor)
+				parents.append(position)
+		position += 1
+	return order, parents
+
+
+def _best_cut(members, tree, values, squares):
+	"""
+		Finds the tree edge in a group whose removal most reduces the sum of squared deviations
+	:return: (reduction, parent zone, child zone) - the child is on the side of the edge that gets cut off
+	"""
+	order, parents = _walk_tree(members[0], tree)
+	counts = numpy.ones(len(order))
+	sums = values[order]
+	sums_of_squares = squares[order]
+	for position in range(len(order) - 1, 0, -1):  # children come after their parents, so add each subtree into its parent
+		parent = parents[position]
+		counts[parent] += counts[position]
+		sums[parent] += sums[position]
+		sums_of_squares[parent] += sums_of_squares[position]
+
+	total = sums_of_squares[0] - sums[0].dot(sums[0]) / counts[0]
+	cut_off = sums_of_squares[1:] - (sums[1:] ** 2).sum(axis=1) / counts[1:]
+	remaining_sums = sums[0] - sums[1:]
+	remaining = (sums_of_squares[0] - sums_of_squares[1:]) - (remaining_sums ** 2).sum(axis=1) / (counts[0] - counts[1:])
+
+	reductions = total - cut_off - remaining
+	best = int(reductions.argmax())
+	return reductions[best], order[parents[best + 1]], order[best + 1]
+
+
+def skater(values, distances, neighbors, num_groups):
+	"""
+		Splits zones into contiguous groups by cutting a minimum spanning tree of adjacent zones (SKATER). Each cut is
+		the tree edge, in any group, whose removal most reduces the total within-group sum of squared deviations.
+	:param values: float array of zones x fields - standardized presence values
+	:param distances: float array of zones x zones - weights for the spanning tree
+	:param neighbors: list of the neighbor positions of each zone
+	:param num_groups: number of groups to make
+	:return: integer array with the group of each zone, numbered from 0
+	"""
+	tree = [set() for zone in range(len(values))]
+	for zone, neighbor in minimum_spanning_forest(distances, neighbors):
+		tree[zone].add(neighbor)
+		tree[neighbor].add(zone)
+
+	labels = numpy.full(len(values), -1, dtype=numpy.int64)
+	group_count = 0
+	for zone in range(len(values)):
+		if labels[zone] < 0:
+			labels[_walk_tree(zone, tree)[0]] = group_count
+			group_count += 1
+	if group_count > num_groups:
+		raise ValueError("The zones form {} separate areas, so they can't be split into {} contiguous groups".format(group_count, num_groups))
+
+	squares = (values ** 2).sum(axis=1)
+	while group_count < num_groups:
+		best = None
+		for group in range(group_count):
+			members = numpy.flatnonzero(labels == group)
+			if len(members) < 2:
+				continue
+			cut = _best_cut(members, tree, values, squares)
+			if best is None or cut[0] > best[0]:
+				best = cut
+		if best is None:
+			raise ValueError("Can't split {} zones into {} groups".format(len(values), num_groups))
+
+		reduction, parent, child = best
+		tree[parent].discard(child)
+		tree[child].discard(parent)
+		labels[_walk_tree(child, tree)[0]] = group_count
+		group_count += 1
+
+	return labels
+
+
+def summarize(values, labels, varies=None):
+	"""
+		Computes the statistics Grouping Analysis reports for a clustering
+	:param values: float array of zones x fields - standardized presence values
+	:param labels: integer array with the group of each zone
+	:param varies: boolean array of the fields with any variation. Fields that don't vary have no R-squared
+	:return: dict with num_groups, pseudo_f (Calinski-Harabasz - higher is better separated), group_sizes, and
+		r_squared (array with the share of each field's variation explained by the groups)
+	"""
+	groups = numpy.unique(labels)
+	total = ((values - values.mean(axis=0)) ** 2).sum(axis=0)
+	within = numpy.zeros(values.shape[1])
+	for group in groups:
+		members = values[labels == group]
+		within += ((members - members.mean(axis=0)) ** 2).sum(axis=0)
+
+	num_groups = len(groups)
+	num_zones = len(values)
+	pseudo_f = None
+	if 1 < num_groups < num_zones and within.sum() > 0:
+		pseudo_f = float(((total.sum() - within.sum()) / (num_groups - 1)) / (within.sum() / (num_zones - num_groups)))
+
+	if varies is None:
+		varies = total > 0
+	r_squared = numpy.full(values.shape[1], numpy.nan)
+	r_squared[varies] = 1 - within[varies] / total[varies]
+
+	return {"num_groups": num_groups,
+			"pseudo_f": pseudo_f,
+			"group_sizes": numpy.bincount(numpy.searchsorted(groups, labels)).tolist(),
+			"r_squared": r_squared}
+
+
+class Clusterer(object):
+	"""
+		The presence matrix of one region with the values every clustering of it needs - computed once, then reused
+		for each number of groups
+	"""
+
+	def __init__(self, presence, neighbors=None, initialization_method="FIND_SEED_LOCATIONS", random_state=None):
+		"""
+		:param presence: boolean array of zones x fields
+		:param neighbors: list of the neighbor positions of each zone, as returned by load_zone_adjacency, for
+			contiguous groups. None clusters without a spatial constraint
+		:param initialization_method: how k-medoids picks its starting medoids - FIND_SEED_LOCATIONS or USE_RANDOM_SEEDS
+		:param random_state: seed for USE_RANDOM_SEEDS
+		"""
+		self.neighbors = neighbors
+		self.initialization_method = initialization_method
+		self.random_state = random_state
+		self.distances = jaccard_distances(presence)
+		self.values, self.varies = standardize(presence)
+
+	def cluster(self, num_groups):
+		"""
+			Clusters the zones into num_groups groups
+		:return: (integer array with the group of each zone, numbered from 1 like Grouping Analysis's SS_GROUP, summary dict)
+		"""
+		if self.neighbors is None:
+			labels = k_medoids(self.distances, num_groups, self.initialization_method, random_state=self.random_state)
+		else:
+			labels = skater(self.values, self.distances, self.neighbors, num_groups)
+		return labels + 1, summarize(self.values, labels, self.varies)
+
+
+def _initialize_worker(presence, neighbors, initialization_method, random_state):
+	global _worker_clusterer
+	_worker_clusterer = Clusterer(presence, neighbors, initialization_method, random_state)
+
+
+def _cluster_in_worker(num_groups):
+	return num_groups, _worker_clusterer.cluster(num_groups)
+
+
+def cluster_sizes(presence, num_groups, neighbors=None, initialization_method="FIND_SEED_LOCATIONS", random_state=None, processes=None):
+	"""
+		Clusters the same zones into each number of groups
+	:param presence: boolean array of zones x fields
+	:param num_groups: iterable of the numbers of groups to make
+	:param neighbors: list of the neighbor positions of each zone for contiguous groups, or None
+	:param initialization_method: FIND_SEED_LOCATIONS or USE_RANDOM_SEEDS
+	:param random_state: seed for USE_RANDOM_SEEDS
+	:param processes: worker processes to split the group sizes across. Defaults to local_vars.clustering_processes
+	:return: OrderedDict of number of groups -> (labels, summary), as returned by Clusterer.cluster
+	"""
+	if processes is None:
+		processes = local_vars.clustering_processes
+	num_groups = list(num_groups)
+
+	processes = min(processes, len(num_groups))
+	if processes > 1:
+		log.write("Clustering {} zones into {} group sizes across {} processes".format(len(presence), len(num_groups), processes), True)
+		pool = multiprocessing.Pool(processes=processes, initializer=_initialize_worker, initargs=(presence, neighbors, initialization_method, random_state))
+		try:
+			return collections.OrderedDict(pool.map(_cluster_in_worker, num_groups, chunksize=1))
+		finally:
+			pool.close()
+			pool.join()
+
+	clusterer = Clusterer(presence, neighbors, initialization_method, random_state)
+	return collections.OrderedDict((size, clusterer.cluster(size)) for size in num_groups)
@@ -264,13 +264,33 @@ def write_column_by_key(layer, layer_field, layer_key, results_dict):
 	:param dict results_dict: The dictionary that the key field will be used to look up results in
 	"""
 
+	write_columns_by_key(layer, layer_key, {layer_field: results_dict})
+
+
+def write_columns_by_key(layer, layer_key, results_by_field):
+	"""
+		Same as write_column_by_key, but writes any number of columns in a single cursor pass over the layer
+
+	:param str layer: The layer to modify
+	:param str layer_key: The key field in the layer that will be used for lookups in the results
+	:param dict results_by_field: dictionary keyed by field name, where each value is a results dictionary like the one
+		passed to write_column_by_key
+	"""
+
 	# for every row
 	arc_curs = arcpy.UpdateCursor(layer)
 	for row in arc_curs:
 		cur_key = row.getValue(layer_key)
 
-		if not cur_key in results_dict:  # skip it if it's not there
-			continue
+		updated = False
+		for layer_field in results_by_field:
+			if not cur_key in results_by_field[layer_field]:  # skip it if it's not there
+				continue
+
+			row.setValue(layer_field, results_by_field[layer_field][cur_key])
+			updated = True
+
+		if updated:
+			arc_curs.updateRow(row)
 
-		row.setValue(layer_field, results_dict[cur_key])
-		arc_curs.updateRow(row)
\ No newline at end of file
+	del arc_curs
@@ -9,6 +9,7 @@ from . import log
 from . import funcs
 from . import local_vars
 from . import api
+from . import range_comparison
 
 from .code_library_data_files import teale_albers
 from . import code_library_geometry as geometry
@@ -52,9 +53,9 @@ def historic_vs_current(fid, collections=local_vars.hq_collections):
 	log.write("Getting percent overlap", 1)
 	pct_over = percent_overlap(historic, current)
 	log.write("Getting centroid distance and direction", 1)
-	cent_dist = geospatial.geometry.simple_centroid_distance(historic, current, geospatial.teale_albers, dissolve=True, centroid_direction=True)
+	cent_dist = geometry.simple_centroid_distance(historic, current, teale_albers, dissolve=True, centroid_direction=True)
 
-	comparison = geospatial.geometry.Comparison()
+	comparison = geometry.Comparison()
 	comparison.percent_overlap = pct_over["percent_overlap"]
 	comparison.percent_overlap_final = pct_over["overlap_final_perspective"]
 	comparison.percent_overlap_initial = pct_over["overlap_init_perspective"]
@@ -66,12 +67,98 @@ def historic_vs_current(fid, collections=local_vars.hq_collections):
 	return comparison
 
 
-def batch_compare_species_ranges(output_file, species=None):
+def build_zone_centroids():
+	"""
+		Computes the zone centroids the python range comparison engine needs, from the zones layer. batch_historic_vs_current
+		runs this the first time it's used - run it again whenever the zones change.
+	"""
+	from .input_filters import common  # imported here because it's only needed for this
+
+	db_cursor, db_conn = funcs.db_connect(local_vars.maindb, "Computing zone centroids")
+	try:
+		range_comparison.build_zone_centroids(db_cursor, common.load_zone_index())
+		db_conn.commit()
+	finally:
+		funcs.db_close(db_cursor, db_conn)
+
+
+def batch_historic_vs_current(species_codes, collections=local_vars.hq_collections, processes=None):
+	"""
+		Compares historic and current ranges for many species at once with range_comparison, from the presence index and
+		zone centroids instead of building layers for each species.
+
+	:param species_codes: iterable of PISCES species FID codes
+	:param str collections: the collection ids to limit the data to. Defaults to the hq_collections variable which uses the "QC dataset"
+	:param processes: worker processes. Defaults to local_vars.range_comparison_processes
+	:return: list of (fid, comparison object) tuples, in the order of species_codes. The comparison is None for species
+		that failed, which range_comparison logs
+	"""
+
+	db_cursor, db_conn = funcs.db_connect(local_vars.maindb, "Comparing ranges")
+	try:
+		if not range_comparison.has_zone_centroids(db_cursor):  # first run on this database
+			from .input_filters import common  # imported here because it's only needed for this
+
+			log.write("Zone centroids haven't been computed yet - computing them now", 1)
+			range_comparison.build_zone_centroids(db_cursor, common.load_zone_index())
+			db_conn.commit()
+
+		results = range_comparison.compare_species(species_codes, db_cursor, collections=collections, processes=processes)
+	finally:
+		funcs.db_close(db_cursor, db_conn)
+
+	comparisons = []
+	for fid, result in results:
+		if result is None:
+			comparisons.append((fid, None))
+			continue
+		comparison = geometry.Comparison()
+		comparison.__dict__.update(result)
+		comparisons.append((fid, comparison))
+	return comparisons
+
+
+def validate_range_comparison(species_codes, tolerance=0.01, collections=local_vars.hq_collections):
+	"""
+		Runs species through both the arcpy path (historic_vs_current) and the python engine, and logs any results that
+		differ by more than tolerance - checks the python engine after changes to either path or to the zones
+
+	:param species_codes: iterable of species codes. Each takes as long as historic_vs_current, so use a handful
+	:param tolerance: allowed relative difference
+	:param collections: the collection ids to limit the data to
+	:return: list of (fid, field, arcpy value, python value) for each mismatch
+	"""
+
+	mismatches = []
+	for fid, python_comparison in batch_historic_vs_current(species_codes, collections=collections, processes=1):
+		if python_comparison is None:
+			mismatches.append((fid, None, None, None))
+			log.warning("Range comparison failed for {} in the python engine".format(fid))
+			continue
+
+		arcpy_comparison = historic_vs_current(fid, collections=collections)
+		for field in range_comparison.result_fields:
+			expected = getattr(arcpy_comparison, field)
+			actual = getattr(python_comparison, field)
+			if expected in (None, False) or actual is None:
+				matches = expected in (None, False) and actual is None
+			else:
+				matches = abs(float(actual) - float(expected)) <= tolerance * max(abs(float(expected)), 1.0)
+			if not matches:
+				mismatches.append((fid, field, expected, actual))
+				log.warning("Range comparison mismatch for {} {}: arcpy {}, python {}".format(fid, field, expected, actual))
+
+	log.write("Validated range comparison for {} species - {} mismatches".format(len(species_codes), len(mismatches)), 1)
+	return mismatches
+
+
+def batch_compare_species_ranges(output_file, species=None, engine=None):
 	"""
 		Pulls the list of native species (since they have historic ranges) from the database and runs :function::historic_vs_current on each one. Returns a csv file with the results
 
 	:param str output_file: Path to new CSV file where results would be placed
 	:param list species: optional. An iterable of species codes to run this for
+	:param str engine: "python" or "arcpy". Defaults to local_vars.range_comparison_engine
 	"""
 
 	log.write("Batch comparing species", 1)
@@ -81,7 +168,10 @@ def batch_compare_species_ranges(output_file, species=None):
 	else:
 		species_codes = funcs.species_group_as_list(group_name="Native_Fish")
 
-	comparison_obj = geospatial.geometry.Comparison()
+	if engine is None:
+		engine = local_vars.range_comparison_engine
+
+	comparison_obj = geometry.Comparison()
 	comparison_obj.species = None
 	comparison_obj.common_name = None
 
@@ -90,16 +180,31 @@ def batch_compare_species_ranges(output_file, species=None):
 	csv_writer.writeheader()
 
 	had_errors = False
-	for code in species_codes:
-		try:
-			dict_obj = historic_vs_current(code).__dict__   # convert it to a dictionary on the fly
-			dict_obj["species"] = code
-			dict_obj["common_name"] = local_vars.all_fish[code].species
-			csv_writer.writerow(dict_obj)
-		except:
-			had_errors = True
-			log.error("Failed to run analysis for species" + code)
-			log.error("Error reported was " + traceback.format_exc())
+	if engine == "python":
+		for code, comparison in batch_historic_vs_current(species_codes):
+			if comparison is None:  # the error was logged when comparing
+				had_errors = True
+				continue
+			try:
+				dict_obj = comparison.__dict__
+				dict_obj["species"] = code
+				dict_obj["common_name"] = local_vars.all_fish[code].species
+				csv_writer.writerow(dict_obj)
+			except:
+				had_errors = True
+				log.error("Failed to run analysis for species" + code)
+				log.error("Error reported was " + traceback.format_exc())
+	else:
+		for code in species_codes:
+			try:
+				dict_obj = historic_vs_current(code).__dict__   # convert it to a dictionary on the fly
+				dict_obj["species"] = code
+				dict_obj["common_name"] = local_vars.all_fish[code].species
+				csv_writer.writerow(dict_obj)
+			except:
+				had_errors = True
+				log.error("Failed to run analysis for species" + code)
+				log.error("Error reported was " + traceback.format_exc())
 
 	if had_errors:
 		log.write("Errors were reported during processing. Please check the error log and correct any missing species (this function can take a list of species codes as a parameter so you can rerun specific missing codes)", 1)
@@ -39,3 +39,8 @@ local_vars.output_common_name = True
 # only valid when a name formula isn't specified for a map in the database, so it won't work for all maps
 local_vars.config_metadata = False
 # speed issue - turning off metadata can make map exports MUCH faster.
+
+## API ##
+
+local_vars.use_presence_index = False
+# speed issue - when True, the presence and listing API functions build an in-memory index of observations once per process and answer from it. Good for batch scripts that make many calls.
@@ -14,16 +14,47 @@
 """
 from __future__ import absolute_import, division, print_function
 
+import binascii
+import hashlib
+import io
+import json
+import math
 import os
 import platform
 import subprocess
 import shutil
+import sqlite3
+
+import six
 
 from . import local_vars
 from . import log
 
 DUMP_EXTENSION = "sqldump"
 DUMP_FOLDER = os.path.join(local_vars.internal_workspace, "data", "dumps")
+DUMP_MANIFEST = "dump_manifest.json"  # table hashes and row counts for the dumps in a folder, written by dehydrate_db
+DUMP_CHUNK_SIZE = 500  # rows per INSERT statement in table dumps, and per fetch when reading tables
+
+# The indexes PISCES expects, as (index name, table, columns). Dumps don't include them, so hydrate_db creates them
+# after loading. Bump INDEX_SET_VERSION whenever this changes - it's stored in the database's user_version.
+INDEX_SET_VERSION = 1
+INDEXES = (
+	# presence lookups and maps for a species, optionally limited to zones and presence types
+	("ix_observations_species_zone_presence", local_vars.observations_table, ("species_id", "zone_id", "presence_type")),
+	# per zone queries in callbacks (richness, diversity, postprocess_zones)
+	("ix_observations_zone_species_presence", local_vars.observations_table, ("zone_id", "species_id", "presence_type")),
+	# whole dataset scans by presence type - covers SELECT DISTINCT zone_id, species_id WHERE presence_type IN (...)
+	("ix_observations_presence_zone_species", local_vars.observations_table, ("presence_type", "zone_id", "species_id")),
+	("ix_observations_set", local_vars.observations_table, ("set_id",)),
+	# joins from observations to collections, and collection filters (hq_collections)
+	("ix_observation_collections_observation", local_vars.observation_collections_table, ("observation_id", "collection_id")),
+	("ix_observation_collections_collection", local_vars.observation_collections_table, ("collection_id", "observation_id")),
+	("ix_invalid_observations_transaction", local_vars.invalid_observations_table, ("transaction_id",)),
+	("ix_species_groups_group", local_vars.species_group_members_table, ("group_id", "fid")),
+	("ix_species_groups_fid", local_vars.species_group_members_table, ("fid", "group_id")),
+	("ix_zones_downstream", local_vars.zones_table, ("HU_12_DS",)),
+	("ix_layer_cache_query_bind", "layer_cache", ("query_id", "bind_var")),
+)
 
 def _get_time(file_path):
 	if platform.system() == 'Windows':
@@ -53,29 +84,53 @@ def _get_latest_export(folder):
 
 def hydrate_db(db=local_vars.maindb,
 			   sqlite=os.path.join(local_vars.internal_workspace, "utils", "sqlite-tools-win32-x86-3240000", "sqlite3.exe"),
-			   db_export_folder=DUMP_FOLDER):
+			   db_export_folder=DUMP_FOLDER,
+			   incremental=True,
+			   use_sqlite_exe=False):
 	"""
-		Retrieves the latest file (by creation time) from db_export_folder with the extension sqldump and loads it into
-		a sqlite database, replacing pisces.sqlite.
+		Loads the table dumps written by dehydrate_db into a sqlite database, making a backup of the existing database
+		into the dumps folder first. Only tables whose dumps differ from the database's current contents are reloaded,
+		all in one transaction, and each table's indexes are created after its data is loaded.
 	:param db:
-	:param sqlite:
+	:param sqlite: path to sqlite3.exe, for use_sqlite_exe
 	:param db_export_folder:
-	:return:
+	:param incremental: when False, the database is removed and every table is loaded
+	:param use_sqlite_exe: load the latest single file dump (by creation time) in db_export_folder with sqlite3.exe
+		instead, as hydrate_db did before dumps were written per table. Replaces the whole database
+	:return: list of the tables that were loaded
 	"""
 
-	data_dump = _get_latest_export(db_export_folder)
-
 	if os.path.exists(db):
 		db_time = _get_time(db)
-		backup_folder = os.path.join(DUMP_FOLDER, "backups")
+		backup_folder = os.path.join(db_export_folder, "backups")
 		if not os.path.exists(backup_folder):
 			os.makedirs(backup_folder)
 
-		log.info("Removing existing DB, but making a backup into dumps folder")
+		from . import orm_models  # imported here so that loading this module doesn't require sqlalchemy
+		orm_models.reset(db)  # pooled ORM connections would otherwise keep pointing at (and locking) the old file
+		from . import funcs  # same for pooled ODBC connections - imported here because it needs pyodbc
+		funcs.close_pooled_connections(db)
+
+		log.info("Making a backup of the existing DB into dumps folder")
 		shutil.copyfile(db, os.path.join(backup_folder, "{}_{}".format(os.path.split(db)[1], db_time)))
-		os.remove(db)
+		if use_sqlite_exe or not incremental:
+			log.info("Removing existing DB")
+			os.remove(db)
+
+	if use_sqlite_exe:
+		_hydrate_with_sqlite_exe(db, sqlite, db_export_folder)
+		tables = None
+	else:
+		tables = load_table_dumps(db, db_export_folder, incremental=incremental)
+
+	create_indexes(db)
+	return tables
+
 
-	hydrate = os.path.join(DUMP_FOLDER, "hydrate.sql")
+def _hydrate_with_sqlite_exe(db, sqlite, db_export_folder):
+	data_dump = _get_latest_export(db_export_folder)
+
+	hydrate = os.path.join(db_export_folder, "hydrate.sql")
 	with open(hydrate, 'w') as hydrate_file:
 		hydrate_file.write("PRAGMA journal_mode = OFF;\nPRAGMA synchronous = OFF; \n.read {}".format(data_dump.replace("\\", "/")))
 
@@ -83,25 +138,326 @@ def hydrate_db(db=local_vars.maindb,
 	subprocess.check_call([sqlite, db, ".read {}".format(hydrate.replace("\\", "/"))])
 
 
+def _sql_literal(value):
+	"""
+		Formats a value from the sqlite3 module as a SQL literal that SQLite reads back as the same value
+	"""
+	if value is None:
+		return "NULL"
+	elif isinstance(value, six.integer_types):
+		return str(value)
+	elif isinstance(value, float):
+		if math.isinf(value):
+			return "9e999" if value > 0 else "-9e999"  # SQLite has no literal for infinity, but these overflow to it
+		return repr(value)
+	elif isinstance(value, six.text_type):
+		return "'{}'".format(value.replace("'", "''"))
+	else:  # blobs - buffer on Python 2, bytes on Python 3
+		return "X'{}'".format(binascii.hexlify(bytes(value)).decode("ascii"))
+
+
+def _row_literal(row):
+	return "({})".format(", ".join(_sql_literal(value) for value in row))
+
+
+def _dump_path(db_export_folder, table):
+	return os.path.join(db_export_folder, "pisces_{}.{}".format(table, DUMP_EXTENSION))
+
+
+def _table_schema(db_cursor, table):
+	"""
+		Returns the CREATE TABLE statement for a table, and the statements that create its indexes and triggers
+	"""
+	create = db_cursor.execute("select sql from sqlite_master where type = 'table' and name = ?", (table,)).fetchone()
+	if create is None:
+		raise ValueError("Table {} doesn't exist".format(table))
+	others = db_cursor.execute("select sql from sqlite_master where type in ('index', 'trigger') and tbl_name = ? and sql is not null order by type, name", (table,)).fetchall()
+	return create[0], [record[0] for record in others]
+
+
+def _table_rows(db_cursor, table, chunk_size):
+	"""
+		Yields lists of up to chunk_size rows of a table, as SQL literals, in rowid order
+	"""
+	db_cursor.execute("select * from {} order by rowid".format(table))
+	while True:
+		rows = db_cursor.fetchmany(chunk_size)
+		if not rows:
+			break
+		yield [_row_literal(row) for row in rows]
+
+
+def table_hash(db_cursor, table, chunk_size=DUMP_CHUNK_SIZE):
+	"""
+		Hashes a table's schema and contents in one pass, without keeping the table in memory. Two tables have the same
+		hash if they'd produce the same dump.
+	:return: hex digest
+	"""
+	create, others = _table_schema(db_cursor, table)
+	content_hash = hashlib.sha256()
+	for statement in [create] + others:
+		content_hash.update(statement.encode("utf-8") + b"\n")
+	for rows in _table_rows(db_cursor, table, chunk_size):
+		for row in rows:
+			content_hash.update(row.encode("utf-8") + b"\n")
+	return content_hash.hexdigest()
+
+
+def read_manifest(db_export_folder=DUMP_FOLDER):
+	"""
+		Reads the manifest dehydrate_db writes alongside the table dumps
+	:return: dict of table name -> {"hash": table_hash, "rows": row count}. Empty if there's no manifest
+	"""
+	manifest_path = os.path.join(db_export_folder, DUMP_MANIFEST)
+	if not os.path.exists(manifest_path):
+		return {}
+	with open(manifest_path, 'r') as manifest_file:
+		return json.load(manifest_file)["tables"]
+
+
+def write_table_dump(db_cursor, table, dump_path, chunk_size=DUMP_CHUNK_SIZE):
+	"""
+		Writes a table as SQL - the CREATE TABLE statement, INSERT statements of up to chunk_size rows each, and then
+		its indexes and triggers, so that loading it creates indexes after the data. The file can also be loaded with
+		sqlite3.exe's .read command. Rows are streamed, so the table is never held in memory.
+	:return: (table_hash, row count)
+	"""
+	create, others = _table_schema(db_cursor, table)
+	content_hash = hashlib.sha256()
+	row_count = 0
+
+	with io.open(dump_path, 'w', encoding="utf-8", newline="") as dump_file:  # no newline translation - values may contain line breaks
+		content_hash.update(create.encode("utf-8") + b"\n")
+		dump_file.write(u"{};\n".format(create))
+		for statement in others:
+			content_hash.update(statement.encode("utf-8") + b"\n")
+
+		for rows in _table_rows(db_cursor, table, chunk_size):
+			for row in rows:
+				content_hash.update(row.encode("utf-8") + b"\n")
+			row_count += len(rows)
+			dump_file.write(u"INSERT INTO {} VALUES\n{};\n".format(table, ",\n".join(rows)))
+
+		for statement in others:
+			dump_file.write(u"{};\n".format(statement))
+
+	return content_hash.hexdigest(), row_count
+
+
+def read_table_dump(dump_path):
+	"""
+		Yields the SQL statements in a dump written by write_table_dump, one at a time
+	"""
+	statement = u""
+	with io.open(dump_path, 'r', encoding="utf-8", newline="") as dump_file:
+		for line in dump_file:
+			statement += line
+			if line.rstrip().endswith(";") and sqlite3.complete_statement(statement):  # only a line ending in ; can end a statement - saves rescanning long INSERTs
+				yield statement
+				statement = u""
+	if statement.strip():
+		raise ValueError("Dump {} ends partway through a statement".format(dump_path))
+
+
+def load_table_dumps(db, db_export_folder=DUMP_FOLDER, incremental=True):
+	"""
+		Loads the table dumps listed in the manifest into a database, in one transaction - if loading any table fails,
+		the database is left as it was.
+	:param db: path to the SQLite database. Created if it doesn't exist
+	:param db_export_folder: folder with the dumps and manifest written by dehydrate_db
+	:param incremental: skip tables whose contents in the database already match their dump's hash
+	:return: list of the tables that were loaded
+	"""
+	manifest = read_manifest(db_export_folder)
+	if not manifest:
+		raise ValueError("No dump manifest in {} - dump the database with dehydrate_db, or load an older single file dump with use_sqlite_exe=True".format(db_export_folder))
+
+	connection = sqlite3.connect(db)
+	connection.isolation_level = None  # we manage the transaction ourselves, so the DROP and CREATE statements are in it too
+	loaded = []
+	try:
+		db_cursor = connection.cursor()
+		db_cursor.execute("PRAGMA journal_mode = MEMORY")  # keeps the rollback journal, but off the disk
+		db_cursor.execute("PRAGMA synchronous = OFF")
+
+		for table in sorted(manifest):
+			if incremental and db_cursor.execute("select name from sqlite_master where type = 'table' and name = ?", (table,)).fetchone() is not None:
+				if table_hash(db_cursor, table) == manifest[table]["hash"]:
+					log.info("{} is unchanged".format(table))
+					continue
+
+			loaded.append(table)
+
+		db_cursor.execute("BEGIN")
+		try:
+			for table in loaded:
+				log.info("Loading {} ({} rows)".format(table, manifest[table]["rows"]))
+				db_cursor.execute("DROP TABLE IF EXISTS {}".format(table))  # drops its indexes and triggers too
+				for statement in read_table_dump(_dump_path(db_export_folder, table)):
+					db_cursor.execute(statement)
+			db_cursor.execute("COMMIT")
+		except:
+			db_cursor.execute("ROLLBACK")
+			raise
+	finally:
+		connection.close()
+
+	return loaded
+
+
+def _existing_index_columns(db_cursor, table):
+	"""
+		Returns the column lists of every index on a table, lowercased, or None if the table doesn't exist
+	"""
+	if db_cursor.execute("select name from sqlite_master where type = 'table' and lower(name) = lower(?)", (table,)).fetchone() is None:
+		return None
+
+	index_columns = []
+	for index in db_cursor.execute("PRAGMA index_list({})".format(table)).fetchall():
+		columns = db_cursor.execute("PRAGMA index_info({})".format(index[1])).fetchall()
+		index_columns.append(tuple(str(column[2]).lower() for column in sorted(columns)))
+	return index_columns
+
+
+def missing_indexes(db=local_vars.maindb, indexes=INDEXES):
+	"""
+		Finds the indexes in the managed index set that a database doesn't have. An index counts as present if any index
+		on the table has the same columns in the same order, whatever its name. Tables that don't exist are skipped.
+	:param db: path to the SQLite database
+	:param indexes: index set to check, in the form of INDEXES
+	:return: list of (index name, table, columns) tuples
+	"""
+	connection = sqlite3.connect(db)
+	try:
+		db_cursor = connection.cursor()
+		missing = []
+		existing = {}
+		for name, table, columns in indexes:
+			if table not in existing:
+				existing[table] = _existing_index_columns(db_cursor, table)
+			if existing[table] is not None and tuple(column.lower() for column in columns) not in existing[table]:
+				missing.append((name, table, columns))
+		return missing
+	finally:
+		connection.close()
+
+
+def check_indexes(db=local_vars.maindb):
+	"""
+		Logs a warning for each managed index the database is missing
+	:return: list of missing indexes, as returned by missing_indexes
+	"""
+	missing = missing_indexes(db)
+	for name, table, columns in missing:
+		log.warning("Database {} is missing index {} on {} ({}) - run db_management.create_indexes to add it".format(db, name, table, ", ".join(columns)))
+	return missing
+
+
+def create_indexes(db=local_vars.maindb, analyze=True):
+	"""
+		Migrates a database to the current index set - creates any missing indexes, updates the query planner's
+		statistics, and records INDEX_SET_VERSION as the database's user_version.
+	:param db: path to the SQLite database
+	:param analyze: run ANALYZE after creating indexes, so the query planner knows to use them
+	:return: list of the indexes created
+	"""
+	missing = missing_indexes(db)
+
+	connection = sqlite3.connect(db)
+	try:
+		db_cursor = connection.cursor()
+		for name, table, columns in missing:
+			log.info("Creating index {} on {}".format(name, table))
+			db_cursor.execute("CREATE INDEX IF NOT EXISTS {} ON {} ({})".format(name, table, ", ".join(columns)))
+
+		if missing and analyze:
+			db_cursor.execute("ANALYZE")
+		db_cursor.execute("PRAGMA user_version = {}".format(INDEX_SET_VERSION))
+		connection.commit()
+	finally:
+		connection.close()
+
+	return missing
+
+
+def get_index_set_version(db=local_vars.maindb):
+	"""
+		Returns the index set version recorded in the database by create_indexes - 0 if it has never been migrated
+	"""
+	connection = sqlite3.connect(db)
+	try:
+		return connection.execute("PRAGMA user_version").fetchone()[0]
+	finally:
+		connection.close()
+
+
 def dehydrate_db(db=local_vars.maindb,
 				 sqlite=os.path.join(local_vars.internal_workspace, "utils", "sqlite-tools-win32-x86-3240000", "sqlite3.exe"),
-				 db_export_folder=DUMP_FOLDER):
+				 db_export_folder=DUMP_FOLDER,
+				 tables=None,
+				 force=False,
+				 chunk_size=DUMP_CHUNK_SIZE,
+				 use_sqlite_exe=False):
 	"""
-		Exports single tables into dump folder so they can be better versioned as they change. The hydrate_db function
-		doesn't yet match this well.
+		Exports single tables into dump folder so they can be better versioned as they change. Each table is hashed
+		first, and only tables that changed since the last dump are rewritten, so unchanged dumps aren't touched. The
+		hashes are kept in a manifest in the dump folder, which hydrate_db reads.
 	:param db:
-	:param sqlite:
+	:param sqlite: path to sqlite3.exe, for use_sqlite_exe
 	:param db_export_folder:
-	:return:
+	:param tables: names of the tables to dump. Defaults to local_vars.all_tables
+	:param force: rewrite every dump, whether or not the table changed
+	:param chunk_size: rows per INSERT statement in the dumps
+	:param use_sqlite_exe: dump the schema and rows of each table with sqlite3.exe instead, as dehydrate_db did before
+		it wrote SQL dumps. These dumps can't be loaded by hydrate_db
+	:return: list of the tables whose dumps were written
 	"""
+	if tables is None:
+		tables = local_vars.all_tables
+
+	if use_sqlite_exe:
+		_dehydrate_with_sqlite_exe(db, sqlite, db_export_folder, tables)
+		return list(tables)
+
+	manifest = read_manifest(db_export_folder)
+	written = []
+
+	connection = sqlite3.connect(db)
+	try:
+		db_cursor = connection.cursor()
+		for table in tables:
+			dump_path = _dump_path(db_export_folder, table)
+			if not force and table in manifest and os.path.exists(dump_path) and table_hash(db_cursor, table, chunk_size) == manifest[table]["hash"]:
+				log.info("{} is unchanged".format(table))
+				continue
+
+			log.info("Exporting to {}".format(dump_path))
+			temporary_path = "{}.partial".format(dump_path)  # so an interrupted dump doesn't replace a good one
+			content_hash, row_count = write_table_dump(db_cursor, table, temporary_path, chunk_size)
+			if os.path.exists(dump_path):
+				os.remove(dump_path)
+			os.rename(temporary_path, dump_path)
+
+			manifest[table] = {"hash": content_hash, "rows": row_count}
+			written.append(table)
+			log.info("Exported {}".format(table))
+	finally:
+		connection.close()
+
+	with open(os.path.join(db_export_folder, DUMP_MANIFEST), 'w') as manifest_file:
+		json.dump({"tables": manifest}, manifest_file, indent=1, sort_keys=True)
+
+	return written
+
 
-	for table in local_vars.all_tables:
-		db_export_file = os.path.join(db_export_folder, "pisces_{}.{}".format(table, DUMP_EXTENSION))
+def _dehydrate_with_sqlite_exe(db, sqlite, db_export_folder, tables):
+	for table in tables:
+		db_export_file = _dump_path(db_export_folder, table)
 		if os.path.exists(db_export_file):
 			log.info("Removing existing DB export file")
 			os.remove(db_export_file)
 
-		dehydrate = os.path.join(DUMP_FOLDER, "dehydrate_{}.sql".format(table))
+		dehydrate = os.path.join(db_export_folder, "dehydrate_{}.sql".format(table))
 		with open(dehydrate, 'w') as dehydrate_file:
 			dehydrate_file.write(".output {}\n".format(db_export_file.replace("\\", "/")))
 			dehydrate_file.write(".schema {}\n".format(table))
@@ -109,4 +465,4 @@ def dehydrate_db(db=local_vars.maindb,
 
 		log.info("Exporting to {}".format(db_export_file))
 		subprocess.check_call([sqlite, db, ".read {}".format(dehydrate.replace("\\", "/"))])
-		log.info("Exported {}".format(table))
\ No newline at end of file
+		log.info("Exported {}".format(table))
@@ -102,6 +102,12 @@ if operation == "Add":  # if we have a species, but not a current one, then we'r
 else:  # otherwise, we're modifying existing records
 	modify_records(zones)  # handles records whether they are being modified or deleted entirely
 
+from . import layer_fingerprints
+from . import stats_summary
+changed_species = [species, new_species] if operation == "Transfer" else [species]
+layer_fingerprints.record_species_changes(db_cursor, changed_species)
+stats_summary.refresh_summary(db_cursor, changed_species)
+
 db_conn.commit()
 log.write("Completed modifications, generating new layer!")
 
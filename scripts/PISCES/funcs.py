@@ -2,6 +2,9 @@ from __future__ import absolute_import, division, print_function
 
 import os
 import re
+import time
+import threading
+import contextlib
 import traceback
 
 import pyodbc
@@ -10,8 +13,17 @@ import arcpy
 
 from . import local_vars
 from . import log
+from . import layer_fingerprints
+from . import stats_summary
+from . import sqlite_driver
 from .local_vars import clean_location, winreg
 
+_pool = {}  # (database, access) -> list of idle connections that db_close returned when local_vars.db_connection_pooling is on
+_pool_lock = threading.Lock()
+_pool_pid = os.getpid()  # connections can't be shared with child processes - the pool is dropped if this changes
+_checked_out = {}  # id of connection -> (pool key or None, note, time opened) for connections handed out by db_connect
+db_timings = {}  # note passed to db_connect -> dict of connections, connect_seconds, and open_seconds - see get_db_timings
+
 
 def isiterable(item):
 	"""
@@ -33,6 +45,15 @@ def index_toolbox_params(tool, params):
 
 
 def db_connect(db_name, note=None, access=False):
+	"""
+		Returns a cursor and connection for a database. When local_vars.db_connection_pooling is True, SQLite
+		connections closed with db_close are kept and handed out again here instead of opening a new connection each time.
+		New SQLite connections get the pragmas in local_vars.sqlite_pragmas.
+	:param db_name: path to the database
+	:param note: description of what the connection is for - used in the log and to group timings in db_timings
+	:param access: connect to an Access database instead of SQLite
+	:return: tuple of (cursor, connection)
+	"""
 
 	log_string = "Making database connection to %s" % db_name
 
@@ -41,30 +62,163 @@ def db_connect(db_name, note=None, access=False):
 
 	log.write(log_string)
 
-	if not access:
-		conn = pyodbc.connect('DRIVER=SQLite3 ODBC Driver;Database=%s' % db_name)
-	else:
-		conn = pyodbc.connect('DRIVER={Microsoft Access Driver (*.mdb)};DBQ='+db_name)
+	start_time = time.time()
+	pool_key = (db_name, access) if local_vars.db_connection_pooling and not access else None
+
+	conn = _take_pooled_connection(pool_key) if pool_key else None
+	if conn is None:
+		if not access and local_vars.db_driver == "sqlite3":
+			conn = sqlite_driver.connect(db_name)
+			set_sqlite_pragmas(conn)
+		elif not access:
+			conn = pyodbc.connect('DRIVER=SQLite3 ODBC Driver;Database=%s' % db_name)
+			set_sqlite_pragmas(conn)
+		else:
+			conn = pyodbc.connect('DRIVER={Microsoft Access Driver (*.mdb)};DBQ='+db_name)
+
+	_checked_out[id(conn)] = (pool_key, note, time.time())
+	_record_timing(note, connect_seconds=time.time() - start_time)
 
 	return conn.cursor(), conn
 
 
 def db_close(cursor, conn):
+	"""
+		Closes a cursor and its connection. Pooled connections are rolled back - discarding uncommitted changes, as
+		closing would - and kept for the next db_connect to the same database.
+	"""
 	log.write("Closing database connection")
 	cursor.close()
+
+	pool_key, note, opened = _checked_out.pop(id(conn), (None, None, None))
+	if opened is not None:
+		_record_timing(note, open_seconds=time.time() - opened)
+
+	if pool_key is not None and _return_pooled_connection(pool_key, conn):
+		return
 	conn.close()
 
 
+@contextlib.contextmanager
+def db_operation(note, db_name=None, commit=False):
+	"""
+		Context manager version of db_connect and db_close, for timing a unit of database work under a name.
+
+		with funcs.db_operation("loading species") as (db_cursor, db_conn):
+			...
+	:param note: name for the operation in the log and db_timings
+	:param db_name: database to connect to - defaults to local_vars.maindb
+	:param commit: commit when the block completes without an exception
+	"""
+	db_cursor, db_conn = db_connect(db_name or local_vars.maindb, note)
+	try:
+		yield db_cursor, db_conn
+		if commit:
+			db_conn.commit()
+	finally:
+		db_close(db_cursor, db_conn)
+
+
+def set_sqlite_pragmas(conn):
+	"""
+		Applies local_vars.sqlite_pragmas to a SQLite connection. Pragmas with a value of None are skipped. journal_mode
+		can't change inside a transaction, so they're run with autocommit on.
+	"""
+	if not local_vars.sqlite_pragmas:
+		return
+
+	autocommit = conn.autocommit
+	conn.autocommit = True
+	cursor = conn.cursor()
+	try:
+		for pragma, value in local_vars.sqlite_pragmas:
+			if value is not None:
+				cursor.execute("PRAGMA {} = {}".format(pragma, value))
+	except pyodbc.Error:
+		log.warning("Unable to set SQLite pragmas on new connection - continuing with defaults. Error was: {}".format(traceback.format_exc()))
+	finally:
+		cursor.close()
+		conn.autocommit = autocommit
+
+
+def _take_pooled_connection(pool_key):
+	global _pool_pid
+
+	with _pool_lock:
+		if os.getpid() != _pool_pid:  # we're in a forked child - the parent's connections aren't ours to use, or to close
+			_pool.clear()
+			_checked_out.clear()
+			_pool_pid = os.getpid()
+
+		idle = _pool.get(pool_key)
+		if idle:
+			return idle.pop()
+	return None
+
+
+def _return_pooled_connection(pool_key, conn):
+	try:
+		conn.rollback()
+	except pyodbc.Error:  # the connection is broken - let the caller close it
+		return False
+
+	with _pool_lock:
+		idle = _pool.setdefault(pool_key, [])
+		if os.getpid() == _pool_pid and len(idle) < local_vars.db_pool_size:
+			idle.append(conn)
+			return True
+	return False
+
+
+def close_pooled_connections(db_name=None):
+	"""
+		Closes idle pooled connections - to every database, or only to db_name. Call before replacing or deleting a
+		database file so that no pooled connection keeps it open.
+	"""
+	with _pool_lock:
+		for pool_key in list(_pool.keys()):
+			if db_name is None or pool_key[0] == db_name:
+				for conn in _pool.pop(pool_key):
+					try:
+						conn.close()
+					except pyodbc.Error:
+						pass
+
+
+def _record_timing(note, connect_seconds=0, open_seconds=0):
+	timing = db_timings.setdefault(note or "unnamed", {"connections": 0, "connect_seconds": 0.0, "open_seconds": 0.0})
+	if connect_seconds:
+		timing["connections"] += 1
+		timing["connect_seconds"] += connect_seconds
+	timing["open_seconds"] += open_seconds
+
+
+def get_db_timings(reset=False):
+	"""
+		Returns the time spent on database connections, grouped by the note given to db_connect or db_operation
+	:param reset: clear the timings after returning them
+	:return: dict of note -> dict with the number of connections, seconds spent connecting, and seconds connections were held open
+	"""
+	timings = dict((note, dict(values)) for note, values in db_timings.items())
+	if reset:
+		db_timings.clear()
+	return timings
+
+
+def log_db_timings():
+	for note, values in sorted(get_db_timings().items(), key=lambda item: item[1]["open_seconds"], reverse=True):
+		log.write("DB timing - {}: {} connections, {:.3f}s connecting, {:.3f}s open".format(note, values["connections"], values["connect_seconds"], values["open_seconds"]), True)
+
+
 def refresh_cursor(database=None, connection=None, existing_cursor=None, close_connection=False):
 	if not database and not connection:
 		raise ValueError("at least one of connection or database parameter is required")
 
-	if existing_cursor:  # close a cursor if we passed one in
-		existing_cursor.close()
-
-	if close_connection:  # if the user specified to close the connection
-		connection.close()
+	if close_connection:  # if the user specified to close the connection - through db_close, which returns it to the pool
+		db_close(existing_cursor or connection.cursor(), connection)
 		connection = None
+	elif existing_cursor:  # close a cursor if we passed one in
+		existing_cursor.close()
 
 	if not connection:  # connection takes priority over database, so use it if we have it
 		cursor, connection = db_connect(database, "refreshing cursor")
@@ -148,30 +302,24 @@ def query_to_list_of_dicts(query, db_cursor, drop_fields=None):
 	return records
 
 
-def data_stats(db_cursor, print_to_screen=True, name_col="Parameter", value_col="Value"):
+def data_stats(db_cursor, print_to_screen=True, name_col="Parameter", value_col="Value", use_summary=None):
+	"""
+		Calculates summary statistics for the database - see stats_summary
+	:param db_cursor: DB-API cursor
+	:param print_to_screen: also print each statistic as it's logged
+	:param name_col: key for the statistic's description in each returned dict
+	:param value_col: key for its value
+	:param use_summary: read observation counts from the stats_summary table instead of scanning observations.
+		Defaults to local_vars.use_stats_summary
+	:return: list of dicts, one per statistic
+	"""
 
 	print("\nCalculating data stats")
 
-	l_queries = {}
-	l_queries['Total Number of Valid and Active Observations'] = "select Count (*) as num from observations"
-	l_queries['Total Number of Datasets Included'] = "select Count(*) as num from (select distinct set_id from Observations)"  # we use this method of gathering this because some sets have been completely tossed.
-	l_queries['Total Number of Species tracked (including data bins and nonfish taxa)'] = "select Count (*) as num from species"
-	l_queries['Total Number of Species tracked (no data bins, but includes nonfish)'] = "select Count (*) as num from Species where Temporary != 1"
-	l_queries['Total Number of Fish Species tracked (no data bins)'] = "select Count (*) as num from all_fish where Temporary != 1"
-	l_queries['Total Number of Native Fish Species tracked (no data bins)'] = "select Count (*) as num from native_fish where Temporary != 1"
-	l_queries['Total Number of Non-Native Fish Species tracked (no data bins)'] = "select Count (*) as num from nonnative_fish where Temporary != 1"
-	l_queries['Total Number of Valid Obervations in the Quality Controlled Set (%s)' % local_vars.hq_collections] = "select Count (*) as num from observation_collections where Collection_ID in (%s)" % local_vars.hq_collections
-	l_queries['Total Number of Taxa (Including NonFish) with Data'] = "select Count(*) as num from (select distinct Species_ID from Observations)"
-	l_queries['Total Number of *Native* Fish Species with Data'] = "select Count(*) as num from (select distinct Observations.Species_ID from Observations, native_fish where Observations.Species_ID = native_fish.fid)"
-	l_queries['Total Number of Fish Species with Present QC Data'] = 'select count(*) as num from (select distinct all_fish.fid from observations, all_fish, observation_collections where observations.species_id = all_fish.fid and observations.presence_type in (%s) and observations.objectid = observation_collections.observation_id and observation_collections.collection_id in (%s));' % (local_vars.current_obs_types, local_vars.hq_collections)
-	l_queries['Total Number of Fish Species with Historic QC Data'] = 'select count(*) as num from (select distinct all_fish.fid from observations, all_fish, observation_collections where observations.species_id = all_fish.fid and observations.presence_type in (%s) and observations.objectid = observation_collections.observation_id and observation_collections.collection_id in (%s));' % (local_vars.historic_obs_types, local_vars.hq_collections)
-
 	values = []
-	for name in l_queries.keys():
-		results = db_cursor.execute(l_queries[name])
-		for result in results:
-			values.append({name_col: name, value_col: result.num})  # add it to the dict
-			log.write("%s: %s" % (name, result.num), print_to_screen)
+	for name, value in stats_summary.get_stats(db_cursor, use_summary=use_summary).items():
+		values.append({name_col: name, value_col: value})  # add it to the dict
+		log.write("%s: %s" % (name, value), print_to_screen)
 
 	return values
 
@@ -398,6 +546,7 @@ def refresh_layer_cache(l_db_cursor=None):
 
 	query = "delete from Layer_Cache"  # delete the records too!
 	l_db_cursor.execute(query)
+	layer_fingerprints.clear(l_db_cursor)
 
 	if l_db_conn:
 		l_db_cursor.close()
@@ -0,0 +1,208 @@
+"""
+	Set based HUC migration for migrate_hucs. The changes from a migrations file (source HUC -> destination HUC) are
+	loaded into a temporary table, and every split and merge is applied with a few INSERT ... SELECT and UPDATE
+	statements per table, instead of statements for each change and each affected observation.
+
+	As in migrate_hucs, the records for a source HUC move to its first destination, and each of its other destinations
+	gets a copy of them. The records each change affects are found before anything moves, so chained changes (A -> B
+	and B -> C) move each record once.
+
+	Nothing here commits - run migrate with a cursor for one transaction and commit once it returns, so that a failure
+	leaves the database as it was.
+"""
+
+from __future__ import absolute_import, division, print_function
+
+from . import local_vars
+from . import log
+from . import layer_fingerprints
+from . import stats_summary
+
+changes_table = "huc_migration_changes"
+
+default_zone_tables = ((local_vars.zones_aux, "zone", "id", True),)  # (table, HUC field, primary key, one record per HUC) for tables keyed by HUC, other than the observation tables
+
+
+def _columns(db_cursor, table):
+	return [record[1] for record in db_cursor.execute("PRAGMA table_info({})".format(table)).fetchall()]
+
+
+def _drop_temp(db_cursor, table):
+	db_cursor.execute("DROP TABLE IF EXISTS temp.{}".format(table))
+
+
+def load_changes(db_cursor, migrations):
+	"""
+		Loads the changes into a temporary table of (source, destination, position), where position 0 is the source's
+		first destination
+	:param db_cursor: DB-API cursor
+	:param migrations: dict of source HUC -> list of destination HUCs, as filled by migrate_hucs.load_migrations
+	:return: number of changes loaded. Changes without a source or destination are skipped
+	"""
+	_drop_temp(db_cursor, changes_table)
+	db_cursor.execute("CREATE TEMP TABLE {} (source TEXT, destination TEXT, position INTEGER)".format(changes_table))
+
+	rows = []
+	skipped = 0
+	for source in sorted(migrations):
+		destinations = [destination for destination in migrations[source] if destination]
+		if not source or not destinations:
+			skipped += len(migrations[source])
+			continue
+		rows.extend((source, destination, position) for position, destination in enumerate(destinations))
+
+	if skipped:
+		log.write("Skipping {} changes without a source or destination HUC - new HUCs are created after migrating".format(skipped), True)
+
+	db_cursor.executemany("INSERT INTO {} (source, destination, position) VALUES (?, ?, ?)".format(changes_table), rows)
+	db_cursor.execute("CREATE INDEX temp.{0}_source ON {0} (source)".format(changes_table))
+	return len(rows)
+
+
+def _snapshot(db_cursor, snapshot, table, zone_field, key_field):
+	"""
+		Records the records in table that the changes affect, with the key each one will have after migrating - its own
+		for the first destination, and a new one, after the table's current maximum, for copies
+	"""
+	_drop_temp(db_cursor, snapshot)
+	db_cursor.execute("CREATE TEMP TABLE {} (row INTEGER PRIMARY KEY, old_id INTEGER, source TEXT, destination TEXT, position INTEGER, new_id INTEGER)".format(snapshot))
+	db_cursor.execute("INSERT INTO {0} (old_id, source, destination, position) "
+					  "SELECT records.{2}, changes.source, changes.destination, changes.position FROM {1} AS records "
+					  "INNER JOIN {3} AS changes ON records.{4} = changes.source "
+					  "ORDER BY changes.position, records.{2}".format(snapshot, table, key_field, changes_table, zone_field))
+	max_id = db_cursor.execute("SELECT coalesce(max({}), 0) FROM {}".format(key_field, table)).fetchone()[0]
+	first_copy = db_cursor.execute("SELECT count(*) FROM {} WHERE position = 0".format(snapshot)).fetchone()[0]  # rows are ordered by position, so the copies come last
+	db_cursor.execute("UPDATE {} SET new_id = CASE WHEN position = 0 THEN old_id ELSE ? + row - ? END".format(snapshot), (max_id, first_copy))
+	db_cursor.execute("CREATE INDEX temp.{0}_old_id ON {0} (old_id)".format(snapshot))
+
+
+def migrate_observations(db_cursor, table, changed_collection=None, invalid=False, zone_field="zone_id", key_field="objectid"):
+	"""
+		Moves the observations in table to their destination HUCs, copying them for additional destinations
+	:param db_cursor: DB-API cursor
+	:param table: observations or invalid observations table
+	:param changed_collection: collection id to add the moved and copied observations to, or None
+	:param invalid: table is the invalid observations table - copies get reason_invalid and invalid_notes pointing to
+		the record they were copied from, and collections aren't recorded
+	:return: list of (objectid, source HUC, destination HUC) for each record moved or created
+	"""
+	snapshot = "huc_migration_{}".format(table)
+	_snapshot(db_cursor, snapshot, table, zone_field, key_field)
+
+	columns = [column for column in _columns(db_cursor, table) if column.lower() != key_field.lower()]
+	values = []
+	for column in columns:
+		if column.lower() == zone_field.lower():
+			values.append("snapshot.destination")
+		elif invalid and column.lower() in ("reason_invalid", "invalid_notes"):
+			values.append("'See ' || snapshot.old_id")
+		else:
+			values.append("records.{}".format(column))
+
+	db_cursor.execute("INSERT INTO {0} ({1}, {2}) SELECT snapshot.new_id, {3} FROM {4} AS snapshot "
+					  "INNER JOIN {0} AS records ON records.{1} = snapshot.old_id WHERE snapshot.position > 0 "
+					  "ORDER BY snapshot.new_id".format(table, key_field, ", ".join(columns), ", ".join(values), snapshot))
+	db_cursor.execute("UPDATE {0} SET {1} = (SELECT destination FROM {2} AS snapshot WHERE snapshot.old_id = {0}.{3} AND snapshot.position = 0) "
+					  "WHERE {3} IN (SELECT old_id FROM {2} WHERE position = 0)".format(table, zone_field, snapshot, key_field))
+
+	if not invalid:
+		collections = local_vars.observation_collections_table
+		db_cursor.execute("INSERT INTO {0} (observation_id, collection_id) SELECT snapshot.new_id, collections.collection_id FROM {1} AS snapshot "
+						  "INNER JOIN {0} AS collections ON collections.observation_id = snapshot.old_id WHERE snapshot.position > 0".format(collections, snapshot))
+		if changed_collection is not None:
+			db_cursor.execute("INSERT INTO {0} (observation_id, collection_id) SELECT new_id, ? FROM {1} AS snapshot "
+							  "WHERE NOT EXISTS (SELECT 1 FROM {0} WHERE observation_id = snapshot.new_id AND collection_id = ?)".format(collections, snapshot),
+							  (changed_collection, changed_collection))
+
+	moved = [tuple(record) for record in db_cursor.execute("SELECT new_id, source, destination FROM {} ORDER BY row".format(snapshot)).fetchall()]
+	log.write("Migrated {} records in {}".format(len(moved), table), True)
+	return moved
+
+
+def migrate_zone_table(db_cursor, table, zone_field, key_field, one_per_zone=True, flag_field=None):
+	"""
+		Moves the records in a table keyed by HUC to their destination HUCs, copying them for additional destinations.
+		When a table can only have one record per HUC and more than one record would end up with a HUC (or the HUC is
+		already there), the first gets it and the others get a temporary HUC of destination_number. Those need a person
+		to decide which record to keep, and are logged.
+	:param db_cursor: DB-API cursor
+	:param table: table name
+	:param zone_field: the table's HUC field
+	:param key_field: the table's primary key field
+	:param one_per_zone: whether the table has at most one record per HUC
+	:param flag_field: field set to local_vars.db_true for moved and copied records, or None
+	:return: list of (record id, destination HUC, temporary HUC) for the records that need attention
+	"""
+	snapshot = "huc_migration_{}".format(table)
+	_snapshot(db_cursor, snapshot, table, zone_field, key_field)
+
+	db_cursor.execute("ALTER TABLE temp.{} ADD COLUMN final TEXT".format(snapshot))
+	if one_per_zone:
+		# the first record moving to a HUC gets it, unless a record that isn't moving already has it
+		db_cursor.execute("UPDATE {0} SET final = destination WHERE row = (SELECT min(row) FROM {0} AS others WHERE others.destination = {0}.destination) "
+						  "AND destination NOT IN (SELECT {1} FROM {2} WHERE {1} IS NOT NULL AND {3} NOT IN (SELECT old_id FROM {0} WHERE position = 0))".format(snapshot, zone_field, table, key_field))
+		db_cursor.execute("UPDATE {} SET final = destination || '_' || row WHERE final IS NULL".format(snapshot))
+	else:
+		db_cursor.execute("UPDATE {} SET final = destination".format(snapshot))
+
+	flag_update = ", {} = {}".format(flag_field, local_vars.db_true) if flag_field else ""
+	# moving records go to a placeholder first, so records trading HUCs don't collide partway through the update
+	db_cursor.execute("UPDATE {0} SET {1} = '~migrating_' || {2} WHERE {2} IN (SELECT old_id FROM {3} WHERE position = 0)".format(table, zone_field, key_field, snapshot))
+	db_cursor.execute("UPDATE {0} SET {1} = (SELECT final FROM {3} AS snapshot WHERE snapshot.old_id = {0}.{2} AND snapshot.position = 0){4} "
+					  "WHERE {2} IN (SELECT old_id FROM {3} WHERE position = 0)".format(table, zone_field, key_field, snapshot, flag_update))
+
+	columns = [column for column in _columns(db_cursor, table) if column.lower() != key_field.lower()]
+	values = []
+	for column in columns:
+		if column.lower() == zone_field.lower():
+			values.append("snapshot.final")
+		elif flag_field and column.lower() == flag_field.lower():
+			values.append(str(local_vars.db_true))
+		else:
+			values.append("records.{}".format(column))
+	db_cursor.execute("INSERT INTO {0} ({1}) SELECT {2} FROM {3} AS snapshot INNER JOIN {0} AS records ON records.{4} = snapshot.old_id "
+					  "WHERE snapshot.position > 0 ORDER BY snapshot.row".format(table, ", ".join(columns), ", ".join(values), snapshot, key_field))
+
+	conflicts = [tuple(record) for record in db_cursor.execute("SELECT old_id, destination, final FROM {} WHERE final != destination ORDER BY row".format(snapshot)).fetchall()]
+	for record_id, destination, final in conflicts:
+		log.write("CARDINALITY VIOLATION: Human intervention needed. Table: {}, record ID: {}. Please manually determine which record to use "
+				  "between the one with the correct ID of {} and a record with the temporary ID of {}".format(table, record_id, destination, final), True)
+
+	return conflicts
+
+
+def migrate(db_cursor, migrations, changed_collection=None, flag_field=None, zone_tables=default_zone_tables):
+	"""
+		Applies a set of HUC changes to the observations, invalid observations, and tables keyed by HUC, and records the
+		species whose observations moved so that only their cached layers and summary statistics are rebuilt.
+	:param db_cursor: DB-API cursor. The caller commits
+	:param migrations: dict of source HUC -> list of destination HUCs, as filled by migrate_hucs.load_migrations
+	:param changed_collection: collection id to add affected observations to, or None
+	:param flag_field: field to flag moved and copied records with in zone_tables, or None
+	:param zone_tables: iterable of (table, HUC field, primary key, one record per HUC)
+	:return: dict with "moved" - a list of dicts (OBJECTID, from_huc, Zone_ID, Table) for each observation moved or
+		created - "species", the species codes whose observations moved, and "conflicts", a dict of table -> records
+		that need attention, as returned by migrate_zone_table
+	"""
+	log.write("Loading {} HUC changes".format(load_changes(db_cursor, migrations)), True)
+
+	moved = []
+	for table, invalid in ((local_vars.observations_table, False), (local_vars.invalid_observations_table, True)):
+		for objectid, source, destination in migrate_observations(db_cursor, table, changed_collection=changed_collection, invalid=invalid):
+			moved.append({"OBJECTID": objectid, "from_huc": source, "Zone_ID": destination, "Table": table})
+
+	conflicts = {}
+	for table, zone_field, key_field, one_per_zone in zone_tables:
+		conflicts[table] = migrate_zone_table(db_cursor, table, zone_field, key_field, one_per_zone=one_per_zone, flag_field=flag_field)
+
+	species = [record[0] for record in db_cursor.execute("SELECT DISTINCT species_id FROM {} WHERE objectid IN (SELECT new_id FROM temp.huc_migration_{})".format(
+																local_vars.observations_table, local_vars.observations_table)).fetchall()]
+	layer_fingerprints.record_species_changes(db_cursor, species)
+	stats_summary.refresh_summary(db_cursor, species)
+	log.write("Observations moved for {} species - their cached layers will be rebuilt on the next mapping run".format(len(species)), True)
+
+	_drop_temp(db_cursor, changes_table)
+	for table in [local_vars.observations_table, local_vars.invalid_observations_table] + [zone_table[0] for zone_table in zone_tables]:
+		_drop_temp(db_cursor, "huc_migration_{}".format(table))
+
+	return {"moved": moved, "species": species, "conflicts": conflicts}
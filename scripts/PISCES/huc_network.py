@@ -0,0 +1,246 @@
+"""
+	The HUC12 flow network as a graph object. Zones are stored once, in sorted order, and the upstream relationships are
+	kept as compressed sparse row (CSR) arrays, so finding everything upstream of a zone is an iterative walk over
+	slices of two arrays instead of a scan of every zone. Traversals never recurse, so there's no need to raise the
+	recursion limit for long networks.
+
+	Networks are built from (HUC_12, HU_12_DS) pairs - callbacks build them from the zones in the layer they're
+	working on. Nothing here uses arcpy.
+"""
+
+from __future__ import absolute_import, division, print_function
+
+import numpy
+
+from . import log
+
+network_end_hucs = ("CLOSED BASIN", "Mexico", "OCEAN")  # values of HU_12_DS that mean the network ends at that zone
+
+_network_end_lookup = set(end.upper() for end in network_end_hucs) | set(["CLOSED BAS"])  # CLOSED BAS is the truncated form in shorter fields
+
+
+def is_network_end(zone):
+	"""
+		Returns True if a downstream value marks the end of the network, rather than another zone
+	"""
+	return zone is not None and str(zone).strip().upper() in _network_end_lookup
+
+
+class HUCNetwork(object):
+	"""
+		Graph of zones and the zone each one drains to. Zones whose downstream value is a network end, is empty, or
+		isn't in the network (eg, HUCs clipped out of a layer) are treated as outlets. Their recorded downstream values
+		are kept in network_end and missing_downstream.
+	"""
+
+	distance_cache_size = 64  # number of source zones to keep distances_from results for
+
+	def __init__(self, zone_pairs):
+		"""
+		:param zone_pairs: iterable of (zone_id, downstream_zone_id) tuples
+		"""
+		downstream_values = {}
+		for zone, downstream in zone_pairs:
+			if zone is not None:
+				downstream_values[zone] = downstream
+
+		self.zones = sorted(downstream_values.keys())
+		self.zone_index = dict((zone, index) for index, zone in enumerate(self.zones))
+		self.network_end = {}  # zone -> HU_12_DS value for zones that drain to a network end
+		self.missing_downstream = {}  # zone -> HU_12_DS value for zones that drain to a zone that isn't in the network
+
+		# index of the downstream zone for each zone, -1 for outlets
+		self.downstream_index = numpy.full(len(self.zones), -1, dtype=numpy.int64)
+		for index, zone in enumerate(self.zones):
+			downstream = downstream_values[zone]
+			if is_network_end(downstream):
+				self.network_end[zone] = downstream
+			elif downstream in self.zone_index:
+				self.downstream_index[index] = self.zone_index[downstream]
+			elif downstream is not None:
+				self.missing_downstream[zone] = downstream
+
+		# upstream adjacency in CSR form - the zones directly upstream of zone i are upstream_indices[upstream_indptr[i]:upstream_indptr[i + 1]]
+		has_downstream = numpy.nonzero(self.downstream_index >= 0)[0]
+		targets = self.downstream_index[has_downstream]
+		order = numpy.argsort(targets, kind="mergesort")
+		self.upstream_indices = has_downstream[order]
+		self.upstream_indptr = numpy.zeros(len(self.zones) + 1, dtype=numpy.int64)
+		numpy.cumsum(numpy.bincount(targets, minlength=len(self.zones)), out=self.upstream_indptr[1:])
+
+		self._topological_order = None
+		self._distances = {}  # source zone index -> array from distances_from
+
+	def __len__(self):
+		return len(self.zones)
+
+	def __contains__(self, zone):
+		return zone in self.zone_index
+
+	def _direct_upstream_indices(self, index):
+		return self.upstream_indices[self.upstream_indptr[index]:self.upstream_indptr[index + 1]]
+
+	def downstream(self, zone):
+		"""
+			Returns the zone directly downstream of the given zone, or None if it's an outlet
+		"""
+		index = self.downstream_index[self.zone_index[zone]]
+		if index < 0:
+			return None
+		return self.zones[index]
+
+	def direct_upstream(self, zone):
+		"""
+			Returns the list of zones that drain directly into the given zone
+		"""
+		return [self.zones[index] for index in self._direct_upstream_indices(self.zone_index[zone])]
+
+	def upstream(self, zone, include_self=False, stop_at=None):
+		"""
+			Returns every zone upstream of the given zone.
+		:param zone: zone id
+		:param include_self: include the zone itself as the first item in the result
+		:param stop_at: optional collection of zones (eg, zones with dams) that are included in the results, but that
+			the walk doesn't continue upstream of
+		:return: list of zone ids, nearest zones first
+		"""
+		start = self.zone_index[zone]
+		stop_indices = set(self.zone_index[stop] for stop in stop_at if stop in self.zone_index) if stop_at else set()
+
+		visited = set([start])
+		result = [start] if include_self else []
+		frontier = [start]
+		while frontier:
+			next_frontier = []
+			for index in frontier:
+				if index != start and index in stop_indices:
+					continue
+				for upstream_index in self._direct_upstream_indices(index):
+					if upstream_index not in visited:  # guards against loops in bad network data
+						visited.add(upstream_index)
+						result.append(upstream_index)
+						next_frontier.append(upstream_index)
+			frontier = next_frontier
+
+		return [self.zones[index] for index in result]
+
+	def path(self, zone, include_missing=False):
+		"""
+			Returns the list of zones from the given zone downstream to its outlet, starting with the zone itself
+		:param zone: zone id
+		:param include_missing: when the path ends at a zone whose downstream zone isn't in the network (eg, clipped
+			out of a layer), add that downstream zone id as the last item, so paths that leave the network at the same
+			place still meet
+		:return: list of zone ids
+		"""
+		if zone not in self.zone_index:
+			return [zone] if include_missing and zone is not None and not is_network_end(zone) else []
+
+		index = self.zone_index[zone]
+		visited = set()
+		path = []
+		while index >= 0 and index not in visited:
+			visited.add(index)
+			path.append(self.zones[index])
+			index = self.downstream_index[index]
+
+		if index >= 0:
+			log.warning("Loop in HUC network downstream of {} - stopping path at {}".format(zone, path[-1]))
+		elif include_missing and path[-1] in self.missing_downstream:
+			path.append(self.missing_downstream[path[-1]])
+		return path
+
+	def topological_order(self):
+		"""
+			Returns zone indices ordered so that every zone comes after all of the zones upstream of it. Zones that are
+			part of a loop can't be ordered and are left out, with a warning.
+		:return: numpy array of indices into self.zones
+		"""
+		if self._topological_order is not None:
+			return self._topological_order
+
+		remaining_upstream = numpy.diff(self.upstream_indptr)
+		ready = list(numpy.nonzero(remaining_upstream == 0)[0])
+		order = []
+		while ready:
+			index = ready.pop()
+			order.append(index)
+			downstream = self.downstream_index[index]
+			if downstream >= 0:
+				remaining_upstream[downstream] -= 1
+				if remaining_upstream[downstream] == 0:
+					ready.append(downstream)
+
+		if len(order) < len(self.zones):
+			log.warning("{} zones in the HUC network are part of a loop and were left out of upstream totals".format(len(self.zones) - len(order)))
+
+		self._topological_order = numpy.array(order, dtype=numpy.int64)
+		return self._topological_order
+
+	def accumulate_upstream(self, values):
+		"""
+			Sums a value over every zone upstream of each zone, not including the zone itself.
+		:param values: sequence of numbers aligned with self.zones. None is treated as 0
+		:return: numpy array of totals aligned with self.zones
+		"""
+		own = numpy.array([0 if value is None else value for value in values], dtype=numpy.float64)
+		totals = numpy.zeros(len(self.zones), dtype=numpy.float64)
+		for index in self.topological_order():
+			downstream = self.downstream_index[index]
+			if downstream >= 0:
+				totals[downstream] += totals[index] + own[index]
+		return totals
+
+	def distances_from(self, zone):
+		"""
+			Network distance - the number of steps along the flow network to the point where the two paths downstream
+			meet, plus the steps from there - from one zone to every zone in the network. Computed in one pass in
+			downstream-first order, since every zone's distance is one more than its downstream zone's unless it's on
+			the source zone's own path. Results are cached per source zone.
+		:param zone: the source zone
+		:return: numpy array of distances aligned with self.zones, with -1 for zones not connected to the source
+		"""
+		source = self.zone_index[zone]
+		if source in self._distances:
+			return self._distances[source]
+
+		source_path = self.path(zone)
+		distances = numpy.full(len(self.zones), -1, dtype=numpy.int64)
+		on_path = set()
+		for position, path_zone in enumerate(source_path):
+			distances[self.zone_index[path_zone]] = position
+			on_path.add(self.zone_index[path_zone])
+
+		# paths that leave the network at the same missing zone meet there, one step past the end of the source's path
+		missing_terminal = self.missing_downstream.get(source_path[-1])
+
+		for index in self.topological_order()[::-1]:
+			if index in on_path:
+				continue
+			downstream = self.downstream_index[index]
+			if downstream >= 0:
+				if distances[downstream] >= 0:
+					distances[index] = distances[downstream] + 1
+			elif missing_terminal is not None and self.missing_downstream.get(self.zones[index]) == missing_terminal:
+				distances[index] = len(source_path) + 1
+
+		if len(self._distances) >= self.distance_cache_size:
+			self._distances.clear()
+		self._distances[source] = distances
+		return distances
+
+	def distance(self, zone1, zone2):
+		"""
+			Network distance between two zones, or None if they aren't connected
+		"""
+		if zone1 not in self.zone_index or zone2 not in self.zone_index:
+			return None
+
+		distance = self.distances_from(zone1)[self.zone_index[zone2]]
+		return None if distance < 0 else int(distance)
+
+	def upstream_counts(self):
+		"""
+			Returns the number of zones upstream of each zone, aligned with self.zones
+		"""
+		return self.accumulate_upstream(numpy.ones(len(self.zones))).astype(numpy.int64)
@@ -11,8 +11,9 @@ from .. import local_vars
 from ..local_vars import input_filter_methods, get_species_from_alt_code, alt_codes_by_filter
 from .. import api
 from .. import funcs
+from .. import spatial_join
 
-from .common import tablecoords_to_file, table_to_array, multifeature_to_HUCs, determine_certainty, copy_row
+from .common import tablecoords_to_file, tablecoords_to_HUCs, table_to_array, multifeature_to_HUCs, determine_certainty, copy_row
 
 log = logging.getLogger("PISCES.input_filters")
 
@@ -242,12 +243,19 @@ class Gen_Table_IF(InputFilter):
 			This function is a key function to override for data of differing form or formats.
 		:return: list: full, spatially joined record information for all HUCs the dataset passed in had data for
 		"""
+		if local_vars.spatial_join_engine == "python":  # read tables without arcpy where we can, so this runs where arcpy isn't installed
+			rows = spatial_join.read_table(self.parent.dataset_path)
+			if rows is not None:
+				return tablecoords_to_HUCs(self.parent.dataset_path, self.fmap_index, self.parent.new_data.Projection_Key, rows=rows)
+
 		try:
 			describer = arcpy.Describe(self.parent.dataset_path)
 		except:
 			raise local_vars.DataProcessingError("Unable to determine object type")
 
-		if describer.dataType == "Table":
+		if describer.dataType == "Table" and local_vars.spatial_join_engine == "python":
+			return tablecoords_to_HUCs(self.parent.dataset_path, self.fmap_index, self.parent.new_data.Projection_Key)
+		elif describer.dataType == "Table":
 			try:
 				l_features = tablecoords_to_file(self.parent.dataset_path, self.fmap_index, self.parent.new_data.Projection_Key)  # dataset, field name for x axis, field name for y axis, and the projection they are all in
 			except local_vars.DataProcessingError as lerror:
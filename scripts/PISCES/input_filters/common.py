@@ -11,9 +11,14 @@ from ..local_vars import input_rows, DataProcessingError, input_filter_list, all
 	maindb, db_last_insert, copy_data, observationsdb, remove_data, newdb, field_maps
 
 from ..funcs import db_connect, db_close
+from .. import layer_fingerprints
+from .. import stats_summary
+from .. import spatial_join
 
 log = logging.getLogger("PISCES.input_filters")
 
+zone_index = None  # spatial_join.ZoneIndex of the zones - loaded on first use by load_zone_index
+
 class EmptyRow(object):
 	def __init__(self):
 		pass
@@ -213,6 +218,93 @@ def multifeature_to_HUCs(feature=None, relationship="HAVE_THEIR_CENTER_IN"):
 	return zones
 
 
+def load_zone_index(reload=False):
+	"""
+		Loads the zone polygons from local_vars.HUCS into a spatial_join.ZoneIndex once per process, for the python
+		spatial join engine. Reads them with arcpy when it's available and with fiona otherwise.
+	:param reload: discard an index that's already loaded and read the zones again
+	:return: spatial_join.ZoneIndex
+	"""
+	global zone_index
+
+	if (zone_index is None or reload) and not local_vars.ARCPY_AVAILABLE:
+		log.info("Loading zones for spatial joins with fiona")
+		zone_index = spatial_join.ZoneIndex.from_fiona(*spatial_join.split_geodatabase_path(local_vars.HUCS))
+	elif zone_index is None or reload:
+		log.info("Loading zones for spatial joins")
+		fields = [field.name for field in arcpy.ListFields(local_vars.HUCS) if field.type not in ("OID", "Geometry")]
+		zones = []
+		ids = []
+		with arcpy.da.SearchCursor(local_vars.HUCS, ["OID@", "SHAPE@"] + fields) as rows:  # file geodatabases return rows in OID order
+			for row in rows:
+				rings = []
+				for part in row[1]:
+					ring = []
+					for point in part:
+						if point is None:  # a None separates a ring from the next ring (holes) in the same part
+							rings.append(ring)
+							ring = []
+						else:
+							ring.append((point.X, point.Y))
+					rings.append(ring)
+				ids.append(row[0])
+				zones.append((dict(zip(fields, row[2:])), rings))
+		zone_index = spatial_join.ZoneIndex(zones, ids=ids)
+
+	return zone_index
+
+
+def tablecoords_to_HUCs(dataset_path, field_map, projection_index, rows=None):
+	"""
+		Python engine version of tablecoords_to_file followed by multifeature_to_HUCs - joins the coordinates in a table
+		to the zones in memory instead of writing out, projecting, and spatially joining a feature class. Records come
+		back in the same form and order as multifeature_to_HUCs returns them, other than the geometry and OBJECTID fields
+		of the joined feature class.
+	:param dataset_path: table with coordinates
+	:param field_map: field map for the dataset - the Longitude and Latitude entries give the coordinate fields
+	:param projection_index: EPSG code of the coordinates
+	:param rows: the table's records as dicts, if they've already been read. When None, they're read with
+		spatial_join.read_table, falling back to arcpy for tables it can't read.
+	:return: list of EmptyRow objects
+	"""
+
+	if projection_index is None:
+		raise local_vars.DataProcessingError("No projection specified for dataset %s" % dataset_path)
+
+	try:
+		x_field = field_map["Longitude"].input_field
+		y_field = field_map["Latitude"].input_field
+	except KeyError:
+		raise local_vars.DataProcessingError("Unable to retrieve coordinates from %s - check your field map" % dataset_path)
+
+	if rows is None:
+		rows = spatial_join.read_table(dataset_path)
+	if rows is None:
+		rows = [row.__dict__ for row in table_to_array(dataset_path)]
+
+	point_records = []
+	for row in rows:
+		try:
+			if row[x_field] is None or row[y_field] is None:  # skip records without both coordinates, like tablecoords_to_file
+				continue
+		except KeyError:
+			raise local_vars.DataProcessingError("Unable to retrieve coordinates from %s - check your field map" % dataset_path)
+		point_records.append(row)
+
+	x, y = spatial_join.transform_coordinates([record[x_field] for record in point_records],
+											  [record[y_field] for record in point_records],
+											  int(projection_index), local_vars.zones_epsg)
+
+	records = []
+	for record in spatial_join.join_records(load_zone_index(), point_records, x, y):
+		l_row = EmptyRow()
+		l_row.__dict__.update(record)
+		records.append(l_row)
+
+	log.info("Joined %s points to zones" % len(records))
+	return records
+
+
 def feature_to_HUCs(feature=None, intersect_centroid="INTERSECT"):
 	"""intersect_centroid is just whether we want to overlap by intersect or centroid methods"""
 
@@ -548,12 +640,64 @@ class observation_set:  # basic data structure that holds the data we'll be addi
 				for c_id in obs.collections:  # basically, if there are any collections, insert them
 					db_cursor.execute(l_sql, obs.db_id, c_id)
 
+	def insert_batched(self, db_cursor, db_conn=None, batch_size=None, commit_interval=None):
+		"""
+			Batched version of insert_data and insert_collections. Allocates a block of objectids for all of the
+			observations up front, so nothing has to be read back after each insert, then inserts the observations and
+			their collections with executemany, batch_size observations at a time.
+		:param db_cursor: cursor to insert with
+		:param db_conn: connection to commit on - only used when commit_interval is set
+		:param batch_size: observations per executemany. Defaults to local_vars.import_batch_size
+		:param commit_interval: commit after this many batches. Defaults to local_vars.import_commit_interval. 0 or None
+			leaves committing to the caller, so a failed import can still be rolled back as a whole
+		:return: None
+		"""
+
+		batch_size = batch_size or local_vars.import_batch_size
+		if commit_interval is None:
+			commit_interval = local_vars.import_commit_interval
+
+		observations = [obs for result in self.results for obs in result.observations]
+		if len(observations) == 0:
+			return
+
+		# objectid is the rowid, so explicit values above the current maximum are the same ones the database would assign
+		max_id = db_cursor.execute("select max(objectid) from observations").fetchone()[0]
+		next_id = (max_id or 0) + 1
+
+		observation_sql = "insert into observations (objectid,set_id,species_id,zone_id,presence_type,if_method,certainty,longitude,latitude,notes,other_data,observation_date,survey_method) values (?,?,?,?,?,?,?,?,?,?,?,?,?)"
+		collection_sql = "insert into observation_collections (observation_id, collection_id) values (?,?)"
+
+		if_methods = {}  # id of observation -> if_method id, since the method is stored on the result, not the observation
+		for result in self.results:
+			for obs in result.observations:
+				if_methods[id(obs)] = result.if_method.method_id
+
+		for batch_number, start in enumerate(range(0, len(observations), batch_size)):
+			batch = observations[start:start + batch_size]
+			for obs in batch:
+				obs.db_id = next_id
+				next_id += 1
+
+			db_cursor.executemany(observation_sql, [(obs.db_id, self.set_id, obs.species_id, obs.zone_id, obs.presence_type, if_methods[id(obs)], obs.certainty, obs.longitude, obs.latitude, obs.notes, obs.other_data, obs.observation_date, obs.survey_method) for obs in batch])
+
+			collection_rows = [(obs.db_id, c_id) for obs in batch for c_id in obs.collections]
+			if collection_rows:
+				db_cursor.executemany(collection_sql, collection_rows)
+
+			if commit_interval and db_conn is not None and (batch_number + 1) % commit_interval == 0:
+				db_conn.commit()
+				log.debug("Committed %s of %s observations for %s" % (start + len(batch), len(observations), self.dataset_name))
+
 	def record_data(self, db_cursor, db_conn):
 		log.info("Inserting new records for %s" % self.dataset_name)
 		log.data_write("Inserting new records for %s" % self.dataset_name)
-		self.insert_data(db_cursor)  # insert the processed observations into the database
+		if local_vars.import_batch_size:
+			self.insert_batched(db_cursor, db_conn)  # inserts the observations and their collections in batches
+		else:
+			self.insert_data(db_cursor)  # insert the processed observations into the database
 
-		self.insert_collections(db_cursor)  # the objectid is already set on all new observations
+			self.insert_collections(db_cursor)  # the objectid is already set on all new observations
 
 		log.info("Copying data source %s to observations database" % self.dataset_name)
 		self.save_data(db_cursor)  # copies the source datafiles to the observations storage database and updates the source locations of the data
@@ -577,6 +721,11 @@ class observation_set:  # basic data structure that holds the data we'll be addi
 		l_sql = "update Observation_Sets set Source_Data = ? where Set_ID = ?"
 		db_cursor.execute(l_sql, self.dataset_path, self.set_id)
 
+		# so the next mapping run rebuilds only the cached layers for the species in this dataset
+		changed_species = [obs.species_id for result in self.results for obs in result.observations]
+		layer_fingerprints.record_species_changes(db_cursor, changed_species)
+		stats_summary.refresh_summary(db_cursor, changed_species)  # keeps data_stats current if the summary table is in use
+
 		#mark the input row as imported - we want that info saved in case something went wrong, so don't delete it
 		self.cleanup_mark_input_row_imported()
 
@@ -594,6 +743,7 @@ class observation_set:  # basic data structure that holds the data we'll be addi
 
 def import_new_data(dataset_name=None):
 
+	local_vars.check_observations_db()  # make sure we have an observations db to copy the datasets into
 	new_data_fetch(dataset_name=dataset_name)  # checks for new data, validates that it exists, and puts the info in the right spots
 	setup_new_data(local_vars.datasets)
 
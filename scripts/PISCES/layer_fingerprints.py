@@ -0,0 +1,144 @@
+"""
+	Fingerprints for the layer cache, so that cached layers are only rebuilt when the data behind them changes. Every
+	layer written to the cache gets a fingerprint - a hash of its query, callback, and the zones the query returned - and
+	a record of the species it was built from. Code that changes observations records the species it touched, and
+	before mapping, invalidate_changed_species removes just the cache entries built from those species instead of the
+	whole cache being thrown away.
+
+	Layers whose species aren't known (multi-species and richness queries, or queries bound to something other than a
+	species) are recorded as depending on all species, so any recorded change invalidates them.
+
+	The tables are created on first use. Nothing here uses arcpy - callers delete the cached feature classes themselves.
+"""
+
+from __future__ import absolute_import, division, print_function
+
+import hashlib
+
+from . import log
+
+fingerprints_table = "layer_cache_fingerprints"
+species_table = "layer_cache_species"
+changes_table = "layer_cache_changed_species"
+
+null_bind = "NULL"  # funcs.generate_layer_name stores layers without a bind variable under this value
+
+
+def _bind(bind_var):
+	return null_bind if bind_var is None else str(bind_var)
+
+
+def ensure_tables(db_cursor):
+	"""
+		Creates the fingerprint, layer species, and species change tables if they don't exist
+	:param db_cursor: DB-API cursor
+	"""
+	db_cursor.execute("CREATE TABLE IF NOT EXISTS {} (query_id INTEGER, bind_var TEXT, fingerprint TEXT, all_species INTEGER, PRIMARY KEY (query_id, bind_var))".format(fingerprints_table))
+	db_cursor.execute("CREATE TABLE IF NOT EXISTS {} (query_id INTEGER, bind_var TEXT, species_id TEXT)".format(species_table))
+	db_cursor.execute("CREATE INDEX IF NOT EXISTS {0}_species_id ON {0} (species_id)".format(species_table))
+	db_cursor.execute("CREATE TABLE IF NOT EXISTS {} (species_id TEXT PRIMARY KEY, changed TEXT)".format(changes_table))
+
+
+def fingerprint(query_string, callback, callback_args, zones):
+	"""
+		Hashes the parts of a layer that determine its contents
+	:param query_string: the layer's query, after variable and bind replacement
+	:param callback: name of the callback, or None
+	:param callback_args: list of callback arguments, or None
+	:param zones: the zones the query returned. Order and duplicates don't matter
+	:return: hex digest string
+	"""
+	digest = hashlib.sha1()
+	for part in (query_string, callback, "|".join(callback_args or ())):
+		digest.update(u"{}\n".format(part).encode("utf-8"))
+	for zone in sorted(set(str(zone) for zone in zones)):
+		digest.update(u"{}\n".format(zone).encode("utf-8"))
+	return digest.hexdigest()
+
+
+def record_layer(db_cursor, query_id, bind_var, layer_fingerprint, species=None):
+	"""
+		Records the fingerprint and species for a layer that was just written to the layer cache
+	:param db_cursor: DB-API cursor
+	:param query_id: map query id
+	:param bind_var: bind variable the layer was made with
+	:param layer_fingerprint: value from fingerprint()
+	:param species: iterable of species codes the layer was built from, or None if it could depend on any species
+	"""
+	ensure_tables(db_cursor)
+	bind_var = _bind(bind_var)
+
+	remove_layer(db_cursor, query_id, bind_var)
+	db_cursor.execute("INSERT INTO {} (query_id, bind_var, fingerprint, all_species) VALUES (?, ?, ?, ?)".format(fingerprints_table),
+					  (query_id, bind_var, layer_fingerprint, 1 if species is None else 0))
+	if species is not None:
+		db_cursor.executemany("INSERT INTO {} (query_id, bind_var, species_id) VALUES (?, ?, ?)".format(species_table),
+							  [(query_id, bind_var, species_id) for species_id in sorted(set(species))])
+
+
+def remove_layer(db_cursor, query_id, bind_var):
+	bind_var = _bind(bind_var)
+	db_cursor.execute("DELETE FROM {} WHERE query_id = ? AND bind_var = ?".format(fingerprints_table), (query_id, bind_var))
+	db_cursor.execute("DELETE FROM {} WHERE query_id = ? AND bind_var = ?".format(species_table), (query_id, bind_var))
+
+
+def is_current(db_cursor, query_id, bind_var, layer_fingerprint):
+	"""
+		Checks whether the cached layer for a query and bind variable was built from the same query and zones
+	:return: True if a fingerprint is recorded and matches, False otherwise
+	"""
+	ensure_tables(db_cursor)
+	row = db_cursor.execute("SELECT fingerprint FROM {} WHERE query_id = ? AND bind_var = ?".format(fingerprints_table), (query_id, _bind(bind_var))).fetchone()
+	return row is not None and row[0] == layer_fingerprint
+
+
+def record_species_changes(db_cursor, species_ids):
+	"""
+		Records that observations for the given species changed, so that layers built from them are invalidated before
+		the next mapping run. Call with the same cursor that makes the changes so that both are committed together.
+	:param db_cursor: DB-API cursor
+	:param species_ids: iterable of species codes. None values are ignored
+	"""
+	species_ids = sorted(set(species_id for species_id in species_ids if species_id))
+	if not species_ids:
+		return
+
+	ensure_tables(db_cursor)
+	db_cursor.executemany("INSERT OR REPLACE INTO {} (species_id, changed) VALUES (?, datetime('now'))".format(changes_table), [(species_id,) for species_id in species_ids])
+
+
+def invalidate_changed_species(db_cursor):
+	"""
+		Removes the layer_cache rows (and fingerprints) for every layer built from a species with recorded changes, plus
+		every layer that depends on all species if there were any changes, then clears the recorded changes.
+	:param db_cursor: DB-API cursor
+	:return: list of layer_file names that were removed from layer_cache - the caller should delete them from the cache
+	"""
+	ensure_tables(db_cursor)
+	changed = [row[0] for row in db_cursor.execute("SELECT species_id FROM {}".format(changes_table)).fetchall()]
+	if not changed:
+		return []
+
+	affected = db_cursor.execute("SELECT DISTINCT query_id, bind_var FROM {0} WHERE species_id IN (SELECT species_id FROM {1}) "
+								 "UNION SELECT query_id, bind_var FROM {2} WHERE all_species = 1".format(species_table, changes_table, fingerprints_table)).fetchall()
+
+	layer_files = []
+	for query_id, bind_var in affected:
+		for row in db_cursor.execute("SELECT layer_file FROM layer_cache WHERE query_id = ? AND bind_var = ?", (query_id, bind_var)).fetchall():
+			layer_files.append(row[0])
+		db_cursor.execute("DELETE FROM layer_cache WHERE query_id = ? AND bind_var = ?", (query_id, bind_var))
+		remove_layer(db_cursor, query_id, bind_var)
+
+	db_cursor.execute("DELETE FROM {}".format(changes_table))
+
+	log.write("Invalidated {} cached layers after changes to {} species".format(len(affected), len(changed)), True)
+	return layer_files
+
+
+def clear(db_cursor):
+	"""
+		Removes all fingerprints and recorded changes - for when the whole layer cache is being rebuilt
+	"""
+	ensure_tables(db_cursor)
+	for table in (fingerprints_table, species_table, changes_table):
+		db_cursor.execute("DELETE FROM {}".format(table))
@@ -8,14 +8,18 @@ import logging
 import sys
 
 import six
+from six.moves import cPickle as pickle
 import pyodbc
 
 import arcpy
 
-if six.PY2:
-	import _winreg as winreg
-else:
-	import winreg
+try:
+	if six.PY2:
+		import _winreg as winreg
+	else:
+		import winreg
+except ImportError:
+	winreg = None  # only read on win32, in set_workspace_vars - lets the benchmarks run on other platforms
 
 from . import ARCPY_AVAILABLE
 from . import log  # safe to import now because we made it not import local vars
@@ -47,14 +51,80 @@ code_folder = None
 #OPTIONS
 auto_project = None
 
+
+class LazyData(dict):
+	"""
+		A dictionary of configuration data from the database that fills itself the first time it's read, so data_setup
+		doesn't need to query for everything at startup. It's always filled in place - modules that did
+		"from local_vars import all_fish" hold this same object, and see the data once it loads.
+	"""
+
+	def __init__(self, name, loader):
+		"""
+		:param name: the name of the dataset in the startup cache
+		:param loader: function that takes this object and fills it
+		"""
+		dict.__init__(self)
+		self.name = name
+		self.loader = loader
+		self.loaded = False
+		lazy_data.append(self)
+
+	def load(self):
+		self.loaded = True  # set first - the loaders read and write the dictionary through its usual methods
+		dict.clear(self)
+		cache_key = startup_cache_key()
+		if not load_from_startup_cache(self, cache_key):
+			try:
+				self.loader(self)
+			except:
+				self.reset()  # so that the next access tries again instead of seeing partial data
+				raise
+			save_to_startup_cache(self, cache_key)
+
+	def reset(self):
+		"""
+			Empties the dictionary so that it reloads on next access - for when the database changes
+		"""
+		dict.clear(self)
+		self.loaded = False
+
+	# compare by identity, so that "in", list.remove, and other equality checks never load from the database - and
+	# two datasets that haven't loaded yet aren't equal just because they're both empty
+	def __eq__(self, other):
+		return self is other
+
+	def __ne__(self, other):
+		return self is not other
+
+	__hash__ = object.__hash__
+
+
+def _load_first(method):
+	def load_and_call(self, *args, **kwargs):
+		if not self.loaded:
+			self.load()
+		return method(self, *args, **kwargs)
+	load_and_call.__name__ = method.__name__
+	return load_and_call
+
+for _method_name in ("__getitem__", "__setitem__", "__delitem__", "__contains__", "__iter__", "__len__", "__repr__",
+						"get", "keys", "values", "items", "copy", "setdefault", "update", "pop", "popitem",
+						"has_key", "iterkeys", "itervalues", "iteritems", "viewkeys", "viewvalues", "viewitems"):
+	if hasattr(dict, _method_name):  # the iter and view methods are Python 2 only
+		setattr(LazyData, _method_name, _load_first(getattr(dict, _method_name)))
+
+lazy_data = []  # every LazyData instance, so data_setup can reset them all
+
 # data variables and input filters
-all_fish = {}
+all_fish = LazyData("all_fish", lambda data: data.update(get_species_data()))
 input_rows = {}
 datasets = []
-observation_certainties = {}
-input_filter_methods = {}  # dictionary containing all IF Methods. Indexed by Filter_Code, each dictionary value is an array of if_method objects that can be looked up by code
-alt_codes_by_filter = {}  # each dictionary entry (input filter is the key) holds another dictionary where the alt_code returns the species id
-field_maps = {}  # indexed by set id number, but not necessarily contiguous. Each entry is an array of the items required for a set
+observation_certainties = LazyData("observation_certainties", lambda data: get_observation_certainties())
+input_filter_methods = LazyData("input_filter_methods", lambda data: retrieve_input_filter_methods())  # dictionary containing all IF Methods. Indexed by Filter_Code, each dictionary value is an array of if_method objects that can be looked up by code
+alt_codes_by_filter = LazyData("alt_codes_by_filter", lambda data: pull_alt_codes())  # each dictionary entry (input filter is the key) holds another dictionary where the alt_code returns the species id
+field_maps = LazyData("field_maps", lambda data: pull_field_maps())  # indexed by set id number, but not necessarily contiguous. Each entry is an array of the items required for a set
+input_filter_list = LazyData("input_filter_list", lambda data: get_input_filter_list())  # input filter code -> class name
 
 seven_zip = None
 data_license = None
@@ -169,6 +239,29 @@ web_layer_csv_writer = None
 web_layer_csv_file = None
 config_metadata = True
 force_cache_search = True  # for items that try the layer cache first, look in the cache instead of at the data table
+postprocess_zones_batch = True  # when True, postprocess_zones runs each of its queries once for all zones with a temporary table of zone IDs instead of once per zone
+use_presence_index = False  # when True, api presence and listing functions answer from an in-memory index (api_components.presence_index) instead of querying each time
+mega_diversity_single_pass = False  # when True, callbacks.mega_diversity_info loads presence data once and computes every column in memory (callbacks.diversity_engine) instead of running each metric as its own set of queries
+bulk_observation_metadata = True  # when True, map layers with metadata plugins retrieve their observation records with a few IN queries instead of one query per observation
+mapping_processes = 1  # number of worker processes mapping.begin uses to make layers. Each worker uses its own scratch geodatabase and the layer cache is written by the main process. 1 makes layers serially in the main process
+incremental_layer_cache = True  # when True, cached layers are reused by later mapping runs until their query results or the observations for their species change (see layer_fingerprints) instead of being rebuilt every run
+import_batch_size = 5000  # observations per executemany when importing datasets. 0 inserts them one at a time, reading back each objectid
+import_commit_interval = 0  # when batching imports, commit after this many batches. 0 commits once at the end of the import, so a failure rolls back everything
+spatial_join_engine = "arcpy"  # how table based imports find the zones for their coordinates - "arcpy" writes, projects, and spatially joins a feature class. "python" joins them in memory with spatial_join (needs pyproj to reproject, and fiona to read zones and geodatabase tables without arcpy)
+zones_epsg = 3310  # EPSG code for the coordinate system of the zones layer (Teale Albers, as in default_proj)
+db_driver = "odbc"  # how funcs.db_connect opens SQLite databases - "odbc" uses pyodbc and the SQLite3 ODBC Driver. "sqlite3" uses Python's built-in sqlite3 module, for machines without the ODBC driver (benchmarks use it). Access databases always use ODBC
+db_connection_pooling = True  # when True, funcs.db_close keeps SQLite connections open for the next funcs.db_connect to the same database instead of closing them
+db_pool_size = 4  # idle connections kept per database when pooling
+sqlite_pragmas = (("journal_mode", "WAL"), ("synchronous", "NORMAL"), ("cache_size", -65536), ("mmap_size", 268435456), ("temp_store", "MEMORY"))  # applied to each new SQLite connection by funcs.db_connect, in order. Set a value to None to skip it - eg, journal_mode on network drives, where WAL doesn't work
+map_profiling = False  # when True, mapping records wall time, SQL statements, and rows read and written for each map, layer, and callback (see profiling) and writes a JSON report to the log folder at the end of mapping.begin
+use_stats_summary = False  # when True, funcs.data_stats reads observation counts from the stats_summary table (building it the first time) instead of scanning observations. Once built, imports and record modifications keep it up to date
+cprofile_map = None  # query set id, short name, or title of a map to run under cProfile - the stats are written to the log folder at the end of mapping.begin
+range_comparison_engine = "python"  # how comparison.batch_compare_species_ranges compares ranges - "python" sums zone areas and centroids from the presence index (range_comparison - zone centroids are computed from the zones on first use, with arcpy or fiona). "arcpy" builds and overlays layers for each species
+range_comparison_processes = 1  # worker processes for the python range comparison engine
+clustering_engine = "arcpy"  # how tbx_make_clusters.make_species_clusters groups zones - "arcpy" runs Grouping Analysis on intermediate feature classes and writes a feature class. "python" clusters the presence matrix in memory (clustering - for contiguous groups, run tbx_make_clusters.build_zone_adjacency once first) and writes a CSV of each zone's groups
+clustering_processes = 1  # worker processes for the python clustering engine - each number of groups runs in its own process
+lazy_data_setup = True  # when True, data_setup doesn't query the database - all_fish, the input filter information, alt codes, observation certainties, and field maps each load on first access. False loads them all at startup
+startup_cache = False  # when True, the data loaded by data_setup is saved to a file in the temp folder and reused by later runs until the main or new data database is modified
 
 
 from .code_library_data_files import data_file
@@ -187,7 +280,7 @@ def set_workspace_vars(l_workspace=None):
 	global internal_workspace, maindb, ormdb, newdb, spatialdb, workspace, calcs_mdb, temp, observationsdb, layer_cache, geo_aux
 	global HUCS, mxd_source, mxd_ddp_source, test_folder
 	global auto_project
-	global all_fish, input_rows, datasets
+	global input_rows, datasets
 	global seven_zip
 	global data_license
 	global set_workspace_run
@@ -241,7 +334,8 @@ def set_workspace_vars(l_workspace=None):
 	auto_project = 1  # sets whether we should attempt to reproject datasets that aren't in Teale Albers. If this is 1, then we will. TODO: Make parameter
 	
 	# data variables
-	all_fish = {}
+	for data in lazy_data:
+		data.reset()  # the databases may have changed
 	input_rows = {}  # stores all of the input data by filename for access at the appropriate time - avoids extra SQL connections/releases and can be accessed later
 	datasets = []
 	
@@ -257,28 +351,19 @@ from PISCES import __version__
 version = __version__
 
 
-### We're duplicating the database connection code here to avoid a circular import - in the future it'd be good to get it out of here entirely. But baby steps
 def db_connect(db_name, note=None, access=False):
-
-	log_string = "Making database connection to %s" % db_name
-
-	if note is not None:
-		log_string += " - note added: %s" % note
-
-	log.write(log_string)
-
-	if not access:
-		conn = pyodbc.connect('DRIVER=SQLite3 ODBC Driver;Database=%s' % db_name)
-	else:
-		conn = pyodbc.connect('DRIVER={Microsoft Access Driver (*.mdb)};DBQ='+db_name)
-
-	return conn.cursor(), conn
+	"""
+		Connects with funcs.db_connect, so that startup data loading gets the same pooling, pragmas, and timings as the
+		rest of PISCES. funcs is imported here, not at the top, because it imports local_vars.
+	"""
+	from . import funcs
+	return funcs.db_connect(db_name, note, access)
 
 
 def db_close(cursor, conn):
-	log.write("Closing database connection")
-	cursor.close()
-	conn.close()
+	from . import funcs
+	funcs.db_close(cursor, conn)
+
 
 def start(arc_script=False):
 	set_workspace_vars()  # call it immediately
@@ -533,27 +618,102 @@ def print_workspace_vars():
 def log_version_information():
 	log.info("PISCES code version {}. Date last record added to database: {}.".format(version, most_recent_record()))
 
-def data_setup():
+def data_setup(lazy=None):
 	"""
-		Main function calling various others to set up internal variables that speed up PISCES
+		Main function calling various others to set up internal variables that speed up PISCES. The observations
+		geodatabase is checked by input_filters.common.import_new_data, which is the only thing that needs it.
+	:param lazy: when True, the data is cleared and loaded from the database on first access instead of now. Defaults to
+		lazy_data_setup
 	"""
+	global data_setup_run
 
-	global all_fish
+	if lazy is None:
+		lazy = lazy_data_setup
 
 	log_version_information()
 	log.write("Loading Configuration Data", 1)
-	all_fish = get_species_data()
-	check_observations_db()  # checks to make sure we have an observations db to import to
-	get_input_filter_list()  # populate the IF list
-	retrieve_input_filter_methods()  # populate the listing of methods for each IF
-	pull_alt_codes()
-	get_observation_certainties()  # populates the dictionary of default certainties for observations
-	pull_field_maps()
+	for data in lazy_data:
+		data.reset()
+	if not lazy:
+		for data in lazy_data:
+			data.load()
 
-	global data_setup_run
 	data_setup_run = True
 
 
+_startup_cache_contents = None  # the cache file's contents once read - {"key": cache key, "data": {dataset name: dict}}
+
+
+def startup_cache_path():
+	return os.path.join(temp, "startup_cache.pickle")
+
+
+def startup_cache_key():
+	"""
+		Identifies the state of the databases the startup data comes from - their paths and modification times (including
+		SQLite's write ahead log, which is written before the database itself) and the PISCES version
+	"""
+	modified = []
+	for path in (maindb, "{}-wal".format(maindb), newdb):
+		try:
+			modified.append(os.path.getmtime(path))
+		except (OSError, TypeError):
+			modified.append(None)
+	return version, maindb, newdb, tuple(modified)
+
+
+def load_from_startup_cache(data, cache_key):
+	"""
+		Fills data from the startup cache file if startup_cache is on and the cache matches the current databases
+	:param data: LazyData instance
+	:param cache_key: from startup_cache_key
+	:return: True if data was filled from the cache
+	"""
+	global _startup_cache_contents
+
+	if not startup_cache:
+		return False
+
+	if _startup_cache_contents is None or _startup_cache_contents["key"] != cache_key:
+		_startup_cache_contents = {"key": cache_key, "data": {}}
+		try:
+			with open(startup_cache_path(), 'rb') as cache_file:
+				contents = pickle.load(cache_file)
+			if contents["key"] == cache_key:
+				_startup_cache_contents = contents
+		except Exception:  # missing, unreadable, or written by another version of Python - it'll be rewritten
+			pass
+
+	if data.name not in _startup_cache_contents["data"]:
+		return False
+
+	dict.update(data, _startup_cache_contents["data"][data.name])
+	log.write("Loaded {} from the startup cache".format(data.name))
+	return True
+
+
+def save_to_startup_cache(data, cache_key):
+	"""
+		Adds data to the startup cache file if startup_cache is on. Failing to write the cache is logged, not raised.
+	:param data: LazyData instance, after loading
+	:param cache_key: from startup_cache_key, computed before data was loaded from the database
+	"""
+	global _startup_cache_contents
+
+	if not startup_cache:
+		return
+
+	if _startup_cache_contents is None or _startup_cache_contents["key"] != cache_key:
+		_startup_cache_contents = {"key": cache_key, "data": {}}
+	_startup_cache_contents["data"][data.name] = dict(dict.items(data))
+
+	try:
+		with open(startup_cache_path(), 'wb') as cache_file:
+			pickle.dump(_startup_cache_contents, cache_file, pickle.HIGHEST_PROTOCOL)
+	except Exception as e:
+		log.warning("Unable to write startup cache to {}: {}".format(startup_cache_path(), e))
+
+
 def initialize():
 	"""
 		Just an alias for data_setup
@@ -834,8 +994,6 @@ class FieldMap(object):
 		self.handler_function_object = None  # this is the retrieved object to run
 
 
-input_filter_list = {}  # this will be filled in on program init
-
 
 def get_species_from_alt_code(l_alt_code_species, filter_code):
 
@@ -3,34 +3,174 @@ from __future__ import absolute_import, division, print_function
 import logging
 import datetime
 import os
+import json
+import time
+import atexit
+import threading
 
+import six
 import arcpy
 
 global mylog
 global datalog
 global errorlog
+global jsonlog
 global arc_script_flag
 
 base_folder = os.path.split(os.path.split(os.path.split(os.path.abspath(__file__))[0])[0])[0]
 
-def write(log_string, auto_print=0):  # default write function - will be overridden by initialize(), but auto-calls it if the user forgets
+buffered = True  # when True, log files are written by a background thread instead of on every call - set before initialize() runs
+flush_interval = 2  # seconds between flushes of buffered log files. Errors and warnings flush immediately, as does exiting
+json_log = False  # when True, initialize() also opens log/pisces_log.jsonl and every message is written to it as a JSON object per line
+
+jsonlog = None
+
+_queue = six.moves.queue.Queue()
+_writer_thread = None
+_writer_pid = None
+_writer_lock = threading.Lock()
+
+
+class QueuedLogFile(object):
+	"""
+		Stands in for a log file opened in append mode - writes are queued for the background writer thread, which
+		writes and flushes them in batches
+	"""
+
+	def __init__(self, path):
+		self.path = path
+		self.file = open(path, 'a')
+
+	def write(self, text):
+		_start_writer()
+		_queue.put((self.file, text))
+
+	def flush(self):
+		flush()
+
+	def close(self):
+		flush()
+		self.file.close()
+
+
+def _reset_after_fork():
+	"""
+		Gives a forked child process its own queue and lock. The copies inherited from the parent may have been locked by
+		another parent thread at the moment of the fork (and would never be released), and still hold the parent's
+		pending messages, which the parent's writer is already going to write.
+	"""
+	global _queue, _writer_thread, _writer_pid, _writer_lock
+
+	_queue = six.moves.queue.Queue()
+	_writer_lock = threading.Lock()
+	_writer_thread = None
+	_writer_pid = None
+
+
+if hasattr(os, "register_at_fork"):  # Python 3.7+ - resets before anything else in the child can touch the queue
+	os.register_at_fork(after_in_child=_reset_after_fork)
+
+
+def _start_writer():
+	global _writer_thread, _writer_pid
+
+	if _writer_thread is not None and _writer_pid == os.getpid() and _writer_thread.is_alive():
+		return
+
+	if _writer_pid is not None and _writer_pid != os.getpid():  # a forked child on Pythons without register_at_fork
+		_reset_after_fork()
+
+	with _writer_lock:
+		if _writer_thread is None or not _writer_thread.is_alive():  # threads don't survive a fork, so child processes start their own
+			_writer_thread = threading.Thread(target=_write_queued, name="PISCES log writer")
+			_writer_thread.daemon = True
+			_writer_pid = os.getpid()
+			_writer_thread.start()
+
+
+def _write_queued():
+	unflushed = set()
+	last_flush = time.time()
+	while True:
+		try:
+			item = _queue.get(timeout=flush_interval)
+		except six.moves.queue.Empty:
+			item = None
+
+		flush_requested = isinstance(item, threading._Event if six.PY2 else threading.Event)  # put on the queue by flush()
+		if isinstance(item, tuple):
+			log_file, text = item
+			try:
+				log_file.write(text)
+				unflushed.add(log_file)
+			except (IOError, OSError, ValueError):  # closed or unavailable file - drop the message rather than kill the writer
+				pass
+
+		if flush_requested or time.time() - last_flush >= flush_interval:
+			for log_file in unflushed:
+				try:
+					log_file.flush()
+				except (IOError, OSError, ValueError):
+					pass
+			unflushed.clear()
+			last_flush = time.time()
+
+			if flush_requested:
+				item.set()
+
+
+def flush(timeout=10):
+	"""
+		Blocks until everything queued so far has been written and flushed to disk
+	:param timeout: maximum number of seconds to wait
+	"""
+	if _writer_thread is None or _writer_pid != os.getpid() or not _writer_thread.is_alive():
+		return
+
+	done = threading.Event()
+	_queue.put(done)
+	done.wait(timeout)
+
+
+atexit.register(flush)
+
+
+def _open_log(path):
+	if buffered:
+		return QueuedLogFile(path)
+	return open(path, 'a')
+
+
+def _write_json(level, log_string):
+	if jsonlog is not None:
+		if isinstance(log_string, six.binary_type):  # byte strings on Python 2 - six.text_type alone would fail on non-ASCII
+			log_string = log_string.decode("utf-8", "replace")
+		jsonlog.write(json.dumps({"time": datetime.datetime.now().isoformat(), "level": level, "pid": os.getpid(), "message": six.text_type(log_string)}) + "\n")
+
+def write(log_string, auto_print=0, json_level="info"):  # default write function - will be overridden by initialize(), but auto-calls it if the user forgets
 	initialize("auto-init")
-	write(log_string, auto_print)
+	write(log_string, auto_print, json_level)
 
 def info(log_string):  # start making an API compatible with Python's built-in logging
 	write(log_string, auto_print=1)
 
-def error(log_string):
-	write(log_string, 1)  # autowrite it to the main log and the screen too
+def _write_error(log_string, level):
+	write(log_string, 1, json_level=None)  # autowrite it to the main log and the screen too - the JSON record is written with the right level below
 	errorlog.write("%s - %s\n" % (get_datestring(), log_string))
+	_write_json(level, log_string)
+	flush()
+
+def error(log_string):
+	_write_error(log_string, "error")
 
 def warning(log_string):
-	error(log_string)  # for normal use, it behaves just the same. In a script tool, it doesn't
+	_write_error(log_string, "warning")  # for normal use, it behaves just like error, other than the JSON level. In a script tool, it doesn't
 
 def initialize(log_string=None, arc_script=0, log_file=None):
 	global mylog
 	global datalog
 	global errorlog
+	global jsonlog
 	global arc_script_flag
 	global write  # we're going to override them in order to save log-time processing power - small hit to maintainability
 	global error  # we're going to override the error function too
@@ -41,11 +181,13 @@ def initialize(log_string=None, arc_script=0, log_file=None):
 	logging.basicConfig(filename=os.path.join(base_folder, "log", "python_logging_output.txt"), level=logging.DEBUG)
 
 	if log_file:  # allow override of log file location
-		mylog = open(log_file, 'a')
+		mylog = _open_log(log_file)
 	else:
-		mylog = open(os.path.join(base_folder, "log", 'fsfish_processing_log.htm'), 'a')  # main log file - open the log file in append mode
-	datalog = open(os.path.join(base_folder, "log", 'fsfish_changes.log.txt'), 'a')  # data log - logs major changes to data between version
-	errorlog = open(os.path.join(base_folder, "log", 'fsfish_error.log.txt'), 'a')
+		mylog = _open_log(os.path.join(base_folder, "log", 'fsfish_processing_log.htm'))  # main log file - open the log file in append mode
+	datalog = _open_log(os.path.join(base_folder, "log", 'fsfish_changes.log.txt'))  # data log - logs major changes to data between version
+	errorlog = _open_log(os.path.join(base_folder, "log", 'fsfish_error.log.txt'))
+	if json_log:
+		jsonlog = _open_log(os.path.join(base_folder, "log", 'pisces_log.jsonl'))
 	l_date_string = get_datestring()
 
 	if log_string is not None:
@@ -57,9 +199,11 @@ def initialize(log_string=None, arc_script=0, log_file=None):
 	errorlog.write("\nNew Run Began at %s%s\n" % (l_date_string, log_string))
 
 	if arc_script == 0:
-		def write(log_string, auto_print=0):
+		def write(log_string, auto_print=0, json_level="info"):  # json_level None skips the JSON record, for callers that write their own
 
 			mylog.write("<p>%s - %s</p>\n" % (get_datestring(), log_string))
+			if json_level is not None:
+				_write_json(json_level, log_string)
 
 			if auto_print == 1 or auto_print is True:  # autoprint lets us just make the call to log.write and have it also appear on screen
 				try:
@@ -67,9 +211,11 @@ def initialize(log_string=None, arc_script=0, log_file=None):
 				except:
 					mylog.write("<p>Unable to write last message to screen</p>")
 	else:
-		def write(log_string, auto_print=0):
+		def write(log_string, auto_print=0, json_level="info"):
 
 			mylog.write("<p>%s - %s</p>\n" % (get_datestring(), log_string))
+			if json_level is not None:
+				_write_json(json_level, log_string)
 
 			if auto_print == 1 or auto_print is True:  # autoprint lets us just make the call to log.write and have it also appear on screen
 				arcpy.AddMessage("%s" % log_string)  # we could theoretically utilize some caller detection to figure out if this is an error (or just have a param) so that we could use AddError instead
@@ -80,6 +226,8 @@ def initialize(log_string=None, arc_script=0, log_file=None):
 			mylog.write("<p>%s - %s</p>\n" % (l_date_string, log_string))
 			arcpy.AddError(log_string)
 			errorlog.write("%s - %s\n" % (l_date_string, log_string))
+			_write_json("error", log_string)
+			flush()
 
 
 		def warning(log_string):
@@ -87,6 +235,8 @@ def initialize(log_string=None, arc_script=0, log_file=None):
 			mylog.write("<p>%s - %s</p>\n" % (l_date_string, log_string))
 			arcpy.AddWarning(log_string)
 			errorlog.write("%s - %s\n" % (l_date_string, log_string))
+			_write_json("warning", log_string)
+			flush()
 
 def get_datestring():
 	l_date = datetime.datetime.now()
@@ -94,6 +244,7 @@ def get_datestring():
 
 def data_write(log_string):
 	datalog.write("%s - %s\n" % (get_datestring(), log_string))
+	_write_json("data", log_string)
 
 
 def debug(log_string, screen=False):  # this formerly only acted if debug was on - skipping for now
@@ -12,9 +12,12 @@ import subprocess  # for when we zip up shapefiles into one
 import csv
 import re
 import copy
+import multiprocessing
 
 import arcpy
 import pyodbc
+import sqlalchemy.orm
+import six
 
 from . import local_vars
 from . import funcs
@@ -23,9 +26,15 @@ from . import callbacks
 from . import orm_models
 from . import config
 from . import metadata
+from . import code_library_data_files
+from . import layer_fingerprints
+from . import profiling
 
 mapping_session = orm_models.new_session()  # creating this here isn't good practice. Should be factored out to behave like db_cursor and be passed in
 
+observation_cache = {}  # objectid -> Observation ORM object (or None if it doesn't exist) - shared across layers within a mapping run when local_vars.bulk_observation_metadata is True
+observation_fetch_chunk_size = 500  # objectids per IN query - keeps us under SQLite's limit on bind variables
+
 
 class fish_map:  # an individual map for a given fish. Each fish can have multiple maps, depending on the queries
 	def __init__(self, map_title=None, short_name=None, query_set=None, query_set_name=None, base_mxd=None, base_ddp_mxd=None, callback=None, callback_args=None, name_formula=None):
@@ -48,6 +57,13 @@ class fish_map:  # an individual map for a given fish. Each fish can have multip
 
 		self.has_bind = False
 
+	def profile_name(self):
+		"""
+			Identifies the map in profiling reports - query set, short name, and bind variable
+		"""
+		bind = self.map_layers[0].custom_query.bind_var if self.map_layers else None
+		return "{} {} {}".format(self.query_set, self.short_name, bind)
+
 	def setup(self, queries, title=None, short_name=None, query_set=None, set_name=None, mxd=None, ddp_mxd=None, callback=None, callback_args=None, fish=None, name_formula=None):
 		"""
 			Used to load the major class items later - __init__ contains some of the critical items, but most of it is set here. When provided custom_query object, sets up a map with the
@@ -264,6 +280,7 @@ class fish_map:  # an individual map for a given fish. Each fish can have multip
 		else:
 			return text_string
 
+	@profiling.timed("map", lambda self, ddp=False: "{}{}".format(self.profile_name(), " ddp" if ddp else ""))
 	def generate(self, ddp=False):  # generates the map once it is set up
 		log.write("\nGenerating Map for set %s - Map title %s" % (self.query_set_name, self.map_title), 1)
 
@@ -465,6 +482,7 @@ class fish_map:  # an individual map for a given fish. Each fish can have multip
 		if arcpy.Exists("z_layer"):  # Prevents an obscure bug where a hidden "z_layer" ends up in map documents - clean it up after each map is produced to make sure it's gone
 			arcpy.Delete_management("z_layer")
 
+	@profiling.timed("export_web_layers", lambda self: self.profile_name())
 	def export_web_layers(self):
 
 		log.write("Exporting and compressing web layers", True)
@@ -724,6 +742,13 @@ class map_layer:
 		else:
 			return False
 
+	def profile_name(self):
+		"""
+			Identifies the layer in profiling reports - query id and bind variable
+		"""
+		return "query {} {}".format(self.custom_query.id, self.custom_query.bind_var)
+
+	@profiling.timed("layer.populate", lambda self, *args, **kwargs: self.profile_name())
 	def populate(self, db_cursor):
 		global mapping_session
 		session = mapping_session
@@ -739,11 +764,16 @@ class map_layer:
 
 
 			log.write("Getting observation records", 1)
+			load_observations = self.custom_query.metadata_plugin and local_vars.config_metadata
+			observation_ids = []
 			try:
 				for result in l_results:
 					self.zones.append(result.zone_id)
-					if self.custom_query.metadata_plugin and local_vars.config_metadata:
-						self.observations.append(session.query(orm_models.Observation).filter_by(pkey=result.objectid).first())  # note, this is backwards and slow - we should consider another way - this results in execution of a query for every observation record hit (as high as 50k!!)
+					if load_observations:
+						if local_vars.bulk_observation_metadata:
+							observation_ids.append(result.objectid)  # collected and retrieved all at once below
+						else:
+							self.observations.append(session.query(orm_models.Observation).filter_by(pkey=result.objectid).first())  # note, this is backwards and slow - this results in execution of a query for every observation record hit (as high as 50k!!)
 					self.aux_attrs.append(result)  # full array, including Zone_ID is appended for access later. If the callback wants to access other information without a new query, this can handle that
 				self.zones = list(set(self.zones))  # dedupe our zones list for faster selections
 			except AttributeError:
@@ -751,10 +781,14 @@ class map_layer:
 				if local_vars.debug:
 					raise
 				raise local_vars.MappingError("Invalid query for map - queries must retrieve HUC_12 ids AS zone_id or else they will be invalid. See the full documentation for more details. (example query: 'select HUC_12 as zone_id from HUC12FullState'")
+
+			if observation_ids:
+				self.observations = get_observations(session, observation_ids)
 		except pyodbc.Error as e:
 			log.error("Error in layer population. Exception string: %s\nPyodbc reported %s." % (str(e), traceback.format_exc()))
 			raise
 
+	@profiling.timed("layer.make", lambda self, *args, **kwargs: self.profile_name())
 	def make(self, zone_layer=None, db_cursor=None):
 		"""
 			Does the actual work of generating the spatial layer from the query. We should have already executed the query to retrieve the zones, but not retrieved the zones as a layer.
@@ -799,7 +833,8 @@ class map_layer:
 			try:  # CALLBACKS - allow custom processing to occur after the layer has been pulled
 				if self.custom_query.callback is not None and self.custom_query.callback != '':  # if we have a callback
 					l_callback = getattr(callbacks, self.custom_query.callback)  # get the callback function's object
-					zone_layer = l_callback(zone_layer, db_cursor, self.custom_query.callback_args, self)  # call it with the layer as the parameter. It's possible that it may copy it out and return a new zone_layer
+					with profiling.stage("callback", self.custom_query.callback):
+						zone_layer = l_callback(zone_layer, db_cursor, self.custom_query.callback_args, self)  # call it with the layer as the parameter. It's possible that it may copy it out and return a new zone_layer
 			except:
 				if local_vars.debug:
 					raise
@@ -816,7 +851,8 @@ class map_layer:
 					else:
 						kwargs = {}
 
-					zone_layer = metadata_function(self, zone_layer, **kwargs)
+					with profiling.stage("metadata", self.custom_query.metadata_plugin):
+						zone_layer = metadata_function(self, zone_layer, **kwargs)
 			except NameError:
 				if local_vars.debug:
 					raise
@@ -857,8 +893,33 @@ class map_layer:
 				log.write("Found cached layer", True)
 				self.cache_file = cached_layer
 				return True
+
+		elif local_vars.incremental_layer_cache and len(self.zones) > 0:  # only once populated - the fingerprint is based on the zones
+			if self.cache_file:
+				return True
+
+			if layer_fingerprints.is_current(db_cursor, self.custom_query.id, self.custom_query.bind_var, self.fingerprint()):
+				cached_layer = cache_layer(None, self.custom_query.bind_var, self.custom_query.id, self, db_cursor)
+				if cached_layer:
+					log.write("Cached layer is current - reusing it", True)
+					self.cache_file = cached_layer
+					return True
 		return False
 
+	def fingerprint(self):
+		"""
+			Returns the layer_fingerprints fingerprint for this layer's query and zones - call after populate
+		"""
+		return layer_fingerprints.fingerprint(self.custom_query.query_string, self.custom_query.callback, self.custom_query.callback_args, self.zones)
+
+	def get_species(self):
+		"""
+			Returns the species this layer was built from, or None if it could depend on any species
+		"""
+		if self.custom_query.bind_var in local_vars.all_fish:
+			return [self.custom_query.bind_var]
+		return None
+
 class custom_query:
 	def __init__(self, query=None, query_rank=None, query_id=None, template_layer_file=None, callback=None, callback_arguments=None, layer_name=None, metadata_plugin=None, metadata_args=None, name_formula=None):
 		self.query_string = query
@@ -917,7 +978,15 @@ def begin(fish_subset, return_maps=False):
 
 	log.write("\nBeginning Mapping", 1)
 
+	reset_observation_cache()  # observations may have changed since the last run in this session
+	profiling.reset()
+
 	mapping_cursor, mapping_conn = funcs.db_connect(local_vars.maindb)  # open the db for the remainder of this function
+	if local_vars.map_profiling:
+		mapping_cursor = profiling.CountingCursor(mapping_cursor)  # counts the statements and rows for each stage
+
+	if local_vars.incremental_layer_cache:
+		invalidate_changed_layers(mapping_cursor, mapping_conn)
 
 	log.write("Retrieving mapping data from database...", 1)
 
@@ -930,12 +999,16 @@ def begin(fish_subset, return_maps=False):
 	all_maps = initialize_maps(mapping_conn)
 
 	zone_layer = refresh_zones()  # if this layer doesn't exist, it makes it. Some of these functions modify the layer
-	if local_vars.usecache == 0:  # if we're not supposed to use the cache only
+	if local_vars.usecache == 0 and local_vars.mapping_processes > 1:  # build the layers across worker processes
+		with profiling.stage("pool", "make_layers_in_pool"):  # stages inside the workers aren't recorded
+			make_layers_in_pool(all_maps, mapping_cursor, mapping_conn)
+	elif local_vars.usecache == 0:  # if we're not supposed to use the cache only
 		for i in range(len(all_maps)):
 			try:
 
-				all_maps[i].populate(mapping_cursor)
-				all_maps[i].make_layers(zone_layer, mapping_cursor)
+				with profiling.stage("map.layers", all_maps[i].profile_name()), profiling.profile_map(all_maps[i]):
+					all_maps[i].populate(mapping_cursor)
+					all_maps[i].make_layers(zone_layer, mapping_cursor)
 
 				#if we've made it to the end of the processing here, we can commit any changes we've made to the layer cache, etc
 				try:
@@ -958,10 +1031,11 @@ def begin(fish_subset, return_maps=False):
 	for index in range(len(all_maps)):  # Doing this as a second loop so that we have some certainty in this - if we reach this point, layer generation and caching is complete
 		if all_maps[index] is not None:  # if it wasn't deleted due to error
 			try:
-				all_maps[index].generate()
+				with profiling.profile_map(all_maps[index]):
+					all_maps[index].generate()
 
-				if all_maps[index].base_ddp_mxd is not None and local_vars.export_ddp is True:  # if we also need to do one with Data Driven Pages...
-					all_maps[index].generate(ddp=True)
+					if all_maps[index].base_ddp_mxd is not None and local_vars.export_ddp is True:  # if we also need to do one with Data Driven Pages...
+						all_maps[index].generate(ddp=True)
 			except:
 				if local_vars.debug:
 					raise
@@ -977,10 +1051,209 @@ def begin(fish_subset, return_maps=False):
 	funcs.db_close(mapping_cursor, mapping_conn)
 	wrapup()
 
+	profiling.write_report()
+	profiling.write_profile()
+
 	log.write("Mapping Complete", 1)
 
 	return all_maps  # return the map objects in case the caller wants any info
 
+def make_layers_in_pool(maps, db_cursor, db_conn):
+	"""
+		Builds the layers for all maps across local_vars.mapping_processes worker processes. Maps are dealt out to the
+		workers round robin. Each worker rebuilds the map objects from the database, makes the layers for its share of the
+		maps, and saves them to its own scratch geodatabase. Caching the layers - copying them into the layer cache and
+		writing the layer_cache rows - happens here, one layer at a time, so workers never write to the database or the
+		layer cache.
+
+		Maps are populated here too, since generating them later needs the zones and observations for each layer.
+	:param maps: list of fish_map objects from initialize_maps. Maps that fail are set to None, as in begin
+	:param db_cursor: cursor for the mapping database
+	:param db_conn: connection for the mapping database - committed after each map's layers are cached
+	:return: None
+	"""
+
+	processes = min(local_vars.mapping_processes, len(maps))
+	if processes < 1:
+		return
+
+	log.write("Making layers with %s worker processes" % processes, 1)
+
+	for i in range(len(maps)):
+		try:
+			maps[i].populate(db_cursor)
+			for layer in maps[i].map_layers:
+				layer.check_layer_cache(db_cursor)  # finds layers that are still current in the cache, now that we know their zones
+		except local_vars.MappingError as e:
+			log.error("Encountered error in mapping id #%d - reported \"%s\". Skipping" % (maps[i].query_set, e))
+			maps[i] = None
+
+	settings = _get_worker_settings()
+	tasks = []
+	for worker in range(processes):
+		map_indices = [i for i in range(worker, len(maps), processes) if maps[i] is not None]
+		if map_indices:
+			tasks.append((dict(map_fish), map_indices, settings))  # the same fish in the same order, so workers build the same list of maps
+
+	pool = multiprocessing.Pool(processes=processes)
+	try:
+		worker_results = pool.map(_make_layers_worker, tasks)
+	finally:
+		pool.close()
+		pool.join()
+
+	for results in worker_results:
+		for map_index, layers, error in results:
+			l_map = maps[map_index]
+			if l_map is None:
+				continue
+
+			try:
+				if error is not None:
+					raise local_vars.MappingError(error)
+
+				for layer_index, layer_path in layers:
+					layer = l_map.map_layers[layer_index]
+					if layer.cache_file is None and layer_path is not None:  # shared layers may have been cached by another map already
+						layer.cache_file = cache_layer(layer_path, layer.custom_query.bind_var, layer.custom_query.id, layer, db_cursor)
+
+					if layer.cache_file is None and len(layer.zones) > 0:
+						raise local_vars.MappingError("No layer was created - skipping")
+
+				try:
+					db_conn.commit()
+				except pyodbc.Error:
+					log.error("Failed to commit changes to database - not critical at this moment, but you should be aware that layer cache changes were not saved")
+
+			except local_vars.MappingError as e:
+				log.error("Encountered error in mapping id #%d - reported \"%s\". Skipping" % (l_map.query_set, e))
+				maps[map_index] = None
+
+
+def _get_worker_settings():
+	"""
+		Snapshot of the simple settings in local_vars (strings, numbers, booleans, and None) so that workers pick up
+		changes made at runtime, like the command line flags set in main.py, after they load the configuration themselves
+	"""
+	settings = {}
+	for name, value in vars(local_vars).items():
+		if name.startswith("_"):
+			continue
+		if value is None or isinstance(value, (six.string_types, bool, int, float)):
+			settings[name] = value
+	return settings
+
+
+def _make_layers_worker(task):
+	"""
+		Runs in a worker process from make_layers_in_pool. Sets up PISCES, points the workspace at a new scratch
+		geodatabase, then populates and makes the layers for the maps at the given indices. Layers are copied into the
+		scratch geodatabase and their paths returned - nothing is written to the layer cache or the database here.
+	:param task: tuple of (map_fish dictionary, list of map indices, local_vars settings from _get_worker_settings)
+	:return: list of (map index, list of (layer index, path to the layer or None), error message or None)
+	"""
+
+	fish, map_indices, settings = task
+
+	local_vars.start()
+	for name, value in settings.items():
+		setattr(local_vars, name, value)
+
+	temp_folder, temp_gdb = code_library_data_files.make_temp(override=True)
+	if not temp_gdb:
+		return [(map_index, [], "Unable to create a scratch geodatabase for the worker process") for map_index in map_indices]
+	local_vars.workspace = temp_gdb
+	arcpy.env.workspace = temp_gdb
+	arcpy.env.overwriteOutput = True
+
+	global map_fish
+	map_fish = fish
+
+	db_cursor, db_conn = funcs.db_connect(local_vars.maindb)
+	results = []
+	try:
+		worker_maps = initialize_maps(db_conn)
+		zone_layer = refresh_zones()
+		saved_layers = {}  # id of layer object -> saved path, since layers can be shared between maps
+
+		for map_index in map_indices:
+			l_map = worker_maps[map_index]
+			layers = []
+			try:
+				l_map.populate(db_cursor)
+				for layer_index, layer in enumerate(l_map.map_layers):
+					if layer.check_layer_cache(db_cursor) or len(layer.zones) == 0:  # already in the layer cache, or nothing to map
+						layers.append((layer_index, None))
+						continue
+
+					if id(layer) not in saved_layers:
+						layer.make(zone_layer, db_cursor)
+						layer_path = os.path.join(temp_gdb, "worker_layer_%s_%s" % (map_index, layer_index))
+						arcpy.CopyFeatures_management(layer.layer_name, layer_path)
+						if layer.layer_name != zone_layer:
+							arcpy.Delete_management(layer.layer_name)
+						saved_layers[id(layer)] = layer_path
+						zone_layer = refresh_zones()  # some callbacks modify the zones layer - start the next layer fresh
+
+					layers.append((layer_index, saved_layers[id(layer)]))
+				results.append((map_index, layers, None))
+			except local_vars.MappingError as e:
+				results.append((map_index, [], str(e)))
+			except:
+				results.append((map_index, [], traceback.format_exc()))
+	finally:
+		funcs.db_close(db_cursor, db_conn)
+
+	return results
+
+
+def get_observations(session, objectids):
+	"""
+		Retrieves Observation ORM objects for a list of objectids with a handful of IN queries, loading each
+		observation's set along with it, instead of one query per observation. Results are kept in observation_cache,
+		so layers that share observations don't retrieve them again.
+	:param session: ORM session
+	:param objectids: list of observation objectids - may contain duplicates
+	:return: list of Observation objects (or None where an objectid doesn't exist) in the same order as objectids
+	"""
+	missing = sorted(set(objectid for objectid in objectids if objectid not in observation_cache))
+	for start in range(0, len(missing), observation_fetch_chunk_size):
+		chunk = missing[start:start + observation_fetch_chunk_size]
+		records = session.query(orm_models.Observation)\
+			.options(sqlalchemy.orm.joinedload(orm_models.Observation.set))\
+			.filter(orm_models.Observation.pkey.in_(chunk))
+		for observation in records:
+			observation_cache[observation.pkey] = observation
+		for objectid in chunk:
+			observation_cache.setdefault(objectid, None)
+
+	return [observation_cache[objectid] for objectid in objectids]
+
+
+def invalidate_changed_layers(db_cursor, db_conn):
+	"""
+		Removes the cached layers built from species whose observations changed since the last mapping run - see
+		layer_fingerprints. Other cached layers are left in place.
+	"""
+	for layer_file in layer_fingerprints.invalidate_changed_species(db_cursor):
+		layer_path = os.path.join(local_vars.layer_cache, layer_file)
+		try:
+			if arcpy.Exists(layer_path):
+				arcpy.Delete_management(layer_path)
+		except:
+			log.warning("Unable to delete invalidated layer %s from the layer cache - it will be replaced when the layer is rebuilt" % layer_path)
+
+	try:
+		db_conn.commit()
+	except pyodbc.Error:
+		log.error("Failed to commit layer cache invalidations to the database")
+
+
+def reset_observation_cache():
+	global observation_cache
+	observation_cache = {}
+
+
 def wrapup():
 	if local_vars.web_layer_csv_file:
 		local_vars.web_layer_csv_file.close()
@@ -1355,6 +1628,12 @@ def cache_layer(arc_layer, bind_var, query_id, map_layer_object, db_cursor, forc
 	except:
 		raise local_vars.MappingError("Unable to update the Layer_Cache table in the database with the new file information")
 
+	if map_layer_object is not None:
+		try:
+			layer_fingerprints.record_layer(db_cursor, query_id, bind_var, map_layer_object.fingerprint(), map_layer_object.get_species())
+		except:  # the layer is still cached - it just won't be reused by an incremental run
+			log.warning("Unable to record the fingerprint for the cached layer for query id %s with bind variable %s" % (query_id, bind_var))
+
 	if not arc_layer == "z_layer":  # TODO: This needs to be more robust. hardcoding the name here is bad. Much better to have some other method of determining what to keep and what to remove (this goes back to the problem of keeping the layer in memory in the first place...it's a bit of a kluge
 		try:
 			arcpy.Delete_management(arc_layer)  # do some cleanup - keeping all of this in memory is probably unwise - we'll read it back in when we need it
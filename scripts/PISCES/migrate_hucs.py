@@ -25,6 +25,7 @@ import pyodbc
 from . import local_vars
 from . import log
 from . import funcs
+from . import huc_migration
 from . input_filters import common
 
 from .tests import test_data
@@ -313,10 +314,8 @@ def clear_cache_tables(tables, db_cursor):
 def alter_tables(db_cursor, tables, field):
 
 	for table in tables:
-		query = "ALTER TABLE %s ADD COLUMN %s yesno" % (table, field)
+		query = "ALTER TABLE %s ADD COLUMN %s INTEGER DEFAULT %s" % (table, field, local_vars.db_false)
 		db_cursor.execute(query)
-		default_query = "Update %s set %s=no" % (table, field)  # set it as the default - access doesn't let us set defaults in SQL
-		db_cursor.execute(default_query)
 
 
 def load_hucs(db_cursor, table):
@@ -393,20 +392,13 @@ def write_species_changes(dataset_id, db_cursor, species_outfile):
 	species_out.close()
 
 
-def write_changes_file(l_migrations, new_hucs, extirpated, changes_outfile, new_output_file, removed_output_file, dataset_id, species_outfile, db_cursor):
+def write_changes_file(migration_output_items, new_hucs, extirpated, changes_outfile, new_output_file, removed_output_file, dataset_id, species_outfile, db_cursor):
+	"""
+	:param migration_output_items: list of dicts with OBJECTID, from_huc, Zone_ID, and Table keys for the records
+		changed - the "moved" list from huc_migration.migrate
+	"""
 
 	#### Write out the migrations made ####
-	migration_output_items = []
-	for item in l_migrations:
-		for obs in list(item.observations + item.invalid_observations):
-			out_item = {
-				'OBJECTID': obs.objectid,
-				'from_huc': item.source,
-				'Zone_ID': item.destination,
-				'Table': obs.table_used,
-			}
-			migration_output_items.append(out_item)
-
 	csv_file = open(changes_outfile, 'wb')
 	csv_writer = csv.DictWriter(csv_file, ('OBJECTID', 'from_huc', 'Zone_ID', 'Table'))
 	csv_writer.writeheader()
@@ -459,12 +451,10 @@ if __name__ == "__main__":
 	collection_id = funcs.create_collection(name='HUC 12 Update - Oct 2013', short_name='hucupdate2013', description='Records all of the Observations affected by the HUC12 Update', db_cursor=master_cursor)
 	log.write("Collection ID for modified records is %s" % collection_id, 1)
 	alter_tables(master_cursor, additional_tables, other_tables_field)
-	log.write("Finding affected records and loading data", 1)
-	changes, source_hucs_only = find_affected(migration_items, changes, collection_id, other_tables_field, additional_tables, master_db_conn)  # split out the data into objects, loading the affected data. Split into "to create" and "to update" objects
-
 	log.write("Updating database", 1)
-	for item in changes:
-		item.update(additional_tables)
+	zone_tables = [(table, additional_tables[table], additional_pkeys[table], cardinality[table] == "One") for table in additional_tables]
+	migration_results = huc_migration.migrate(master_cursor, migration_items, changed_collection=collection_id, flag_field=other_tables_field, zone_tables=zone_tables)  # moves everything with a few statements per table, and records the species that moved so only their cached layers are rebuilt
+	source_hucs_only = list(migration_items.keys())
 
 	master_db_conn.commit()  # commit changes - only commit when everything is done. This is an all or nothing transaction. Closing early so can copy over new layer without a schema lock
 	funcs.db_close(master_cursor, master_db_conn)
@@ -479,12 +469,11 @@ if __name__ == "__main__":
 
 	log.write("The following HUC12s no longer exist: %s" % str(extirpated_hucs), 1)
 
-	log.write("Clearing caches and verifying", 1)
-	clear_cache_tables(clear_tables, master_cursor)
+	log.write("Verifying", 1)
 	verify(source_hucs_only, master_tables, additional_tables, extirpated_hucs, new_hucs_added, master_cursor)
 
 	log.write("Writing out Observations changes to %s" % changes_output_file, 1)
-	write_changes_file(changes, new_hucs_added, extirpated_hucs, changes_output_file, new_hucs_output_file, removed_hucs_output_file, collection_id, species_outfile=changed_species_output_file, db_cursor=master_cursor)
+	write_changes_file(migration_results["moved"], new_hucs_added, extirpated_hucs, changes_output_file, new_hucs_output_file, removed_hucs_output_file, collection_id, species_outfile=changed_species_output_file, db_cursor=master_cursor)
 
 	master_db_conn.commit()  # commit changes - only commit when everything is done. This is an all or nothing transaction. Closing early so can copy over new layer without a schema lock
 
@@ -2,13 +2,16 @@ from __future__ import absolute_import, division, print_function
 
 __author__ = 'dsx'
 
+import os
+import threading
+
 import pkg_resources
 pkg_resources.require("sqlalchemy>=0.9.4")
 
 import sqlalchemy
 from sqlalchemy.ext.declarative import declarative_base
 from sqlalchemy.ext.hybrid import hybrid_property
-from sqlalchemy import orm, Column, Integer, String, Boolean, Float, ForeignKey, Table, DateTime, UniqueConstraint
+from sqlalchemy import orm, pool, Column, Integer, String, Boolean, Float, ForeignKey, Table, DateTime, UniqueConstraint
 from sqlalchemy.orm import relationship, backref, scoped_session
 
 from . import local_vars
@@ -17,17 +20,63 @@ engine = None
 Session = None
 Base = declarative_base()
 
+_factories = {}  # normalized database path -> (engine, sessionmaker) - built once per process and reused by connect
+_factories_lock = threading.Lock()
+
+
+def _database_key(db):
+	return os.path.normcase(os.path.abspath(db))
+
+
+def get_engine_and_sessionmaker(db=local_vars.ormdb):
+	"""
+		Returns the engine and sessionmaker for a database, creating them on first use. Engines hold a connection pool,
+		so reusing them avoids reopening the SQLite database for every session. The pool is a QueuePool set explicitly -
+		SQLAlchemy's default for file databases is NullPool, which opens a new connection every time. Connections are
+		allowed to move between threads because a session may be closed on a different thread than the one that opened it.
+	:param db: path to the SQLite database
+	:return: tuple of (engine, sessionmaker)
+	"""
+	key = _database_key(db)
+	with _factories_lock:
+		if key not in _factories:
+			new_engine = sqlalchemy.create_engine("sqlite+pysqlite:///%s" % db, poolclass=pool.QueuePool,
+													connect_args={"check_same_thread": False})
+			_factories[key] = (new_engine, orm.sessionmaker(bind=new_engine))
+		return _factories[key]
+
 
 def connect(db=local_vars.ormdb):
 	"""
 		Don't use me directly! Use api.connect_orm instead - it'll better handle some of the startup.
+		Sets the module level engine and Session for the database. Engines are reused for the life of the process -
+		call reset to discard them.
 	:param db:
 	:return:
 	"""
 	global engine, Session
 
-	engine = sqlalchemy.create_engine("sqlite+pysqlite:///%s" % db)
-	Session = orm.sessionmaker(bind=engine)
+	engine, Session = get_engine_and_sessionmaker(db)
+
+
+def reset(db=None):
+	"""
+		Disposes of cached engines so that the next connect builds a new one. Use in tests, or after replacing the
+		database file on disk (eg, after hydrating it), so that pooled connections don't point at the old file.
+	:param db: path of the database to reset. If None, all engines are reset
+	"""
+	global engine, Session
+
+	with _factories_lock:
+		keys = list(_factories.keys()) if db is None else [_database_key(db)]
+		for key in keys:
+			if key not in _factories:
+				continue
+			old_engine = _factories.pop(key)[0]
+			old_engine.dispose()
+			if old_engine is engine:
+				engine = None
+				Session = None
 
 
 def disconnect_engine_and_session():
@@ -503,6 +552,7 @@ class Observation(Base):
 	survey_method_id = Column("survey_method", Integer, ForeignKey("{0:s}.id".format(local_vars.survey_methods_table)))
 	survey_method = relationship(SurveyMethod, primaryjoin=(survey_method_id == SurveyMethod.pkey), backref="observations")
 
+	certainty = Column("certainty", Integer)
 	notes = Column("notes", String)
 	longitude = Column("longitude", String)
 	latitude = Column("latitude", String)
@@ -0,0 +1,269 @@
+"""
+	Instrumentation for mapping runs. When local_vars.map_profiling is True, mapping records each map, layer, and
+	callback as a stage with its wall time, the number of SQL statements it ran, and the rows it read and wrote, and
+	mapping.begin writes the stages out as a JSON report when it finishes. Stages nest - a callback is inside the layer
+	that ran it - and each records its own time (excluding nested stages) as well as its total time.
+
+	SQL is counted through CountingCursor, which mapping.begin wraps around the cursor it passes to layers and
+	callbacks. Statements run on other connections aren't counted.
+
+	Separately, local_vars.cprofile_map names a single map to run under cProfile - see profile_map.
+"""
+
+from __future__ import absolute_import, division, print_function
+
+import contextlib
+import cProfile
+import datetime
+import functools
+import json
+import os
+import pstats
+import time
+
+import six
+
+from . import local_vars
+from . import log
+
+write_statements = ("insert", "update", "delete", "replace")
+
+counters = {"queries": 0, "rows_read": 0, "rows_written": 0}
+stages = []  # records of completed stages, in the order they finished
+_open_stages = []  # stack of records for the stages currently running
+_started = None
+
+_profiler = None  # cProfile.Profile for the map named in local_vars.cprofile_map, once it's found
+_profiled_map = None  # the fish_map being profiled - other maps with the same name aren't
+
+
+class CountingCursor(object):
+	"""
+		Wraps a DB-API cursor (pyodbc or sqlite3) to count statements and rows in the module counters. Everything
+		else is passed through to the wrapped cursor.
+	"""
+
+	def __init__(self, cursor):
+		self.cursor = cursor
+
+	def _count_written(self, sql, rows):
+		if sql.lstrip()[:7].lower().startswith(write_statements):
+			counters["rows_written"] += rows
+
+	def execute(self, sql, *params):
+		counters["queries"] += 1
+		self.cursor.execute(sql, *params)
+		self._count_written(sql, max(self.cursor.rowcount, 0))
+		return self  # pyodbc and sqlite3 both return the cursor, so results are iterated through the wrapper
+
+	def executemany(self, sql, params):
+		params = list(params)
+		counters["queries"] += 1
+		self.cursor.executemany(sql, params)
+		self._count_written(sql, self.cursor.rowcount if self.cursor.rowcount > 0 else len(params))  # pyodbc reports -1 for executemany
+		return self
+
+	def fetchone(self):
+		row = self.cursor.fetchone()
+		if row is not None:
+			counters["rows_read"] += 1
+		return row
+
+	def fetchmany(self, *args):
+		rows = self.cursor.fetchmany(*args)
+		counters["rows_read"] += len(rows)
+		return rows
+
+	def fetchall(self):
+		rows = self.cursor.fetchall()
+		counters["rows_read"] += len(rows)
+		return rows
+
+	def __iter__(self):
+		for row in self.cursor:
+			counters["rows_read"] += 1
+			yield row
+
+	def __getattr__(self, name):
+		return getattr(self.cursor, name)
+
+
+def reset():
+	"""
+		Clears recorded stages and counters - mapping.begin calls this at the start of each run
+	"""
+	global _started, _profiler, _profiled_map
+
+	for key in counters:
+		counters[key] = 0
+	del stages[:]
+	del _open_stages[:]
+	_started = datetime.datetime.now()
+	_profiler = None
+	_profiled_map = None
+
+
+@contextlib.contextmanager
+def stage(kind, name):
+	"""
+		Records a stage when local_vars.map_profiling is on. Does nothing otherwise.
+
+		with profiling.stage("callback", "postprocess_zones"):
+			...
+	:param kind: the type of stage - map, layer, callback, etc. The report totals stages by kind
+	:param name: identifies this stage among others of the same kind
+	"""
+	if not local_vars.map_profiling:
+		yield
+		return
+
+	record = {"kind": kind, "name": name, "depth": len(_open_stages), "parent": None, "nested_seconds": 0.0}
+	if _open_stages:
+		record["parent"] = "{}:{}".format(_open_stages[-1]["kind"], _open_stages[-1]["name"])
+	starting_counts = dict(counters)
+	_open_stages.append(record)
+
+	started = time.time()
+	try:
+		yield
+	finally:
+		record["seconds"] = time.time() - started
+		record["self_seconds"] = record["seconds"] - record.pop("nested_seconds")
+		for key, value in counters.items():
+			record[key] = value - starting_counts[key]
+
+		_open_stages.pop()
+		if _open_stages:
+			_open_stages[-1]["nested_seconds"] += record["seconds"]
+		stages.append(record)
+
+
+def timed(kind, name=None):
+	"""
+		Decorator version of stage, for methods
+	:param kind: the type of stage
+	:param name: function called with the decorated function's arguments that returns the stage name. Defaults to the
+		function's name
+	"""
+	def decorate(function):
+		@functools.wraps(function)
+		def wrapper(*args, **kwargs):
+			if not local_vars.map_profiling:
+				return function(*args, **kwargs)
+			with stage(kind, name(*args, **kwargs) if name else function.__name__):
+				return function(*args, **kwargs)
+		return wrapper
+	return decorate
+
+
+def summarize(records):
+	"""
+		Totals stages by kind and name
+	:param records: stage records
+	:return: dict of kind -> list of dicts with name, count, seconds, self_seconds, and the counters, slowest first
+	"""
+	totals = {}
+	for record in records:
+		key = (record["kind"], record["name"])
+		if key not in totals:
+			totals[key] = {"name": record["name"], "count": 0, "seconds": 0.0, "self_seconds": 0.0, "queries": 0, "rows_read": 0, "rows_written": 0}
+		total = totals[key]
+		total["count"] += 1
+		for field in ("seconds", "self_seconds", "queries", "rows_read", "rows_written"):
+			total[field] += record[field]
+
+	by_kind = {}
+	for (kind, name), total in totals.items():
+		by_kind.setdefault(kind, []).append(total)
+	for kind in by_kind:
+		by_kind[kind].sort(key=lambda total: total["self_seconds"], reverse=True)
+	return by_kind
+
+
+def write_report(path=None, top=10):
+	"""
+		Writes the recorded stages and their totals as JSON and logs the stages that took the most time
+	:param path: file to write. Defaults to a timestamped map_profile file in the log folder
+	:param top: number of stages of each kind to log
+	:return: path of the report, or None if profiling is off
+	"""
+	if not local_vars.map_profiling:
+		return None
+
+	finished = datetime.datetime.now()
+	started = _started or finished
+	if path is None:
+		path = os.path.join(local_vars.internal_workspace, "log", "map_profile_{}.json".format(started.strftime("%Y%m%d_%H%M%S")))
+
+	summary = summarize(stages)
+	report = {
+		"started": started.isoformat(),
+		"finished": finished.isoformat(),
+		"seconds": (finished - started).total_seconds(),
+		"totals": dict(counters),
+		"by_kind": summary,
+		"stages": stages,
+	}
+
+	with open(path, 'w') as report_file:
+		json.dump(report, report_file, indent=1, sort_keys=True)
+
+	for kind in sorted(summary):
+		log.write("Slowest {} stages:".format(kind), True)
+		for total in summary[kind][:top]:
+			log.write("\t{name}: {self_seconds:.2f}s own time ({seconds:.2f}s total) over {count} runs, {queries} queries, {rows_read} rows read, {rows_written} rows written".format(**total), True)
+	log.write("Wrote mapping profile to {}".format(path), True)
+
+	return path
+
+
+def _map_matches(fish_map, target):
+	target = six.text_type(target)
+	return target in (six.text_type(fish_map.query_set), six.text_type(fish_map.short_name), six.text_type(fish_map.map_title))
+
+
+@contextlib.contextmanager
+def profile_map(fish_map):
+	"""
+		Runs the block under cProfile if fish_map is the map named in local_vars.cprofile_map (by query set id, short
+		name, or title). Only the first matching map is profiled, but every block run for it - populating, making
+		layers, and generating - goes into the same profile. Call write_profile to save it.
+	"""
+	global _profiler, _profiled_map
+
+	if local_vars.cprofile_map is None or (_profiled_map is not None and fish_map is not _profiled_map) or not _map_matches(fish_map, local_vars.cprofile_map):
+		yield
+		return
+
+	if _profiler is None:
+		log.write("Profiling map {} with cProfile".format(fish_map.map_title), True)
+		_profiler = cProfile.Profile()
+		_profiled_map = fish_map
+
+	_profiler.enable()
+	try:
+		yield
+	finally:
+		_profiler.disable()
+
+
+def write_profile(path=None, top=30):
+	"""
+		Saves the cProfile stats for the profiled map, if any, and logs the functions with the most cumulative time
+	:param path: file for the stats, readable with pstats or snakeviz. Defaults to a map_profile .prof file in the log folder
+	:param top: number of functions to log
+	:return: path of the stats file, or None if no map was profiled
+	"""
+	if _profiler is None:
+		return None
+
+	if path is None:
+		path = os.path.join(local_vars.internal_workspace, "log", "map_profile_{}.prof".format(datetime.datetime.now().strftime("%Y%m%d_%H%M%S")))
+	_profiler.dump_stats(path)
+
+	output = six.StringIO()
+	pstats.Stats(_profiler, stream=output).sort_stats("cumulative").print_stats(top)
+	log.write(output.getvalue(), True)
+	log.write("Wrote cProfile stats to {}".format(path), True)
+
+	return path
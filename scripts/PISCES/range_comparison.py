@@ -0,0 +1,261 @@
+"""
+	Historic vs. current range comparisons without arcpy, for comparison.batch_compare_species_ranges. HUC_12s don't
+	overlap, so the area of a dissolved range is the sum of its zones' Shape_Area values, the intersection and union of
+	two ranges are the zones in both or either, and the centroid of a dissolved range is the area-weighted mean of its
+	zones' centroids. Ranges come from the presence index as bitsets, so no feature classes are made for each species.
+
+	Zone centroids are computed once from the zone polygons by build_zone_centroids (comparison.batch_historic_vs_current
+	runs it on first use) and stored in the zone_centroids table. Results have the same fields, units, and meaning as code_library_geometry.Comparison from the arcpy path -
+	areas in square meters, distances in meters, and directions in degrees counterclockwise from east, from the historic
+	centroid to the current one.
+"""
+
+from __future__ import absolute_import, division, print_function
+
+import binascii
+import math
+import multiprocessing
+import traceback
+
+import numpy
+
+from . import local_vars
+from . import log
+
+centroids_table = "zone_centroids"
+
+result_fields = ("centroid_distance", "centroid_direction", "percent_overlap", "percent_overlap_initial", "percent_overlap_final",
+				 "overlap_union_area", "overlap_intersect_area")
+
+_worker_comparer = None  # RangeComparer for pool worker processes, set by _initialize_worker
+
+
+def ring_centroid(rings):
+	"""
+		Finds the centroid and area of a polygon from its rings. Holes must wind the opposite way from exterior rings, as
+		they do in geodatabases and shapefiles, so that their signed areas subtract.
+	:param rings: list of sequences of (x, y) vertices - exterior rings, holes, and parts all go in the same list
+	:return: (x, y, area), or None if the polygon has no area
+	"""
+	area = 0.0
+	moment_x = 0.0
+	moment_y = 0.0
+	for ring in rings:
+		ring = numpy.asarray(ring, dtype=numpy.float64)
+		if len(ring) < 3:
+			continue
+		x = ring[:, 0] - ring[0, 0]  # relative to the first vertex, to keep precision with large projected coordinates
+		y = ring[:, 1] - ring[0, 1]
+		x2 = numpy.roll(x, -1)
+		y2 = numpy.roll(y, -1)
+		cross = x * y2 - x2 * y
+		ring_area = cross.sum() / 2
+		area += ring_area
+		moment_x += ((x + x2) * cross).sum() / 6 + ring_area * ring[0, 0]
+		moment_y += ((y + y2) * cross).sum() / 6 + ring_area * ring[0, 1]
+
+	if area == 0:
+		return None
+	return moment_x / area, moment_y / area, abs(area)
+
+
+def build_zone_centroids(db_cursor, zone_index, id_field=local_vars.huc_field):
+	"""
+		Computes the centroid of every zone and stores them in the zone centroids table, replacing what's there. Run
+		again whenever the zone polygons change. The caller commits.
+	:param db_cursor: DB-API cursor
+	:param zone_index: spatial_join.ZoneIndex of the zones, in Teale Albers - eg, from input_filters.common.load_zone_index
+	:param id_field: zone attribute with the HUC_12 ID
+	:return: number of zones stored
+	"""
+	records = []
+	for attributes, rings in zip(zone_index.attributes, zone_index.rings):
+		centroid = ring_centroid(rings)
+		if centroid is None:
+			log.warning("Zone {} has no area - skipping its centroid".format(attributes[id_field]))
+			continue
+		records.append((attributes[id_field],) + centroid)
+
+	db_cursor.execute("DROP TABLE IF EXISTS {}".format(centroids_table))
+	db_cursor.execute("CREATE TABLE {} (zone_id TEXT PRIMARY KEY, x REAL, y REAL, area REAL)".format(centroids_table))
+	db_cursor.executemany("INSERT INTO {} (zone_id, x, y, area) VALUES (?, ?, ?, ?)".format(centroids_table), records)
+	log.write("Stored centroids for {} zones".format(len(records)), True)
+	return len(records)
+
+
+def has_zone_centroids(db_cursor):
+	"""
+		Checks whether build_zone_centroids has been run on this database
+	"""
+	return db_cursor.execute("SELECT name FROM sqlite_master WHERE type = 'table' AND name = ?", (centroids_table,)).fetchone() is not None
+
+
+def load_zone_data(db_cursor):
+	"""
+		Reads each zone's area from the zones table and its centroid from the zone centroids table
+	:return: dict of HUC_12 -> (area, x, y)
+	"""
+	if not has_zone_centroids(db_cursor):
+		raise ValueError("Zone centroids haven't been computed - run range_comparison.build_zone_centroids first")
+
+	records = db_cursor.execute("SELECT zones.{0}, zones.Shape_Area, centroids.x, centroids.y FROM {1} AS zones "
+								"INNER JOIN {2} AS centroids ON zones.{0} = centroids.zone_id".format(local_vars.huc_field, local_vars.zones_table, centroids_table)).fetchall()
+	return dict((record[0], (record[1], record[2], record[3])) for record in records)
+
+
+def _bits_to_mask(bits, length):
+	"""
+		Converts a presence index bitset into a boolean numpy array where item n is bit n
+	"""
+	if not bits:
+		return numpy.zeros(length, dtype=bool)
+	hex_string = "{:x}".format(bits)
+	if len(hex_string) % 2:
+		hex_string = "0" + hex_string
+	raw = numpy.frombuffer(binascii.unhexlify(hex_string), dtype=numpy.uint8)[::-1]  # least significant byte first
+	mask = numpy.unpackbits(raw).reshape(-1, 8)[:, ::-1].ravel().astype(bool)  # least significant bit first within each byte
+	if len(mask) < length:
+		mask = numpy.concatenate([mask, numpy.zeros(length - len(mask), dtype=bool)])
+	return mask[:length]
+
+
+def _parse_ids(values):
+	if isinstance(values, (list, tuple, set)):
+		return [int(value) for value in values]
+	return [int(value) for value in str(values).split(",") if value.strip()]
+
+
+class RangeComparer(object):
+	"""
+		Zone areas and centroids lined up with the bit positions of the presence index, so each comparison is a few
+		numpy sums
+	"""
+
+	def __init__(self, zones, zone_data):
+		"""
+		:param zones: HUC_12 IDs in bit position order - PresenceIndex.zones
+		:param zone_data: dict of HUC_12 -> (area, x, y), as returned by load_zone_data
+		"""
+		missing = [zone for zone in zones if zone not in zone_data]
+		if missing:
+			log.warning("{} zones with observations have no area or centroid and will be left out of range comparisons - eg, {}".format(len(missing), ", ".join(missing[:5])))
+
+		self.length = len(zones)
+		self.areas = numpy.array([zone_data[zone][0] if zone in zone_data else 0.0 for zone in zones], dtype=numpy.float64)
+		self.x = numpy.array([zone_data[zone][1] if zone in zone_data else 0.0 for zone in zones], dtype=numpy.float64)
+		self.y = numpy.array([zone_data[zone][2] if zone in zone_data else 0.0 for zone in zones], dtype=numpy.float64)
+
+	def centroid(self, mask):
+		weights = self.areas[mask]
+		total = weights.sum()
+		if total == 0:
+			return None
+		return (self.x[mask] * weights).sum() / total, (self.y[mask] * weights).sum() / total
+
+	def compare(self, historic_bits, current_bits):
+		"""
+			Compares a historic range to a current range
+		:param historic_bits: presence index bitset of the historic range
+		:param current_bits: presence index bitset of the current range
+		:return: dict with the result_fields. As on the arcpy path, the overlap percentages and union area are None when
+			the ranges don't intersect, and the centroid fields are None when either range is empty
+		"""
+		result = dict((field, None) for field in result_fields)
+
+		historic = _bits_to_mask(historic_bits, self.length)
+		current = _bits_to_mask(current_bits, self.length)
+
+		intersect_area = float(self.areas[historic & current].sum())
+		result["overlap_intersect_area"] = intersect_area
+		if intersect_area > 0:
+			union_area = float(self.areas[historic | current].sum())
+			result["overlap_union_area"] = union_area
+			result["percent_overlap"] = intersect_area / union_area * 100
+			result["percent_overlap_initial"] = intersect_area / float(self.areas[historic].sum()) * 100
+			result["percent_overlap_final"] = intersect_area / float(self.areas[current].sum()) * 100
+
+		historic_centroid = self.centroid(historic)
+		current_centroid = self.centroid(current)
+		if historic_centroid is not None and current_centroid is not None:
+			delta_x = current_centroid[0] - historic_centroid[0]
+			delta_y = current_centroid[1] - historic_centroid[1]
+			result["centroid_distance"] = math.hypot(delta_x, delta_y)
+			result["centroid_direction"] = math.degrees(math.atan2(delta_y, delta_x))
+
+		return result
+
+
+def _initialize_worker(zones, zone_data):
+	global _worker_comparer
+	_worker_comparer = RangeComparer(zones, zone_data)
+
+
+def _compare_task(comparer, task):
+	"""
+		Compares one species' ranges, logging the error and returning None for the result if it fails so that one species
+		doesn't stop the rest
+	"""
+	fid, historic_bits, current_bits = task
+	if historic_bits is None:  # reading its ranges failed - already logged
+		return fid, None
+
+	try:
+		return fid, comparer.compare(historic_bits, current_bits)
+	except Exception:
+		log.error("Failed to compare ranges for species {}".format(fid))
+		log.error("Error reported was " + traceback.format_exc())
+		return fid, None
+
+
+def _species_task(index, fid, historic_types, current_types, collections):
+	try:
+		return fid, index.species_bits(fid, historic_types, collections), index.species_bits(fid, current_types, collections)
+	except Exception:
+		log.error("Failed to read ranges for species {}".format(fid))
+		log.error("Error reported was " + traceback.format_exc())
+		return fid, None, None
+
+
+def _compare_in_worker(task):
+	return _compare_task(_worker_comparer, task)
+
+
+def compare_species(species_codes, db_cursor, collections=local_vars.hq_collections, historic_types=local_vars.historic_obs_types,
+					current_types=local_vars.current_obs_types, index=None, processes=None):
+	"""
+		Compares the historic and current ranges of many species
+	:param species_codes: iterable of species codes
+	:param db_cursor: DB-API cursor for reading zone areas and centroids
+	:param collections: collection ids to limit the data to, as a comma separated string or iterable
+	:param historic_types: presence types for historic ranges
+	:param current_types: presence types for current ranges
+	:param index: api_components.presence_index.PresenceIndex to read ranges from. Defaults to the process-wide index
+	:param processes: worker processes to split the species across. Defaults to local_vars.range_comparison_processes
+	:return: list of (species code, result dict) in the order the species were given. The result is None for species
+		that failed - the error is logged and the other species are still compared
+	"""
+	if index is None:
+		from .api_components import presence_index  # imported here so the comparisons themselves don't need sqlalchemy
+		index = presence_index.get_index()
+	if processes is None:
+		processes = local_vars.range_comparison_processes
+
+	collections = _parse_ids(collections)
+	historic_types = _parse_ids(historic_types)
+	current_types = _parse_ids(current_types)
+
+	zone_data = load_zone_data(db_cursor)
+	tasks = [_species_task(index, fid, historic_types, current_types, collections) for fid in species_codes]
+
+	processes = min(processes, len(tasks))
+	if processes > 1:
+		log.write("Comparing ranges for {} species across {} processes".format(len(tasks), processes), True)
+		pool = multiprocessing.Pool(processes=processes, initializer=_initialize_worker, initargs=(index.zones, zone_data))
+		try:
+			return pool.map(_compare_in_worker, tasks, chunksize=max(1, len(tasks) // (processes * 4)))
+		finally:
+			pool.close()
+			pool.join()
+
+	comparer = RangeComparer(index.zones, zone_data)
+	return [_compare_task(comparer, task) for task in tasks]
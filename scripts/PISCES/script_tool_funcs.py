@@ -22,6 +22,8 @@ from . import funcs
 from . import log
 from . import orm_models
 from . import mapping
+from . import layer_fingerprints
+from . import stats_summary
 from .input_filters import common
 from .funcs import index_toolbox_params as index_params
 
@@ -603,6 +605,10 @@ def reverse_transaction(transaction_id, db_cursor):
 
 	db_cursor.execute(sql_statement, transaction_id)
 
+	restored_species = db_cursor.execute("select distinct species_id from invalid_observations where transaction_id = ?", transaction_id).fetchall()
+	layer_fingerprints.record_species_changes(db_cursor, [row[0] for row in restored_species])
+	stats_summary.refresh_summary(db_cursor, [row[0] for row in restored_species])
+
 
 def get_generic_filter_picker(table_column, validation_class, selector_index):
 
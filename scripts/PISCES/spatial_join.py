@@ -0,0 +1,272 @@
+"""
+	Point in polygon spatial joins without arcpy. Zone polygons are loaded once into a ZoneIndex, which buckets their
+	bounding boxes into a uniform grid, and points are assigned to zones in numpy batches - only the zones whose boxes
+	share a grid cell with a point are tested, and each test runs over every point in the batch at once.
+
+	The results match a JOIN_ONE_TO_MANY, KEEP_COMMON spatial join of the zones with the points, which is what
+	input_filters.common.multifeature_to_HUCs runs in arcpy: one record per (zone, point) pair, ordered by zone, then
+	by point.
+
+	Reprojection uses pyproj when it's installed. Loading polygons straight from a geodatabase uses fiona when it's
+	installed - input_filters.common.load_zone_index loads them with arcpy when arcpy is available, and with fiona
+	otherwise. Coordinate tables are read by read_table - CSVs with the csv module and geodatabase tables with fiona -
+	so the python engine can run where arcpy isn't installed.
+"""
+
+from __future__ import absolute_import, division, print_function
+
+import csv
+import io
+import os
+
+import numpy
+import six
+
+try:
+	import pyproj
+except ImportError:
+	pyproj = None
+
+try:
+	import fiona
+except ImportError:
+	fiona = None
+
+max_comparisons = 4000000  # points x edges to test at once - bounds the memory used by each vectorized ring test
+
+
+def _close_ring(ring):
+	ring = numpy.asarray(ring, dtype=numpy.float64)
+	if len(ring) and not numpy.array_equal(ring[0], ring[-1]):
+		ring = numpy.vstack([ring, ring[:1]])
+	return ring
+
+
+def points_in_rings(x, y, rings):
+	"""
+		Even-odd test of points against a set of rings, so exterior rings, holes, and multiple parts can all be passed
+		together the way they come out of a polygon.
+	:param x: numpy array of point x coordinates
+	:param y: numpy array of point y coordinates
+	:param rings: list of closed (n, 2) vertex arrays
+	:return: boolean numpy array - True for points inside
+	"""
+	inside = numpy.zeros(len(x), dtype=bool)
+	for ring in rings:
+		if len(ring) < 4:  # a closed ring needs at least three distinct vertices
+			continue
+
+		x1, y1 = ring[:-1, 0], ring[:-1, 1]
+		x2, y2 = ring[1:, 0], ring[1:, 1]
+		chunk = max(1, max_comparisons // len(x1))
+		for start in range(0, len(x), chunk):
+			px = x[start:start + chunk, numpy.newaxis]
+			py = y[start:start + chunk, numpy.newaxis]
+			with numpy.errstate(divide="ignore", invalid="ignore"):  # horizontal edges divide by zero, but are excluded by the first test
+				crosses = ((y1 > py) != (y2 > py)) & (px < (x2 - x1) * (py - y1) / (y2 - y1) + x1)
+			inside[start:start + chunk] ^= (crosses.sum(axis=1) % 2).astype(bool)
+	return inside
+
+
+class ZoneIndex(object):
+	"""
+		Zone polygons with a uniform grid over their bounding boxes
+	"""
+
+	def __init__(self, zones, cell_size=None, ids=None):
+		"""
+		:param zones: list of (attributes, rings) tuples, in the order the zones should come out of a join. attributes
+			is a dict of field name -> value. rings is a list of sequences of (x, y) vertices - exterior rings, holes,
+			and parts all go in the same list
+		:param cell_size: width and height of grid cells. Defaults to the median zone bounding box size
+		:param ids: object ids of the zones, reported as TARGET_FID by join_records. Defaults to 1 through the number of zones
+		"""
+		self.attributes = [attributes for attributes, rings in zones]
+		self.ids = list(ids) if ids is not None else list(range(1, len(zones) + 1))
+		self.rings = [[_close_ring(ring) for ring in rings] for attributes, rings in zones]
+
+		self.bounds = numpy.zeros((len(self.rings), 4), dtype=numpy.float64)  # xmin, ymin, xmax, ymax
+		for index, rings in enumerate(self.rings):
+			vertices = numpy.vstack(rings) if rings else numpy.zeros((1, 2))
+			self.bounds[index] = (vertices[:, 0].min(), vertices[:, 1].min(), vertices[:, 0].max(), vertices[:, 1].max())
+
+		if cell_size is None and len(self.bounds):
+			sizes = numpy.maximum(self.bounds[:, 2] - self.bounds[:, 0], self.bounds[:, 3] - self.bounds[:, 1])
+			cell_size = float(numpy.median(sizes))
+		self.cell_size = cell_size if cell_size else 1.0
+
+		self.origin = self.bounds[:, :2].min(axis=0) if len(self.bounds) else numpy.zeros(2)
+		self.cells = {}  # (column, row) -> list of zone indices whose bounding boxes touch the cell
+		for index, (xmin, ymin, xmax, ymax) in enumerate(self.bounds):
+			min_column, min_row = self._cell(xmin, ymin)
+			max_column, max_row = self._cell(xmax, ymax)
+			for column in range(min_column, max_column + 1):
+				for row in range(min_row, max_row + 1):
+					self.cells.setdefault((column, row), []).append(index)
+
+	def __len__(self):
+		return len(self.rings)
+
+	def _cell(self, x, y):
+		return int(numpy.floor((x - self.origin[0]) / self.cell_size)), int(numpy.floor((y - self.origin[1]) / self.cell_size))
+
+	@classmethod
+	def from_fiona(cls, path, layer=None, cell_size=None):
+		"""
+			Loads zones from any dataset fiona can read (eg, the HUC12 feature class in a file geodatabase)
+		:param path: path to the dataset or geodatabase
+		:param layer: layer (feature class) name within path
+		"""
+		if fiona is None:
+			raise ImportError("fiona is required to load zones without arcpy")
+
+		zones = []
+		ids = []
+		with fiona.open(path, layer=layer) as features:
+			for feature in features:
+				geometry = feature["geometry"]
+				polygons = geometry["coordinates"] if geometry["type"] == "MultiPolygon" else [geometry["coordinates"]]
+				rings = [[vertex[:2] for vertex in ring] for polygon in polygons for ring in polygon]
+				zones.append((dict(feature["properties"]), rings))
+				ids.append(int(feature["id"]))  # the object id, as arcpy's OID@ reports it
+		return cls(zones, cell_size=cell_size, ids=ids)
+
+	def join(self, x, y):
+		"""
+			Finds the zones each point falls in.
+		:param x: sequence of point x coordinates, in the same coordinate system as the zones
+		:param y: sequence of point y coordinates
+		:return: list of (zone index, point index) tuples sorted by zone, then point. Points outside every zone are left
+			out and points inside more than one zone appear once for each
+		"""
+		x = numpy.asarray(x, dtype=numpy.float64)
+		y = numpy.asarray(y, dtype=numpy.float64)
+		if len(x) == 0 or len(self) == 0:
+			return []
+
+		columns = numpy.floor((x - self.origin[0]) / self.cell_size).astype(numpy.int64)
+		rows = numpy.floor((y - self.origin[1]) / self.cell_size).astype(numpy.int64)
+
+		# the points to test against each zone, gathered from every cell the zone touches
+		candidates = {}
+		cell_keys, cell_of_point = numpy.unique(numpy.stack([columns, rows], axis=1), axis=0, return_inverse=True)
+		cell_of_point = cell_of_point.reshape(-1)
+		order = numpy.argsort(cell_of_point, kind="mergesort")
+		boundaries = numpy.searchsorted(cell_of_point[order], numpy.arange(len(cell_keys) + 1))
+		for cell_number, (column, row) in enumerate(cell_keys):
+			for zone_index in self.cells.get((int(column), int(row)), ()):
+				candidates.setdefault(zone_index, []).append(order[boundaries[cell_number]:boundaries[cell_number + 1]])
+
+		pairs = []
+		for zone_index in sorted(candidates):
+			points = numpy.sort(numpy.concatenate(candidates[zone_index]))
+			xmin, ymin, xmax, ymax = self.bounds[zone_index]
+			points = points[(x[points] >= xmin) & (x[points] <= xmax) & (y[points] >= ymin) & (y[points] <= ymax)]
+			if len(points) == 0:
+				continue
+
+			inside = points_in_rings(x[points], y[points], self.rings[zone_index])
+			pairs.extend((zone_index, int(point)) for point in points[inside])
+
+		return pairs
+
+
+def transform_coordinates(x, y, source_epsg, target_epsg):
+	"""
+		Reprojects coordinates between two EPSG codes with pyproj. Coordinates are returned unchanged when the codes match.
+	:return: tuple of numpy arrays (x, y)
+	"""
+	x = numpy.asarray(x, dtype=numpy.float64)
+	y = numpy.asarray(y, dtype=numpy.float64)
+	if int(source_epsg) == int(target_epsg):
+		return x, y
+
+	if pyproj is None:
+		raise ImportError("pyproj is required to reproject coordinates without arcpy")
+
+	transformer = pyproj.Transformer.from_crs(int(source_epsg), int(target_epsg), always_xy=True)
+	return transformer.transform(x, y)
+
+
+def join_records(zone_index, point_records, x, y):
+	"""
+		Builds the records a one to many spatial join would return - the zone's attributes, then the point's, with
+		Join_Count, TARGET_FID, and JOIN_FID first. Point fields with the same name as a zone field get a _1 suffix, as
+		they do in arcpy.
+	:param zone_index: ZoneIndex
+	:param point_records: list of dicts of point attributes, aligned with x and y
+	:param x: point x coordinates, in the zones' coordinate system
+	:param y: point y coordinates
+	:return: list of dicts
+	"""
+	records = []
+	for zone_number, point_number in zone_index.join(x, y):
+		record = {"Join_Count": 1, "TARGET_FID": zone_index.ids[zone_number], "JOIN_FID": point_number + 1}
+		record.update(zone_index.attributes[zone_number])
+		for field, value in point_records[point_number].items():
+			if field in zone_index.attributes[zone_number] or field in ("Join_Count", "TARGET_FID", "JOIN_FID"):
+				field = "{}_1".format(field)
+			record[field] = value
+		records.append(record)
+	return records
+
+
+def split_geodatabase_path(path):
+	"""
+		Splits an arcpy style path to a feature class or table into the dataset and layer fiona opens - eg,
+		data.gdb/HUCs/HUC12FullState (in a feature dataset) becomes (data.gdb, HUC12FullState). Paths that aren't in a
+		geodatabase, like shapefiles, are returned with no layer.
+	:return: tuple of (path, layer or None)
+	"""
+	parts = os.path.normpath(path).split(os.sep)
+	for index, part in enumerate(parts):
+		if part.lower().endswith(".gdb") and index < len(parts) - 1:
+			return os.sep.join(parts[:index + 1]), parts[-1]
+	return path, None
+
+
+def _convert_column(values):
+	"""
+		Converts a column of CSV strings to ints or floats when every value in it can be, the way arcpy types CSV
+		columns. Empty strings become None.
+	"""
+	filled = [value for value in values if value != ""]
+	for converter in (int, float):
+		try:
+			converted = [converter(value) for value in filled]
+		except ValueError:
+			continue
+		converted.reverse()
+		return [None if value == "" else converted.pop() for value in values]
+	return [None if value == "" else value for value in values]
+
+
+def read_table(path):
+	"""
+		Reads a table of records without arcpy - CSVs with the csv module, and tables in geodatabases or other
+		datasets with fiona
+	:param path: path to the table
+	:return: list of dicts of field -> value, or None if the dataset can't be read without arcpy - it has geometry
+		(feature classes are joined by arcpy), or it isn't a CSV and fiona isn't installed
+	"""
+	if os.path.splitext(path)[1].lower() in (".csv", ".txt"):
+		if six.PY2:
+			csv_file = open(path, 'rb')
+		else:
+			csv_file = io.open(path, 'r', newline="", encoding="utf-8-sig")  # utf-8-sig drops the byte order mark Excel writes
+		with csv_file:
+			reader = csv.reader(csv_file)
+			fields = next(reader, [])
+			rows = [row + [""] * (len(fields) - len(row)) for row in reader if row]
+
+		columns = [_convert_column([row[index] for row in rows]) for index in range(len(fields))]
+		return [dict(zip(fields, values)) for values in zip(*columns)] if columns else []
+
+	if fiona is None:
+		return None
+
+	dataset, layer = split_geodatabase_path(path)
+	with fiona.open(dataset, layer=layer) as records:
+		if records.schema.get("geometry") not in (None, "None"):
+			return None
+		return [dict(record["properties"]) for record in records]
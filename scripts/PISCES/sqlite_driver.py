@@ -0,0 +1,123 @@
+"""
+	Connections to SQLite databases through Python's built-in sqlite3 module that behave like pyodbc connections, for
+	machines without the SQLite ODBC driver - funcs.db_connect uses them when local_vars.db_driver is "sqlite3".
+
+	PISCES code is written against pyodbc, so the wrappers accept bind variables as separate arguments to execute, give
+	rows attribute access to their columns (row.zone_id), have an autocommit property, and raise pyodbc's exception
+	classes, so existing "except pyodbc.Error" handling still applies.
+"""
+
+from __future__ import absolute_import, division, print_function
+
+import sqlite3
+
+import pyodbc
+import six
+
+
+class Row(sqlite3.Row):
+	"""
+		sqlite3 row that also allows attribute access to columns, like pyodbc.Row
+	"""
+
+	def __getattr__(self, name):
+		try:
+			return self[name]
+		except IndexError:
+			raise AttributeError(name)
+
+	@property
+	def cursor_description(self):
+		return tuple((name, None, None, None, None, None, None) for name in self.keys())
+
+
+def _translate_errors(function):
+	"""
+		Reraises sqlite3 errors as the matching pyodbc errors
+	"""
+	def translated(*args, **kwargs):
+		try:
+			return function(*args, **kwargs)
+		except sqlite3.IntegrityError as e:
+			six.raise_from(pyodbc.IntegrityError(*e.args), e)
+		except sqlite3.Error as e:
+			six.raise_from(pyodbc.Error(*e.args), e)
+	return translated
+
+
+class Cursor(object):
+
+	def __init__(self, cursor):
+		self.cursor = cursor
+
+	@_translate_errors
+	def execute(self, sql, *params):
+		if len(params) == 1 and isinstance(params[0], (list, tuple)):  # pyodbc takes either a sequence or separate arguments
+			params = params[0]
+		self.cursor.execute(sql, params)
+		return self
+
+	@_translate_errors
+	def executemany(self, sql, params):
+		self.cursor.executemany(sql, params)
+		return self
+
+	def fetchone(self):
+		return self.cursor.fetchone()
+
+	def fetchmany(self, *args):
+		return self.cursor.fetchmany(*args)
+
+	def fetchall(self):
+		return self.cursor.fetchall()
+
+	def __iter__(self):
+		return iter(self.cursor)
+
+	def __getattr__(self, name):
+		return getattr(self.cursor, name)  # description, rowcount, close
+
+
+class Connection(object):
+
+	def __init__(self, db_name):
+		self.connection = sqlite3.connect(db_name, check_same_thread=False)
+		self.connection.row_factory = Row
+
+	@property
+	def autocommit(self):
+		return self.connection.isolation_level is None
+
+	@autocommit.setter
+	def autocommit(self, value):
+		self.connection.isolation_level = None if value else ""
+
+	def cursor(self):
+		return Cursor(self.connection.cursor())
+
+	@_translate_errors
+	def execute(self, sql, *params):
+		return self.cursor().execute(sql, *params)
+
+	@_translate_errors
+	def commit(self):
+		self.connection.commit()
+
+	@_translate_errors
+	def rollback(self):
+		self.connection.rollback()
+
+	def close(self):
+		self.connection.close()
+
+
+def connect(db_name):
+	"""
+		Opens a SQLite database
+	:param db_name: path to the database
+	:return: Connection
+	"""
+	try:
+		return Connection(db_name)
+	except sqlite3.Error as e:
+		six.raise_from(pyodbc.Error(*e.args), e)
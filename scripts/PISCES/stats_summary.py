@@ -0,0 +1,178 @@
+"""
+	Statistics for funcs.data_stats. The observation counts are computed together in a single scan of the observations
+	table instead of a query per statistic, and can optionally come from a summary table - one row per species and
+	observation set with its observation counts - that is updated for just the species that change. Imports
+	(observation_set.save_data), tbx_modify_records, and transaction reversal refresh the summary for the species they
+	touch, so once it's built, data_stats only reads the small summary and species tables.
+
+	The summary depends on local_vars.current_obs_types, historic_obs_types, and hq_collections. They're stored with
+	it, and the summary is rebuilt if they change.
+"""
+
+from __future__ import absolute_import, division, print_function
+
+import collections
+
+from . import local_vars
+from . import log
+
+summary_table = "stats_summary"
+settings_table = "stats_summary_settings"
+
+species_chunk_size = 500  # species per IN clause - keeps us under SQLite's limit on bind variables
+
+
+def _labels():
+	return collections.OrderedDict([
+		("observations", "Total Number of Valid and Active Observations"),
+		("datasets", "Total Number of Datasets Included"),
+		("species", "Total Number of Species tracked (including data bins and nonfish taxa)"),
+		("species_no_bins", "Total Number of Species tracked (no data bins, but includes nonfish)"),
+		("fish", "Total Number of Fish Species tracked (no data bins)"),
+		("native_fish", "Total Number of Native Fish Species tracked (no data bins)"),
+		("nonnative_fish", "Total Number of Non-Native Fish Species tracked (no data bins)"),
+		("hq_observations", "Total Number of Valid Obervations in the Quality Controlled Set (%s)" % local_vars.hq_collections),
+		("taxa_with_data", "Total Number of Taxa (Including NonFish) with Data"),
+		("native_with_data", "Total Number of *Native* Fish Species with Data"),
+		("current_qc_fish", "Total Number of Fish Species with Present QC Data"),
+		("historic_qc_fish", "Total Number of Fish Species with Historic QC Data"),
+	])
+
+
+def _in_hq_collection(objectid_column):
+	return "EXISTS (SELECT 1 FROM observation_collections WHERE observation_collections.observation_id = {} AND observation_collections.collection_id IN ({}))".format(objectid_column, local_vars.hq_collections)
+
+
+def _settings():
+	return (local_vars.current_obs_types, local_vars.historic_obs_types, local_vars.hq_collections)
+
+
+def species_stats(db_cursor):
+	"""
+		Counts from the species tables and views, and the number of observation links to high quality collections, in
+		one query. These are all small, or covered by an index.
+	:return: dict of statistic key -> value
+	"""
+	row = db_cursor.execute("SELECT (SELECT count(*) FROM species), "
+							"(SELECT count(*) FROM species WHERE temporary != 1), "
+							"(SELECT count(*) FROM all_fish WHERE temporary != 1), "
+							"(SELECT count(*) FROM native_fish WHERE temporary != 1), "
+							"(SELECT count(*) FROM nonnative_fish WHERE temporary != 1), "
+							"(SELECT count(*) FROM observation_collections WHERE collection_id IN ({}))".format(local_vars.hq_collections)).fetchone()
+	return dict(zip(("species", "species_no_bins", "fish", "native_fish", "nonnative_fish", "hq_observations"), row))
+
+
+def observation_stats(db_cursor):
+	"""
+		Computes every observation statistic in a single scan of the observations table
+	:return: dict of statistic key -> value
+	"""
+	row = db_cursor.execute("SELECT count(*), count(DISTINCT set_id), count(DISTINCT species_id), "
+							"count(DISTINCT CASE WHEN species_id IN (SELECT fid FROM native_fish) THEN species_id END), "
+							"count(DISTINCT CASE WHEN presence_type IN ({0}) AND species_id IN (SELECT fid FROM all_fish) AND {2} THEN species_id END), "
+							"count(DISTINCT CASE WHEN presence_type IN ({1}) AND species_id IN (SELECT fid FROM all_fish) AND {2} THEN species_id END) "
+							"FROM observations".format(local_vars.current_obs_types, local_vars.historic_obs_types, _in_hq_collection("observations.objectid"))).fetchone()
+	return dict(zip(("observations", "datasets", "taxa_with_data", "native_with_data", "current_qc_fish", "historic_qc_fish"), row))
+
+
+def summary_exists(db_cursor):
+	return db_cursor.execute("SELECT name FROM sqlite_master WHERE type = 'table' AND name = ?", (summary_table,)).fetchone() is not None
+
+
+def summary_is_current(db_cursor):
+	"""
+		Checks that the summary table exists and was built with the current observation type and collection settings
+	"""
+	if not summary_exists(db_cursor):
+		return False
+	row = db_cursor.execute("SELECT current_obs_types, historic_obs_types, hq_collections FROM {}".format(settings_table)).fetchone()
+	return row is not None and tuple(row) == _settings()
+
+
+def _insert_summary_rows(db_cursor, where="", params=()):
+	query = ("INSERT INTO {0} (species_id, set_id, observations, current_qc, historic_qc) "
+					  "SELECT species_id, set_id, count(*), "
+					  "sum(CASE WHEN presence_type IN ({1}) AND {3} THEN 1 ELSE 0 END), "
+					  "sum(CASE WHEN presence_type IN ({2}) AND {3} THEN 1 ELSE 0 END) "
+					  "FROM observations {4} GROUP BY species_id, set_id".format(summary_table, local_vars.current_obs_types, local_vars.historic_obs_types,
+																				  _in_hq_collection("observations.objectid"), where))
+	if params:
+		db_cursor.execute(query, params)
+	else:
+		db_cursor.execute(query)
+
+
+def build_summary(db_cursor):
+	"""
+		Creates (or recreates) the summary table from the whole observations table. The caller commits.
+	"""
+	log.write("Building statistics summary table", True)
+	db_cursor.execute("DROP TABLE IF EXISTS {}".format(summary_table))
+	db_cursor.execute("DROP TABLE IF EXISTS {}".format(settings_table))
+	db_cursor.execute("CREATE TABLE {} (species_id TEXT, set_id INTEGER, observations INTEGER, current_qc INTEGER, historic_qc INTEGER)".format(summary_table))
+	db_cursor.execute("CREATE INDEX {0}_species ON {0} (species_id)".format(summary_table))
+	db_cursor.execute("CREATE TABLE {} (current_obs_types TEXT, historic_obs_types TEXT, hq_collections TEXT, built TEXT)".format(settings_table))
+
+	_insert_summary_rows(db_cursor)
+	db_cursor.execute("INSERT INTO {} (current_obs_types, historic_obs_types, hq_collections, built) VALUES (?, ?, ?, datetime('now'))".format(settings_table), _settings())
+
+
+def refresh_summary(db_cursor, species_ids):
+	"""
+		Recomputes the summary rows for species whose observations changed. Does nothing if the summary table hasn't
+		been built, and rebuilds it if the settings it was built with have changed. Call with the cursor that made the
+		changes, before committing, so that both are committed together.
+	:param db_cursor: DB-API cursor
+	:param species_ids: iterable of species codes. None values are ignored
+	"""
+	if not summary_exists(db_cursor):
+		return
+	if not summary_is_current(db_cursor):
+		build_summary(db_cursor)
+		return
+
+	species_ids = sorted(set(species_id for species_id in species_ids if species_id))
+	for start in range(0, len(species_ids), species_chunk_size):
+		chunk = species_ids[start:start + species_chunk_size]
+		markers = ", ".join("?" * len(chunk))
+		db_cursor.execute("DELETE FROM {} WHERE species_id IN ({})".format(summary_table, markers), chunk)
+		_insert_summary_rows(db_cursor, "WHERE species_id IN ({})".format(markers), chunk)
+
+
+def summary_stats(db_cursor):
+	"""
+		Computes the observation statistics from the summary table
+	:return: dict of statistic key -> value, with the same keys as observation_stats
+	"""
+	row = db_cursor.execute("SELECT coalesce(sum(observations), 0), count(DISTINCT set_id), count(DISTINCT species_id), "
+							"count(DISTINCT CASE WHEN species_id IN (SELECT fid FROM native_fish) THEN species_id END), "
+							"count(DISTINCT CASE WHEN current_qc > 0 AND species_id IN (SELECT fid FROM all_fish) THEN species_id END), "
+							"count(DISTINCT CASE WHEN historic_qc > 0 AND species_id IN (SELECT fid FROM all_fish) THEN species_id END) "
+							"FROM {}".format(summary_table)).fetchone()
+	return dict(zip(("observations", "datasets", "taxa_with_data", "native_with_data", "current_qc_fish", "historic_qc_fish"), row))
+
+
+def get_stats(db_cursor, use_summary=None):
+	"""
+		Returns the statistics that funcs.data_stats reports
+	:param db_cursor: DB-API cursor
+	:param use_summary: read observation statistics from the summary table, building it first if it's missing or out
+		of date. Defaults to local_vars.use_stats_summary
+	:return: OrderedDict of statistic description -> value
+	"""
+	if use_summary is None:
+		use_summary = local_vars.use_stats_summary
+
+	values = species_stats(db_cursor)
+	if use_summary:
+		if not summary_is_current(db_cursor):
+			build_summary(db_cursor)
+			if hasattr(db_cursor, "commit"):  # pyodbc cursors commit their connection
+				db_cursor.commit()
+			else:
+				db_cursor.connection.commit()
+		values.update(summary_stats(db_cursor))
+	else:
+		values.update(observation_stats(db_cursor))
+
+	return collections.OrderedDict((label, values[key]) for key, label in _labels().items())
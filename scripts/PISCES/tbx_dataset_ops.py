@@ -1,13 +1,45 @@
 import arcpy, sys, os
 import string
 
+from PISCES import funcs
+from PISCES import local_vars
+from PISCES import layer_fingerprints
+from PISCES import stats_summary
 
 
-def remove_dataset(set_id, invalidate=1):
+def remove_dataset(set_id, invalidate=1, db_cursor=None):
+	"""
+	:param set_id: the observation set to remove
+	:param invalidate: 1 to invalidate the set's records, anything else to delete the set and its records entirely
+	:param db_cursor: DB-API cursor to delete with. The caller commits. When None, a connection to the main database is
+		opened and committed here
+	:return: list of the species whose observations were deleted
+	"""
 
 	if invalidate == 1:  # if we just want to invalidate the whole set, not nuke it into oblivion
 		import tbx_modify_records
 		tbx_modify_records.invalidate_records("Set_ID = %s" % set_id)
 	else: # we want it gone
-		query1 = "delete from observation_sets where set_id = ?"
-		query2 = "delete from observations where set_id = ?"
+		db_conn = None
+		if db_cursor is None:
+			db_cursor, db_conn = funcs.db_connect(local_vars.maindb, "Removing dataset {}".format(set_id))
+
+		try:
+			species = [row[0] for row in db_cursor.execute("select distinct species_id from observations where set_id = ?", (set_id,)).fetchall()]
+
+			query0 = "delete from observation_collections where observation_id in (select objectid from observations where set_id = ?)"
+			query1 = "delete from observation_sets where set_id = ?"
+			query2 = "delete from observations where set_id = ?"
+			for query in (query0, query1, query2):
+				db_cursor.execute(query, (set_id,))
+
+			layer_fingerprints.record_species_changes(db_cursor, species)
+			stats_summary.refresh_summary(db_cursor, species)
+
+			if db_conn is not None:
+				db_conn.commit()
+		finally:
+			if db_conn is not None:
+				funcs.db_close(db_cursor, db_conn)
+
+		return species
@@ -3,14 +3,19 @@ import tempfile
 import csv
 import logging
 import shutil
+import collections
 
 import arcpy
+import numpy
+import pandas
 
 from PISCES import local_vars
-from PISCES.tbx_make_matrix import make_matrix
+from PISCES.tbx_make_matrix import make_matrix, get_presence_matrix
 from PISCES import script_tool_funcs
 from PISCES import api
 from PISCES import api_tools
+from PISCES import clustering
+from PISCES import funcs
 
 log = logging.getLogger("PISCES.tools.clustering")
 
@@ -36,9 +41,9 @@ def _check_output_location(output_path):
 		raise ValueError("Folder or geodatabase in output path {} does not exist - please specify an existing geodatabase or folder for output. If placing in a folder, make sure to use the appropriate output extension (such as .shp), but putting the result in a geodatabase is recommended".format(output_path))
 
 
-def make_species_clusters(output_path, group_name="Flow_Sensitive", presence_values="1,3,9", min_species=2, num_groups=(2, 3, 4, 5, 6, 7, 8, 9), huc_regions=None, region_group_field=None, zones_field="huc_12_string", region_group_join_field="huc_12_double", aggregation=None, spatial_constraint="NO_SPATIAL_CONSTRAINT", initialization_method="FIND_SEED_LOCATIONS", report_folder=None):
+def make_species_clusters(output_path, group_name="Flow_Sensitive", presence_values="1,3,9", min_species=2, num_groups=(2, 3, 4, 5, 6, 7, 8, 9), huc_regions=None, region_group_field=None, zones_field="huc_12_string", region_group_join_field="huc_12_double", aggregation=None, spatial_constraint="NO_SPATIAL_CONSTRAINT", initialization_method="FIND_SEED_LOCATIONS", report_folder=None, engine=None, processes=None):
 	"""
-		Currently won't work when not passing in a region because we need a field that's a double
+		Currently won't work when not passing in a region because we need a field that's a double (arcpy engine only)
 	:param group_name:
 	:param presence_values:
 	:param min_species:
@@ -51,9 +56,25 @@ def make_species_clusters(output_path, group_name="Flow_Sensitive", presence_val
 	:param spatial_constraint: passed straight into ArcGIS's Grouping Analysis tool
 	:param initialization_method: passed straight into ArcGIS's Grouping Analysis tool
 	:param report_folder: folder used when clustering reports are dumped by ArcGIS, but also for cluster assemblage tables
-	:return:
+	:param engine: "arcpy" or "python" - see local_vars.clustering_engine, the default. The python engine writes a CSV
+		to output_path and its reports are CSVs of the summary statistics
+	:param processes: worker processes for the python engine. Defaults to local_vars.clustering_processes
+	:return: for the python engine, a dict of region -> OrderedDict of number of groups -> summary statistics (see
+		clustering.summarize)
 	"""
 
+	if engine is None:
+		engine = local_vars.clustering_engine
+	if engine == "python":
+		return _make_species_clusters_python(output_path, group_name=group_name, presence_values=presence_values,
+											 min_species=min_species, num_groups=num_groups, huc_regions=huc_regions,
+											 region_group_field=region_group_field, zones_field=zones_field,
+											 aggregation=aggregation, spatial_constraint=spatial_constraint,
+											 initialization_method=initialization_method, report_folder=report_folder,
+											 processes=processes)
+	elif engine != "arcpy":
+		raise ValueError("Unknown clustering engine {} - options are arcpy and python".format(engine))
+
 	# Originally had a value check for multiple parameters, but I think these fields are unrelated, so cancelling this check, but not removing it yet
 	#if (region_group_field or region_group_join_field) and not (region_group_field and region_group_field):
 	#	raise ValueError("Parameters region_group_field, and region_group_join_field must all be supplied if one is supplied. Cannot continue")
@@ -131,6 +152,148 @@ def make_species_clusters(output_path, group_name="Flow_Sensitive", presence_val
 		# shutil.rmtree(working_folder)
 
 
+def _make_species_clusters_python(output_path, group_name, presence_values, min_species, num_groups, huc_regions, region_group_field, zones_field, aggregation, spatial_constraint, initialization_method, report_folder, processes):
+	"""
+		make_species_clusters without arcpy - clusters the presence matrix in memory with the clustering module. The
+		output is a CSV with a row for each zone that was clustered, its region, and a column with its group for each
+		number of groups.
+	"""
+	if os.path.exists(output_path):
+		raise ValueError("Output path {} already exists - please specify a unique output path".format(output_path))
+	if spatial_constraint not in clustering.spatial_constraints:
+		raise ValueError("Spatial constraint {} isn't supported by the python clustering engine - options are {}".format(spatial_constraint, ", ".join(clustering.spatial_constraints)))
+
+	presence, zones, fields = get_presence_matrix(group_name, presence_types=presence_values, qc_flag=True,  # local_vars.hq_collections gets used
+												  use_scientific_name=False, aggregation=aggregation)
+
+	if min_species != 0:
+		huc_counts = dict(api.counts.count_species_in_group_by_huc(group_name, presence_values))
+		keep = numpy.array([huc_counts.get(zone, 0) >= min_species for zone in zones], dtype=bool)
+		presence = presence[keep]
+		zones = [zone for zone, kept in zip(zones, keep) if kept]
+
+	regions = _zone_regions(huc_regions, region_group_field, zones_field)
+	if regions is None:
+		region_names = ["all_zones"] * len(zones)
+	else:
+		region_names = [regions.get(zone) for zone in zones]
+		in_a_region = numpy.array([name is not None for name in region_names], dtype=bool)
+		presence = presence[in_a_region]
+		zones = [zone for zone, kept in zip(zones, in_a_region) if kept]
+		region_names = [name for name in region_names if name is not None]
+
+	output = pandas.DataFrame({"region": region_names}, index=pandas.Index(zones, name=local_vars.huc_field))
+	for group_size in num_groups:
+		output["{}groups_num".format(group_size)] = numpy.zeros(len(zones), dtype=numpy.int64)
+	summaries = {}
+
+	db_cursor, db_conn = funcs.db_connect(local_vars.maindb, "Reading zone adjacency for clustering")
+	try:
+		for region in sorted(set(region_names)):
+			rows = numpy.array([name == region for name in region_names], dtype=bool)
+			region_zones = [zone for zone, in_region in zip(zones, rows) if in_region]
+			log.info("Clustering {} zones in region {}".format(len(region_zones), region))
+
+			neighbors = None
+			if spatial_constraint != "NO_SPATIAL_CONSTRAINT":
+				neighbors = clustering.load_zone_adjacency(db_cursor, region_zones, edges_only=spatial_constraint == "CONTIGUITY_EDGES_ONLY")
+
+			results = clustering.cluster_sizes(presence[rows], num_groups, neighbors=neighbors,
+												initialization_method=initialization_method, processes=processes)
+
+			summaries[region] = collections.OrderedDict()
+			for group_size, (labels, summary) in results.items():
+				log.info("{} groups in {}: pseudo F-statistic {}".format(group_size, region, summary["pseudo_f"]))
+				summaries[region][group_size] = summary
+				output.loc[rows, "{}groups_num".format(group_size)] = labels
+
+				if report_folder:
+					zones_by_cluster = {}
+					for zone, label in zip(region_zones, labels):
+						zones_by_cluster.setdefault(int(label), []).append(zone)
+					write_assemblage_table(zones_by_cluster, os.path.join(report_folder, "{}_{}groups_num.csv".format(region, group_size)),
+										   species_group=group_name, presence_types=presence_values, aggregation=aggregation,
+										   collections=local_vars.hq_collections)
+
+			if report_folder:
+				_write_cluster_reports(summaries[region], fields, region, report_folder)
+	finally:
+		funcs.db_close(db_cursor, db_conn)
+
+	output.to_csv(output_path)
+	return summaries
+
+
+def _zone_regions(huc_regions, region_group_field, zones_field):
+	"""
+		Reads which region each zone is in for the python engine
+	:param huc_regions: dict of zone -> region, a CSV, or a feature class (needs arcpy) with zones_field and
+		region_group_field. When None, regions come from region_group_field in the zones table
+	:return: dict of zone -> region, or None to cluster all zones together. Without region_group_field, all the zones
+		in huc_regions go in a single region
+	"""
+	if isinstance(huc_regions, dict):
+		return huc_regions
+	if huc_regions is None and not region_group_field:
+		return None
+
+	if huc_regions is None:
+		db_cursor, db_conn = funcs.db_connect(local_vars.maindb, "Reading zone regions")
+		try:
+			records = db_cursor.execute("SELECT {}, {} FROM {}".format(local_vars.huc_field, region_group_field, local_vars.zones_table)).fetchall()
+		finally:
+			funcs.db_close(db_cursor, db_conn)
+	elif huc_regions.lower().endswith(".csv"):
+		table = pandas.read_csv(huc_regions, dtype=str)
+		records = zip(table[zones_field], table[region_group_field] if region_group_field else ["all_zones"] * len(table))
+	else:
+		read_fields = [zones_field, region_group_field] if region_group_field else [zones_field]
+		with arcpy.da.SearchCursor(huc_regions, read_fields) as rows:
+			records = [(row[0], row[1] if region_group_field else "all_zones") for row in rows]
+
+	return dict((zone, region) for zone, region in records if region is not None)
+
+
+def _write_cluster_reports(summaries, fields, region_name, report_folder):
+	"""
+		Writes the summary statistics for a region's clusterings to CSVs in the report folder - one with the pseudo
+		F-statistic and group sizes for each number of groups, and one with the R-squared of each field
+	"""
+	if not os.path.exists(report_folder):
+		os.makedirs(report_folder)
+		log.debug("Making report folder {}".format(report_folder))
+
+	statistics = pandas.DataFrame([{"num_groups": group_size,
+									"pseudo_f": summary["pseudo_f"],
+									"smallest_group": min(summary["group_sizes"]),
+									"largest_group": max(summary["group_sizes"])} for group_size, summary in summaries.items()],
+								  columns=("num_groups", "pseudo_f", "smallest_group", "largest_group"))
+	statistics.to_csv(os.path.join(report_folder, "{}_cluster_statistics.csv".format(region_name)), index=False)
+
+	r_squared = pandas.DataFrame(dict(("{}_groups".format(group_size), summary["r_squared"]) for group_size, summary in summaries.items()),
+								 index=pandas.Index(fields, name="field"), columns=["{}_groups".format(group_size) for group_size in summaries])
+	r_squared.to_csv(os.path.join(report_folder, "{}_cluster_r_squared.csv".format(region_name)))
+
+
+def build_zone_adjacency(zone_index=None):
+	"""
+		Finds which zones touch, for contiguous groups with the python clustering engine. Run once, and again whenever
+		the zones change.
+	:param zone_index: spatial_join.ZoneIndex of the zones. Defaults to the zones layer, read with arcpy - without
+		arcpy, load it with spatial_join.ZoneIndex.from_fiona
+	"""
+	if zone_index is None:
+		from PISCES.input_filters import common  # imported here because it's only needed for this
+		zone_index = common.load_zone_index()
+
+	db_cursor, db_conn = funcs.db_connect(local_vars.maindb, "Computing zone adjacency")
+	try:
+		clustering.build_zone_adjacency(db_cursor, zone_index)
+		db_conn.commit()
+	finally:
+		funcs.db_close(db_cursor, db_conn)
+
+
 def join_matrix_to_hucs(csv_path, huc_regions, region_group_join_field, working_gdb_path, min_species, huc_counts, matrix_info):
 	with Env("workspace", working_gdb_path):
 		new_table_name = "converted_matrix"
@@ -313,6 +476,20 @@ def dump_assemblage_table(clusters, cluster_field, output_folder, zone_field, sp
 	log.debug("Cluster Assemblage: Cluster Count: {}".format(debug_cluster_count))
 	del all_records  # clear the cursor out
 
+	write_assemblage_table(clusters, output_name, species_group, presence_types, aggregation, collections)
+
+
+def write_assemblage_table(clusters, output_name, species_group, presence_types, aggregation, collections):
+	"""
+		Writes a CSV with the assemblage of each cluster
+	:param clusters: dict of cluster id -> list of zones in the cluster
+	:param output_name: path of the CSV to write
+	:return:
+	"""
+	output_folder = os.path.split(output_name)[0]
+	if output_folder and not os.path.exists(output_folder):
+		os.makedirs(output_folder)
+
 	## for each key in dictionary
 	outputs = []
 	for cluster_id in clusters:
@@ -325,9 +502,10 @@ def dump_assemblage_table(clusters, cluster_field, output_folder, zone_field, sp
 											 presence_types=presence_types,
 											 collections=collections)
 
-		if aggregation.lower() in ("species", "genus", "family"):
+		if aggregation and aggregation.lower() in ("species", "genus", "family"):
 			# if we have an aggregation level, get the common name from the species string as a new list
-			common_name_assemblage = [api_tools.get_common_name_from_species_string(scientific_name=sci_name, level=aggregation) for sci_name in output_dict["cluster_assemblage"]]
+			common_names = api_tools.get_common_names(output_dict["cluster_assemblage"], level=aggregation)
+			common_name_assemblage = [common_names[sci_name] for sci_name in output_dict["cluster_assemblage"]]
 			output_dict["cluster_assemblage"] = ", ".join(sorted(common_name_assemblage))  # then join those common names into a string
 		else:
 			output_dict["cluster_assemblage"] = ", ".join(sorted(output_dict["cluster_assemblage"]))  # make it print nicer by making it a string
@@ -336,11 +514,8 @@ def dump_assemblage_table(clusters, cluster_field, output_folder, zone_field, sp
 		log.debug("Cluster Assemblage: Assemblage for {}: {}".format(cluster_id, output_dict["cluster_assemblage"]))
 	log.debug("Cluster Assemblage: Output Length: {}".format(len(outputs)))
 
-	## With DictWriter, write out all clusters/assemblages to csv table
-	with open(output_name, 'wb') as output_file:
-		writer = csv.DictWriter(output_file, fieldnames=("cluster_name", "cluster_assemblage"))
-		writer.writeheader()
-		writer.writerows(outputs)
+	## write out all clusters/assemblages to csv table
+	pandas.DataFrame(outputs, columns=("cluster_name", "cluster_assemblage")).to_csv(output_name, index=False)
 
 def make_safe(field_name):
 	return field_name.replace(" ", "_").replace("(", "_").replace(")", "_").replace("-", "_")
@@ -8,6 +8,7 @@ import os
 import re
 
 import six
+import numpy
 import pandas
 
 import arcpy
@@ -123,7 +124,7 @@ def write_csv(filename, headers, rows, sci_name_output, header_row=None):
 		del csvwriter
 
 
-def make_matrix(species_list, output_folder, presence_types="1,3,6,7,9", true_value=1, false_value=0, qc_flag=True, use_scientific_name=False, override_query=False, zones_table="HUC12FullState", zone_field="HUC_12", out_name="", aggregation=None):
+def make_matrix(species_list, output_folder, presence_types="1,3,6,7,9", true_value=1, false_value=0, qc_flag=True, use_scientific_name=False, override_query=False, zones_table="HUC12FullState", zone_field="HUC_12", out_name="", aggregation=None, extra_formats=None):
 	"""
 		Produces a matrix of species presence information where the rows are zone ids (huc 12s) and the columns are species names.
 		Presence is denoted using a true or false value in each cell
@@ -144,18 +145,52 @@ def make_matrix(species_list, output_folder, presence_types="1,3,6,7,9", true_va
 			is set (options are "species", "genus", and "family"), columns will be created for the chosen aggregation
 			level instead of individual taxa, and the column will show presence if at least one taxa in that aggregated
 			level of the taxonomic tree is presence in a zone.
+	:param extra_formats: default None. A list of additional formats to write next to the CSV - "parquet" writes the
+			data frame as a Parquet file (requires pyarrow or fastparquet), and "npz" writes a compressed numpy file
+			with arrays "presence" (boolean, zones x taxa), "zones", and "fields".
 	:return dict: keys key_field and species_fields. key_field is the field the matrix can join on and species_fields
-			is a list of all of the fields with species data
+			is a list of all of the fields with species data. output_path is the CSV and output_paths has the path
+			for each format written, keyed by format
+	"""
+
+	out_base = "{}_{}_presence_matrix".format(os.path.join(output_folder, zones_table), out_name)
+	out_name = "{}.csv".format(out_base)
+
+	presence, all_zones, taxa_fields = get_presence_matrix(species_list, presence_types=presence_types, qc_flag=qc_flag,
+														   use_scientific_name=use_scientific_name, zones_table=zones_table,
+														   zone_field=zone_field, aggregation=aggregation)
+	main_df = presence_frame(presence, all_zones, taxa_fields, true_value, false_value)
+
+	main_df.to_csv(out_name, index_label="HUC_12")
+	output_paths = {"csv": out_name}
+
+	for extra_format in (extra_formats or ()):
+		extra_format = extra_format.lower()
+		if extra_format == "parquet":
+			output_paths["parquet"] = "{}.parquet".format(out_base)
+			main_df.rename_axis("HUC_12").to_parquet(output_paths["parquet"])
+		elif extra_format == "npz":
+			output_paths["npz"] = "{}.npz".format(out_base)
+			numpy.savez_compressed(output_paths["npz"], presence=presence,
+								   zones=numpy.array([six.text_type(zone) for zone in all_zones]),
+								   fields=numpy.array(taxa_fields))
+		else:
+			raise ValueError("Unknown matrix output format {} - options are parquet and npz".format(extra_format))
+
+	return {"key_field": zone_field, "species_fields": taxa_fields, "output_path": out_name, "output_paths": output_paths, "data_frame": main_df}
+
+
+def get_presence_matrix(species_list, presence_types="1,3,6,7,9", qc_flag=True, use_scientific_name=False, zones_table="HUC12FullState", zone_field="HUC_12", aggregation=None):
+	"""
+		Builds the matrix make_matrix writes out, without writing it, for code that works with the matrix directly. The
+		parameters are the same as make_matrix's.
+	:return: tuple of (numpy boolean array of zones x taxa, list of zones - the rows, list of field names - the columns)
 	"""
 
 	# VALIDATION OF SPECIES PROVIDED IS DONE IN get_presence_by_taxa
 
 	all_zones, rows_index = get_zones(zones_table, zone_field)
 
-	headers = [zone_field]
-	header_row = {}
-	header_row[zone_field] = zone_field
-
 	if qc_flag:
 		collections = local_vars.hq_collections
 	else:
@@ -166,25 +201,6 @@ def make_matrix(species_list, output_folder, presence_types="1,3,6,7,9", true_va
 															  presence_types=presence_types,
 															  collections=collections)
 
-	all_taxa = [record.taxon for record in species_presence_data]  # get a list of just the taxa
-	distinct_taxa = list(set(all_taxa))  # dedupe - this is now the order that we'll go through them in
-	del all_taxa  # it'll be large, so get rid of it quickly
-
-	# Now, let's make a pandas data frame with the same number of rows
-	# as we have zones and same number of columns as taxa - we need to be careful about the column data
-	# types - since we know they'll all eventually get exported to CSVs, we can probably safely use text
-	# for all, but if we think we might want to just use the pandas data frame for other purposes later,
-	# then we might want to check if our presence/absence values are numbers and set column data types
-	# accordingly. If we can just name numpy array fields, then skip pandas, as we'll then need to add
-	# it as a dependency.
-
-	# alternatively, we can just index all of the zones in the records, then go through them one by one
-	# and check for each species in order - that seems slower than filling an array with our false value
-	# then setting presence for each record.
-
-	# could probably also have gotten exactly what we wanted with SQL statements, but using the API seems
-	# better and more tested, even if less performant
-
 	if not aggregation:
 		if use_scientific_name:
 			species_name_attribute = "sci_name"
@@ -192,30 +208,73 @@ def make_matrix(species_list, output_folder, presence_types="1,3,6,7,9", true_va
 			species_name_attribute = "species"
 	else:
 		species_name_attribute = None
-	out_name = "{}_{}_presence_matrix.csv".format(os.path.join(output_folder, zones_table), out_name)
-
-	taxa_fields = [_make_safe_field_name(taxon, taxa_info=local_vars.all_fish, name_attribute=species_name_attribute) for taxon in distinct_taxa]
 
-	main_df = _make_empty_matrix(columns=taxa_fields, rows=all_zones, false_value=false_value)
-	for record in species_presence_data:  # go through and set the actual present values
-		main_df[_make_safe_field_name(record.taxon, taxa_info=local_vars.all_fish, name_attribute=species_name_attribute)][record.zone_id] = true_value
+	field_names = {}  # taxon -> field name, so each distinct taxon only gets looked up once
+	def field_for_taxon(taxon):
+		if taxon not in field_names:
+			field_names[taxon] = _make_safe_field_name(taxon, taxa_info=local_vars.all_fish, name_attribute=species_name_attribute)
+		return field_names[taxon]
 
-	main_df.to_csv(out_name, index_label="HUC_12")
+	presence, taxa_fields = build_presence_matrix(species_presence_data, all_zones, field_for_taxon)
+	return presence, all_zones, taxa_fields
 
-	return {"key_field": zone_field, "species_fields": taxa_fields, "output_path": out_name, "data_frame": main_df}
 
-
-def _make_empty_matrix(columns, rows, false_value):
+def build_presence_matrix(presence_records, zones, field_for_taxon):
 	"""
-		Makes an empty data frame with the specified rows and columns and fills it with the false value - from here
-		we'll just set the true values based on the pulled data
-	:param columns:
-	:param rows:
-	:param false_value:
-	:return:
+		Builds a zones x fields boolean presence matrix in one pass from (zone_id, taxon) records, like the ones returned
+		by api.presence.get_presence_by_taxa. Zones are encoded as categorical codes and fields by first appearance,
+		then every present cell is set at once. Records for zones that aren't in zones are dropped.
+	:param presence_records: iterable of records with zone_id and taxon attributes
+	:param zones: list of zone ids - the rows of the matrix, in order
+	:param field_for_taxon: function that returns the field (column) name for a taxon. Taxa that share a field name
+		share a column
+	:return: tuple of (numpy boolean array, list of field names)
+	"""
+	record_zones = []
+	record_fields = []
+	fields = []
+	field_index = {}
+	for record in presence_records:
+		field = field_for_taxon(record.taxon)
+		if field not in field_index:
+			field_index[field] = len(fields)
+			fields.append(field)
+		record_zones.append(record.zone_id)
+		record_fields.append(field_index[field])
+
+	rows = pandas.Categorical(record_zones, categories=zones).codes
+	columns = numpy.array(record_fields, dtype=numpy.int64)
+	in_zones = rows >= 0  # -1 means the record's zone isn't one of our zones - our study area may be smaller than we track
+
+	presence = numpy.zeros((len(zones), len(fields)), dtype=bool)
+	presence[rows[in_zones], columns[in_zones]] = True
+	return presence, fields
+
+
+def presence_frame(presence, zones, fields, true_value=1, false_value=0, sparse=False):
+	"""
+		Converts a boolean presence matrix into a data frame of true_value and false_value
+	:param presence: numpy boolean array of zones x fields
+	:param zones: row labels
+	:param fields: column labels
+	:param true_value: value for cells where the taxon is present
+	:param false_value: value for cells where it isn't
+	:param sparse: when True, the columns are stored as pandas sparse arrays with false_value as the fill value,
+		which saves memory for large, mostly empty matrices
+	:return: pandas.DataFrame
 	"""
-	base_matrix = pandas.DataFrame(columns=columns, index=rows)
-	return base_matrix.fillna(false_value)
+	if type(true_value) is type(false_value):
+		values = numpy.where(presence, true_value, false_value)
+	else:  # keep each value as it is instead of letting numpy coerce them to a common type
+		values = numpy.empty(presence.shape, dtype=object)
+		values[presence] = true_value
+		values[~presence] = false_value
+
+	if sparse:
+		return pandas.DataFrame(dict((field, pandas.arrays.SparseArray(values[:, index], fill_value=false_value)) for index, field in enumerate(fields)),
+								index=zones, columns=fields)
+
+	return pandas.DataFrame(values, index=zones, columns=fields)
 
 
 def _make_safe_field_name(name, taxa_info, name_attribute=None):
@@ -12,6 +12,8 @@ from PISCES import funcs
 from PISCES import mapping
 from PISCES import api
 from PISCES import script_tool_funcs
+from PISCES import layer_fingerprints
+from PISCES import stats_summary
 
 '''This script is meant to be run only as an ArcGIS script tool - messages will be passed out using arcpy'''
 '''This is the primary toolbox function from before they were prefixed with tbx_ - it handles modifications of records directly from within ArcGIS'''
@@ -205,6 +207,9 @@ def modify_range(l_layer, l_species, l_operation, l_new_species, l_reason_messag
 	else:  # otherwise, we're modifying existing records
 		modify_records(zones)  # handles records whether they are being modified or deleted entirely
 
+	layer_fingerprints.record_species_changes(db_cursor, [species, new_species])  # new_species is empty unless transferring
+	stats_summary.refresh_summary(db_cursor, [species, new_species])
+
 	db_conn.commit()
 	log.write("Completed modifications", 1)
 
@@ -159,3 +159,35 @@ class GetPresenceByHUCSetTest(unittest.TestCase):
 
 
 
+
+
+class PresenceIndexTest(unittest.TestCase):
+	"""
+		Confirms the in-memory presence index gives the same answers as the ORM queries it replaces
+	"""
+
+	def setUp(self):
+		api.presence_index.invalidate()
+
+	def test_presence_by_taxa(self):
+		for level in ("fid", "common_name", "species", "genus", "family"):
+			from_orm = api.presence.get_presence_by_taxa("Flow_Sensitive", taxonomic_aggregation_level=level, use_index=False)
+			from_index = api.presence.get_presence_by_taxa("Flow_Sensitive", taxonomic_aggregation_level=level, use_index=True)
+			self.assertEqual(set(from_orm), set(from_index))
+
+	def test_presence_by_huc_set(self):
+		hucs = [u'160501020504', u'160501020503', u'160501010102', u'160503010101', u'160503020102']
+		from_orm = api.presence.get_presence_by_huc_set("Flow_Sensitive_V2", hucs, "common_name", "1,3,9", use_index=False)
+		from_index = api.presence.get_presence_by_huc_set("Flow_Sensitive_V2", hucs, "common_name", "1,3,9", use_index=True)
+		self.assertEqual(set(from_orm), set(from_index))
+
+	def test_hucs_for_species(self):
+		from_orm = api.listing.get_hucs_for_species_as_list("CMC01", "1,3,6,7,9", use_index=False)
+		from_index = api.listing.get_hucs_for_species_as_list("CMC01", "1,3,6,7,9", use_index=True)
+		self.assertEqual(sorted(from_orm), from_index)
+
+	def test_reuse(self):
+		index = api.presence_index.get_index()
+		self.assertIs(index, api.presence_index.get_index())
+		api.presence_index.invalidate()
+		self.assertIsNot(index, api.presence_index.get_index())
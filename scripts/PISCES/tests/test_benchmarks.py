@@ -0,0 +1,89 @@
+__author__ = 'nrsantos'
+
+import os
+import shutil
+import sqlite3
+import tempfile
+import unittest
+
+from PISCES import funcs
+from PISCES import huc_network
+from PISCES import local_vars
+from PISCES import orm_models
+from PISCES.api_components import presence_index
+from PISCES.benchmarks import synthetic
+from PISCES.benchmarks import runner
+
+
+class SyntheticDatabaseTest(unittest.TestCase):
+
+	def setUp(self):
+		self.folder = tempfile.mkdtemp()
+		self.db_path = os.path.join(self.folder, "synthetic.sqlite")
+		synthetic.generate(self.db_path, n_hucs=300, n_species=20, n_observations=2000, seed=3)
+		self.connection = sqlite3.connect(self.db_path)
+
+	def tearDown(self):
+		self.connection.close()
+		shutil.rmtree(self.folder)
+
+	def test_network_is_a_tree(self):
+		pairs = self.connection.execute("select HUC_12, HU_12_DS from huc12fullstate").fetchall()
+		self.assertEqual(300, len(set(pair[0] for pair in pairs)))
+
+		network = huc_network.HUCNetwork(pairs)
+		self.assertEqual({}, network.missing_downstream)  # every downstream value is a zone or a network end
+		self.assertEqual(300, len(network.topological_order()))  # no loops
+
+	def test_observations(self):
+		self.assertEqual(2000, self.connection.execute("select count(*) from observations").fetchone()[0])
+		self.assertEqual(0, self.connection.execute("select count(*) from observations where certainty is null").fetchone()[0])
+		orphans = self.connection.execute("select count(*) from observations where zone_id not in (select HUC_12 from huc12fullstate) "
+										  "or species_id not in (select fid from species)").fetchone()[0]
+		self.assertEqual(0, orphans)
+		uncollected = self.connection.execute("select count(*) from observations where objectid not in (select observation_id from observation_collections)").fetchone()[0]
+		self.assertEqual(0, uncollected)
+
+	def test_overwrite(self):
+		self.assertRaises(ValueError, synthetic.generate, self.db_path)
+
+
+class FindRegressionsTest(unittest.TestCase):
+
+	def test_find_regressions(self):
+		previous = {"results": {"fast": {"median": 1.0}, "slow": {"median": 1.0}}}
+		results = {"fast": {"median": 1.1}, "slow": {"median": 1.5}, "new": {"median": 9.0}}
+		self.assertEqual([("slow", 1.0, 1.5)], runner.find_regressions(results, previous, threshold=0.25))
+		self.assertEqual([], runner.find_regressions(results, None))
+
+
+class RunTest(unittest.TestCase):
+	"""
+		Runs every registered benchmark once against a tiny database, through the sqlite3 driver
+	"""
+
+	def setUp(self):
+		self.folder = tempfile.mkdtemp()
+		self.addCleanup(shutil.rmtree, self.folder, True)
+
+		for name in ("maindb", "ormdb", "db_driver", "data_setup_run"):
+			self.addCleanup(setattr, local_vars, name, getattr(local_vars, name))
+		self.addCleanup(presence_index.invalidate)
+		self.addCleanup(orm_models.reset)
+		self.addCleanup(funcs.close_pooled_connections)
+
+	def test_every_benchmark_runs(self):
+		dataset = {"n_hucs": 60, "n_species": 8, "n_observations": 400, "seed": 2}
+		results_path = os.path.join(self.folder, "benchmarks.jsonl")
+		record, regressions = runner.run(dataset, db_path=os.path.join(self.folder, "tiny.sqlite"), repeat=1, results_path=results_path)
+
+		self.assertEqual(sorted(name for name, setup, function in runner.benchmarks), sorted(record["results"].keys()))
+		self.assertEqual("sqlite3", record["driver"])
+		self.assertEqual([], regressions)
+		self.assertEqual(record["results"], runner.load_previous(results_path, dataset)["results"])
+
+		connection = sqlite3.connect(os.path.join(self.folder, "tiny.sqlite"))
+		try:
+			self.assertEqual(400, connection.execute("select count(*) from observations").fetchone()[0])  # the insert benchmarks roll back
+		finally:
+			connection.close()
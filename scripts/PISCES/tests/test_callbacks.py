@@ -1,6 +1,7 @@
 __author__ = 'nrsantos'
 
 import unittest
+import sqlite3
 
 import arcpy
 
@@ -9,6 +10,9 @@ from PISCES import log
 from PISCES import local_vars
 from PISCES import mapping
 from PISCES import callbacks
+from PISCES.callbacks import batch
+from PISCES.callbacks import diversity_engine
+from PISCES.callbacks import beta_diversity
 
 class ComposeQueryTest(unittest.TestCase):
 
@@ -39,3 +43,179 @@ class ExportRasterTest(unittest.TestCase):
 
 		self.assertTrue(arcpy.Exists(self.map_layer.layer_name))
 
+
+
+
+class BatchZoneValuesTest(unittest.TestCase):
+	"""
+		Checks that the set-based postprocess_zones queries give the same values as running the query once per zone.
+		Uses an in-memory SQLite fixture, so it doesn't need arcpy or the PISCES database.
+	"""
+
+	def setUp(self):
+		self.db_conn = sqlite3.connect(":memory:")
+		self.db_cursor = self.db_conn.cursor()
+		self.db_cursor.executescript("""
+			CREATE TABLE observations (objectid INTEGER PRIMARY KEY, species_id TEXT, zone_id TEXT, presence_type INTEGER);
+			INSERT INTO observations (species_id, zone_id, presence_type) VALUES
+				('CMC01', '180101010101', 1), ('SOM09', '180101010101', 1), ('CMC01', '180101010101', 3),
+				('CMC01', '180101010102', 1), ('SOM09', '180101010103', 2);
+		""")
+		self.zones = ["180101010101", "180101010102", "180101010103", "180101010104"]
+
+	def tearDown(self):
+		self.db_conn.close()
+
+	def _per_zone(self, query):
+		values = {}
+		for zone in self.zones:
+			result = self.db_cursor.execute(query, (zone,)).fetchone()
+			values[zone] = result[0] if result else None
+		return values
+
+	def test_count_query(self):
+		query = """SELECT count(*) AS col_value FROM (SELECT DISTINCT observations.species_id FROM observations
+					WHERE observations.zone_id = ? AND observations.presence_type IN (1,3))"""
+		self.assertEqual(self._per_zone(query), batch.get_zone_values(self.db_cursor, query, self.zones))
+
+	def test_first_row_query(self):
+		query = "SELECT observations.species_id AS col_value FROM observations WHERE observations.zone_id = ? ORDER BY species_id"
+		self.assertEqual(self._per_zone(query), batch.get_zone_values(self.db_cursor, query, self.zones))
+
+	def test_unbatchable_query(self):
+		good_query = "SELECT count(*) AS col_value FROM observations WHERE zone_id = ?"
+		bad_query = "SELECT count(*) AS col_value FROM observations WHERE zone_id = ? AND species_id = ?"
+		results = batch.get_zone_values_for_queries(self.db_cursor, [good_query, bad_query], self.zones)
+		self.assertIn(good_query, results)
+		self.assertNotIn(bad_query, results)
+
+
+class DiversityEngineTest(unittest.TestCase):
+	"""
+		Checks the single-pass mega_diversity_info engine against the per-zone SQL it replaces, on an in-memory fixture
+	"""
+
+	def setUp(self):
+		self.db_conn = sqlite3.connect(":memory:")
+		self.db_cursor = self.db_conn.cursor()
+		self.db_cursor.executescript("""
+			CREATE TABLE species (fid TEXT PRIMARY KEY, common_name TEXT, native INTEGER);
+			CREATE TABLE species_aux (fid TEXT, average REAL);
+			CREATE TABLE defs_species_groups (id INTEGER PRIMARY KEY, group_name TEXT);
+			CREATE TABLE species_groups (fid TEXT, group_id INTEGER);
+			CREATE TABLE observations (objectid INTEGER PRIMARY KEY, species_id TEXT, zone_id TEXT, presence_type INTEGER);
+			CREATE TABLE observation_collections (observation_id INTEGER, collection_id INTEGER);
+			CREATE TABLE zones_aux (zone TEXT, beta_div_nat_hist REAL, beta_div_nn_hist REAL);
+			CREATE VIEW native_fish AS SELECT species.fid FROM species, species_groups WHERE species.fid = species_groups.fid AND species_groups.group_id = 1 AND species.native = 1;
+
+			INSERT INTO species VALUES ('CMC01', 'Hardhead', 1), ('SOM09', 'Sacramento Pikeminnow', 1), ('CCP01', 'Common Carp', 0);
+			INSERT INTO species_aux VALUES ('CMC01', 2.5), ('SOM09', 3.5), ('CCP01', 4.0);
+			INSERT INTO defs_species_groups VALUES (1, 'Fish'), (2, 'Native_Fish');
+			INSERT INTO species_groups VALUES ('CMC01', 1), ('SOM09', 1), ('CCP01', 1), ('CMC01', 2), ('SOM09', 2);
+			INSERT INTO observations (objectid, species_id, zone_id, presence_type) VALUES
+				(1, 'CMC01', 'A', 1), (2, 'CMC01', 'A', 3), (3, 'SOM09', 'A', 2), (4, 'CCP01', 'A', 1),
+				(5, 'SOM09', 'B', 1), (6, 'CMC01', 'B', 2), (7, 'CCP01', 'C', 1);
+			INSERT INTO observation_collections VALUES (1, 5), (1, 15), (2, 5), (3, 5), (5, 16), (6, 5), (7, 99);
+			INSERT INTO zones_aux (zone) VALUES ('A'), ('B'), ('C');
+		""")
+		self.downstream = {"A": "B", "B": "OCEAN", "C": "B"}
+		self.data = diversity_engine.AssemblageData(self.db_cursor, "5,15,16")
+		self.fields, self.values, self.beta = diversity_engine.compute_mega_diversity(self.data, self.downstream,
+																			diversity_engine.parse_types("1,3,6,7,9"),
+																			diversity_engine.parse_types("2,5,10"), run_non_qc=True)
+
+	def tearDown(self):
+		self.db_conn.close()
+
+	def _per_zone(self, query):
+		return dict((zone, self.db_cursor.execute(query, (zone,)).fetchone()[0]) for zone in self.downstream)
+
+	def test_richness_matches_sql(self):
+		query = """SELECT count(*) AS col_value FROM (SELECT DISTINCT observations.species_id
+					FROM observations, native_fish, observation_collections
+					WHERE observations.zone_id = ? AND observations.species_id = native_fish.fid
+					AND observations.presence_type IN (1,3,6,7,9)
+					AND observations.objectid = observation_collections.observation_id
+					AND observation_collections.collection_id IN (5,15,16))"""
+		self.assertEqual(self._per_zone(query), self.values["native_qc_richness"])
+		self.assertEqual({"A": 2, "B": 1, "C": 1}, self.values["all_richness"])
+
+	def test_sensitivity_average_is_weighted_by_rows(self):
+		query = """SELECT avg(species_aux.average) AS col_value
+					FROM observations, species_aux, species_groups, observation_collections
+					WHERE observations.zone_id = ? AND observations.species_id = species_aux.fid
+					AND species_groups.fid = observations.species_id AND species_groups.group_id = 1
+					AND observations.presence_type IN (1,3,6,7,9)
+					AND observations.objectid = observation_collections.observation_id
+					AND observation_collections.collection_id IN (5,15,16)"""
+		expected = self._per_zone(query)
+		for zone in expected:
+			if expected[zone] is None:
+				self.assertIsNone(self.values["avg_qc_sensitivity_score"][zone])
+			else:
+				self.assertAlmostEqual(expected[zone], self.values["avg_qc_sensitivity_score"][zone])
+
+	def test_losses_and_gains(self):
+		self.assertEqual(1, self.values["losses_Native_Fish"]["A"])  # SOM09 historic only
+		self.assertEqual("Sacramento Pikeminnow", self.values["losses_list_Native_Fish"]["A"])
+		self.assertEqual(0, self.values["richness_difference_Native_Fish"]["A"])
+		self.assertNotIn("C", self.values["losses_Native_Fish"])  # no qc records for the group
+		self.assertEqual(0, self.values["current_richness_Native_Fish"]["C"])
+
+	def test_beta_diversity(self):
+		# A has {CMC01}, B has {SOM09}, C has none - B is downstream of A and C
+		self.assertEqual(1.0, self.values["div_native_qc"]["A"])
+		self.assertEqual(1.0, self.values["div_native_qc"]["C"])
+		diversity_engine.write_beta_diversity(self.db_cursor, self.beta)
+		result = self.db_cursor.execute("SELECT beta_div_nat_hist FROM zones_aux WHERE zone = 'A'").fetchone()
+		self.assertEqual(self.beta["beta_div_nat_hist"]["A"], result[0])
+
+	def test_downstream(self):
+		self.assertEqual("Sacramento Pikeminnow, ", self.values["downstream_assemblage"]["A"])
+		self.assertEqual("", self.values["downstream_assemblage"]["B"])
+
+
+class BetaDiversityMatrixTest(unittest.TestCase):
+	"""
+		Checks that the matrix based beta diversity gives the same values as the per-watershed functions
+	"""
+
+	def setUp(self):
+		network = {"A": ("C", ["1", "2"]), "B": ("C", ["2", "3"]), "C": ("OCEAN", ["1"]), "D": ("E", ["4"]), "F": ("C", [])}
+		self.all_watersheds = {}
+		for zone in network:
+			watershed = callbacks.watershed()
+			watershed.HUC_12 = zone
+			watershed.downstream, watershed.assemblage = network[zone]
+			self.all_watersheds[zone] = watershed
+		for zone in network:
+			if self.all_watersheds[zone].downstream in self.all_watersheds:
+				self.all_watersheds[self.all_watersheds[zone].downstream].upstream.append(zone)
+
+	def _expected(self, diversity_func):
+		return dict((zone, diversity_func(self.all_watersheds[zone], self.all_watersheds)) for zone in self.all_watersheds)
+
+	def _matrix_values(self, div_func):
+		callbacks._diversity_by_matrix(self.all_watersheds, div_func)
+		return dict((zone, self.all_watersheds[zone].beta_div) for zone in self.all_watersheds)
+
+	def test_jaccard(self):
+		expected = self._expected(callbacks.diversity_jaccard)
+		results = self._matrix_values("diversity_jaccard")
+		for zone in expected:
+			self.assertAlmostEqual(expected[zone], results[zone])
+
+	def test_count(self):
+		self.assertEqual(self._expected(callbacks.diversity_count), self._matrix_values("diversity_count"))
+
+	def test_load_assemblages(self):
+		db_conn = sqlite3.connect(":memory:")
+		db_cursor = db_conn.cursor()
+		db_cursor.executescript("""
+			CREATE TABLE observations (objectid INTEGER PRIMARY KEY, species_id TEXT, zone_id TEXT, presence_type INTEGER);
+			INSERT INTO observations (species_id, zone_id, presence_type) VALUES ('CMC01', 'A', 1), ('CMC01', 'A', 3), ('SOM09', 'A', 2), ('SOM09', 'B', 1);
+		""")
+		assemblages = beta_diversity.load_assemblages(db_cursor, "1,3")
+		self.assertEqual({"A": ["CMC01"], "B": ["SOM09"]}, assemblages)
+		db_conn.close()
+
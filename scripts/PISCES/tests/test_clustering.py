@@ -0,0 +1,75 @@
+__author__ = 'nrsantos'
+
+import unittest
+
+import numpy
+
+from PISCES import clustering
+
+
+def square(x, y):
+	return [[(x, y), (x, y + 1), (x + 1, y + 1), (x + 1, y), (x, y)]]
+
+
+class AdjacencyTest(unittest.TestCase):
+
+	def test_grid(self):
+		zone_rings = [square(0, 0), square(1, 0), square(0, 1), square(1, 1)]
+		corners, edges = clustering.find_adjacency(zone_rings)
+		self.assertEqual([[0, 1], [0, 2], [0, 3], [1, 2], [1, 3], [2, 3]], corners.tolist())  # diagonal zones touch at the center
+		self.assertEqual([[0, 1], [0, 2], [1, 3], [2, 3]], edges.tolist())
+
+
+class ClusteringTest(unittest.TestCase):
+
+	def setUp(self):
+		# a line of zones, each touching the next, where the ends have the same assemblage
+		self.presence = numpy.array([[1, 1, 0, 0],
+									 [1, 1, 0, 0],
+									 [0, 0, 1, 1],
+									 [0, 0, 1, 1],
+									 [1, 1, 0, 0],
+									 [1, 1, 0, 1]], dtype=bool)
+		self.neighbors = [[1], [0, 2], [1, 3], [2, 4], [3, 5], [4]]
+
+	def test_jaccard_distances(self):
+		distances = clustering.jaccard_distances(self.presence)
+		self.assertAlmostEqual(0, distances[0, 1])
+		self.assertAlmostEqual(1, distances[0, 2])
+		self.assertAlmostEqual(1 - 2 / 3.0, distances[4, 5])
+		self.assertAlmostEqual(0, clustering.jaccard_distances(numpy.zeros((2, 3), dtype=bool))[0, 1])
+
+	def test_k_medoids(self):
+		labels = clustering.k_medoids(clustering.jaccard_distances(self.presence), 2)
+		self.assertEqual(1, len(set(labels[[0, 1, 4, 5]])))
+		self.assertEqual(1, len(set(labels[[2, 3]])))
+		self.assertNotEqual(labels[0], labels[2])
+
+		self.assertRaises(ValueError, clustering.k_medoids, clustering.jaccard_distances(self.presence[:4]), 3)  # only two distinct assemblages
+
+	def test_skater_groups_are_contiguous(self):
+		values, varies = clustering.standardize(self.presence)
+		labels = clustering.skater(values, clustering.jaccard_distances(self.presence), self.neighbors, 3)
+		groups = set(frozenset(numpy.flatnonzero(labels == label).tolist()) for label in set(labels))
+		self.assertEqual(set([frozenset([0, 1]), frozenset([2, 3]), frozenset([4, 5])]), groups)
+
+		self.assertRaises(ValueError, clustering.skater, values, clustering.jaccard_distances(self.presence), [[] for zone in range(6)], 3)  # six separate zones
+
+	def test_cluster_sizes(self):
+		results = clustering.cluster_sizes(self.presence, (2, 3), neighbors=self.neighbors, processes=1)
+		self.assertEqual([2, 3], list(results.keys()))
+
+		labels, summary = results[3]
+		self.assertEqual(1, labels.min())  # numbered from 1, like SS_GROUP
+		self.assertEqual([2, 2, 2], summary["group_sizes"])
+		self.assertGreater(summary["pseudo_f"], results[2][1]["pseudo_f"])
+		self.assertAlmostEqual(1, summary["r_squared"][0])  # the first field is the same within every group
+
+	def test_summarize(self):
+		values, varies = clustering.standardize(self.presence[:4])
+		summary = clustering.summarize(values, numpy.array([0, 0, 1, 1]), varies)
+		self.assertIsNone(summary["pseudo_f"])  # no variation within groups
+		self.assertAlmostEqual(1, summary["r_squared"][3])
+
+		values, varies = clustering.standardize(self.presence[:2])
+		self.assertTrue(numpy.isnan(clustering.summarize(values, numpy.array([0, 1]), varies)["r_squared"]).all())  # no field varies
@@ -0,0 +1,103 @@
+__author__ = 'nrsantos'
+
+import os
+import shutil
+import sqlite3
+import tempfile
+import unittest
+
+from PISCES import db_management
+
+
+class IndexSetTest(unittest.TestCase):
+
+	def setUp(self):
+		self.folder = tempfile.mkdtemp()
+		self.db = os.path.join(self.folder, "pisces.sqlite")
+		connection = sqlite3.connect(self.db)
+		connection.execute("CREATE TABLE observations (objectid INTEGER PRIMARY KEY, set_id, species_id, zone_id, presence_type)")
+		connection.execute("CREATE INDEX existing_set_index ON observations (set_id)")  # same columns as a managed index, different name
+		connection.execute("CREATE TABLE observation_collections (observation_id, collection_id)")
+		connection.commit()
+		connection.close()
+
+	def tearDown(self):
+		shutil.rmtree(self.folder)
+
+	def test_missing_indexes(self):
+		missing = [name for name, table, columns in db_management.missing_indexes(self.db)]
+		self.assertIn("ix_observations_species_zone_presence", missing)
+		self.assertIn("ix_observation_collections_collection", missing)
+		self.assertNotIn("ix_observations_set", missing)  # covered by existing_set_index
+		self.assertNotIn("ix_layer_cache_query_bind", missing)  # the table doesn't exist
+
+	def test_create_indexes(self):
+		self.assertEqual(0, db_management.get_index_set_version(self.db))
+
+		created = db_management.create_indexes(self.db)
+		self.assertEqual(5, len(created))
+		self.assertEqual([], db_management.missing_indexes(self.db))
+		self.assertEqual(db_management.INDEX_SET_VERSION, db_management.get_index_set_version(self.db))
+
+		self.assertEqual([], db_management.create_indexes(self.db))  # nothing left to do
+
+
+class DumpTest(unittest.TestCase):
+
+	def setUp(self):
+		self.folder = tempfile.mkdtemp()
+		self.db = os.path.join(self.folder, "pisces.sqlite")
+		self.dumps = os.path.join(self.folder, "dumps")
+		os.makedirs(self.dumps)
+
+		connection = sqlite3.connect(self.db)
+		connection.execute("CREATE TABLE species (fid TEXT PRIMARY KEY, common_name TEXT, notes TEXT, weight REAL, image BLOB)")
+		connection.execute("CREATE INDEX species_name ON species (common_name)")
+		connection.execute("CREATE TABLE observations (objectid INTEGER PRIMARY KEY, species_id TEXT, zone_id TEXT)")
+		connection.executemany("INSERT INTO species VALUES (?, ?, ?, ?, ?)", [
+			("SOM04", "Chinook salmon", "it's got a quote;\nand a line break;", 1.5, None),
+			("CMC01", u"Sacramento pikeminnow", None, None, b"\x00\x01"),
+		])
+		connection.executemany("INSERT INTO observations VALUES (?, ?, ?)", [(number, "SOM04", "1802{:08d}".format(number)) for number in range(1, 1201)])
+		connection.commit()
+		connection.close()
+
+	def tearDown(self):
+		shutil.rmtree(self.folder)
+
+	def rows(self, db, table):
+		connection = sqlite3.connect(db)
+		try:
+			return connection.execute("select * from {} order by rowid".format(table)).fetchall()
+		finally:
+			connection.close()
+
+	def test_round_trip(self):
+		tables = ["species", "observations"]
+		self.assertEqual(tables, db_management.dehydrate_db(self.db, db_export_folder=self.dumps, tables=tables))
+		self.assertEqual([], db_management.dehydrate_db(self.db, db_export_folder=self.dumps, tables=tables))  # nothing changed
+
+		new_db = os.path.join(self.folder, "hydrated.sqlite")
+		self.assertEqual(["observations", "species"], db_management.load_table_dumps(new_db, self.dumps))
+		for table in tables:
+			self.assertEqual(self.rows(self.db, table), self.rows(new_db, table))
+		self.assertEqual([], db_management.load_table_dumps(new_db, self.dumps))  # already up to date
+
+		connection = sqlite3.connect(new_db)
+		self.assertIsNotNone(connection.execute("select name from sqlite_master where type = 'index' and name = 'species_name'").fetchone())
+		connection.close()
+
+	def test_only_changed_tables(self):
+		tables = ["species", "observations"]
+		db_management.dehydrate_db(self.db, db_export_folder=self.dumps, tables=tables)
+		new_db = os.path.join(self.folder, "hydrated.sqlite")
+		db_management.load_table_dumps(new_db, self.dumps)
+
+		connection = sqlite3.connect(self.db)
+		connection.execute("UPDATE species SET common_name = 'King salmon' WHERE fid = 'SOM04'")
+		connection.commit()
+		connection.close()
+
+		self.assertEqual(["species"], db_management.dehydrate_db(self.db, db_export_folder=self.dumps, tables=tables))
+		self.assertEqual(["species"], db_management.load_table_dumps(new_db, self.dumps))
+		self.assertEqual(self.rows(self.db, "species"), self.rows(new_db, "species"))
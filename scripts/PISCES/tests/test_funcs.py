@@ -4,6 +4,11 @@ __author__ = 'nickrsan'
 
 import unittest
 
+try:
+	from unittest import mock
+except ImportError:  # Python 2
+	import mock
+
 import arcpy
 
 from PISCES import funcs
@@ -161,5 +166,110 @@ class ComposeQueryTest(unittest.TestCase):
 	def test_get_path(self):
 		print(funcs.get_path())
 
+class ConnectionPoolTest(unittest.TestCase):
+	"""
+		Pooling in db_connect and db_close, with pyodbc connections mocked
+	"""
+
+	def setUp(self):
+		funcs._pool.clear()
+		funcs._checked_out.clear()
+		self.addCleanup(funcs._pool.clear)
+		self.addCleanup(funcs._checked_out.clear)
+
+		for setting, value in (("db_connection_pooling", True), ("db_pool_size", 2), ("sqlite_pragmas", (("journal_mode", "WAL"), ("cache_size", None)))):
+			patcher = mock.patch.object(local_vars, setting, value)
+			patcher.start()
+			self.addCleanup(patcher.stop)
+
+		patcher = mock.patch.object(funcs.pyodbc, "connect", side_effect=lambda *args, **kwargs: mock.MagicMock(autocommit=False))
+		self.connect = patcher.start()
+		self.addCleanup(patcher.stop)
+
+	def test_reuses_connections(self):
+		cursor, conn = funcs.db_connect("a.sqlite", "first")
+		funcs.db_close(cursor, conn)
+		cursor2, conn2 = funcs.db_connect("a.sqlite", "second")
+
+		self.assertIs(conn, conn2)
+		self.assertEqual(1, self.connect.call_count)
+
+		cursor3, conn3 = funcs.db_connect("b.sqlite")  # another database gets its own connection
+		self.assertIsNot(conn, conn3)
+		self.assertEqual(2, self.connect.call_count)
+
+	def test_rolls_back_when_returned(self):
+		cursor, conn = funcs.db_connect("a.sqlite")
+		funcs.db_close(cursor, conn)
+		conn.rollback.assert_called_once_with()
+		self.assertFalse(conn.close.called)
+		self.assertEqual([conn], funcs._pool[("a.sqlite", False)])
+
+		cursor, conn = funcs.db_connect("a.sqlite")
+		conn.rollback.side_effect = funcs.pyodbc.Error("broken")
+		funcs.db_close(cursor, conn)
+		conn.close.assert_called_once_with()  # broken connections aren't pooled
+		self.assertEqual([], funcs._pool[("a.sqlite", False)])
+
+	def test_pool_size(self):
+		connections = [funcs.db_connect("a.sqlite") for index in range(3)]
+		for cursor, conn in connections:
+			funcs.db_close(cursor, conn)
+		self.assertEqual(2, len(funcs._pool[("a.sqlite", False)]))
+		connections[2][1].close.assert_called_once_with()
+
+	def test_pool_reset_after_fork(self):
+		cursor, conn = funcs.db_connect("a.sqlite")
+		funcs.db_close(cursor, conn)
+
+		with mock.patch.object(funcs, "_pool_pid", -1):  # as if the pool came from a parent process
+			cursor2, conn2 = funcs.db_connect("a.sqlite")
+			self.assertIsNot(conn, conn2)
+			self.assertEqual({}, funcs._pool)
+			self.assertFalse(conn.close.called)  # the parent's connection isn't ours to close
+
+	def test_close_pooled_connections(self):
+		opened = [funcs.db_connect(name) for name in ("a.sqlite", "b.sqlite")]
+		for cursor, conn in opened:
+			funcs.db_close(cursor, conn)
+
+		funcs.close_pooled_connections("a.sqlite")
+		opened[0][1].close.assert_called_once_with()
+		self.assertFalse(opened[1][1].close.called)
+
+		funcs.close_pooled_connections()
+		opened[1][1].close.assert_called_once_with()
+		self.assertEqual({}, funcs._pool)
+
+	def test_pragmas(self):
+		cursor, conn = funcs.db_connect("a.sqlite")
+		conn.cursor.return_value.execute.assert_called_once_with("PRAGMA journal_mode = WAL")  # None values are skipped
+		self.assertFalse(conn.autocommit)  # restored after the pragmas run
+
+	def test_timings(self):
+		funcs.get_db_timings(reset=True)
+		with funcs.db_operation("timed", db_name="a.sqlite", commit=True) as (cursor, conn):
+			pass
+		conn.commit.assert_called_once_with()
+
+		timings = funcs.get_db_timings(reset=True)
+		self.assertEqual(1, timings["timed"]["connections"])
+		self.assertEqual({}, funcs.get_db_timings())
+
+	def test_local_vars_connections_are_pooled(self):
+		cursor, conn = local_vars.db_connect("a.sqlite", "loading startup data")  # data_setup's loaders connect this way
+		conn.cursor.return_value.execute.assert_called_once_with("PRAGMA journal_mode = WAL")
+		local_vars.db_close(cursor, conn)
+		self.assertEqual([conn], funcs._pool[("a.sqlite", False)])
+		self.assertEqual({}, funcs._checked_out)
+
+	def test_refresh_cursor_returns_connection(self):
+		conn, cursor = funcs.refresh_cursor(database="a.sqlite")
+		conn2, cursor2 = funcs.refresh_cursor(database="a.sqlite", connection=conn, existing_cursor=cursor, close_connection=True)
+		self.assertIs(conn, conn2)  # closed through db_close, so it went back to the pool and was handed out again
+		self.assertFalse(conn.close.called)
+		self.assertEqual([id(conn)], list(funcs._checked_out.keys()))
+
+
 if __name__ == '__main__':
 	unittest.main()
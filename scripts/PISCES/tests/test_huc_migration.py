@@ -0,0 +1,62 @@
+__author__ = 'nrsantos'
+
+import sqlite3
+import unittest
+
+from PISCES import huc_migration
+from PISCES import layer_fingerprints
+
+
+class MigrateTest(unittest.TestCase):
+
+	def setUp(self):
+		self.connection = sqlite3.connect(":memory:")
+		self.db_cursor = self.connection.cursor()
+		self.db_cursor.execute("CREATE TABLE observations (objectid INTEGER PRIMARY KEY, species_id TEXT, zone_id TEXT, presence_type INTEGER)")
+		self.db_cursor.execute("CREATE TABLE invalid_observations (objectid INTEGER PRIMARY KEY, species_id TEXT, zone_id TEXT, reason_invalid TEXT, invalid_notes TEXT)")
+		self.db_cursor.execute("CREATE TABLE observation_collections (observation_id INTEGER, collection_id INTEGER)")
+		self.db_cursor.execute("CREATE TABLE zones_aux (id INTEGER PRIMARY KEY, zone TEXT UNIQUE, rim_dam INTEGER, updated INTEGER DEFAULT 0)")
+
+		self.db_cursor.executemany("INSERT INTO observations VALUES (?, ?, ?, ?)", [
+			(1, "SOM04", "A", 1),
+			(2, "CMC01", "B", 3),
+			(3, "SOM04", "D", 1),
+			(4, "CGO01", "X", 1),
+		])
+		self.db_cursor.execute("INSERT INTO invalid_observations VALUES (1, 'SOM04', 'D', 'bad', NULL)")
+		self.db_cursor.execute("INSERT INTO observation_collections VALUES (3, 5)")
+		self.db_cursor.executemany("INSERT INTO zones_aux (id, zone, rim_dam) VALUES (?, ?, ?)", [(1, "A", 0), (2, "B", 0), (3, "D", 1), (4, "G", 0), (5, "X", 0)])
+
+		# A -> B and B -> C chain, D splits into E and F, and G merges into E
+		self.migrations = {"A": ["B"], "B": ["C"], "D": ["E", "F"], "G": ["E"]}
+
+	def tearDown(self):
+		self.connection.close()
+
+	def zones(self, table, key_field):
+		return dict(self.db_cursor.execute("SELECT {}, zone{} FROM {}".format(key_field, "_id" if "observations" in table else "", table)).fetchall())
+
+	def test_migrate(self):
+		results = huc_migration.migrate(self.db_cursor, self.migrations, changed_collection=20, flag_field="updated")
+
+		self.assertEqual({1: "B", 2: "C", 3: "E", 4: "X", 5: "F"}, self.zones("observations", "objectid"))  # 5 is the copy of 3 for F
+		self.assertEqual([(5,), (20,)], self.db_cursor.execute("SELECT collection_id FROM observation_collections WHERE observation_id = 5 ORDER BY collection_id").fetchall())
+		self.assertEqual(4, self.db_cursor.execute("SELECT count(*) FROM observation_collections WHERE collection_id = 20").fetchone()[0])
+
+		self.assertEqual({1: "E", 2: "F"}, self.zones("invalid_observations", "objectid"))
+		self.assertEqual(("See 1", "See 1"), self.db_cursor.execute("SELECT reason_invalid, invalid_notes FROM invalid_observations WHERE objectid = 2").fetchone())
+
+		# D keeps E, so G's record needs attention
+		self.assertEqual({1: "B", 2: "C", 3: "E", 4: "E_4", 5: "X", 6: "F"}, self.zones("zones_aux", "id"))
+		self.assertEqual([(4, "E", "E_4")], results["conflicts"]["zones_aux"])
+		self.assertEqual(1, self.db_cursor.execute("SELECT rim_dam FROM zones_aux WHERE zone = 'F'").fetchone()[0])
+		self.assertEqual(0, self.db_cursor.execute("SELECT count(*) FROM zones_aux WHERE updated = 1 AND zone = 'X'").fetchone()[0])
+
+		self.assertEqual(["CMC01", "SOM04"], sorted(results["species"]))
+		self.assertEqual(6, len(results["moved"]))  # four observations and two invalid observations
+		changed = self.db_cursor.execute("SELECT species_id FROM {} ORDER BY species_id".format(layer_fingerprints.changes_table)).fetchall()
+		self.assertEqual([("CMC01",), ("SOM04",)], changed)
+
+
+if __name__ == '__main__':
+	unittest.main()
@@ -0,0 +1,72 @@
+__author__ = 'nrsantos'
+
+import unittest
+
+from PISCES import huc_network
+
+
+class HUCNetworkTest(unittest.TestCase):
+	"""
+		Small network:  A -> C, B -> C, C -> E, D -> E, E -> OCEAN, F -> G (G is missing), H -> CLOSED BASIN
+	"""
+
+	def setUp(self):
+		self.network = huc_network.HUCNetwork([
+			("A", "C"), ("B", "C"), ("C", "E"), ("D", "E"), ("E", "OCEAN"), ("F", "G"), ("H", "CLOSED BASIN"),
+		])
+
+	def test_network_ends(self):
+		self.assertIsNone(self.network.downstream("E"))
+		self.assertEqual("OCEAN", self.network.network_end["E"])
+		self.assertEqual("G", self.network.missing_downstream["F"])
+		self.assertNotIn("OCEAN", self.network)
+
+	def test_upstream(self):
+		self.assertEqual(["A", "B"], sorted(self.network.direct_upstream("C")))
+		self.assertEqual(["A", "B", "C", "D"], sorted(self.network.upstream("E")))
+		self.assertEqual([], self.network.upstream("A"))
+		self.assertEqual("E", self.network.upstream("E", include_self=True)[0])
+
+	def test_upstream_stops_at_dams(self):
+		self.assertEqual(["C", "D"], sorted(self.network.upstream("E", stop_at=["C"])))
+
+	def test_path(self):
+		self.assertEqual(["A", "C", "E"], self.network.path("A"))
+		self.assertEqual(["F"], self.network.path("F"))
+		self.assertEqual(["F", "G"], self.network.path("F", include_missing=True))
+
+	def test_accumulate(self):
+		counts = dict(zip(self.network.zones, self.network.upstream_counts()))
+		self.assertEqual(4, counts["E"])
+		self.assertEqual(2, counts["C"])
+		self.assertEqual(0, counts["H"])
+
+		values = [1 for zone in self.network.zones]
+		totals = dict(zip(self.network.zones, self.network.accumulate_upstream(values)))
+		self.assertEqual(4, totals["E"])
+
+	def test_distances(self):
+		self.assertEqual(0, self.network.distance("A", "A"))
+		self.assertEqual(2, self.network.distance("A", "B"))  # A -> C <- B
+		self.assertEqual(3, self.network.distance("A", "D"))  # A -> C -> E <- D
+		self.assertEqual(2, self.network.distance("E", "A"))
+		self.assertIsNone(self.network.distance("A", "H"))
+
+	def test_distances_match_paths(self):
+		for zone1 in self.network.zones:
+			path1 = self.network.path(zone1, include_missing=True)
+			for zone2 in self.network.zones:
+				path2 = self.network.path(zone2, include_missing=True)
+				meeting = [index for index, zone in enumerate(path1) if zone in path2]
+				expected = meeting[0] + path2.index(path1[meeting[0]]) if meeting else None
+				self.assertEqual(expected, self.network.distance(zone1, zone2))
+
+	def test_missing_downstream_meets(self):
+		network = huc_network.HUCNetwork([("A", "X"), ("B", "X")])
+		self.assertEqual(2, network.distance("A", "B"))
+
+	def test_loop(self):
+		network = huc_network.HUCNetwork([("A", "B"), ("B", "A"), ("C", "A")])
+		self.assertEqual(["A", "B"], network.path("A"))
+		self.assertEqual(["B", "C"], sorted(network.upstream("A")))
+		self.assertEqual(1, len(network.topological_order()))  # only C can be ordered
@@ -3,7 +3,9 @@ __author__ = 'nickrsan'
 
 import unittest
 import re
+import sqlite3
 
+from PISCES import local_vars
 from PISCES.input_filters import common
 
 class TestInputFilterCommon(unittest.TestCase):
@@ -15,3 +17,43 @@ class TestInputFilterCommon(unittest.TestCase):
 		self.assertEqual(common.convert_DDM_to_DD(pattern, u"34° 42.570'"), 34.7095)
 		self.assertAlmostEqual(common.convert_DDM_to_DD(pattern, u"34° 42.979'"), 34.716316666)
 
+
+class TestBatchedInsert(unittest.TestCase):
+	def setUp(self):
+		self.connection = sqlite3.connect(":memory:")
+		self.cursor = self.connection.cursor()
+		self.cursor.execute("create table observations (objectid INTEGER PRIMARY KEY, set_id, species_id, zone_id, presence_type, if_method, certainty, longitude, latitude, notes, other_data, observation_date, survey_method)")
+		self.cursor.execute("create table observation_collections (observation_id, collection_id)")
+		self.cursor.execute("insert into observations (objectid, species_id) values (41, 'SOC01')")
+
+		if_method = common.EmptyRow()  # only method_id is used when inserting
+		if_method.method_id = 7
+
+		observations = []
+		for index in range(5):
+			obs = local_vars.observation()
+			obs.species_id = "CCK01"
+			obs.zone_id = "18010101010{}".format(index)
+			obs.presence_type = 3
+			obs.collections = [5] if index % 2 == 0 else []
+			observations.append(obs)
+
+		self.obs_set = common.observation_set(l_dataset_name="test_dataset")
+		self.obs_set.set_id = 12
+		self.obs_set.results = [local_vars.result_set(observations, if_method)]
+
+	def tearDown(self):
+		self.connection.close()
+
+	def test_insert_batched(self):
+		self.obs_set.insert_batched(self.cursor, self.connection, batch_size=2, commit_interval=0)
+
+		ids = [obs.db_id for obs in self.obs_set.results[0].observations]
+		self.assertEqual([42, 43, 44, 45, 46], ids)
+
+		rows = self.cursor.execute("select objectid, set_id, zone_id, if_method from observations where species_id = 'CCK01' order by objectid").fetchall()
+		self.assertEqual(5, len(rows))
+		self.assertEqual((42, 12, "180101010100", 7), rows[0])
+
+		collections = self.cursor.execute("select observation_id, collection_id from observation_collections order by observation_id").fetchall()
+		self.assertEqual([(42, 5), (44, 5), (46, 5)], collections)
@@ -0,0 +1,84 @@
+__author__ = 'nrsantos'
+
+import unittest
+import sqlite3
+
+from PISCES import layer_fingerprints
+from PISCES import tbx_add_to_collection
+from PISCES import tbx_dataset_ops
+
+
+class LayerFingerprintsTest(unittest.TestCase):
+
+	def setUp(self):
+		self.connection = sqlite3.connect(":memory:")
+		self.cursor = self.connection.cursor()
+		self.cursor.execute("CREATE TABLE layer_cache (query_id INTEGER, bind_var TEXT, layer_file TEXT, last_updated TEXT)")
+		for query_id, bind_var, layer_file in ((1, "SOC01", "f_SOC01_1"), (1, "CCK01", "f_CCK01_1"), (2, "NULL", "layer_q2")):
+			self.cursor.execute("INSERT INTO layer_cache VALUES (?, ?, ?, datetime('now'))", (query_id, bind_var, layer_file))
+
+		layer_fingerprints.record_layer(self.cursor, 1, "SOC01", "a", ["SOC01"])
+		layer_fingerprints.record_layer(self.cursor, 1, "CCK01", "b", ["CCK01"])
+		layer_fingerprints.record_layer(self.cursor, 2, None, "c", None)  # a richness layer - depends on every species
+
+	def tearDown(self):
+		self.connection.close()
+
+	def test_fingerprint_ignores_zone_order(self):
+		first = layer_fingerprints.fingerprint("select zone_id from observations", None, None, ["180101", "180102", "180101"])
+		second = layer_fingerprints.fingerprint("select zone_id from observations", None, None, ["180102", "180101"])
+		self.assertEqual(first, second)
+		self.assertNotEqual(first, layer_fingerprints.fingerprint("select zone_id from observations", None, None, ["180102"]))
+
+	def test_is_current(self):
+		self.assertTrue(layer_fingerprints.is_current(self.cursor, 1, "SOC01", "a"))
+		self.assertFalse(layer_fingerprints.is_current(self.cursor, 1, "SOC01", "b"))
+		self.assertTrue(layer_fingerprints.is_current(self.cursor, 2, None, "c"))
+		self.assertFalse(layer_fingerprints.is_current(self.cursor, 3, "SOC01", "a"))
+
+	def test_no_changes(self):
+		self.assertEqual([], layer_fingerprints.invalidate_changed_species(self.cursor))
+		self.assertEqual(3, self.cursor.execute("SELECT count(*) FROM layer_cache").fetchone()[0])
+
+	def test_invalidate_changed_species(self):
+		layer_fingerprints.record_species_changes(self.cursor, ["SOC01", None])
+
+		removed = layer_fingerprints.invalidate_changed_species(self.cursor)
+		self.assertEqual(["f_SOC01_1", "layer_q2"], sorted(removed))
+
+		remaining = self.cursor.execute("SELECT bind_var FROM layer_cache").fetchall()
+		self.assertEqual([("CCK01",)], remaining)
+		self.assertFalse(layer_fingerprints.is_current(self.cursor, 1, "SOC01", "a"))
+		self.assertTrue(layer_fingerprints.is_current(self.cursor, 1, "CCK01", "b"))
+
+		self.assertEqual([], layer_fingerprints.invalidate_changed_species(self.cursor))  # changes are cleared once applied
+
+	def _add_observations(self):
+		self.cursor.execute("CREATE TABLE defs_collections (id INTEGER PRIMARY KEY, collection_name TEXT)")
+		self.cursor.execute("CREATE TABLE observation_sets (set_id INTEGER PRIMARY KEY)")
+		self.cursor.execute("CREATE TABLE observations (objectid INTEGER PRIMARY KEY, set_id INTEGER, species_id TEXT)")
+		self.cursor.execute("CREATE TABLE observation_collections (observation_id INTEGER, collection_id INTEGER)")
+		self.cursor.execute("INSERT INTO defs_collections VALUES (5, 'QC')")
+		self.cursor.executemany("INSERT INTO observation_sets VALUES (?)", [(1,), (2,)])
+		self.cursor.executemany("INSERT INTO observations VALUES (?, ?, ?)", [(1, 1, "SOC01"), (2, 1, "SOC01"), (3, 2, "CCK01")])
+		self.cursor.execute("INSERT INTO observation_collections VALUES (1, 5)")
+
+	def test_collection_edit_invalidates(self):
+		self._add_observations()
+
+		self.assertEqual(1, tbx_add_to_collection.add_to_collection(self.cursor, "SOC01", "QC"))  # observation 1 was already in it
+		self.assertEqual(2, self.cursor.execute("SELECT count(*) FROM observation_collections").fetchone()[0])
+
+		removed = layer_fingerprints.invalidate_changed_species(self.cursor)
+		self.assertEqual(["f_SOC01_1", "layer_q2"], sorted(removed))
+		self.assertFalse(layer_fingerprints.is_current(self.cursor, 1, "SOC01", "a"))
+		self.assertTrue(layer_fingerprints.is_current(self.cursor, 1, "CCK01", "b"))
+
+	def test_dataset_delete_invalidates(self):
+		self._add_observations()
+
+		self.assertEqual(["CCK01"], tbx_dataset_ops.remove_dataset(2, invalidate=0, db_cursor=self.cursor))
+		self.assertEqual(2, self.cursor.execute("SELECT count(*) FROM observations").fetchone()[0])
+
+		removed = layer_fingerprints.invalidate_changed_species(self.cursor)
+		self.assertEqual(["f_CCK01_1", "layer_q2"], sorted(removed))
@@ -38,5 +38,49 @@ class DataLoadTest(unittest.TestCase):
 		local_vars.start()
 		self.assertGreater(len(local_vars.all_fish.keys()), 0)
 
+
+class LazyDataTest(unittest.TestCase):
+
+	def setUp(self):
+		self.loads = 0
+
+	def load(self, data):
+		self.loads += 1
+		data["SOM04"] = "loaded"
+
+	def make_data(self):
+		data = local_vars.LazyData("test_data", self.load)
+		self.addCleanup(self.unregister, data)
+		return data
+
+	def unregister(self, data):
+		local_vars.lazy_data[:] = [registered for registered in local_vars.lazy_data if registered is not data]  # by identity - nothing loads
+
+	def test_loads_on_first_access(self):
+		data = self.make_data()
+		self.assertEqual(0, self.loads)
+		self.assertIn("SOM04", data)
+		self.assertEqual("loaded", data["SOM04"])
+		self.assertEqual(1, len(data))
+		self.assertEqual(1, self.loads)
+
+		data.reset()
+		self.assertEqual(["SOM04"], list(data.keys()))
+		self.assertEqual(2, self.loads)
+
+	def test_writes_load_first(self):
+		data = self.make_data()
+		data["CMC01"] = "added"
+		self.assertEqual({"SOM04": "loaded", "CMC01": "added"}, dict(data.items()))
+
+	def test_equality_does_not_load(self):
+		data = self.make_data()
+		other = self.make_data()
+		self.assertIn(data, local_vars.lazy_data)
+		self.assertNotEqual(data, other)  # both empty until loaded, but they're different datasets
+		self.assertEqual(0, self.loads)
+		self.assertFalse(data.loaded)
+
+
 if __name__ == '__main__':
 	unittest.main()
@@ -0,0 +1,151 @@
+# -*- coding: utf-8 -*-
+__author__ = 'nrsantos'
+
+import io
+import json
+import os
+import shutil
+import tempfile
+import unittest
+
+try:
+	from unittest import mock
+except ImportError:
+	import mock
+
+from PISCES import log
+
+
+class LogTest(unittest.TestCase):
+	"""
+		Writes through the buffered writer to log files in a temporary folder
+	"""
+
+	def setUp(self):
+		self.folder = tempfile.mkdtemp()
+		os.mkdir(os.path.join(self.folder, "log"))
+		self.addCleanup(shutil.rmtree, self.folder, True)
+
+		saved = dict((name, getattr(log, name, None)) for name in ("mylog", "datalog", "errorlog", "jsonlog", "write", "error", "warning",
+																	 "arc_script_flag", "buffered", "json_log", "base_folder"))
+		self.addCleanup(self.restore, saved)
+		self.opened = []
+
+	def restore(self, saved):
+		log.flush()
+		for log_file in self.opened:
+			log_file.close()
+		for name, value in saved.items():
+			setattr(log, name, value)
+
+	def open_log(self, name):
+		log_file = log._open_log(os.path.join(self.folder, "log", name))
+		self.opened.append(log_file)
+		return log_file
+
+	def read(self, name):
+		with io.open(os.path.join(self.folder, "log", name), encoding="utf-8") as log_file:
+			return log_file.read()
+
+	def initialize(self):
+		log.base_folder = self.folder
+		log.buffered = True
+		log.json_log = True
+		with mock.patch.object(log.logging, "basicConfig"):  # don't point the root logger at the temporary folder
+			log.initialize("testing")
+		self.opened.extend([log.mylog, log.datalog, log.errorlog, log.jsonlog])
+
+	def json_records(self):
+		return [json.loads(line) for line in self.read("pisces_log.jsonl").splitlines()]
+
+	def test_unbuffered(self):
+		log.buffered = False
+		log_file = self.open_log("plain.txt")
+		self.assertNotIsInstance(log_file, log.QueuedLogFile)
+		log_file.write("line\n")
+		log_file.flush()
+		self.assertEqual("line\n", self.read("plain.txt"))
+
+	def test_flush_writes_in_order(self):
+		log.buffered = True
+		first = self.open_log("first.txt")
+		second = self.open_log("second.txt")
+		self.assertIsInstance(first, log.QueuedLogFile)
+
+		for line in range(500):
+			first.write("%s\n" % line)
+			if line % 2:
+				second.write("%s\n" % line)
+		log.flush()  # blocks until everything queued before it is on disk
+
+		self.assertEqual(["%s" % line for line in range(500)], self.read("first.txt").splitlines())
+		self.assertEqual(["%s" % line for line in range(1, 500, 2)], self.read("second.txt").splitlines())
+
+	def test_json_output(self):
+		self.initialize()
+		log.write(u"Processed café records")
+		log.data_write("Changed data")
+		log.flush()
+
+		records = self.json_records()
+		self.assertEqual([("info", u"Processed café records"), ("data", "Changed data")], [(record["level"], record["message"]) for record in records])
+		self.assertEqual(os.getpid(), records[0]["pid"])
+
+	def test_error_writes_one_json_record(self):
+		self.initialize()
+		with mock.patch("sys.stdout"):  # error() prints too
+			log.error("Something failed")
+
+		self.assertEqual([("error", "Something failed")], [(record["level"], record["message"]) for record in self.json_records()])  # error() flushes itself
+		self.assertIn("Something failed", self.read("fsfish_error.log.txt"))
+		self.assertIn("Something failed", self.read("fsfish_processing_log.htm"))
+
+	def test_warning_json_level(self):
+		self.initialize()
+		with mock.patch("sys.stdout"):
+			log.warning("Something looks off")
+
+		self.assertEqual([("warning", "Something looks off")], [(record["level"], record["message"]) for record in self.json_records()])
+		self.assertIn("Something looks off", self.read("fsfish_error.log.txt"))
+
+	def test_new_queue_after_pid_change(self):
+		log.buffered = True
+		log_file = self.open_log("forked.txt")
+		log_file.write("parent\n")
+		log.flush()
+
+		parent_queue, parent_lock = log._queue, log._writer_lock
+		parent_lock.acquire()  # as if another parent thread held it at the moment of the fork
+		self.addCleanup(parent_lock.release)
+
+		with mock.patch.object(log.os, "getpid", return_value=-1):  # pretend to be a child process without register_at_fork
+			log_file.write("child\n")
+			log.flush()
+			self.assertIsNot(parent_queue, log._queue)
+			self.assertIsNot(parent_lock, log._writer_lock)
+
+		self.assertEqual(["parent", "child"], self.read("forked.txt").splitlines())
+
+	@unittest.skipUnless(hasattr(os, "fork"), "requires os.fork")
+	def test_forked_child_writes(self):
+		log.buffered = True
+		log_file = self.open_log("forked.txt")
+		log_file.write("parent\n")
+		log.flush()
+		log_file.write("pending in parent\n")  # may still be queued at the fork - only the parent's writer may write it
+
+		pid = os.fork()
+		if pid == 0:  # child - must leave through os._exit so that the test runner doesn't continue in it
+			try:
+				log_file.write("child\n")
+				log.flush()
+			finally:
+				os._exit(0)
+
+		os.waitpid(pid, 0)
+		log.flush()
+		self.assertEqual(["child", "parent", "pending in parent"], sorted(self.read("forked.txt").splitlines()))
+
+
+if __name__ == '__main__':
+	unittest.main()
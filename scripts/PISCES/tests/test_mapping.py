@@ -7,13 +7,22 @@ __author__ = 'nrsantos'
 import unittest
 import sys
 
+try:
+	from unittest import mock
+except ImportError:
+	import mock
+
 import arcpy
+import six
+import sqlalchemy
+import sqlalchemy.orm
 
 from PISCES import local_vars
 from PISCES import script_tool_funcs
 from PISCES import log
 from PISCES import mapping
 from PISCES import funcs
+from PISCES import orm_models
 
 num_hucs_total = int(arcpy.GetCount_management(local_vars.HUCS).getOutput(0))
 local_vars.debug = False  # run it like end users will
@@ -238,6 +247,146 @@ class MakeLayerTest(unittest.TestCase):
 		self.huc_limit(all_zones - 3)  # and try just slightly less
 
 
+class GetObservationsTest(unittest.TestCase):
+	"""
+		Checks bulk observation metadata loading (local_vars.bulk_observation_metadata) against loading each
+		observation on its own, with a small chunk size so that the IN queries split
+	"""
+
+	def setUp(self):
+		engine = sqlalchemy.create_engine("sqlite://")
+		orm_models.Base.metadata.create_all(engine, tables=[orm_models.ObservationSet.__table__, orm_models.Observation.__table__])
+		self.session = sqlalchemy.orm.sessionmaker(bind=engine)()
+		self.addCleanup(self.session.close)
+
+		for set_id in (1, 2):
+			self.session.add(orm_models.ObservationSet(pkey=set_id, name="set {}".format(set_id)))
+		for objectid in range(1, 8):
+			self.session.add(orm_models.Observation(pkey=objectid, set_id=1 + objectid % 2, species_id="SOC01", zone_id="18010101010{}".format(objectid)))
+		self.session.commit()
+		self.session.expunge_all()  # start with nothing loaded, as a new mapping run would
+
+		original_chunk_size = mapping.observation_fetch_chunk_size
+		self.addCleanup(setattr, mapping, "observation_fetch_chunk_size", original_chunk_size)
+		mapping.observation_fetch_chunk_size = 3
+		mapping.reset_observation_cache()
+		self.addCleanup(mapping.reset_observation_cache)
+
+	def one_at_a_time(self, objectids):
+		return [self.session.query(orm_models.Observation).filter_by(pkey=objectid).first() for objectid in objectids]
+
+	def assertSameObservations(self, objectids):
+		bulk = mapping.get_observations(self.session, objectids)
+		single = self.one_at_a_time(objectids)
+		self.assertEqual(len(objectids), len(bulk))
+		for objectid, bulk_observation, single_observation in zip(objectids, bulk, single):
+			self.assertIs(single_observation, bulk_observation, "observation {}".format(objectid))
+			if bulk_observation is not None:
+				self.assertEqual(objectid, bulk_observation.pkey)
+				self.assertEqual("set {}".format(1 + objectid % 2), bulk_observation.set.name)
+
+	def test_exact_chunks(self):
+		self.assertSameObservations([6, 5, 4, 3, 2, 1])  # two full chunks
+
+	def test_chunk_boundary(self):
+		self.assertSameObservations([7, 1, 3, 3, 2, 4, 99, 5, 6])  # 99 doesn't exist, making a partial third chunk, and 3 repeats
+
+	def test_cached_between_calls(self):
+		mapping.get_observations(self.session, [1, 2, 3])
+		self.assertEqual(set([1, 2, 3]), set(mapping.observation_cache.keys()))
+		self.assertSameObservations([3, 4])  # 4 is the only one retrieved
+		self.assertEqual(set([1, 2, 3, 4]), set(mapping.observation_cache.keys()))
+
+
+class WorkerSettingsTest(unittest.TestCase):
+
+	def test_simple_settings_only(self):
+		settings = mapping._get_worker_settings()
+		self.assertIn("maindb", settings)
+		self.assertIn("debug", settings)
+		self.assertIn("mapping_processes", settings)
+		for name, value in settings.items():
+			self.assertFalse(name.startswith("_"), name)
+			self.assertTrue(value is None or isinstance(value, six.string_types + (bool, int, float)), name)
+		self.assertNotIn("map_fish", settings)  # dictionaries aren't copied
+		self.assertNotIn("os", settings)  # nor are modules
+
+	def test_runtime_changes(self):
+		with mock.patch.object(local_vars, "config_metadata", not local_vars.config_metadata):
+			self.assertEqual(local_vars.config_metadata, mapping._get_worker_settings()["config_metadata"])
+
+
+class FakeMap(object):
+
+	def __init__(self, query_set, fails=False):
+		self.query_set = query_set
+		self.fails = fails
+		layer = mock.MagicMock(cache_file=None, zones=["180101010101"])
+		layer.check_layer_cache.return_value = False
+		self.map_layers = [layer]
+
+	def populate(self, db_cursor):
+		if self.fails:
+			raise local_vars.MappingError("no records")
+
+
+class MakeLayersInPoolTest(unittest.TestCase):
+	"""
+		Checks how maps are dealt out to the workers and how their results come back, with the pool mocked
+	"""
+
+	def setUp(self):
+		self.pool = mock.MagicMock()
+		self.pool.map.side_effect = self.run_workers
+		self.pool_class = self.patch(mapping.multiprocessing, "Pool", return_value=self.pool)
+		self.patch(mapping, "cache_layer", side_effect=lambda layer_path, *args: "cached_{}".format(layer_path))
+		self.patch(mapping, "map_fish", {"SOC01": "Coho salmon"}, create=True)  # set by begin
+		self.patch(log, "error")  # failing maps are logged
+
+		self.tasks = None
+		self.worker_errors = {}
+
+	def patch(self, target, name, new=mock.DEFAULT, **kwargs):
+		patcher = mock.patch.object(target, name, new, **kwargs)
+		self.addCleanup(patcher.stop)
+		return patcher.start()
+
+	def run_workers(self, worker, tasks):
+		self.tasks = tasks
+		return [[(map_index, [(0, "layer_{}".format(map_index))], self.worker_errors.get(map_index)) for map_index in map_indices]
+				for fish, map_indices, settings in tasks]
+
+	def make_layers(self, maps, processes):
+		with mock.patch.object(local_vars, "mapping_processes", processes):
+			mapping.make_layers_in_pool(maps, mock.MagicMock(), mock.MagicMock())
+
+	def test_round_robin(self):
+		maps = [FakeMap(number) for number in range(7)]
+		self.make_layers(maps, 3)
+
+		self.pool_class.assert_called_once_with(processes=3)
+		self.assertEqual([[0, 3, 6], [1, 4], [2, 5]], [map_indices for fish, map_indices, settings in self.tasks])
+		self.assertEqual({"SOC01": "Coho salmon"}, self.tasks[0][0])
+		self.assertEqual(3, self.tasks[0][2]["mapping_processes"])  # settings are taken while mapping runs
+		self.assertEqual(["cached_layer_{}".format(number) for number in range(7)], [l_map.map_layers[0].cache_file for l_map in maps])
+
+	def test_failed_maps_are_skipped(self):
+		maps = [FakeMap(0), FakeMap(1, fails=True), FakeMap(2), FakeMap(3)]
+		self.worker_errors[2] = "worker failed"
+		self.make_layers(maps, 2)
+
+		self.assertEqual([[0, 2], [3]], [map_indices for fish, map_indices, settings in self.tasks])  # map 1 failed to populate
+		self.assertEqual([False, True, True, False], [l_map is None for l_map in maps])
+
+	def test_processes_limited_to_maps(self):
+		self.make_layers([FakeMap(0)], 4)
+		self.pool_class.assert_called_once_with(processes=1)
+		self.assertEqual([[0]], [map_indices for fish, map_indices, settings in self.tasks])
+
+		self.make_layers([], 4)  # nothing to do - no pool
+		self.assertEqual(1, self.pool_class.call_count)
+
+
 if __name__ == "__main__":
 	# If this script is invoked directly, then it means we're running the secondary tests
 	# One issue that cropped up only appeared when something was run multiple times in a row.
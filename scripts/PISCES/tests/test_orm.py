@@ -1,5 +1,7 @@
 __author__ = 'nrsantos'
 
+import os
+import tempfile
 import unittest
 
 import sqlalchemy
@@ -20,6 +22,40 @@ class ComposeQueryTest(unittest.TestCase):
 			self.assertTrue(record.HUC_12.startswith("1") or record.HUC_12.startswith("M"))
 
 
+class EngineCacheTest(unittest.TestCase):
+	def setUp(self):
+		self.db = os.path.join(tempfile.gettempdir(), "pisces_engine_cache_test.sqlite")
+
+	def tearDown(self):
+		orm.reset(self.db)
+
+	def test_engine_reused(self):
+		orm.connect(self.db)
+		first_engine, first_session = orm.engine, orm.Session
+		orm.connect(self.db)
+		self.assertIs(first_engine, orm.engine)
+		self.assertIs(first_session, orm.Session)
+
+	def test_sessions_share_connection(self):
+		orm.connect(self.db)
+		self.assertIsInstance(orm.engine.pool, sqlalchemy.pool.QueuePool)
+
+		connections = []
+		for attempt in range(2):
+			session = orm.Session()
+			connections.append(session.connection().connection.connection)  # the underlying sqlite3 connection
+			session.close()  # returns the connection to the pool
+		self.assertIs(connections[0], connections[1])
+
+	def test_reset(self):
+		orm.connect(self.db)
+		first_engine = orm.engine
+		orm.reset(self.db)
+		self.assertIsNone(orm.engine)
+		orm.connect(self.db)
+		self.assertIsNot(first_engine, orm.engine)
+
+
 class TaxonomicLevelTest(unittest.TestCase):
 	def setUp(self):
 		self.session = api.support.connect_orm(hotload=True)
@@ -79,3 +115,17 @@ class TaxonomicLevelTest(unittest.TestCase):
 																						level="Genus"))
 		self.assertEqual("Salmonids", api_tools.get_common_name_from_species_string(scientific_name="Salmonidae Oncorhynchus",
 																						level="Genus"))
+
+	def test_get_common_names(self):
+		names = api_tools.get_common_names(["Salmonidae Oncorhynchus tshawytscha", "Osmeridae Hypomesus pacificus", "Cyprinidae Hesperoleucus symmetricus x venustus"],
+										   level="Species")
+		self.assertEqual({"Salmonidae Oncorhynchus tshawytscha": "Chinook salmon",
+						  "Osmeridae Hypomesus pacificus": "Delta smelt",
+						  "Cyprinidae Hesperoleucus symmetricus x venustus": "Roach (symmetricus x venustus)"}, names)
+
+		# the cached names match the uncached lookups
+		for sci_name, common_name in names.items():
+			self.assertEqual(common_name, api_tools.get_common_name_from_species_string(scientific_name=sci_name, level="Species", speedup=False))
+
+		self.assertEqual("Salmonidae Oncorhynchus", api_tools.get_names(["Salmonidae Oncorhynchus"], level="Genus")["Salmonidae Oncorhynchus"].scientific_name)
+		self.assertIsNone(api_tools.get_names(["ZZZ99"])["ZZZ99"])
@@ -0,0 +1,47 @@
+__author__ = 'nrsantos'
+
+import unittest
+import sqlite3
+
+from PISCES import local_vars
+from PISCES import profiling
+
+
+class ProfilingTest(unittest.TestCase):
+
+	def setUp(self):
+		self.original_setting = local_vars.map_profiling
+		local_vars.map_profiling = True
+		profiling.reset()
+
+		self.connection = sqlite3.connect(":memory:")
+		self.cursor = profiling.CountingCursor(self.connection.cursor())
+		self.cursor.execute("create table observations (zone_id TEXT, species_id TEXT)")
+
+	def tearDown(self):
+		local_vars.map_profiling = self.original_setting
+		self.connection.close()
+
+	def test_counts(self):
+		with profiling.stage("layer", "query 1"):
+			self.cursor.executemany("insert into observations values (?, ?)", [("180101010101", "SOC01"), ("180101010102", "SOC01")])
+			with profiling.stage("callback", "postprocess_zones"):
+				rows = [row for row in self.cursor.execute("select zone_id from observations")]
+				self.cursor.execute("select count(*) from observations").fetchone()
+
+		self.assertEqual(2, len(rows))
+		callback, layer = profiling.stages
+		self.assertEqual(("callback", "layer:query 1", 1), (callback["kind"], callback["parent"], callback["depth"]))
+		self.assertEqual((2, 3, 0), (callback["queries"], callback["rows_read"], callback["rows_written"]))
+		self.assertEqual((3, 3, 2), (layer["queries"], layer["rows_read"], layer["rows_written"]))  # includes the callback
+		self.assertAlmostEqual(layer["seconds"] - callback["seconds"], layer["self_seconds"])
+
+		summary = profiling.summarize(profiling.stages)
+		self.assertEqual(["postprocess_zones"], [total["name"] for total in summary["callback"]])
+
+	def test_disabled(self):
+		local_vars.map_profiling = False
+		with profiling.stage("layer", "query 1"):
+			pass
+		self.assertEqual([], profiling.stages)
+		self.assertIsNone(profiling.write_report())
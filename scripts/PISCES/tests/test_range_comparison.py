@@ -0,0 +1,107 @@
+__author__ = 'nrsantos'
+
+import math
+import sqlite3
+import unittest
+
+from PISCES import local_vars
+from PISCES import range_comparison
+
+
+class RingCentroidTest(unittest.TestCase):
+
+	def test_square_with_hole(self):
+		exterior = [(0, 0), (0, 10), (10, 10), (10, 0), (0, 0)]  # clockwise, as in geodatabases
+		hole = [(0, 0), (4, 0), (4, 4), (0, 4), (0, 0)]  # counterclockwise
+		x, y, area = range_comparison.ring_centroid([exterior, hole])
+		self.assertAlmostEqual(84, area)
+		self.assertAlmostEqual((5 * 100 - 2 * 16) / 84.0, x)
+		self.assertAlmostEqual(x, y)
+
+	def test_large_coordinates(self):
+		x, y, area = range_comparison.ring_centroid([[(500000, 4000000), (500000, 4001000), (501000, 4001000), (501000, 4000000)]])
+		self.assertAlmostEqual(1000000, area)
+		self.assertAlmostEqual(500500, x)
+		self.assertAlmostEqual(4000500, y)
+
+
+class RangeComparerTest(unittest.TestCase):
+
+	def setUp(self):
+		zones = ["a", "b", "c", "d"]
+		zone_data = {"a": (1.0, 0.0, 0.0), "b": (1.0, 10.0, 0.0), "c": (2.0, 10.0, 10.0), "d": (1.0, 0.0, 10.0)}
+		self.comparer = range_comparison.RangeComparer(zones, zone_data)
+
+	def test_bits_to_mask(self):
+		self.assertEqual([True, False, True, False, False, False, False, False, False, True],
+						 list(range_comparison._bits_to_mask(0b1000000101, 10)))
+		self.assertEqual([False] * 3, list(range_comparison._bits_to_mask(0, 3)))
+
+	def test_compare(self):
+		result = self.comparer.compare(0b0011, 0b0110)  # historic a and b, current b and c
+		self.assertAlmostEqual(1.0, result["overlap_intersect_area"])
+		self.assertAlmostEqual(4.0, result["overlap_union_area"])
+		self.assertAlmostEqual(25.0, result["percent_overlap"])
+		self.assertAlmostEqual(50.0, result["percent_overlap_initial"])
+		self.assertAlmostEqual(100 / 3.0, result["percent_overlap_final"])
+
+		# centroids are (5, 0) and (10, 20 / 3), weighted by area
+		self.assertAlmostEqual(math.hypot(5, 20 / 3.0), result["centroid_distance"])
+		self.assertAlmostEqual(math.degrees(math.atan2(20 / 3.0, 5)), result["centroid_direction"])
+
+	def test_no_overlap(self):
+		result = self.comparer.compare(0b0001, 0b0100)
+		self.assertEqual(0, result["overlap_intersect_area"])
+		self.assertIsNone(result["percent_overlap"])
+		self.assertIsNotNone(result["centroid_distance"])
+
+		result = self.comparer.compare(0b0001, 0)
+		self.assertIsNone(result["centroid_distance"])
+
+
+class FakeIndex(object):
+	"""
+		Stands in for the presence index - species BAD01 fails to load
+	"""
+	zones = ["a", "b"]
+
+	def species_bits(self, fid, presence_types, collections):
+		if fid == "BAD01":
+			raise KeyError(fid)
+		return 0b01 if 1 in presence_types else 0b11
+
+
+class CompareSpeciesTest(unittest.TestCase):
+
+	def setUp(self):
+		self.db_conn = sqlite3.connect(":memory:")
+		self.addCleanup(self.db_conn.close)
+		self.db_cursor = self.db_conn.cursor()
+		self.db_cursor.execute("CREATE TABLE {} ({} TEXT, Shape_Area REAL)".format(local_vars.zones_table, local_vars.huc_field))
+		self.db_cursor.executemany("INSERT INTO {} VALUES (?, ?)".format(local_vars.zones_table), [("a", 1.0), ("b", 1.0)])
+
+	def add_centroids(self):
+		self.db_cursor.execute("CREATE TABLE {} (zone_id TEXT PRIMARY KEY, x REAL, y REAL, area REAL)".format(range_comparison.centroids_table))
+		self.db_cursor.executemany("INSERT INTO {} VALUES (?, ?, ?, ?)".format(range_comparison.centroids_table), [("a", 0.0, 0.0, 1.0), ("b", 10.0, 0.0, 1.0)])
+
+	def compare(self, species_codes):
+		return range_comparison.compare_species(species_codes, self.db_cursor, collections="1", historic_types="1", current_types="2",
+												index=FakeIndex(), processes=1)
+
+	def test_has_zone_centroids(self):
+		self.assertFalse(range_comparison.has_zone_centroids(self.db_cursor))
+		self.assertRaises(ValueError, self.compare, ["SOC01"])
+		self.add_centroids()
+		self.assertTrue(range_comparison.has_zone_centroids(self.db_cursor))
+
+	def test_failed_species_do_not_stop_the_batch(self):
+		self.add_centroids()
+		results = self.compare(["SOC01", "BAD01", "CMC01"])
+		self.assertEqual(["SOC01", "BAD01", "CMC01"], [fid for fid, result in results])
+		self.assertIsNone(results[1][1])
+		self.assertAlmostEqual(50.0, results[0][1]["percent_overlap"])
+		self.assertAlmostEqual(50.0, results[2][1]["percent_overlap"])
+
+
+if __name__ == '__main__':
+	unittest.main()
@@ -0,0 +1,161 @@
+__author__ = 'nrsantos'
+
+import collections
+import os
+import shutil
+import tempfile
+import unittest
+
+import numpy
+
+from PISCES import local_vars
+from PISCES import spatial_join
+from PISCES.input_filters import common
+
+FieldMapEntry = collections.namedtuple("FieldMapEntry", ["input_field"])
+
+# zones A, B, and C are 1 km squares in a row, in Teale Albers (EPSG 3310). The points are well inside them so that
+# boundary handling doesn't matter when comparing the engines
+ZONE_SQUARES = (("A", 0), ("B", 1000), ("C", 2000))
+POINTS_CSV = "point_id,x,y,Species,notes\n" \
+			 "1,500,500,SOC01,first\n" \
+			 "2,1500,250,SOC01,\n" \
+			 "3,,400,CMC01,no x\n" \
+			 "4,2750,900,CMC01,last\n" \
+			 "5,4000,500,SOC01,outside\n" \
+			 "6,1250,750,CMC01,\n"
+
+
+def square(x):
+	return [(x, 0), (x, 1000), (x + 1000, 1000), (x + 1000, 0), (x, 0)]
+
+
+class ZoneIndexTest(unittest.TestCase):
+	"""
+		Zone A is a square with a square hole, B is the square to its right, and C is a triangle on top of both
+	"""
+
+	def setUp(self):
+		self.index = spatial_join.ZoneIndex([
+			({"HUC_12": "A"}, [[(0, 0), (10, 0), (10, 10), (0, 10)], [(4, 4), (6, 4), (6, 6), (4, 6)]]),
+			({"HUC_12": "B"}, [[(10, 0), (20, 0), (20, 10), (10, 10)]]),
+			({"HUC_12": "C"}, [[(0, 10), (20, 10), (10, 30)]]),
+		], cell_size=3, ids=[11, 12, 13])
+
+	def test_join(self):
+		x = [5, 1, 15, 25, 10.5, 10, 9.99]
+		y = [5, 1, 5, 5, 15, 20, 9.99]
+		# the first point is in A's hole and the fourth is outside every zone
+		self.assertEqual([(0, 1), (0, 6), (1, 2), (2, 4), (2, 5)], self.index.join(x, y))
+
+	def test_join_matches_testing_every_zone(self):
+		random = numpy.random.RandomState(0)
+		x = random.uniform(-5, 25, 5000)
+		y = random.uniform(-5, 35, 5000)
+
+		expected = []
+		for zone in range(len(self.index)):
+			expected.extend((zone, int(point)) for point in numpy.nonzero(spatial_join.points_in_rings(x, y, self.index.rings[zone]))[0])
+		self.assertEqual(sorted(expected), self.index.join(x, y))
+
+	def test_join_records(self):
+		records = spatial_join.join_records(self.index, [{"HUC_12": "point", "Species": "SOC01"}], [15], [5])
+		self.assertEqual([{"Join_Count": 1, "TARGET_FID": 12, "JOIN_FID": 1, "HUC_12": "B", "HUC_12_1": "point", "Species": "SOC01"}], records)
+
+
+class ReadTableTest(unittest.TestCase):
+
+	def setUp(self):
+		self.folder = tempfile.mkdtemp()
+		self.addCleanup(shutil.rmtree, self.folder)
+		self.csv_path = os.path.join(self.folder, "points.csv")
+		with open(self.csv_path, 'w') as csv_file:
+			csv_file.write(POINTS_CSV)
+
+	def test_csv_types(self):
+		rows = spatial_join.read_table(self.csv_path)
+		self.assertEqual(6, len(rows))
+		self.assertEqual({"point_id": 1, "x": 500, "y": 500, "Species": "SOC01", "notes": "first"}, rows[0])
+		self.assertIsNone(rows[1]["notes"])
+		self.assertIsNone(rows[2]["x"])  # empty values are None, like nulls from arcpy
+
+	def test_split_geodatabase_path(self):
+		self.assertEqual((os.path.join("data", "layers.gdb"), "HUC12FullState"), spatial_join.split_geodatabase_path(os.path.join("data", "layers.gdb", "HUCs", "HUC12FullState")))
+		self.assertEqual((os.path.join("data", "zones.shp"), None), spatial_join.split_geodatabase_path(os.path.join("data", "zones.shp")))
+
+
+class TableCoordsToHUCsTest(unittest.TestCase):
+	"""
+		Runs the python engine from a CSV on disk, the way it runs on machines without arcpy
+	"""
+
+	def setUp(self):
+		self.folder = tempfile.mkdtemp()
+		self.addCleanup(shutil.rmtree, self.folder)
+		self.csv_path = os.path.join(self.folder, "points.csv")
+		with open(self.csv_path, 'w') as csv_file:
+			csv_file.write(POINTS_CSV)
+
+		self.field_map = {"Longitude": FieldMapEntry("x"), "Latitude": FieldMapEntry("y")}
+
+		original_index = common.zone_index
+		self.addCleanup(setattr, common, "zone_index", original_index)
+		common.zone_index = spatial_join.ZoneIndex([({"HUC_12": name}, [square(x)]) for name, x in ZONE_SQUARES], ids=[1, 2, 3])
+
+	def test_join_from_csv(self):
+		records = common.tablecoords_to_HUCs(self.csv_path, self.field_map, 3310)
+		self.assertEqual([("A", 1), ("B", 2), ("B", 6), ("C", 4)], [(record.HUC_12, record.point_id) for record in records])
+		self.assertEqual("last", records[3].notes)
+
+	def test_missing_field(self):
+		self.field_map["Longitude"] = FieldMapEntry("longitude")
+		self.assertRaises(local_vars.DataProcessingError, common.tablecoords_to_HUCs, self.csv_path, self.field_map, 3310)
+
+
+@unittest.skipUnless(local_vars.ARCPY_AVAILABLE, "arcpy is required to compare the engines")
+class ArcpyParityTest(unittest.TestCase):
+	"""
+		Joins the same points with the arcpy engine (tablecoords_to_file and multifeature_to_HUCs) and the python
+		engine (tablecoords_to_HUCs reading the zones from the feature class) and checks they find the same records
+	"""
+
+	def setUp(self):
+		import arcpy
+
+		self.folder = tempfile.mkdtemp()
+		self.addCleanup(shutil.rmtree, self.folder, True)
+		arcpy.CreateFileGDB_management(self.folder, "parity.gdb")
+		workspace = os.path.join(self.folder, "parity.gdb")
+
+		spatial_reference = arcpy.SpatialReference(3310)
+		arcpy.CreateFeatureclass_management(workspace, "zones", "POLYGON", spatial_reference=spatial_reference)
+		zones = os.path.join(workspace, "zones")
+		arcpy.AddField_management(zones, "HUC_12", "TEXT")
+		with arcpy.da.InsertCursor(zones, ["SHAPE@", "HUC_12"]) as cursor:
+			for name, x in ZONE_SQUARES:
+				cursor.insertRow([arcpy.Polygon(arcpy.Array([arcpy.Point(*vertex) for vertex in square(x)]), spatial_reference), name])
+
+		self.csv_path = os.path.join(self.folder, "points.csv")
+		with open(self.csv_path, 'w') as csv_file:
+			csv_file.write(POINTS_CSV)
+
+		for name, value in (("HUCS", zones), ("workspace", workspace), ("default_proj", spatial_reference), ("zones_epsg", 3310)):
+			self.addCleanup(setattr, local_vars, name, getattr(local_vars, name))
+			setattr(local_vars, name, value)
+
+		original_index = common.zone_index
+		self.addCleanup(setattr, common, "zone_index", original_index)
+		common.zone_index = None
+
+		self.field_map = {"Longitude": FieldMapEntry("x"), "Latitude": FieldMapEntry("y")}
+
+	def test_engines_match(self):
+		features = common.tablecoords_to_file(self.csv_path, self.field_map, 3310)
+		arcpy_records = common.multifeature_to_HUCs(features, relationship="INTERSECT")
+		python_records = common.tablecoords_to_HUCs(self.csv_path, self.field_map, 3310)
+
+		def summarize(records):
+			return sorted((record.HUC_12, record.TARGET_FID, int(record.point_id), record.Species, record.Join_Count) for record in records)
+
+		self.assertEqual(summarize(arcpy_records), summarize(python_records))
+		self.assertEqual(4, len(python_records))
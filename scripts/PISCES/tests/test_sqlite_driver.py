@@ -0,0 +1,47 @@
+__author__ = 'nrsantos'
+
+import unittest
+
+import pyodbc
+
+from PISCES import sqlite_driver
+
+
+class SQLiteDriverTest(unittest.TestCase):
+
+	def setUp(self):
+		self.connection = sqlite_driver.connect(":memory:")
+		self.addCleanup(self.connection.close)
+		self.cursor = self.connection.cursor()
+		self.cursor.execute("CREATE TABLE observations (objectid INTEGER PRIMARY KEY, species_id TEXT, zone_id TEXT)")
+
+	def test_pyodbc_style_parameters(self):
+		self.cursor.execute("INSERT INTO observations (species_id, zone_id) VALUES (?, ?)", "SOC01", "180101010101")  # separate arguments
+		self.cursor.execute("INSERT INTO observations (species_id, zone_id) VALUES (?, ?)", ("CMC01", "180101010102"))  # or a sequence
+		self.cursor.executemany("INSERT INTO observations (species_id, zone_id) VALUES (?, ?)", [("SOM09", "180101010103")])
+
+		row = self.cursor.execute("SELECT species_id, zone_id AS Zone_ID FROM observations WHERE objectid = ?", 2).fetchone()
+		self.assertEqual("CMC01", row.species_id)
+		self.assertEqual("180101010102", row.zone_id)  # names match regardless of case, as in the SQLite ODBC driver
+		self.assertEqual(("CMC01", "180101010102"), tuple(row))
+		self.assertEqual(["species_id", "Zone_ID"], [column[0] for column in row.cursor_description])
+		self.assertRaises(AttributeError, getattr, row, "missing")
+
+		self.assertEqual(3, len(list(self.cursor.execute("SELECT * FROM observations"))))
+
+	def test_errors_are_pyodbc_errors(self):
+		self.cursor.execute("INSERT INTO observations (objectid) VALUES (1)")
+		self.assertRaises(pyodbc.IntegrityError, self.cursor.execute, "INSERT INTO observations (objectid) VALUES (1)")
+		self.assertRaises(pyodbc.Error, self.cursor.execute, "SELECT * FROM missing_table")
+
+	def test_autocommit(self):
+		self.assertFalse(self.connection.autocommit)
+		self.connection.autocommit = True
+		self.assertTrue(self.connection.autocommit)
+		self.cursor.execute("PRAGMA journal_mode = MEMORY")  # pragmas that can't run in a transaction
+		self.connection.autocommit = False
+		self.assertFalse(self.connection.autocommit)
+
+
+if __name__ == '__main__':
+	unittest.main()
@@ -0,0 +1,78 @@
+__author__ = 'nrsantos'
+
+import unittest
+import sqlite3
+
+from PISCES import local_vars
+from PISCES import stats_summary
+
+
+class StatsSummaryTest(unittest.TestCase):
+
+	def setUp(self):
+		self.connection = sqlite3.connect(":memory:")
+		self.cursor = self.connection.cursor()
+		self.cursor.execute("create table species (fid TEXT, native INTEGER, temporary INTEGER)")
+		self.cursor.execute("create view all_fish as select * from species where fid != 'FRG01'")
+		self.cursor.execute("create view native_fish as select * from all_fish where native = 1")
+		self.cursor.execute("create view nonnative_fish as select * from all_fish where native = 0")
+		self.cursor.execute("create table observations (objectid INTEGER PRIMARY KEY, set_id INTEGER, species_id TEXT, zone_id TEXT, presence_type INTEGER)")
+		self.cursor.execute("create table observation_collections (observation_id INTEGER, collection_id INTEGER)")
+
+		self.cursor.executemany("insert into species values (?, ?, ?)", [("SOC01", 1, 0), ("CCK01", 1, 0), ("CAP01", 0, 0), ("FRG01", 0, 0), ("UNK01", 0, 1)])
+		self.cursor.executemany("insert into observations values (?, ?, ?, ?, ?)", [
+			(1, 1, "SOC01", "180101010101", 1),
+			(2, 1, "SOC01", "180101010102", 2),
+			(3, 2, "CCK01", "180101010101", 3),
+			(4, 2, "CAP01", "180101010103", 1),
+			(5, 3, "FRG01", "180101010103", 1),
+		])
+		self.cursor.executemany("insert into observation_collections values (?, ?)", [(1, 5), (2, 5), (3, 2), (4, 15), (5, 5), (99, 5)])
+
+	def tearDown(self):
+		self.connection.close()
+
+	def original_stats(self):
+		"""
+			The separate queries data_stats used to run
+		"""
+		def count(query):
+			return self.cursor.execute(query).fetchone()[0]
+
+		qc_query = "select count(*) from (select distinct all_fish.fid from observations, all_fish, observation_collections where observations.species_id = all_fish.fid and observations.presence_type in (%s) and observations.objectid = observation_collections.observation_id and observation_collections.collection_id in (%s))"
+		return {
+			"observations": count("select count(*) from observations"),
+			"datasets": count("select count(*) from (select distinct set_id from observations)"),
+			"taxa_with_data": count("select count(*) from (select distinct species_id from observations)"),
+			"native_with_data": count("select count(*) from (select distinct observations.species_id from observations, native_fish where observations.species_id = native_fish.fid)"),
+			"current_qc_fish": count(qc_query % (local_vars.current_obs_types, local_vars.hq_collections)),
+			"historic_qc_fish": count(qc_query % (local_vars.historic_obs_types, local_vars.hq_collections)),
+		}
+
+	def test_single_scan(self):
+		expected = self.original_stats()
+		self.assertEqual((5, 3, 4, 2, 2, 1), tuple(expected[key] for key in ("observations", "datasets", "taxa_with_data", "native_with_data", "current_qc_fish", "historic_qc_fish")))
+		self.assertEqual(expected, stats_summary.observation_stats(self.cursor))
+
+		species = stats_summary.species_stats(self.cursor)
+		self.assertEqual((5, 4, 3, 2, 1, 5), (species["species"], species["species_no_bins"], species["fish"], species["native_fish"], species["nonnative_fish"], species["hq_observations"]))
+
+	def test_summary(self):
+		stats_summary.refresh_summary(self.cursor, ["SOC01"])  # no summary yet, so nothing happens
+		self.assertFalse(stats_summary.summary_exists(self.cursor))
+
+		stats_summary.build_summary(self.cursor)
+		self.assertEqual(self.original_stats(), stats_summary.summary_stats(self.cursor))
+
+		self.cursor.execute("delete from observations where species_id = 'SOC01'")
+		self.cursor.execute("insert into observations values (6, 4, 'CCK01', '180101010104', 5)")
+		self.cursor.execute("insert into observation_collections values (6, 16)")
+		stats_summary.refresh_summary(self.cursor, ["SOC01", "CCK01", None])
+		self.assertEqual(self.original_stats(), stats_summary.summary_stats(self.cursor))
+
+	def test_get_stats(self):
+		direct = stats_summary.get_stats(self.cursor, use_summary=False)
+		from_summary = stats_summary.get_stats(self.cursor, use_summary=True)
+		self.assertEqual(direct, from_summary)
+		self.assertEqual(12, len(direct))
+		self.assertTrue(stats_summary.summary_is_current(self.cursor))
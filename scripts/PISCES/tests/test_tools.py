@@ -1,5 +1,6 @@
 import unittest
 import tempfile
+import collections
 
 import numpy
 
@@ -18,6 +19,28 @@ class TestTools(unittest.TestCase):
 												region_group_field="huc_region_group",
 												spatial_constraint="CONTIGUITY_EDGES_CORNERS")
 
+class TestBuildPresenceMatrix(unittest.TestCase):
+	def setUp(self):
+		record = collections.namedtuple("zone_taxon", ["zone_id", "taxon"])
+		self.records = [record("A", "CMC01"), record("B", "CMC01"), record("B", "SOM09"), record("Z", "SOM09")]
+		self.zones = ["A", "B", "C"]
+
+	def test_presence(self):
+		presence, fields = tbx_make_matrix.build_presence_matrix(self.records, self.zones, lambda taxon: taxon.lower())
+		self.assertEqual(["cmc01", "som09"], fields)
+		self.assertEqual([[True, False], [True, True], [False, False]], presence.tolist())  # zone Z isn't in the zones, so it's dropped
+
+	def test_frame_values(self):
+		presence, fields = tbx_make_matrix.build_presence_matrix(self.records, self.zones, lambda taxon: taxon)
+		frame = tbx_make_matrix.presence_frame(presence, self.zones, fields, true_value="Y", false_value=0)
+		self.assertEqual("Y", frame["SOM09"]["B"])
+		self.assertEqual(0, frame["SOM09"]["A"])
+
+		sparse_frame = tbx_make_matrix.presence_frame(presence, self.zones, fields, true_value=1, false_value=0, sparse=True)
+		self.assertEqual(1, sparse_frame["CMC01"]["A"])
+		self.assertEqual(0, sparse_frame["CMC01"]["C"])
+
+
 class TestTbxMakeMatrix(unittest.TestCase):
 	def test_matrix_aggregation(self):
 		taxa_folder = tempfile.mkdtemp(prefix="pisces_test")
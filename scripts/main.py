@@ -5,9 +5,13 @@ Usage:
   main.py clearcaches
   main.py cleartemp [--softerror]
   main.py stats
-  main.py [[map|export] [--usecache] [--continue] [--notrans] [--export_png=<boolean>]]
+  main.py [[map|export] [--usecache] [--continue] [--notrans] [--export_png=<boolean>] [--profile] [--cprofile=<map>]]
   main.py import
   main.py [help] [--help] [-h] [--usage]
+
+Options:
+  --profile         Write a report of the time, queries, and rows for each map, layer, and callback to the log folder
+  --cprofile=<map>  Run one map (query set id, short name, or title) under cProfile and write its stats to the log folder
 """
 from __future__ import print_function
 
@@ -41,9 +45,8 @@ if (arguments["--help"] or arguments["help"] or arguments["-h"] or arguments["--
 args.process_args(arguments)
 
 if arguments["stats"]:
-	t_cursor, t_conn = funcs.db_connect(local_vars.maindb, "getting stats")
-	funcs.data_stats(t_cursor)
-	funcs.db_close(t_cursor, t_conn)
+	with funcs.db_operation("getting stats") as (t_cursor, t_conn):
+		funcs.data_stats(t_cursor)
 	sys.exit()
 
 if arguments["clearcaches"]:
@@ -68,9 +71,8 @@ local_vars.data_setup()  # populates variables with data from the database
 
 
 # run stats for a normal run here so that they sit for a while while everything else gets set up
-t_cursor, t_conn = funcs.db_connect(local_vars.maindb, "getting stats")
-funcs.data_stats(t_cursor)
-funcs.db_close(t_cursor, t_conn)
+with funcs.db_operation("getting stats") as (t_cursor, t_conn):
+	funcs.data_stats(t_cursor)
 
 
 ### Process Any New Data ###
@@ -85,10 +87,16 @@ if arguments["map"] or arguments["export"]:
 		local_vars.usecache = 1
 	if arguments["--continue"]:
 		local_vars.continue_mapping = True
+	if arguments["--profile"]:
+		local_vars.map_profiling = True
+	if arguments["--cprofile"]:
+		local_vars.cprofile_map = arguments["--cprofile"]
 
 	try:
 		mapping.begin("all")
 	except local_vars.MappingError as error:
 		print("Uncaught error encountered while mapping - program provided: %s" % error)
 
+funcs.log_db_timings()  # time spent connecting to and holding each kind of database connection during the run
+
 print("\nComplete")
\ No newline at end of file